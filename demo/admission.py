@@ -0,0 +1,248 @@
+"""
+ACPay Admission - 按客户端IP / Agent ID / 端点的令牌桶准入控制
+
+在任何验证与 RPC 之前执行，超限请求直接返回 429：
+
+    ADMISSION = Admission(DEFAULT_RULES, paths=DEMO_SERVICES)
+    app.before_request(ADMISSION.flask_hook)
+
+每个活跃键只保存 [令牌数, 上次时间] 两个数，按最近访问顺序排列，
+空闲超过 idle_ttl 的键在后续调用中顺带淘汰（均摊 O(1)）。
+设置 ACPAY_ADMISSION_DB 时改用同一 SQLite 文件（WAL 模式）保存令牌桶，
+多个 worker 进程共享同一份限额；prefork 运行时 share_memory() 把令牌桶换到
+fork 前创建的共享内存表（shm_table.py）。ACPAY_ADMISSION=0 关闭准入控制。
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+from flask import jsonify, request
+
+from shm_table import SharedTable
+from x402_headers import HeaderError, parse_payment_proof
+from x402_metrics import METRICS
+
+
+class Rule(NamedTuple):
+    """令牌桶参数"""
+    rate: float   # 每秒补充的令牌数
+    burst: float  # 桶容量
+
+
+# scope -> Rule
+#   ip:        每个客户端IP的全部请求
+#   verify_ip: 每个客户端IP携带支付证明（会触发验证/RPC）的请求
+#   agent:     每个Agent ID（来自 Payment-Proof）的请求
+#   endpoint:  每个端点的全局请求
+DEFAULT_RULES = {
+    "ip": Rule(50, 100),
+    "verify_ip": Rule(10, 20),
+    "agent": Rule(10, 20),
+    "endpoint": Rule(500, 1000),
+}
+
+_EVICT_PER_CALL = 4
+
+
+class TokenBuckets:
+    """进程内令牌桶集合"""
+
+    def __init__(self, rule: Rule, idle_ttl: Optional[float] = None):
+        self.rule = rule
+        # 空闲足够久的桶已被补满，淘汰后重建结果相同
+        self.idle_ttl = idle_ttl if idle_ttl is not None else max(60.0, rule.burst / rule.rate)
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def take(self, key: str, cost: float = 1.0) -> float:
+        """
+        尝试取出 cost 个令牌
+
+        Returns:
+            0.0 表示放行，否则为建议的重试等待秒数
+        """
+        rate, burst = self.rule
+        now = time.monotonic()
+        with self._lock:
+            buckets = self._buckets
+            for _ in range(_EVICT_PER_CALL):
+                if not buckets:
+                    break
+                oldest_key, oldest = next(iter(buckets.items()))
+                if now - oldest[1] < self.idle_ttl:
+                    break
+                del buckets[oldest_key]
+
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = [burst, now]
+            else:
+                buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0.0
+            return (cost - bucket[0]) / rate
+
+
+class SQLiteTokenBuckets:
+    """多进程共享的令牌桶（同一 SQLite 文件，WAL 模式）"""
+
+    def __init__(self, rule: Rule, path: str, scope: str, idle_ttl: Optional[float] = None):
+        self.rule = rule
+        self.path = path
+        self.scope = scope
+        self.idle_ttl = idle_ttl if idle_ttl is not None else max(60.0, rule.burst / rule.rate)
+        self._local = threading.local()
+        self._calls = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")  # 限流状态丢失可接受
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "scope TEXT, key TEXT, tokens REAL, last REAL, PRIMARY KEY (scope, key))"
+            )
+            self._local.conn = conn
+        return conn
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM buckets WHERE scope = ?", (self.scope,)).fetchone()[0]
+
+    def take(self, key: str, cost: float = 1.0) -> float:
+        rate, burst = self.rule
+        now = time.time()  # 跨进程共享，不能用 monotonic
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT tokens, last FROM buckets WHERE scope = ? AND key = ?", (self.scope, key)
+            ).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate
+            conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)", (self.scope, key, tokens, now))
+
+            self._calls += 1
+            if self._calls % 1024 == 0:
+                conn.execute("DELETE FROM buckets WHERE scope = ? AND last < ?", (self.scope, now - self.idle_ttl))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+class SharedTokenBuckets:
+    """多进程共享的令牌桶（共享内存表，须在 fork 之前创建）"""
+
+    def __init__(self, rule: Rule, capacity: int = 65536, idle_ttl: Optional[float] = None):
+        self.rule = rule
+        self.idle_ttl = idle_ttl if idle_ttl is not None else max(60.0, rule.burst / rule.rate)
+        # 值为 (令牌数, 上次时间)；空闲超过 idle_ttl 的桶过期后槽位被复用
+        self.table = SharedTable(capacity, "dd")
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def take(self, key: str, cost: float = 1.0) -> float:
+        rate, burst = self.rule
+        wait = [0.0]
+
+        def refill(bucket):
+            now = time.time()  # 跨进程共享，不能用 monotonic
+            tokens = burst if bucket is None else min(burst, bucket[0] + max(0.0, now - bucket[1]) * rate)
+            if tokens >= cost:
+                return tokens - cost, now
+            wait[0] = (cost - tokens) / rate
+            return tokens, now
+
+        self.table.update(key, refill, ttl=self.idle_ttl)
+        return wait[0]
+
+
+class Admission:
+    """请求准入控制"""
+
+    def __init__(self, rules: Dict[str, Rule] = None, paths: Iterable[str] = (),
+                 db_path: Optional[str] = None):
+        """
+        Args:
+            rules: scope -> Rule（默认 DEFAULT_RULES）
+            paths: 需要准入控制的路径（付费端点等）
+            db_path: 共享 SQLite 文件（默认读取 ACPAY_ADMISSION_DB，未设置时使用进程内令牌桶）
+        """
+        rules = dict(DEFAULT_RULES if rules is None else rules)
+        db_path = db_path or os.getenv("ACPAY_ADMISSION_DB")
+        if db_path:
+            self.buckets = {scope: SQLiteTokenBuckets(rule, db_path, scope) for scope, rule in rules.items()}
+        else:
+            self.buckets = {scope: TokenBuckets(rule) for scope, rule in rules.items()}
+        self.paths = frozenset(paths)
+        self.enabled = os.getenv("ACPAY_ADMISSION", "1") != "0"
+
+    def share_memory(self, capacity: int = 65536) -> None:
+        """改用共享内存令牌桶（prefork 运行时在 fork 之前调用，已有的进程内状态被丢弃）"""
+        self.buckets = {scope: SharedTokenBuckets(buckets.rule, capacity) for scope, buckets in self.buckets.items()}
+
+    def check(self, ip: str, endpoint: str, agent_id: Optional[str] = None,
+              verifies: bool = False) -> Optional[Tuple[str, float]]:
+        """
+        检查请求是否放行
+
+        Returns:
+            None 表示放行，否则为 (被限制的 scope, 重试等待秒数)
+        """
+        checks = [("ip", ip), ("endpoint", endpoint)]
+        if verifies:
+            checks.append(("verify_ip", ip))
+        if agent_id:
+            checks.append(("agent", agent_id))
+        for scope, key in checks:
+            buckets = self.buckets.get(scope)
+            if buckets is None:
+                continue
+            wait = buckets.take(key)
+            if wait:
+                return scope, wait
+        return None
+
+    def flask_hook(self):
+        """Flask before_request 钩子：超限时返回 429"""
+        if not self.enabled or request.path not in self.paths:
+            return None
+
+        agent_id = None
+        proof = request.headers.get('Payment-Proof')
+        if proof:
+            try:
+                agent_id = parse_payment_proof(proof).agent
+            except HeaderError:
+                pass  # 格式错误由端点返回 400
+        verifies = bool(proof or request.headers.get('X-Payment-Hash'))
+
+        denied = self.check(request.remote_addr or "-", request.path, agent_id, verifies)
+        if denied is None:
+            return None
+        scope, wait = denied
+        METRICS.inc(f"admission_rejected_{scope}")
+        retry_after = max(1, int(wait + 0.999))
+        response = jsonify({"error": "Too Many Requests", "scope": scope, "retry_after": retry_after})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(retry_after)
+        return response
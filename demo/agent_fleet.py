@@ -0,0 +1,234 @@
+"""
+ACPay Agent Fleet - 单进程托管大量 Agent 身份
+
+所有 Agent 共享同一组资源，而不是每个实例各建一套：
+
+- HTTP：一个 aiohttp 会话与连接池（max_connections 个连接）
+- RPC：一个 AsyncWeb3 连接与合约对象（同一份 ABI）
+- 状态镜像：一个列式 SpendingLedger（规则与当日消费，语义同合约 _validatePayment）
+
+每个 Agent 只保存ID、私钥字节、预算与账本行号；地址在首次使用时派生。
+调度为协作式 asyncio，全局并发由信号量限制：
+
+    async with AgentFleet() as fleet:
+        for i in range(10_000):
+            fleet.add(f"agent-{i}", budget=50 * 10**6)
+        results = await fleet.run((f"agent-{i}", "/api/weather") for i in range(10_000))
+"""
+
+import asyncio
+import hashlib
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import aiohttp
+from eth_account import Account
+from web3 import AsyncHTTPProvider, AsyncWeb3
+
+from buyer_wallet import BuyerWalletClient, get_contract
+from demo_agent import (BUYER_WALLET_ADDRESS, DEFAULT_DAILY_LIMIT, DEFAULT_TX_LIMIT,
+                        DEMO_API_BASE, INJECTIVE_TESTNET_RPC)
+from spending_ledger import REASON_NAMES, SpendingLedger
+from x402_headers import HeaderError, parse_accept_payment
+from x402_metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+
+def derive_key(agent_id: str, seed: bytes = b"acpay-fleet") -> bytes:
+    """为演示派生确定性私钥（不要在生产环境使用！）"""
+    return hashlib.sha256(seed + b":" + agent_id.encode()).digest()
+
+
+class FleetAgent:
+    """托管在 AgentFleet 中的一个 Agent 身份"""
+
+    __slots__ = ("agent_id", "key", "budget", "spent", "row", "_address")
+
+    def __init__(self, agent_id: str, key: bytes, budget: int, row: int):
+        self.agent_id = agent_id
+        self.key = key          # 32字节私钥
+        self.budget = budget    # 本次运行的消费上限（最小单位）
+        self.spent = 0          # 已消费 + 已预留
+        self.row = row          # 在共享账本中的行号
+        self._address = None
+
+    @property
+    def address(self) -> str:
+        """签名地址（首次访问时派生）"""
+        if self._address is None:
+            self._address = Account.from_key(self.key).address
+        return self._address
+
+    @property
+    def remaining(self) -> int:
+        return self.budget - self.spent
+
+
+class AgentFleet:
+    """多 Agent 运行时（共享 HTTP / RPC 连接池与状态镜像）"""
+
+    def __init__(self, api_base: str = DEMO_API_BASE, rpc_url: str = INJECTIVE_TESTNET_RPC,
+                 max_connections: int = 64, concurrency: int = 256,
+                 ledger: Optional[SpendingLedger] = None):
+        """
+        Args:
+            api_base: 付费API地址
+            rpc_url: Injective EVM RPC（用于同步链上规则与当日消费）
+            max_connections: 共享HTTP连接池大小
+            concurrency: 同时进行的调用数上限
+            ledger: 共享状态镜像（默认新建）
+        """
+        self.api_base = api_base
+        self.max_connections = max_connections
+        self.concurrency = concurrency
+        self.ledger = ledger or SpendingLedger()
+        self.agents: Dict[str, FleetAgent] = {}
+
+        self.w3 = AsyncWeb3(AsyncHTTPProvider(rpc_url))
+        self.contract = get_contract(self.w3, BUYER_WALLET_ADDRESS)
+        self.wallet = BuyerWalletClient(self.w3, BUYER_WALLET_ADDRESS)
+        self.http: Optional[aiohttp.ClientSession] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    async def __aenter__(self) -> "AgentFleet":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def start(self) -> None:
+        """在事件循环中创建共享HTTP会话"""
+        if self.http is None:
+            self.http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=10),
+            )
+            self._slots = asyncio.Semaphore(self.concurrency)
+
+    async def close(self) -> None:
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+
+    # ============ Agent 管理 ============
+
+    def add(self, agent_id: str, key: Optional[bytes] = None, budget: int = DEFAULT_DAILY_LIMIT,
+            daily_limit: int = DEFAULT_DAILY_LIMIT, transaction_limit: int = DEFAULT_TX_LIMIT) -> FleetAgent:
+        """
+        添加一个 Agent 身份
+
+        Args:
+            agent_id: Agent ID
+            key: 32字节私钥（默认 derive_key 派生）
+            budget: 本次运行的消费上限（最小单位）
+            daily_limit, transaction_limit: 镜像中的支付规则（可用 sync_from_chain 覆盖）
+        """
+        if agent_id in self.agents:
+            raise ValueError(f"agent {agent_id} already in fleet")
+        row = self.ledger.register(agent_id, daily_limit, transaction_limit)
+        agent = self.agents[agent_id] = FleetAgent(agent_id, key or derive_key(agent_id), budget, row)
+        return agent
+
+    async def sync_from_chain(self, agent_ids: Optional[Iterable[str]] = None) -> int:
+        """
+        通过共享 RPC 连接刷新镜像中的规则与当日消费
+
+        Returns:
+            成功同步的 Agent 数
+        """
+        agents = [self.agents[a] for a in agent_ids] if agent_ids is not None else list(self.agents.values())
+
+        async def sync(agent: FleetAgent) -> bool:
+            async with self._slots:
+                try:
+                    (rules,) = await self.wallet.call_raw_async("getPaymentRules", agent.agent_id)
+                    (spent,) = await self.wallet.call_raw_async("getTodaySpending", agent.agent_id)
+                except Exception as e:
+                    logger.warning("sync %s failed: %s", agent.agent_id, e)
+                    return False
+            self.ledger.set_rules(agent.row, rules[0], rules[1], rules[2])
+            self.ledger.set_spending(agent.agent_id, spent)
+            return True
+
+        return sum(await asyncio.gather(*(sync(agent) for agent in agents)))
+
+    # ============ 调用 ============
+
+    async def call(self, agent_id: str, endpoint: str, method: str = "GET",
+                   data: Dict = None) -> Tuple[bool, Dict[str, Any]]:
+        """
+        以指定 Agent 身份调用x402付费API（402 -> 支付 -> 带证明重试）
+
+        预算与规则检查在两次 await 之间完成并立即预留金额，
+        同一 Agent 的并发调用不会超出预算。
+        """
+        agent = self.agents[agent_id]
+        url = f"{self.api_base}{endpoint}"
+        async with self._slots:
+            status, body, headers = await self._request(method, url, data)
+            if status != 402:
+                return status == 200, body
+
+            try:
+                info = parse_accept_payment(headers.get('Accept-Payment'), agent_id)
+            except HeaderError as e:
+                return False, {"error": f"无法解析支付信息: {e}"}
+
+            denied = self._reserve(agent, info.amount)
+            if denied:
+                return False, {"error": denied, "agent_id": agent_id, "amount": info.amount}
+
+            payment_hash = "0x" + hashlib.sha256(
+                f"{agent_id}_{info.amount}_{info.recipient}_{endpoint}_{info.nonce}".encode()
+            ).hexdigest()
+            with METRICS.span("agent_retry"):
+                status, body, _ = await self._request(
+                    method, url, data, {'X-Payment-Hash': payment_hash, 'X-Agent-ID': agent_id}
+                )
+            if status != 200:
+                # 支付未被接受：释放预留
+                agent.spent -= info.amount
+                self.ledger.record([agent_id], [-info.amount])
+                return False, body
+            return True, body
+
+    async def run(self, jobs: Iterable[Tuple[str, str]]) -> List[Tuple[bool, Dict[str, Any]]]:
+        """并发执行 (agent_id, endpoint) 调用，结果与输入顺序一致"""
+        return await asyncio.gather(*(self.call(agent_id, endpoint) for agent_id, endpoint in jobs))
+
+    def status(self) -> Dict[str, Any]:
+        """整个舰队的消费概况"""
+        agents = self.agents.values()
+        return {
+            "agents": len(self.agents),
+            "budget": sum(a.budget for a in agents),
+            "spent": sum(a.spent for a in agents),
+            "exhausted": sum(1 for a in agents if a.remaining <= 0),
+        }
+
+    # ============ 内部实现 ============
+
+    def _reserve(self, agent: FleetAgent, amount: int) -> Optional[str]:
+        """检查预算与镜像规则并预留金额，拒绝时返回原因"""
+        if amount > agent.remaining:
+            return f"超出Agent预算: {amount / 10**6} > {agent.remaining / 10**6} USDT"
+        allowed, reasons = self.ledger.check([agent.agent_id], [amount])
+        if not allowed[0]:
+            return f"支付规则拒绝: {REASON_NAMES[int(reasons[0])]}"
+        agent.spent += amount
+        self.ledger.record([agent.agent_id], [amount])
+        return None
+
+    async def _request(self, method: str, url: str, data: Optional[Dict],
+                       headers: Optional[Dict[str, str]] = None) -> Tuple[int, Dict[str, Any], Any]:
+        try:
+            async with self.http.request(method, url, json=data, headers=headers) as response:
+                try:
+                    body = await response.json(content_type=None)
+                except ValueError:
+                    body = {"details": await response.text()}
+                return response.status, body, response.headers
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return 0, {"error": "网络异常", "details": str(e)}, {}
@@ -2,79 +2,57 @@ import os
 import json
 import time
 import requests
+import uuid
+from urllib.parse import urlparse
 from web3 import Web3
 from eth_account import Account
 from typing import Dict, Any, Optional
 
+from buyer_wallet import BuyerWalletClient, get_contract
+from chain_head import get_tracker, wait_for_receipt
+from resilience import CircuitOpenError, ResilientHTTPProvider, get_policy
+from payment_journal import (PaymentJournal, journal_path, INTENT, SIGNED, BROADCAST,
+                             CONFIRMED, CONSUMED, FAILED)
+
 # Injective EVM测试网配置
 INJECTIVE_TESTNET_RPC = "https://k8s.testnet.json-rpc.injective.network/"
+INJECTIVE_TESTNET_WS = os.getenv("INJECTIVE_WS_RPC")  # 可选，未设置时轮询链头
 BUYER_WALLET_ADDRESS = "0x..."  # 部署后的合约地址
 USDT_ADDRESS = "0xaDC7bcB5d8fe053Ef19b4E0C861c262Af6e0db60"  # 官方测试网USDT地址
+AGENT_ID = os.getenv("AGENT_ID", "ai-agent")  # 在合约中注册的Agent ID
 
-# 合约ABI（简化版，仅包含需要的方法）
-BUYER_WALLET_ABI = [
-    {
-        "inputs": [
-            {"name": "_recipient", "type": "address"},
-            {"name": "_amount", "type": "uint256"},
-            {"name": "_metadata", "type": "string"}
-        ],
-        "name": "pay",
-        "outputs": [],
-        "stateMutability": "nonpayable",
-        "type": "function"
-    },
-    {
-        "inputs": [{"name": "_agentAddress", "type": "address"}],
-        "name": "getDailySpending",
-        "outputs": [
-            {"name": "todaySpent", "type": "uint256"},
-            {"name": "dailyLimit", "type": "uint256"},
-            {"name": "remainingLimit", "type": "uint256"}
-        ],
-        "stateMutability": "view",
-        "type": "function"
-    },
-    {
-        "anonymous": False,
-        "inputs": [
-            {"indexed": True, "name": "agent", "type": "address"},
-            {"indexed": True, "name": "recipient", "type": "address"},
-            {"name": "amount", "type": "uint256"},
-            {"name": "metadata", "type": "string"},
-            {"name": "timestamp", "type": "uint256"}
-        ],
-        "name": "PaymentMade",
-        "type": "event"
-    }
-]
 
 class AIAgent:
     """AI代理类，演示x402协议支付流程"""
     
-    def __init__(self, private_key: str, agent_name: str = "Demo AI Agent"):
+    def __init__(self, private_key: str, agent_name: str = "Demo AI Agent",
+                 journal: Optional[PaymentJournal] = None, agent_id: str = AGENT_ID):
         """
         初始化AI代理
         
         Args:
-            private_key: 代理的私钥
+            private_key: 代理的私钥（钱包所有者，直接发送 payDirect 交易）
             agent_name: 代理名称
+            journal: 支付日志（默认 ~/.acpay/<代理地址>.journal）
+            agent_id: 在合约中注册的Agent ID
         """
         self.private_key = private_key
         self.agent_name = agent_name
+        self.agent_id = agent_id
+        self.http = requests.Session()  # 持久连接：402响应与带支付的重试复用同一个连接
         
         # 连接到Injective EVM
-        self.w3 = Web3(Web3.HTTPProvider(INJECTIVE_TESTNET_RPC))
+        self.w3 = Web3(ResilientHTTPProvider(INJECTIVE_TESTNET_RPC))
+        self.chain_head = get_tracker(INJECTIVE_TESTNET_RPC, INJECTIVE_TESTNET_WS)
         
         # 获取代理账户
         self.account = Account.from_key(private_key)
         self.address = self.account.address
+        self.journal = journal or PaymentJournal(journal_path(self.address.lower()))
         
-        # 连接到BuyerWallet合约
-        self.buyer_wallet = self.w3.eth.contract(
-            address=BUYER_WALLET_ADDRESS,
-            abi=BUYER_WALLET_ABI
-        )
+        # 连接到BuyerWallet合约（共享ABI与合约对象；只读调用走 eth_call 快速路径）
+        self.buyer_wallet = get_contract(self.w3, BUYER_WALLET_ADDRESS)
+        self.wallet = BuyerWalletClient(self.w3, BUYER_WALLET_ADDRESS)
         
         print(f"🤖 AI Agent '{agent_name}' initialized")
         print(f"📍 Agent Address: {self.address}")
@@ -85,28 +63,32 @@ class AIAgent:
     def get_spending_status(self) -> Dict[str, Any]:
         """获取代理的消费状态"""
         try:
-            result = self.buyer_wallet.functions.getDailySpending(self.address).call()
+            today_spent = self.wallet.get_today_spending(self.agent_id)
+            daily_limit = self.wallet.get_payment_rules(self.agent_id)[0]
             return {
-                "today_spent": result[0] / 10**6,  # 转换为USDC
-                "daily_limit": result[1] / 10**6,
-                "remaining_limit": result[2] / 10**6
+                "today_spent": today_spent / 10**6,  # 转换为USDC
+                "daily_limit": daily_limit / 10**6,
+                "remaining_limit": max(0, daily_limit - today_spent) / 10**6
             }
         except Exception as e:
             print(f"❌ Error getting spending status: {e}")
             return {}
     
-    def pay_for_service(self, recipient: str, amount_usdc: float, metadata: str) -> Optional[str]:
+    def pay_for_service(self, recipient: str, amount_usdc: float, metadata: str,
+                        api_endpoint: str = "") -> Optional[str]:
         """
-        通过智能钱包支付服务费用
+        通过智能钱包支付服务费用（每一步先写入支付日志，崩溃后可由 resume_pending 恢复）
         
         Args:
             recipient: 接收方地址
             amount_usdc: 支付金额（USDC）
             metadata: 支付元数据
+            api_endpoint: 支付对应的API端点（用于复用已确认但未使用的支付）
             
         Returns:
             交易哈希或None（如果失败）
         """
+        payment_id = uuid.uuid4().hex
         try:
             # 转换金额为wei（USDC使用6位小数）
             amount_wei = int(amount_usdc * 10**6)
@@ -117,7 +99,8 @@ class AIAgent:
             print(f"   Metadata: {metadata}")
             
             # 构建交易
-            transaction = self.buyer_wallet.functions.pay(
+            transaction = self.buyer_wallet.functions.payDirect(
+                self.agent_id,
                 recipient,
                 amount_wei,
                 metadata
@@ -127,30 +110,75 @@ class AIAgent:
                 'gasPrice': self.w3.to_wei('20', 'gwei'),
                 'nonce': self.w3.eth.get_transaction_count(self.address),
             })
+            self.journal.append(payment_id, INTENT, endpoint=api_endpoint, recipient=recipient,
+                                amount=amount_wei, nonce=transaction['nonce'])
             
             # 签名交易
             signed_txn = self.w3.eth.account.sign_transaction(transaction, self.private_key)
+            raw_tx = getattr(signed_txn, 'raw_transaction', None) or signed_txn.rawTransaction
+            self.journal.append(payment_id, SIGNED, raw_tx=Web3.to_hex(raw_tx),
+                                tx_hash=Web3.to_hex(signed_txn.hash))
             
             # 发送交易
-            tx_hash = self.w3.eth.send_raw_transaction(signed_txn.rawTransaction)
+            tx_hash = self.w3.eth.send_raw_transaction(raw_tx)
+            self.journal.append(payment_id, BROADCAST)
             
             print(f"📤 Transaction sent: {tx_hash.hex()}")
             
-            # 等待交易确认
-            receipt = self.w3.eth.wait_for_transaction_receipt(tx_hash, timeout=120)
-            
-            if receipt.status == 1:
-                print(f"✅ Payment successful!")
-                print(f"   Gas used: {receipt.gasUsed}")
-                return tx_hash.hex()
-            else:
-                print(f"❌ Payment failed!")
-                return None
+            return self._confirm_payment(payment_id, tx_hash)
                 
         except Exception as e:
             print(f"❌ Payment error: {e}")
+            entry = self.journal.get(payment_id)
+            if entry and entry.state == INTENT:
+                # 尚未签名，不会上链
+                self.journal.append(payment_id, FAILED, error=str(e))
+            return None
+    
+    def _confirm_payment(self, payment_id: str, tx_hash) -> Optional[str]:
+        """等待交易确认（每个新区块查询一次收据）并记录结果"""
+        receipt = wait_for_receipt(self.w3, tx_hash, self.chain_head, timeout=120)
+        
+        if receipt.status == 1:
+            self.journal.append(payment_id, CONFIRMED, block=receipt.blockNumber)
+            print(f"✅ Payment successful!")
+            print(f"   Gas used: {receipt.gasUsed}")
+            return Web3.to_hex(tx_hash)
+        else:
+            self.journal.append(payment_id, FAILED, error="reverted")
+            print(f"❌ Payment failed!")
             return None
     
+    def resume_pending(self) -> int:
+        """
+        重启后恢复未完成的支付（只读取本地日志，不扫描链上数据）
+        
+        已签名未广播的交易重新广播，已广播的交易继续等待确认；
+        同一笔签名交易重复广播不会重复支付（nonce 相同）。
+        
+        Returns:
+            恢复后确认的支付数
+        """
+        confirmed = 0
+        for entry in self.journal.pending(INTENT):
+            self.journal.append(entry.payment_id, FAILED, error="interrupted before signing")
+        for entry in self.journal.pending(SIGNED, BROADCAST):
+            print(f"🔁 Resuming payment {entry.payment_id[:8]} ({entry.state})")
+            try:
+                if entry.state == SIGNED:
+                    try:
+                        self.w3.eth.send_raw_transaction(entry.data['raw_tx'])
+                    except ValueError as e:
+                        # 节点已收到过这笔交易
+                        if 'known' not in str(e).lower():
+                            raise
+                    self.journal.append(entry.payment_id, BROADCAST)
+                if self._confirm_payment(entry.payment_id, entry.data['tx_hash']):
+                    confirmed += 1
+            except Exception as e:
+                print(f"⚠️  Resume failed, will retry later: {e}")
+        return confirmed
+    
     def call_paid_api(self, api_endpoint: str, payment_amount: float) -> Optional[Dict]:
         """
         模拟调用付费API的完整x402流程
@@ -166,7 +194,9 @@ class AIAgent:
         
         try:
             # 第一步：调用API，期望收到402响应
-            response = requests.get(api_endpoint, timeout=10)
+            policy = get_policy(f"api:{urlparse(api_endpoint).netloc}")
+            response = policy.call(self.http.get, api_endpoint, timeout=policy.timeout(), idempotent=True,
+                                   failed=lambda r: r.status_code >= 500)
             
             if response.status_code == 402:
                 print("💰 Received 402 Payment Required")
@@ -178,19 +208,31 @@ class AIAgent:
                 
                 print(f"   Required payment: {required_amount} USDC to {recipient}")
                 
-                # 第二步：执行支付
-                tx_hash = self.pay_for_service(
-                    recipient,
-                    required_amount,
-                    f"API payment for {api_endpoint}"
-                )
+                # 第二步：执行支付（已有确认但未使用的同额支付时直接复用）
+                entry = self.journal.find(CONFIRMED, endpoint=api_endpoint,
+                                          amount=int(required_amount * 10**6))
+                if entry:
+                    print(f"♻️  Reusing confirmed payment {entry.data['tx_hash']}")
+                    tx_hash = entry.data['tx_hash']
+                else:
+                    tx_hash = self.pay_for_service(
+                        recipient,
+                        required_amount,
+                        f"API payment for {api_endpoint}",
+                        api_endpoint
+                    )
+                    entry = self.journal.find(CONFIRMED, tx_hash=tx_hash) if tx_hash else None
                 
                 if tx_hash:
                     # 第三步：重新调用API，带上支付证明
                     headers = {'Payment-Tx': tx_hash}
-                    final_response = requests.get(api_endpoint, headers=headers, timeout=10)
+                    final_response = policy.call(self.http.get, api_endpoint, headers=headers,
+                                                 timeout=policy.timeout(),
+                                                 failed=lambda r: r.status_code >= 500)
                     
                     if final_response.status_code == 200:
+                        if entry:
+                            self.journal.append(entry.payment_id, CONSUMED)
                         print("✅ API call successful with payment!")
                         return final_response.json()
                     else:
@@ -207,7 +249,7 @@ class AIAgent:
                 print(f"❌ API call failed: {response.status_code}")
                 return None
                 
-        except requests.RequestException as e:
+        except (requests.RequestException, CircuitOpenError) as e:
             print(f"❌ API request error: {e}")
             return None
     
@@ -273,7 +315,8 @@ def main():
         # 创建AI代理实例
         agent = AIAgent(private_key, "Weather & AI Agent")
         
-        # 运行演示场景
+        # 恢复上次未完成的支付，再运行演示场景
+        agent.resume_pending()
         agent.demo_scenario()
         
     except Exception as e:
@@ -0,0 +1,1519 @@
+#!/usr/bin/env python3
+"""
+ACPay 性能基准
+
+用法:
+    python3 benchmarks.py                 # 运行全部基准
+    python3 benchmarks.py spending-ledger # 只运行指定基准
+"""
+
+import sys
+import time
+import argparse
+from typing import Callable, Dict
+
+BENCHMARKS: Dict[str, Callable[[], None]] = {}
+
+
+def benchmark(name: str):
+    """注册基准函数"""
+    def wrap(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return wrap
+
+
+def timed(fn, *args, repeat: int = 3, **kwargs) -> float:
+    """返回多次运行中的最短耗时（秒）"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+@benchmark("spending-ledger")
+def bench_spending_ledger():
+    """SpendingLedger.check 批量检查 vs 逐笔检查"""
+    import numpy as np
+    from spending_ledger import SpendingLedger, SECONDS_PER_DAY
+
+    n_agents = 10_000
+    now = 1_750_000_000
+    rng = np.random.default_rng(42)
+
+    ledger = SpendingLedger(capacity=n_agents)
+    agent_ids = [f"agent-{i}" for i in range(n_agents)]
+    for agent_id in agent_ids:
+        ledger.register(agent_id, 100 * 10**6, 10 * 10**6)
+    ledger.spent[:n_agents] = rng.integers(0, 100 * 10**6, n_agents)
+    # 一半Agent的消费记录停留在昨天，覆盖日期滚动分支
+    ledger.day[:n_agents] = now // SECONDS_PER_DAY - rng.integers(0, 2, n_agents)
+
+    def scalar_check(rows, amounts):
+        today = now // SECONDS_PER_DAY
+        out = []
+        for row, amount in zip(rows.tolist(), amounts.tolist()):
+            if not ledger.enabled[row] or amount > ledger.transaction_limit[row]:
+                out.append(False)
+                continue
+            spent = ledger.spent[row] if ledger.day[row] == today else 0
+            out.append(spent + amount <= ledger.daily_limit[row])
+        return out
+
+    print(f"{'intents':>10} {'vectorized':>14} {'intents/s':>14} {'scalar':>12} {'speedup':>9}")
+    for n in (1_000, 10_000, 100_000, 1_000_000):
+        rows = rng.integers(0, n_agents, n)
+        amounts = rng.integers(1, 15 * 10**6, n)
+        vec = timed(ledger.check, rows, amounts, now=now)
+        if n <= 100_000:
+            scalar = timed(scalar_check, rows, amounts, repeat=1)
+            scalar_s, speedup = f"{scalar * 1e3:9.1f} ms", f"{scalar / vec:8.0f}x"
+        else:
+            scalar_s, speedup = f"{'-':>12}", f"{'-':>9}"
+        print(f"{n:>10} {vec * 1e3:11.2f} ms {n / vec:14,.0f} {scalar_s} {speedup}")
+
+    # 字符串Agent ID路径（包含字典查找）
+    ids = [agent_ids[i] for i in rng.integers(0, n_agents, 100_000)]
+    amounts = rng.integers(1, 15 * 10**6, 100_000)
+    t = timed(ledger.check, ids, amounts, now=now)
+    print(f"100k intents by string id: {t * 1e3:.2f} ms ({100_000 / t:,.0f} intents/s)")
+
+
+@benchmark("proof-records")
+def bench_proof_records():
+    """1M 缓存支付证明的内存占用：dataclass vs NamedTuple vs 二进制"""
+    import gc
+    import os
+    import tracemalloc
+    from dataclasses import dataclass
+    from x402_records import X402PaymentProof
+
+    @dataclass
+    class LegacyProof:
+        payment_hash: bytes
+        agent_id: str
+        recipient: str
+        amount: int
+        api_endpoint: str
+        timestamp: int
+        tx_hash: bytes
+
+    n = 1_000_000
+    recipient = "0xc1E4400506b6178ff92eD8A353e996A3227eD877"
+
+    def abi_rows():
+        # 每行字段都是新对象，模拟 web3 每次解码 verifyX402Payment 的结果
+        for i in range(n):
+            yield (os.urandom(32), f"agent-{i % 100}", "0x" + recipient[2:], 2_000_000 + i,
+                   "/x402/" + "weather", 1_750_000_000 + i, os.urandom(32))
+
+    def measure(label, build):
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        cache = build()
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label:<22} {size / 2**20:9.1f} MiB {size / n:8.0f} B/proof {elapsed:8.2f} s build")
+        return cache
+
+    print(f"{n:,} proofs cached by payment hash (keys, records and fields counted):")
+    measure("dataclass", lambda: {r[0]: LegacyProof(*r) for r in abi_rows()})
+    measure("NamedTuple.from_abi", lambda: {r[0]: X402PaymentProof.from_abi(r) for r in abi_rows()})
+    blobs = measure("to_bytes (binary)", lambda: {r[0]: X402PaymentProof.from_abi(r).to_bytes() for r in abi_rows()})
+
+    sample = list(blobs.values())[:100_000]
+    t = timed(lambda: [X402PaymentProof.from_bytes(b) for b in sample], repeat=1)
+    print(f"binary size: {len(sample[0])} B/proof, from_bytes: {len(sample) / t:,.0f} proofs/s")
+
+
+@benchmark("x402-headers")
+def bench_x402_headers():
+    """头部解析 ops/s：x402_headers vs 旧实现（split + dict / JSON 响应体）"""
+    import json
+    from x402_headers import (format_accept_payment, format_payment_proof,
+                              parse_accept_payment, parse_payment_proof)
+
+    def legacy_parse_payment_proof(header):
+        try:
+            parts = header.split()
+            if parts[0] != "injective":
+                return None
+            proof_data = {}
+            for part in parts[1:]:
+                if '=' in part:
+                    key, value = part.split('=', 1)
+                    proof_data[key] = value
+            return proof_data
+        except:
+            return None
+
+    recipient = "0xc1E4400506b6178ff92eD8A353e996A3227eD877"
+    accept = format_accept_payment(recipient, 2_000_000, "USDT", "/api/weather", 1_750_000_000_000, 1_750_003_600)
+    proof = format_payment_proof(hash="0x" + "ab" * 32, agent="weather-agent", nonce=7,
+                                 timestamp=1_750_000_000, signature="0x" + "cd" * 65)
+    body = json.dumps({
+        "error": "Payment Required",
+        "message": "此API需要支付 2.0 USDT",
+        "service": {"name": "天气数据 API", "description": "获取实时天气数据", "price": "2.0 USDT"},
+        "payment_info": {"recipient": recipient, "amount": 2_000_000, "currency": "USDT",
+                         "endpoint": "/api/weather", "nonce": 1_750_000_000_000,
+                         "expiry": 1_750_003_600, "contract": recipient},
+        "x402_demo": {"status": "等待支付", "next_step": "Agent需要调用智能合约进行支付",
+                      "demo_scenario": "演示x402协议自动支付流程"},
+    })
+    oversized = "injective " + "x" * 100_000
+
+    def ops(fn, arg, n=200_000):
+        def loop():
+            for _ in range(n):
+                fn(arg)
+        return n / timed(loop)
+
+    def reject(fn):
+        def wrapped(arg):
+            try:
+                fn(arg)
+            except ValueError:
+                pass
+        return wrapped
+
+    rows = [
+        ("Payment-Proof legacy (no validation)", ops(legacy_parse_payment_proof, proof)),
+        ("Payment-Proof x402_headers (strict)", ops(parse_payment_proof, proof)),
+        ("402 JSON body decode (legacy agent)", ops(json.loads, body)),
+        ("Accept-Payment x402_headers (strict)", ops(parse_accept_payment, accept)),
+        ("100KB header legacy", ops(legacy_parse_payment_proof, oversized, n=2_000)),
+        ("100KB header x402_headers (rejected)", ops(reject(parse_payment_proof), oversized, n=2_000)),
+    ]
+    for label, rate in rows:
+        print(f"{label:<40} {rate:>14,.0f} ops/s")
+
+
+@benchmark("metrics")
+def bench_metrics():
+    """每个 span 的开销（关闭 / 开启），以及 /metrics 渲染耗时"""
+    from x402_metrics import Metrics
+
+    n = 1_000_000
+
+    def loop_empty():
+        for _ in range(n):
+            pass
+
+    def loop_span(metrics):
+        span = metrics.span
+        for _ in range(n):
+            with span("header_parse"):
+                pass
+
+    def loop_timed(metrics):
+        fn = metrics.timed("payment_verify")(lambda: None)
+        for _ in range(n):
+            fn()
+
+    base = timed(loop_empty)
+    for enabled in (False, True):
+        metrics = Metrics(enabled=enabled)
+        span_ns = (timed(loop_span, metrics) - base) / n * 1e9
+        timed_ns = (timed(loop_timed, metrics) - base) / n * 1e9
+        state = "enabled" if enabled else "disabled"
+        print(f"{state:<9} span: {span_ns:7.0f} ns/op   timed decorator: {timed_ns:7.0f} ns/op (incl. call)")
+
+    t = timed(metrics.render, repeat=5)
+    print(f"render ({len(metrics._histograms)} stages): {t * 1e3:.2f} ms")
+
+
+@benchmark("async-logging")
+def bench_async_logging():
+    """demo_server 在 5k rps 开环负载下：同步日志 vs 异步采样日志"""
+    import logging
+    import tempfile
+    from werkzeug.test import EnvironBuilder
+    import demo_server
+    from x402_logging import setup_async_logging, _stop_listener
+
+    app = demo_server.app
+    demo_server.ADMISSION.enabled = False  # 单一客户端压测，不受准入限流影响
+    paid = EnvironBuilder(path="/api/weather", headers={"X-Payment-Hash": "0x" + "ab" * 32})
+    unpaid = EnvironBuilder(path="/api/weather")
+
+    def call(environ):
+        body = app(environ, lambda status, headers: None)
+        for _ in body:
+            pass
+        body.close()
+
+    def run(rps, seconds):
+        # 开环：按计划时间发请求，延迟从计划时间算起（包含排队）
+        n = int(rps * seconds)
+        environs = [(paid if i % 2 else unpaid).get_environ() for i in range(n)]
+        interval = 1 / rps
+        latencies = []
+        start = time.perf_counter()
+        for i, environ in enumerate(environs):
+            scheduled = start + i * interval
+            while time.perf_counter() < scheduled:
+                pass
+            call(environ)
+            latencies.append(time.perf_counter() - scheduled)
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        return n / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+    def configure_sync(sink):
+        _stop_listener()
+        root = logging.getLogger()
+        for h in list(root.handlers):
+            root.removeHandler(h)
+        handler = logging.StreamHandler(sink)
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        root.addHandler(handler)
+        root.setLevel(logging.INFO)
+
+    class BlockingSink:
+        """模拟阻塞写出（终端 / 管道 / 远端日志收集器），每次写入约 50µs"""
+
+        def __init__(self, path):
+            self._file = open(path, "w")
+
+        def write(self, data):
+            time.sleep(50e-6)
+            self._file.write(data)
+
+        def flush(self):
+            self._file.flush()
+
+        def close(self):
+            self._file.close()
+
+    def configure_off(sink):
+        configure_sync(sink)
+        logging.getLogger().setLevel(logging.CRITICAL)
+
+    def configure_async(sink, sampling=None):
+        # setup_async_logging 只替换自己的处理器：先摘掉上一种模式的 StreamHandler
+        logging.getLogger().handlers.clear()
+        setup_async_logging(stream=sink, sampling=sampling)
+
+    modes = [
+        ("logging off (ceiling)", configure_off),
+        ("sync StreamHandler", configure_sync),
+        ("async JSON, no sampling", configure_async),
+        ("async JSON, 1/10 sampled", lambda sink: configure_async(sink, {"/api/weather": (10, 0)})),
+    ]
+    print("sink: ~50µs blocking write per record; 50% unpaid (402) / 50% paid requests")
+    print(f"{'mode':<26} {'max rps':>9} {'@5k rps':>9} {'p50':>10} {'p99':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, configure in modes:
+            sink = BlockingSink(f"{tmp}/server.log")
+            configure(sink)
+            run(2_000, 0.25)  # 预热
+            n = 5_000
+            environs = [(paid if i % 2 else unpaid).get_environ() for i in range(n)]
+            t = timed(lambda: [call(e) for e in environs], repeat=1)
+            achieved, p50, p99 = run(5_000, 2)
+            _stop_listener()
+            sink.close()
+            print(f"{label:<26} {n / t:9,.0f} {achieved:9,.0f} {p50 * 1e3:8.2f}ms {p99 * 1e3:8.2f}ms")
+
+    configure_sync(sys.stderr)
+
+
+@benchmark("quote-prepay")
+def bench_quote_prepay():
+    """402 探价握手 vs 缓存报价预付（支付前以304确认报价）：每次调用的往返次数与端到端延迟"""
+    import logging
+    import threading
+    from werkzeug.serving import make_server
+    import demo_server
+    import demo_agent
+    from x402_quotes import QuoteCache
+
+    rtt = 0.020  # 模拟 20ms 网络往返
+
+    def delayed(environ, start_response):
+        counter[0] += 1
+        time.sleep(rtt)
+        return demo_server.app(environ, start_response)
+
+    counter = [0]
+    server = make_server("127.0.0.1", 0, delayed, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    demo_agent.DEMO_API_BASE = f"http://127.0.0.1:{server.server_port}"
+    logging.getLogger().setLevel(logging.CRITICAL)
+    logging.getLogger("werkzeug").setLevel(logging.CRITICAL)
+    demo_server.ADMISSION.enabled = False
+
+    def measure(label, quotes, calls=50):
+        agent = demo_agent.DemoAgent("weather-agent", private_key="0x" + "11" * 32, quotes=quotes)
+        agent.call_api_with_x402_payment("/api/weather")  # 预热（含报价加载）
+        counter[0] = 0
+        latencies = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            ok, _ = agent.call_api_with_x402_payment("/api/weather")
+            latencies.append(time.perf_counter() - start)
+            assert ok
+        latencies.sort()
+        print(f"{label:<22} {counter[0] / calls:>9.2f} {latencies[calls // 2] * 1e3:8.1f}ms "
+              f"{latencies[int(calls * 0.99)] * 1e3:8.1f}ms")
+        return latencies[calls // 2]
+
+    print(f"simulated RTT: {rtt * 1e3:.0f} ms per request")
+    print(f"{'mode':<22} {'req/call':>9} {'p50':>10} {'p99':>10}")
+    try:
+        legacy = measure("402 handshake", None)
+        quotes = QuoteCache(f"{demo_agent.DEMO_API_BASE}/demo/services")
+        prepaid = measure("cached quote prepay", quotes)
+        print(f"handshake latency saved: {(legacy - prepaid) * 1e3:.1f} ms/call; quotes {quotes.stats()}")
+    finally:
+        server.shutdown()
+
+
+@benchmark("session-tokens")
+def bench_session_tokens():
+    """每次调用独立验证支付 vs 预付会话令牌本地扣费"""
+    import logging
+    from werkzeug.test import EnvironBuilder
+    import demo_server
+
+    rpc = 0.005  # 模拟一次 verifyX402Payment RPC 耗时
+    verify = demo_server.verify_payment_mock
+    verifications = [0]
+
+    def slow_verify(*args):
+        verifications[0] += 1
+        time.sleep(rpc)
+        return verify(*args)
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    demo_server.verify_payment_mock = slow_verify
+    demo_server.ADMISSION.enabled = False
+    app = demo_server.app
+    try:
+        client = app.test_client()
+        token = client.post("/demo/session", json={"amount": 10**15},
+                            headers={"X-Payment-Hash": "0x" + "cd" * 32}).get_json()["token"]
+        per_call = EnvironBuilder(path="/api/weather", headers={"X-Payment-Hash": "0x" + "ab" * 32}).get_environ()
+        session = EnvironBuilder(path="/api/weather", headers={"Authorization": f"Bearer {token}"}).get_environ()
+
+        def run(environ, n):
+            for _ in range(n):
+                body = app(dict(environ), lambda status, headers: None)
+                for _ in body:
+                    pass
+                body.close()
+
+        print(f"simulated verify RPC: {rpc * 1e3:.0f} ms")
+        print(f"{'mode':<22} {'calls':>7} {'verifies':>9} {'calls/s':>10} {'per call':>10}")
+        for label, environ, n in (("per-call payment", per_call, 200), ("session token", session, 5_000)):
+            verifications[0] = 0
+            t = timed(run, environ, n, repeat=1)
+            print(f"{label:<22} {n:>7,} {verifications[0]:>9,} {n / t:>10,.0f} {t / n * 1e6:>8.1f}µs")
+
+        t = timed(lambda: [demo_server.SESSIONS.charge(token, 1) for _ in range(100_000)])
+        print(f"SessionManager.charge: {100_000 / t:,.0f} ops/s")
+    finally:
+        demo_server.verify_payment_mock = verify
+
+
+@benchmark("response-cache")
+def bench_response_cache():
+    """付费 GET 端点：每次重建负载 vs 缓存负载 + 拼接支付字段"""
+    import json
+    import logging
+    from werkzeug.test import EnvironBuilder
+    import demo_server
+    from response_cache import ResponseCache
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    demo_server.ADMISSION.enabled = False
+    app = demo_server.app
+    environ = EnvironBuilder(path="/api/weather", headers={"X-Payment-Hash": "0x" + "ab" * 32}).get_environ()
+
+    def run(n):
+        for _ in range(n):
+            body = app(dict(environ), lambda status, headers: None)
+            for _ in body:
+                pass
+            body.close()
+
+    n = 5_000
+    original = demo_server.RESPONSE_CACHES["/api/weather"]
+    print(f"{'mode':<26} {'req/s':>9} {'per req':>10}")
+    try:
+        for label, cache in (("rebuild every request", ResponseCache(ttl=0, stale=0)),
+                             ("cached payload", ResponseCache(ttl=60, stale=30))):
+            demo_server.RESPONSE_CACHES["/api/weather"] = cache
+            t = timed(run, n)
+            print(f"{label:<26} {n / t:9,.0f} {t / n * 1e6:8.1f}µs")
+    finally:
+        demo_server.RESPONSE_CACHES["/api/weather"] = original
+
+    # 仅负载构建部分
+    cache = ResponseCache(ttl=60, stale=30)
+    fields = {"payment_verified": True, "payment_hash": "0x" + "ab" * 32}
+
+    def rebuild():
+        for _ in range(100_000):
+            data = demo_server.build_weather_data()
+            data.update(fields)
+            json.dumps(data, ensure_ascii=False)
+
+    def cached():
+        for _ in range(100_000):
+            cache.render((), demo_server.build_weather_data, **fields)
+
+    for label, fn in (("payload rebuild + dumps", rebuild), ("cache.render", cached)):
+        t = timed(fn)
+        print(f"{label:<26} {100_000 / t:9,.0f} {t / 100_000 * 1e6:8.2f}µs")
+
+
+@benchmark("admission")
+def bench_admission():
+    """令牌桶准入：进程内 / SQLite 共享存储的单次判定开销，及10万个活跃键的内存"""
+    import os
+    import tempfile
+    import tracemalloc
+    from admission import Rule, SQLiteTokenBuckets, TokenBuckets
+
+    rule = Rule(50, 100)
+    keys = [f"10.0.{i // 256}.{i % 256}" for i in range(1_000)]
+
+    def run(buckets, n):
+        for i in range(n):
+            buckets.take(keys[i % len(keys)])
+
+    local = TokenBuckets(rule)
+    t = timed(run, local, 200_000)
+    print(f"{'in-process':<18} {200_000 / t:>10,.0f} takes/s {t / 200_000 * 1e6:>7.2f}µs")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        shared = SQLiteTokenBuckets(rule, os.path.join(tmp, "admission.db"), "ip")
+        t = timed(run, shared, 20_000)
+        print(f"{'sqlite (WAL)':<18} {20_000 / t:>10,.0f} takes/s {t / 20_000 * 1e6:>7.2f}µs")
+
+    tracemalloc.start()
+    buckets = TokenBuckets(rule)
+    for i in range(100_000):
+        buckets.take(f"agent-{i}")
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"100k active keys: {size / 1e6:.1f} MB ({size / 100_000:.0f} B/key, including key strings)")
+
+
+@benchmark("single-flight")
+def bench_single_flight():
+    """并发验证同一哈希的压力测试：有无 SingleFlight 时的 RPC 次数"""
+    import threading
+    from singleflight import SingleFlight
+
+    rpc = 0.050  # 模拟一次 verifyX402Payment RPC
+    hashes, per_hash = 20, 50
+    rpc_calls = [0]
+    lock = threading.Lock()
+
+    def verify(payment_hash):
+        with lock:
+            rpc_calls[0] += 1
+        time.sleep(rpc)
+        if payment_hash.endswith("bad"):
+            raise RuntimeError("rpc failure")
+        return True
+
+    def stress_threads(flights):
+        barrier = threading.Barrier(hashes * per_hash)
+        results, errors = [], []
+
+        def worker(i):
+            payment_hash = f"0x{i % hashes:064x}" if i % hashes else "0xbad"
+            barrier.wait()
+            try:
+                if flights is None:
+                    results.append(verify(payment_hash))
+                else:
+                    results.append(flights.do(payment_hash, verify, payment_hash))
+            except RuntimeError:
+                errors.append(i)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(hashes * per_hash)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return time.perf_counter() - start, len(results), len(errors)
+
+    print(f"{hashes} hashes x {per_hash} concurrent requests, simulated RPC {rpc * 1e3:.0f} ms")
+    print(f"{'mode':<22} {'rpc calls':>10} {'coalesced':>10} {'ok':>6} {'errors':>7} {'wall':>9}")
+    for label, flights in (("threads, no dedup", None), ("threads, SingleFlight", SingleFlight())):
+        rpc_calls[0] = 0
+        wall, ok, errors = stress_threads(flights)
+        coalesced = flights.coalesced if flights else 0
+        print(f"{label:<22} {rpc_calls[0]:>10,} {coalesced:>10,} {ok:>6,} {errors:>7,} {wall * 1e3:>7.0f}ms")
+        assert ok + errors == hashes * per_hash and errors == per_hash
+        if flights:
+            assert rpc_calls[0] == flights.calls and flights.calls + flights.coalesced == hashes * per_hash
+
+
+@benchmark("payment-journal")
+def bench_payment_journal():
+    """支付日志：每条记录单独提交 vs 成组提交（均为 fsync 落盘后返回），以及重启回放"""
+    import tempfile
+    import threading
+    from payment_journal import PaymentJournal, INTENT, SIGNED, CONSUMED
+
+    writers, payments = 16, 100  # 每笔支付 3 条记录
+
+    def run(path, **kwargs):
+        journal = PaymentJournal(path, **kwargs)
+
+        def worker(w):
+            for i in range(payments):
+                payment_id = f"{w}-{i}"
+                journal.append(payment_id, INTENT, url="/api/weather", amount=1000)
+                journal.append(payment_id, SIGNED, proof="0x" + "ab" * 65)
+                journal.append(payment_id, CONSUMED, status=200)
+
+        threads = [threading.Thread(target=worker, args=(w,)) for w in range(writers)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        journal.close()
+        return journal, elapsed
+
+    print(f"{writers} writer threads x {payments} payments x 3 events, synchronous=FULL")
+    print(f"{'mode':<22} {'events/s':>10} {'commits':>9} {'events/commit':>14}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, kwargs in (("commit per event", dict(batch_window=0, max_batch=1)),
+                              ("group commit", {})):
+            path = f"{tmp}/{label.replace(' ', '-')}.journal"
+            journal, elapsed = run(path, **kwargs)
+            assert journal.appended == writers * payments * 3
+            print(f"{label:<22} {journal.appended / elapsed:>10,.0f} {journal.commits:>9,} "
+                  f"{journal.appended / journal.commits:>14.1f}")
+
+        start = time.perf_counter()
+        reopened = PaymentJournal(path)
+        elapsed = time.perf_counter() - start
+        assert not reopened.pending() and reopened.get("0-0").state == CONSUMED
+        reopened.close()
+        print(f"replay {writers * payments * 3:,} events on open: {elapsed * 1e3:.1f} ms")
+
+
+@benchmark("spending-analytics")
+def bench_spending_analytics():
+    """消费统计：预聚合区间查询 vs 扫描原始支付，以及CSV导出吞吐"""
+    import random
+    from spending_analytics import DAY, HOUR, Payment, PaymentStore
+
+    n, agents, days = 200_000, 100, 30
+    rng = random.Random(38)
+    start = int(time.time()) // DAY * DAY - days * DAY
+    endpoints = ["/x402/weather", "/x402/ai-model", "/api/premium-data", "/api/bulk-service"]
+    payments = [
+        Payment(f"0x{i:064x}", f"agent-{rng.randrange(agents)}", f"0x{rng.randrange(8):040x}",
+                rng.choice(endpoints), rng.randrange(1, 25) * 10**6, start + rng.randrange(days * DAY))
+        for i in range(n)
+    ]
+
+    store = PaymentStore()
+    t0 = time.perf_counter()
+    for i in range(0, n, 10_000):
+        store.record_many(payments[i:i + 10_000])
+    ingest = time.perf_counter() - t0
+    print(f"{n:,} payments, {agents} agents, {days} days: ingest {n / ingest:,.0f} payments/s")
+
+    end = start + days * DAY
+    week = (end - 7 * DAY, end)
+
+    def raw_scan():
+        with store._lock:
+            return store._conn.execute(
+                "SELECT agent_id, SUM(amount), COUNT(*) FROM payments WHERE ts >= ? AND ts < ? GROUP BY agent_id",
+                week
+            ).fetchall()
+
+    print(f"{'query':<42} {'latency':>10}")
+    for label, fn in (
+        ("7d totals by agent, raw scan", raw_scan),
+        ("7d totals by agent, daily rollup", lambda: store.totals(*week)),
+        ("30d daily series, one agent", lambda: store.spending(start, end, DAY, by=(), agent_id="agent-7")),
+        ("7d hourly series by endpoint", lambda: store.spending(*week, HOUR, by=("endpoint",))),
+    ):
+        print(f"{label:<42} {timed(fn, repeat=5) * 1e3:>8.2f}ms")
+
+    rows = [0]
+
+    def export():
+        rows[0] = sum(chunk.count("\n") for chunk in store.export_csv(start, end, HOUR)) - 1
+
+    elapsed = timed(export, repeat=1)
+    print(f"CSV export, hourly x all dimensions: {rows[0]:,} rows in {elapsed * 1e3:.0f} ms "
+          f"({rows[0] / elapsed:,.0f} rows/s)")
+
+
+@benchmark("agent-fleet")
+def bench_agent_fleet():
+    """单进程多Agent：每个空闲Agent的内存（独立实例 vs 舰队），以及共享连接池下的调用吞吐"""
+    import asyncio
+    import gc
+    import logging
+    import threading
+    import tracemalloc
+    from werkzeug.serving import make_server
+    import demo_server
+    import demo_agent
+    from agent_fleet import AgentFleet
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    logging.getLogger("werkzeug").setLevel(logging.CRITICAL)
+    demo_server.ADMISSION.enabled = False
+
+    def per_agent(make, n):
+        gc.collect()
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        keep = [make(i) for i in range(n)]
+        used = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        del keep
+        return used / n
+
+    standalone = per_agent(lambda i: demo_agent.DemoAgent(f"solo-{i}"), 200)
+    fleet = AgentFleet()
+    pooled = per_agent(lambda i: fleet.add(f"fleet-{i}"), 10_000)
+    print(f"{'idle agent memory':<30} {'bytes/agent':>12}")
+    print(f"{'DemoAgent (own Web3 + ABI)':<30} {standalone:>12,.0f}")
+    print(f"{'AgentFleet (shared pools)':<30} {pooled:>12,.0f}")
+
+    # 开发服务器每个请求后关闭连接，这里统计同时打开的连接数峰值
+    inflight = [0, 0]
+    lock = threading.Lock()
+
+    def app(environ, start_response):
+        with lock:
+            inflight[0] += 1
+            inflight[1] = max(inflight[1], inflight[0])
+        try:
+            return demo_server.app(environ, start_response)
+        finally:
+            with lock:
+                inflight[0] -= 1
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    agents, calls = 2_000, 2
+
+    async def run():
+        async with AgentFleet(api_base=f"http://127.0.0.1:{server.server_port}", max_connections=32) as fleet:
+            for i in range(agents):
+                fleet.add(f"agent-{i}", budget=3 * 10**6)  # 预算只够一次 2 USDT 调用
+            start = time.perf_counter()
+            results = await fleet.run((f"agent-{i % agents}", "/api/weather") for i in range(agents * calls))
+            return time.perf_counter() - start, results, fleet.status()
+
+    try:
+        elapsed, results, status = asyncio.run(run())
+    finally:
+        server.shutdown()
+    ok = sum(1 for success, _ in results if success)
+    assert ok == agents and status["spent"] == agents * 2 * 10**6
+    print(f"{agents:,} agents x {calls} calls: {len(results) / elapsed:,.0f} calls/s, "
+          f"peak {inflight[1]} concurrent connections (pool 32), "
+          f"{ok:,} paid, {len(results) - ok:,} stopped by budget")
+
+
+@benchmark("abi-codec")
+def bench_abi_codec():
+    """热点合约调用的每次编解码开销：web3 合约对象 vs 预构建编解码器 + 原始 eth_call"""
+    from eth_abi import encode
+    from web3 import Web3
+    from web3.providers.base import BaseProvider
+    from buyer_wallet import HOT_CALLS, BuyerWalletClient, get_contract
+
+    class CannedProvider(BaseProvider):
+        """立即返回固定结果的进程内 provider，只测本地开销"""
+
+        def __init__(self, result: bytes):
+            super().__init__()
+            self.result = "0x" + result.hex()
+
+        def make_request(self, method, params):
+            return {"jsonrpc": "2.0", "id": 1, "result": "0x1" if method == "eth_chainId" else self.result}
+
+    address = "0x14ebB18cA52796a3c1A68FfC0E74374CD735f74A"
+    recipient = Web3.to_checksum_address("0x" + "ab" * 20)
+    pay_args = ("weather-agent", recipient, 2 * 10**6, "x402 payment for /x402/weather", b"\x01" * 65, 7, 1_700_000_600)
+    proof = encode(["(bytes32,string,address,uint256,string,uint256,bytes32)"],
+                   [(b"\x11" * 32, "weather-agent", recipient, 2 * 10**6, "/x402/weather", 1_700_000_000, b"\x22" * 32)])
+
+    spending_w3 = Web3(CannedProvider(encode(["uint256"], [42])))
+    proof_w3 = Web3(CannedProvider(proof))
+    cases = (
+        ("encode payByAgent",
+         lambda: get_contract(spending_w3, address).encode_abi("payByAgent", args=list(pay_args)),
+         lambda: HOT_CALLS["payByAgent"].encode(*pay_args)),
+        ("call getTodaySpending",
+         lambda: get_contract(spending_w3, address).functions.getTodaySpending("weather-agent").call(),
+         lambda: BuyerWalletClient(spending_w3, address).get_today_spending("weather-agent")),
+        ("call verifyX402Payment",
+         lambda: get_contract(proof_w3, address).functions.verifyX402Payment(b"\x11" * 32).call(),
+         lambda: BuyerWalletClient(proof_w3, address).get_x402_proof(b"\x11" * 32)),
+    )
+
+    n = 2_000
+    print(f"{'operation':<24} {'web3 contract':>14} {'hot path':>10} {'speedup':>8}")
+    for label, slow, fast in cases:
+        slow_t = timed(lambda: [slow() for _ in range(n)]) / n
+        fast_t = timed(lambda: [fast() for _ in range(n)]) / n
+        print(f"{label:<24} {slow_t * 1e6:>12.1f}us {fast_t * 1e6:>8.1f}us {slow_t / fast_t:>7.1f}x")
+
+
+def _dev_wallet(agent_id: str):
+    """
+    在本地 anvil 节点上部署 MockUSDT + BuyerWallet，充值并注册一个 Agent
+
+    Returns:
+        (w3, wallet, signer, recipient)；缺少 forge build 产物或节点不可用时打印原因并返回 None
+    """
+    from eth_account import Account
+    from web3 import Web3
+    from buyer_wallet import AgentSigner
+    from wallet_parity import E2E_RPC, artifacts_available, deploy_contracts
+
+    w3 = Web3(Web3.HTTPProvider(E2E_RPC))
+    if not artifacts_available():
+        print("需要 forge build 产物（在仓库根目录运行 forge build）")
+        return None
+    if not w3.is_connected():
+        print(f"需要本地节点：anvil（或设置 ACPAY_E2E_RPC），当前 {E2E_RPC} 不可用")
+        return None
+
+    w3.eth.default_account = w3.eth.accounts[0]
+    usdt, wallet = deploy_contracts(w3, 10_000 * 10**6, 10 * 10**6)
+    signer = AgentSigner(Account.create().key, w3.eth.chain_id, wallet.address)
+    usdt.functions.approve(wallet.address, 1_000 * 10**6).transact()
+    wallet.functions.deposit(1_000 * 10**6).transact()
+    wallet.functions.registerAgent(agent_id, "E2E Agent", signer.address).transact()
+    return w3, wallet, signer, Account.create().address
+
+
+@benchmark("x402-batch-verify")
+def bench_x402_batch_verify():
+    """端到端（本地 anvil 节点）：payX402 记录证明，逐个 verifyX402Payment vs 一次 verifyX402Payments"""
+    from web3.exceptions import ContractLogicError
+    from buyer_wallet import BuyerWalletClient, x402_payment_hash
+    from payment_filter import X402_PAYMENT_TOPIC
+    from x402_records import X402PaymentInfo
+
+    chain = _dev_wallet("e2e-agent")
+    if chain is None:
+        return
+    w3, wallet, signer, recipient = chain
+    owner = w3.eth.default_account
+
+    # 授权带截止时间：先全部签好，再依次提交
+    n = 50
+    payment_topic = bytes.fromhex(X402_PAYMENT_TOPIC[2:])
+    deadline = w3.eth.get_block("latest").timestamp + 3600
+    infos = [X402PaymentInfo("e2e-agent", recipient, 10_000 + nonce, "/x402/weather", nonce, deadline)
+             for nonce in range(1, n + 1)]
+    signatures = [signer.sign_x402(info) for info in infos]
+    hashes, timestamps = [], []
+    for info, signature in zip(infos, signatures):
+        payment_hash = x402_payment_hash(info)
+        assert wallet.functions.getX402PaymentHash(tuple(info[:6])).call() == payment_hash, \
+            "x402_payment_hash differs from getX402PaymentHash"
+        tx = wallet.functions.payX402(tuple(info[:6]), signature).transact({"from": owner})
+        receipt = w3.eth.wait_for_transaction_receipt(tx)
+        assert receipt.status == 1, f"payX402 nonce {info.nonce} reverted"
+        events = [log for log in receipt.logs if log["topics"] and bytes(log["topics"][0]) == payment_topic]
+        assert len(events) == 1 and bytes(events[0]["topics"][1]) == payment_hash, "X402PaymentMade not emitted"
+        hashes.append(payment_hash)
+        timestamps.append(w3.eth.get_block(receipt.blockNumber).timestamp)
+    print(f"payX402: {receipt.gasUsed:,} gas（单笔，含记录证明）")
+
+    # 同一授权不能再次使用（nonce 已消耗）
+    try:
+        wallet.functions.payX402(tuple(infos[0][:6]), signatures[0]).transact({"from": owner})
+    except ContractLogicError:
+        pass
+    else:
+        raise AssertionError("replayed payX402 authorization was accepted")
+
+    client = BuyerWalletClient(w3, wallet.address)
+    single = [client.get_x402_proof(h) for h in hashes]
+    batch = client.get_x402_proofs(hashes + [b"\x00" * 32, hashes[0]])
+    assert single == batch[:n], "batch proofs differ from single lookups"
+    assert batch[n + 1] == batch[0], "duplicate hash in a batch should return the same proof"
+    assert not batch[n].exists, "unknown hash should return empty proof"
+    for proof, info, payment_hash, timestamp in zip(batch, infos, hashes, timestamps):
+        assert proof.exists and proof.payment_hash == payment_hash, "proof missing for payment hash"
+        assert (proof.agent_id, proof.recipient.lower(), proof.amount, proof.api_endpoint) == \
+            (info.agent_id, info.recipient.lower(), info.amount, info.api_endpoint), f"proof fields differ: {proof}"
+        assert proof.timestamp == timestamp, "proof timestamp should be the block timestamp"
+        assert proof.tx_hash == b"\x00" * 32, "txHash is not known on-chain and should be zero"
+
+    single_t = timed(lambda: [client.get_x402_proof(h) for h in hashes])
+    batch_t = timed(lambda: client.get_x402_proofs(hashes))
+    print(f"verify {n} proofs: {n} x verifyX402Payment {single_t * 1e3:.1f}ms, "
+          f"1 x verifyX402Payments {batch_t * 1e3:.1f}ms ({single_t / batch_t:.1f}x)")
+
+
+@benchmark("agent-presign")
+def bench_agent_presign():
+    """EIP-712 授权预签：批量签名吞吐，以及从付费请求路径上移除的签名耗时"""
+    from eth_account import Account
+    from web3 import Web3
+    from buyer_wallet import AgentSigner, agent_payment_typed_data
+
+    key = b"\x01" * 32
+    wallet = "0x14ebB18cA52796a3c1A68FfC0E74374CD735f74A"
+    recipient = Web3.to_checksum_address("0x" + "ab" * 20)
+    signer = AgentSigner(key, 1439, wallet)
+    n = 300
+    deadline = int(time.time()) + 3600
+
+    # 与 eth_account 的 EIP-712 实现逐字节一致
+    for nonce in range(1, 4):
+        expected = Account.sign_typed_data(key, full_message=agent_payment_typed_data(
+            1439, wallet, "weather-agent", recipient, 2 * 10**6, "/x402/weather", nonce, deadline)).signature
+        assert signer.sign("weather-agent", recipient, 2 * 10**6, "/x402/weather", nonce, deadline) == bytes(expected)
+
+    elapsed = timed(lambda: [signer.sign("weather-agent", recipient, 2 * 10**6, "/x402/weather", nonce, deadline)
+                             for nonce in range(1, n + 1)])
+    print(f"预签 {n} 笔授权: {elapsed * 1e3:.0f}ms ({n / elapsed:,.0f} signatures/s)")
+    print(f"预签后每次付费请求省去 {elapsed / n * 1e3:.2f}ms 签名耗时（截止时间前任意时刻提交）")
+
+
+@benchmark("relayer")
+def bench_relayer():
+    """端到端（本地 anvil 节点）：预签 payByAgent 授权交给 Relayer，吞吐、队列深度与每块交易数"""
+    from collections import Counter
+    from relayer import Authorization, Relayer
+
+    chain = _dev_wallet("relay-agent")
+    if chain is None:
+        return
+    w3, wallet, signer, recipient = chain
+
+    # anvil 默认第二个账户作为 Relayer 发送方（与部署账户分开，nonce 互不干扰）
+    relayer_key = "0x59c6995e998f97a5a0044966f0945389dc9c86dae88c7a8412e4603b6b78690d"
+    n = 200
+    deadline = w3.eth.get_block("latest").timestamp + 3600
+    auths = [Authorization("payByAgent", "relay-agent", recipient, 1_000 + nonce, "bench", nonce, deadline,
+                           signer.sign("relay-agent", recipient, 1_000 + nonce, "bench", nonce, deadline))
+             for nonce in range(1, n + 1)]
+
+    relayer = Relayer(w3, wallet.address, relayer_key, poll_interval=0.05).start()
+    start = time.perf_counter()
+    # 逆序提交：全部排队后才凑齐连续 nonce，队列深度达到 n
+    jobs = relayer.submit_many(reversed(auths))
+    while not relayer.idle():
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    relayer.stop()
+
+    stats = relayer.stats()
+    assert stats["confirmed"] == n, f"relayer confirmed {stats['confirmed']}/{n}: {stats}"
+    assert wallet.functions.agentNonces("relay-agent").call() == n
+    per_block = Counter(job.block_number for job in jobs)
+    print(f"{n} authorizations: {elapsed:.2f}s ({n / elapsed:,.0f} auth/s), "
+          f"max queue depth {stats['max_queue_depth']}, sent {stats['sent']} tx, "
+          f"{len(per_block)} blocks ({n / len(per_block):.1f} tx/block)")
+
+
+@benchmark("x402-relayed")
+def bench_x402_relayed():
+    """端到端（本地 anvil 节点）：X402Agent 经 Relayer 提交 payX402，x402_server 按证明中的支付哈希放行"""
+    import logging
+    import os
+    import tempfile
+    import threading
+    from werkzeug.serving import make_server
+    from buyer_wallet import BuyerWalletClient
+    from payment_filter import X402_PAYMENT_TOPIC
+    from payment_journal import PaymentJournal
+    from relayer import Relayer, create_app
+    from wallet_parity import E2E_RPC
+    from x402_headers import format_payment_proof
+    import x402_agent
+    import x402_server
+
+    chain = _dev_wallet("x402-agent")
+    if chain is None:
+        return
+    w3, wallet, signer, recipient = chain
+
+    def serve(app):
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f"http://127.0.0.1:{server.server_port}"
+
+    # Relayer 使用 anvil 第二个账户；服务端读取本地链上的证明（关闭过滤器、准入与乐观模式）
+    relayer = Relayer(w3, wallet.address, "0x59c6995e998f97a5a0044966f0945389dc9c86dae88c7a8412e4603b6b78690d",
+                      poll_interval=0.05).start()
+    relay_server, relay_url = serve(create_app(relayer))
+    x402_server.wallet = BuyerWalletClient(w3, wallet.address)
+    x402_server.SERVICE_RECIPIENT = recipient
+    x402_server.KNOWN_PAYMENTS.enabled = False
+    x402_server.ADMISSION.enabled = False
+    x402_server.OPTIMISTIC.enabled = False
+    api_server, api_url = serve(x402_server.app)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    x402_agent.INJECTIVE_TESTNET_RPC, x402_agent.INJECTIVE_TESTNET_WS = E2E_RPC, None
+    x402_agent.BUYER_WALLET_ADDRESS, x402_agent.RELAYER_URL = wallet.address, relay_url
+    journal = PaymentJournal(os.path.join(tempfile.mkdtemp(), "x402-agent.journal"))
+    agent = x402_agent.X402Agent("x402-agent", signer.account.key, "E2E Agent", journal=journal)
+    try:
+        start = time.perf_counter()
+        data = agent.call_x402_api(f"{api_url}/x402/weather")
+        elapsed = time.perf_counter() - start
+        assert data is not None and data.get("payment_verified"), f"relayed payment was not accepted: {data}"
+
+        assert not journal.pending(), "payment should be journaled as consumed"
+        logs = w3.eth.get_logs({"address": wallet.address, "fromBlock": 0, "topics": [X402_PAYMENT_TOPIC]})
+        assert len(logs) == 1, f"expected one X402PaymentMade, got {len(logs)}"
+        payment_hash = "0x" + bytes(logs[0]["topics"][1]).hex()
+        proof = x402_server.wallet.get_x402_proof(payment_hash)
+        assert proof.exists and proof.agent_id == "x402-agent", "payX402 proof missing on-chain"
+        assert (proof.recipient.lower(), proof.amount, proof.api_endpoint) == \
+            (recipient.lower(), x402_server.SERVICES["/x402/weather"]["price"], "/x402/weather")
+        assert relayer.stats()["confirmed"] == 1
+
+        # 同一证明不能再次换取响应
+        proof_header = format_payment_proof(hash=payment_hash, agent="x402-agent")
+        replay = agent.http.get(f"{api_url}/x402/weather", headers={"Payment-Proof": proof_header})
+        assert replay.status_code == 402, f"replayed proof answered {replay.status_code}"
+        print(f"402 -> payX402 via relayer -> 200: {elapsed:.2f}s, proof {payment_hash[:18]}…, replay rejected")
+    finally:
+        agent.close()
+        relayer.stop()
+        relay_server.shutdown()
+        api_server.shutdown()
+
+
+@benchmark("optimistic")
+def bench_optimistic():
+    """乐观模式：同步验证 vs 先服务后台验证的请求延迟，以及恶意 Agent 的损失上限"""
+    import logging
+    from werkzeug.test import EnvironBuilder
+    from x402_headers import format_payment_proof
+    from x402_records import X402PaymentProof
+    import x402_server
+
+    rpc = 0.02  # 模拟一次 verifyX402Payment RPC 耗时
+    price = x402_server.SERVICES["/x402/weather"]["price"]
+    bad_hashes = set()
+
+    class SlowWallet:
+        def get_x402_proof(self, payment_hash):
+            time.sleep(rpc)
+            if payment_hash in bad_hashes:
+                return X402PaymentProof(b"", "", "0x" + "00" * 20, 0, "", 0, b"")
+            return X402PaymentProof(bytes.fromhex(payment_hash[2:]), "bench-agent", x402_server.SERVICE_RECIPIENT,
+                                    price, "/x402/weather", int(time.time()), b"\x00" * 32)
+
+        def get_agent_signer(self, agent_id):
+            return "0x" + "5e" * 20
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    wallet, optimistic = x402_server.wallet, x402_server.OPTIMISTIC
+    x402_server.wallet = SlowWallet()
+    x402_server.OPTIMISTIC = x402_server.OptimisticVerifier(
+        x402_server.settle_optimistic, x402_server.wallet.get_agent_signer, workers=8,
+        risk_cap=4 * price, retries=0, caps={}, enabled=False)
+    x402_server.ADMISSION.enabled = False
+    app = x402_server.app
+    counter = iter(range(1, 10**9))
+
+    def call(bad=False):
+        payment_hash = f"0x{next(counter):064x}"
+        if bad:
+            bad_hashes.add(payment_hash)
+        environ = EnvironBuilder(path="/x402/weather", headers={
+            "Payment-Proof": format_payment_proof(hash=payment_hash, agent="bench-agent"),
+            "X-Payment-Hash": payment_hash}).get_environ()
+        start = time.perf_counter()
+        status = []
+        body = app(environ, lambda s, headers: status.append(s))
+        for _ in body:
+            pass
+        body.close()
+        return time.perf_counter() - start, status[0]
+
+    try:
+        n = 100
+        print(f"simulated verify RPC: {rpc * 1e3:.0f} ms, risk cap {4 * price / 10**6:g} USDT")
+        sync = sorted(call()[0] for _ in range(n))   # 关闭乐观模式：同步验证，同时累积信誉
+        x402_server.OPTIMISTIC.drain(5)
+        x402_server.OPTIMISTIC.enabled = True
+        fast = []
+        for _ in range(n):
+            fast.append(call()[0])
+            x402_server.OPTIMISTIC.drain(5)           # 逐笔结算，敞口不触及上限
+        fast.sort()
+        print(f"{'mode':<14} {'p50':>9} {'p99':>9}")
+        for label, samples in (("sync verify", sync), ("optimistic", fast)):
+            print(f"{label:<14} {samples[n // 2] * 1e3:>7.2f}ms {samples[n * 99 // 100] * 1e3:>7.2f}ms")
+
+        # 恶意 Agent：连续发送无效证明，直到被拉黑或触及风险上限
+        served = sum(call(bad=True)[1].startswith("200") for _ in range(20))
+        x402_server.OPTIMISTIC.drain(5)
+        stats = x402_server.OPTIMISTIC.stats()
+        assert stats["losses"] <= 4 * price, stats
+        print(f"bad proofs: served {served} of 20 before cap/blacklist, "
+              f"losses {stats['losses'] / 10**6:g} USDT, blacklisted {stats['blacklisted']}")
+    finally:
+        x402_server.OPTIMISTIC.close()
+        x402_server.wallet, x402_server.OPTIMISTIC = wallet, optimistic
+
+
+@benchmark("prefork")
+def bench_prefork():
+    """共享内存表读写开销，以及 prefork worker 1 -> 16 的请求吞吐"""
+    import asyncio
+    import logging
+    import multiprocessing
+    import os
+    import signal
+    import socket
+    import aiohttp
+    import prefork
+    from shm_table import SharedTable
+    import demo_server
+
+    n = 100_000
+    table = SharedTable(1 << 18, "dd")
+    keys = [f"0x{i:064x}" for i in range(n)]
+    plain = {}
+    put = timed(lambda: [table.put(k, (1.0, 2.0), ttl=60) for k in keys], repeat=1)
+    get = timed(lambda: [table.get(k) for k in keys])
+    dict_get = timed(lambda: [plain.get(k) for k in keys])
+    print(f"SharedTable: put {n / put:,.0f} ops/s (cross-process lock), get {n / get:,.0f} ops/s (lock-free), "
+          f"dict.get {n / dict_get:,.0f} ops/s, evictions {table.evictions}")
+    table.close()
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    logging.getLogger("werkzeug").setLevel(logging.CRITICAL)
+    demo_server.ADMISSION.enabled = False
+    fork = multiprocessing.get_context("fork")
+    duration, clients, concurrency = 3.0, max(1, min(8, (os.cpu_count() or 1) // 2)), 32
+    headers = {"X-Payment-Hash": "0x" + "ab" * 32}
+
+    def load(port, results):
+        async def run():
+            url = f"http://127.0.0.1:{port}/api/weather"
+            done, stop = [0], time.perf_counter() + duration
+            async with aiohttp.ClientSession() as session:
+                async def worker():
+                    while time.perf_counter() < stop:
+                        async with session.get(url, headers=headers) as response:
+                            await response.read()
+                            done[0] += response.status == 200
+                await asyncio.gather(*(worker() for _ in range(concurrency)))
+            return done[0]
+        results.put(asyncio.run(run()))
+
+    def wait_ready(port):
+        for _ in range(200):
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("prefork server did not start")
+
+    print(f"{os.cpu_count()} CPUs, {clients} load processes x {concurrency} connections, {duration:.0f}s per run")
+    print(f"{'workers':>8} {'req/s':>10} {'speedup':>8}")
+    base = None
+    for workers in (1, 2, 4, 8, 16):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        server = fork.Process(target=prefork.serve, args=(demo_server.app, "127.0.0.1", port, workers))
+        server.start()
+        try:
+            wait_ready(port)
+            results = fork.SimpleQueue()
+            loaders = [fork.Process(target=load, args=(port, results)) for _ in range(clients)]
+            for loader in loaders:
+                loader.start()
+            total = sum(results.get() for _ in loaders)
+            for loader in loaders:
+                loader.join()
+        finally:
+            os.kill(server.pid, signal.SIGTERM)
+            server.join()
+        rps = total / duration
+        base = base or rps
+        print(f"{workers:>8} {rps:>10,.0f} {rps / base:>7.1f}x")
+
+
+@benchmark("payment-filter")
+def bench_payment_filter():
+    """已知支付哈希布隆过滤器：10M 哈希的内存、构建耗时、查询吞吐与实测误判率"""
+    import os
+    from payment_filter import BloomFilter
+
+    n, probes = 10_000_000, 1_000_000
+    known = os.urandom(32 * n)
+    unknown = os.urandom(32 * probes)
+    singles = ["0x" + unknown[i * 32:(i + 1) * 32].hex() for i in range(100_000)]
+
+    print(f"{n:,} hashes (raw set would be {n * 32 / 2**20:,.0f} MiB of hashes + set overhead)")
+    print(f"{'fp target':>9} {'k':>3} {'MiB':>7} {'build':>8} {'batch lookup':>16} {'single lookup':>15} {'fp measured':>12}")
+    for fp_rate in (0.01, 0.001):
+        bloom = BloomFilter(n, fp_rate)
+        build = timed(bloom.add_many, known, repeat=1)
+        assert bloom.contains_many(known[:32 * probes]).all(), "false negative"
+        batch = timed(bloom.contains_many, unknown)
+        single = timed(lambda bloom=bloom: [h in bloom for h in singles], repeat=1)
+        measured = bloom.contains_many(unknown).mean()
+        print(f"{fp_rate:>9} {bloom.k:>3} {bloom.nbytes / 2**20:>7.1f} {build:>7.1f}s "
+              f"{batch / probes * 1e9:>8.0f} ns/hash {single / len(singles) * 1e9:>8.0f} ns/hash {measured:>12.5f}")
+        del bloom
+
+
+@benchmark("compact-transport")
+def bench_compact_transport():
+    """每次握手的字节数与 CPU：JSON 402 + 文本 Payment-Proof vs CBOR 402 + 二进制 Payment-Proof"""
+    import logging
+    from x402_cbor import decode_payment_required
+    from x402_headers import (format_compact_payment_proof, format_payment_proof,
+                              parse_accept_payment, parse_payment_proof)
+    import demo_server
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    demo_server.ADMISSION.enabled = False
+    client = demo_server.app.test_client()
+    n = 2_000
+
+    def wire_size(headers, body=b""):
+        return sum(len(f"{key}: {value}\r\n") for key, value in headers.items()) + len(body)
+
+    payment_hash, signature = "0x" + "ab" * 32, "0x" + "cd" * 65
+    text_headers = {
+        "Payment-Proof": format_payment_proof(hash=payment_hash, agent="weather-agent", nonce=7,
+                                              timestamp=1_750_000_000, signature=signature),
+        "X-Payment-Hash": payment_hash,
+    }
+    compact_headers = {
+        "Payment-Proof": format_compact_payment_proof(hash=payment_hash, agent="weather-agent", nonce=7,
+                                                      timestamp=1_750_000_000, signature=signature),
+    }
+    assert parse_payment_proof(text_headers["Payment-Proof"]) == parse_payment_proof(compact_headers["Payment-Proof"])
+
+    def handshake(accept, decode, proof_headers, format_proof):
+        request_headers = {"Accept": accept} if accept else {}
+        response = client.get("/api/weather", headers=request_headers)
+        assert response.status_code == 402
+        info = decode(response)
+        assert info.amount == 2_000_000
+
+        def server_402():
+            for _ in range(n):
+                client.get("/api/weather", headers=request_headers)
+
+        def agent_decode():
+            for _ in range(n * 10):
+                decode(response)
+
+        def proof_roundtrip():
+            for _ in range(n * 10):
+                parse_payment_proof(format_proof(hash=payment_hash, agent="weather-agent", nonce=7,
+                                                 timestamp=1_750_000_000, signature=signature))
+
+        size = (wire_size(request_headers) + wire_size(response.headers, response.data)
+                + wire_size(proof_headers))
+        return (size, wire_size(response.headers, response.data), wire_size(proof_headers),
+                timed(server_402) / n * 1e6, timed(agent_decode) / (n * 10) * 1e6,
+                timed(proof_roundtrip) / (n * 10) * 1e6)
+
+    rows = [
+        ("JSON + text proof", handshake(
+            None, lambda r: parse_accept_payment(r.headers["Accept-Payment"]), text_headers, format_payment_proof)),
+        ("CBOR + binary proof", handshake(
+            "application/cbor", lambda r: decode_payment_required(r.data), compact_headers,
+            format_compact_payment_proof)),
+    ]
+    print(f"{'':<22}{'bytes/hs':>10}{'402 resp':>10}{'proof hdr':>10}"
+          f"{'server 402':>13}{'agent decode':>14}{'proof fmt+parse':>17}")
+    for label, (size, response, proof, server, decode, proof_cpu) in rows:
+        print(f"{label:<22}{size:>10}{response:>10}{proof:>10}"
+              f"{server:>10.1f} us{decode:>11.2f} us{proof_cpu:>14.2f} us")
+    (json_size, *_), (cbor_size, *_) = rows[0][1], rows[1][1]
+    print(f"bytes per handshake: {json_size} -> {cbor_size} ({cbor_size / json_size:.0%})")
+
+
+@benchmark("keepalive")
+def bench_keepalive():
+    """402 握手（探价 + 带证明的重试）延迟：每请求一个连接 vs HTTP/1.1 持久连接，回环加模拟 RTT"""
+    import logging
+    import queue
+    import socket
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    import requests
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    import demo_agent
+    import demo_server
+    from prefork import KeepAliveRequestHandler
+
+    rtt = 0.010  # 模拟 10ms 网络往返：建连 1 RTT，请求/响应各单程 RTT/2
+    connections = [0]
+
+    def pump(src, dst):
+        """转发一个方向的数据，每个分片延迟 RTT/2 到达（保持顺序，不串行累加）"""
+        pending = queue.SimpleQueue()
+
+        def deliver():
+            while True:
+                due, data = pending.get()
+                time.sleep(max(0.0, due - time.perf_counter()))
+                try:
+                    if data is None:
+                        dst.shutdown(socket.SHUT_WR)
+                        return
+                    dst.sendall(data)
+                except OSError:
+                    return
+
+        threading.Thread(target=deliver, daemon=True).start()
+        while True:
+            try:
+                data = src.recv(65536)
+            except OSError:
+                data = b""
+            pending.put((time.perf_counter() + rtt / 2, data or None))
+            if not data:
+                return
+
+    def proxy(listener, upstream_port):
+        while True:
+            try:
+                client, _ = listener.accept()
+            except OSError:
+                return
+            connections[0] += 1
+
+            def connect(client=client):
+                time.sleep(rtt)   # TCP 三次握手
+                upstream = socket.create_connection(("127.0.0.1", upstream_port))
+                for sock in (client, upstream):
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                threading.Thread(target=pump, args=(upstream, client), daemon=True).start()
+                pump(client, upstream)
+
+            threading.Thread(target=connect, daemon=True).start()
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    logging.getLogger("werkzeug").setLevel(logging.CRITICAL)
+    demo_server.ADMISSION.enabled = False
+
+    def measure(label, handler, http, calls=30, concurrency=16, per_thread=8):
+        server = make_server("127.0.0.1", 0, demo_server.app, threaded=True, request_handler=handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        front = socket.create_server(("127.0.0.1", 0))
+        threading.Thread(target=proxy, args=(front, server.server_port), daemon=True).start()
+        demo_agent.DEMO_API_BASE = f"http://127.0.0.1:{front.getsockname()[1]}"
+        agent = demo_agent.DemoAgent("weather-agent", private_key="0x" + "11" * 32, http=http)
+        try:
+            assert agent.call_api_with_x402_payment("/api/weather")[0]   # 预热
+            connections[0] = 0
+            latencies = []
+            for _ in range(calls):
+                start = time.perf_counter()
+                assert agent.call_api_with_x402_payment("/api/weather")[0]
+                latencies.append(time.perf_counter() - start)
+            latencies.sort()
+            sequential_conns = connections[0] / calls
+
+            def worker(_):
+                for _ in range(per_thread):
+                    assert agent.call_api_with_x402_payment("/api/weather")[0]
+
+            connections[0] = 0
+            start = time.perf_counter()
+            with ThreadPoolExecutor(concurrency) as pool:
+                list(pool.map(worker, range(concurrency)))
+            elapsed = time.perf_counter() - start
+            total = concurrency * per_thread
+            print(f"{label:<30} {latencies[calls // 2] * 1e3:7.1f}ms {latencies[int(calls * 0.9)] * 1e3:7.1f}ms "
+                  f"{sequential_conns:>9.2f} {total / elapsed:>11.1f} {connections[0]:>9}")
+        finally:
+            server.shutdown()
+            front.close()
+
+    print(f"simulated RTT: {rtt * 1e3:.0f} ms; concurrent phase: 16 threads x 8 handshakes through one agent")
+    print(f"{'mode':<30} {'p50':>9} {'p90':>9} {'conn/hs':>9} {'hs/s (16x)':>11} {'conns':>9}")
+    measure("HTTP/1.0 server", WSGIRequestHandler, demo_agent.DEMO_HTTP)
+    measure("keep-alive server, no session", KeepAliveRequestHandler, requests)
+    measure("keep-alive + shared session", KeepAliveRequestHandler, demo_agent.DEMO_HTTP)
+
+
+@benchmark("resilience")
+def bench_resilience():
+    """模拟 RPC 节点间歇 5xx 与停顿：web3 默认 HTTPProvider vs ResilientHTTPProvider"""
+    import json
+    import logging
+    import random
+    import threading
+    from web3 import Web3
+    from werkzeug.serving import make_server
+    import resilience
+
+    node = {"error_rate": 0.0, "stall": 0.0}
+
+    def rpc_app(environ, start_response):
+        request = json.loads(environ["wsgi.input"].read(int(environ.get("CONTENT_LENGTH") or 0)))
+        time.sleep(0.005 + node["stall"])
+        if random.random() < node["error_rate"]:
+            start_response("500 Internal Server Error", [("Content-Type", "text/plain")])
+            return [b"upstream error"]
+        body = json.dumps({"jsonrpc": "2.0", "id": request["id"], "result": "0x10"}).encode()
+        start_response("200 OK", [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+        return [body]
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    logging.getLogger("werkzeug").setLevel(logging.CRITICAL)
+    server = make_server("127.0.0.1", 0, rpc_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    uri = f"http://127.0.0.1:{server.server_port}/"
+    # 演示用的小参数：最小超时 50ms、熔断 1 秒后探测
+    resilience.get_policy(f"rpc:{uri}:eth_blockNumber", min_timeout=0.05, reset_timeout=1.0)
+
+    phases = [
+        ("healthy", 0.0, 0.0, 40),
+        ("flaky (20% 5xx)", 0.2, 0.0, 40),
+        ("stalled (+1s)", 0.0, 1.0, 8),
+    ]
+
+    def run(label, w3):
+        random.seed(7)
+        for phase, error_rate, stall, calls in phases:
+            node.update(error_rate=error_rate, stall=stall)
+            ok, latencies = 0, []
+            start = time.perf_counter()
+            for _ in range(calls):
+                t = time.perf_counter()
+                try:
+                    w3.eth.block_number
+                    ok += 1
+                except Exception:
+                    pass
+                latencies.append(time.perf_counter() - t)
+            elapsed = time.perf_counter() - start
+            latencies.sort()
+            print(f"{label:<10} {phase:<17} {ok:>4}/{calls:<4} {latencies[len(latencies) // 2] * 1e3:8.1f}ms "
+                  f"{latencies[-1] * 1e3:8.1f}ms {elapsed:8.2f}s")
+        node.update(error_rate=0.0, stall=0.0)
+
+    try:
+        print(f"{'provider':<10} {'node':<17} {'ok':>9} {'p50':>10} {'max':>10} {'wall':>9}")
+        run("default", Web3(Web3.HTTPProvider(uri, request_kwargs={"timeout": 10})))
+        w3 = Web3(resilience.ResilientHTTPProvider(uri))
+        run("resilient", w3)
+        time.sleep(1.0)
+        t = time.perf_counter()
+        w3.eth.block_number
+        print(f"after recovery: probe {(time.perf_counter() - t) * 1e3:.1f}ms, "
+              f"policy {resilience.all_stats()[f'rpc:{uri}:eth_blockNumber']}")
+    finally:
+        server.shutdown()
+
+
+@benchmark("wallet-model")
+def bench_wallet_model():
+    """WalletModel 容量模拟：1万个Agent、200个收款方（20个池子）两天内的 1M 笔签名支付"""
+    import random
+    from collections import Counter
+    from wallet_model import WalletModel, WalletRevert
+    from x402_records import X402PaymentInfo
+
+    rng = random.Random(1)
+    agents, recipients, n = 10_000, 200, 1_000_000
+    owner = "0x" + "00" * 19 + "01"
+    model = WalletModel(daily_limit=300 * 10**6, transaction_limit=10 * 10**6, owner=owner, timestamp=1_700_000_000)
+    model.deposit(10**9 * 10**6)
+    agent_ids = [f"agent-{i}" for i in range(agents)]
+    signers = [f"0x{i + 1:040x}" for i in range(agents)]
+    addresses = [f"0x{0xa0000 + i:040x}" for i in range(recipients)]
+    for agent_id, signer in zip(agent_ids, signers):
+        model.register_agent(agent_id, agent_id, signer)
+    for pool in addresses[:20]:
+        model.add_pool_address(pool)
+
+    # 预先生成输入，计时只包含模型本身（每1000笔推进172秒：1M 笔跨两个自然日）
+    picks = [rng.randrange(agents) for _ in range(n)]
+    to = [addresses[rng.randrange(recipients)] for _ in range(n)]
+    amounts = [rng.randint(1, 12) * 10**6 for _ in range(n)]
+    deadline = model.timestamp + 7 * 86400
+    reasons = Counter()
+
+    def simulate():
+        state = model.agents
+        for i in range(n):
+            if i % 1000 == 0:
+                model.advance(172)
+            a = picks[i]
+            agent_id = agent_ids[a]
+            try:
+                model.pay_by_agent(agent_id, to[i], amounts[i], "sim", state[agent_id].nonce + 1, deadline, signers[a])
+                reasons["ok"] += 1
+            except WalletRevert as e:
+                reasons[e.reason] += 1
+
+    elapsed = timed(simulate, repeat=1)
+    stats = model.stats()
+    print(f"pay_by_agent: {n:,} payments in {elapsed:.2f}s ({n / elapsed:,.0f}/s, {n / elapsed * 60 / 1e6:.1f}M/min)")
+    for reason, count in reasons.most_common():
+        print(f"  {count:>9,}  {reason}")
+    print(f"  direct {stats['direct_payments']:,}, pooled {stats['pooled_payments']:,}, "
+          f"aggregations {stats['aggregations']:,}, still pending {stats['pending_payments']:,}")
+
+    # x402：每笔额外计算支付哈希并记录证明（新的一天，日限额已重置）
+    model.advance(86400)
+    m = 100_000
+    infos = [X402PaymentInfo(agent_ids[a], to[i], amounts[i] // 10, "/x402/weather", 0, deadline)
+             for i, a in enumerate(picks[:m])]
+
+    def simulate_x402():
+        state = model.agents
+        for i, info in enumerate(infos):
+            try:
+                model.pay_x402(info._replace(nonce=state[info.agent_id].nonce + 1), signers[picks[i]])
+            except WalletRevert:
+                pass
+
+    elapsed = timed(simulate_x402, repeat=1)
+    print(f"pay_x402: {m:,} payments in {elapsed:.2f}s ({m / elapsed:,.0f}/s, {m / elapsed * 60 / 1e6:.1f}M/min), "
+          f"{len(model.receipts):,} proofs recorded")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ACPay 性能基准")
+    parser.add_argument("names", nargs="*", help=f"要运行的基准: {', '.join(sorted(BENCHMARKS))}")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(unknown)}")
+
+    for name in args.names or sorted(BENCHMARKS):
+        print(f"\n=== {name} ===")
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
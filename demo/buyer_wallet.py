@@ -0,0 +1,279 @@
+"""
+ACPay BuyerWallet Client - 各模块共享的合约 ABI、合约对象与快速调用路径
+
+ABI 只从仓库根目录的 BuyerWallet.abi.json 加载一次；热点函数的选择器与
+eth_abi 编解码器在导入时预先构建，call_raw 直接发送 eth_call，
+绕过 web3 合约对象每次调用时的 ABI 查找、参数规范化与格式化中间件：
+
+    wallet = BuyerWalletClient(w3, BUYER_WALLET_ADDRESS)
+    spent = wallet.get_today_spending("weather-agent")      # 一次 eth_call
+    calldata = HOT_CALLS["payByAgent"].encode(agent_id, recipient, amount, metadata, signature, nonce, deadline)
+
+需要完整 web3 功能（构建交易、事件过滤）时使用 get_contract，
+同一 (Web3, 地址) 只创建一次合约对象。
+
+Agent 支付授权使用 EIP-712 类型签名（带截止时间），可以提前批量签好：
+
+    signer = AgentSigner(private_key, chain_id, BUYER_WALLET_ADDRESS)
+    signatures = [signer.sign(agent_id, recipient, amount, metadata, nonce, deadline) for ...]
+"""
+
+import json
+import os
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Tuple
+
+from eth_abi import encode
+from eth_abi.abi import default_codec
+from eth_account import Account
+from eth_utils import function_signature_to_4byte_selector, keccak, to_checksum_address
+from web3 import Web3
+
+from x402_records import X402PaymentInfo, X402PaymentProof
+
+ABI_PATH = os.getenv(
+    "ACPAY_ABI_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "BuyerWallet.abi.json"),
+)
+
+# 预先构建编解码器的热点函数
+HOT_FUNCTIONS = ("payByAgent", "payX402", "getTodaySpending", "getPaymentRules", "agentNonces", "agents",
+                 "verifyX402Payment", "verifyX402Payments")
+
+
+# EIP-712 域与授权类型（与 BuyerWallet.sol 一致）
+EIP712_NAME = "BuyerWallet"
+EIP712_VERSION = "1"
+AGENT_PAYMENT_TYPE = (
+    "AgentPayment(string agentId,address recipient,uint256 amount,string metadata,uint256 nonce,uint256 deadline)"
+)
+_DOMAIN_TYPEHASH = keccak(text="EIP712Domain(string name,string version,uint256 chainId,address verifyingContract)")
+_AGENT_PAYMENT_TYPEHASH = keccak(text=AGENT_PAYMENT_TYPE)
+_X402_AGENT_OFFSET = (192).to_bytes(32, "big")   # 6 个头部字之后是 agentId 的数据
+
+
+class RawCallError(RuntimeError):
+    """eth_call 返回错误（包括合约 revert）"""
+
+
+@lru_cache(maxsize=None)
+def load_abi(path: str = ABI_PATH) -> Tuple[Dict[str, Any], ...]:
+    """加载合约ABI（每个路径只读取一次）"""
+    with open(path, encoding="utf-8") as f:
+        return tuple(json.load(f))
+
+
+def _abi_type(param: Dict[str, Any]) -> str:
+    if param["type"].startswith("tuple"):
+        inner = ",".join(_abi_type(c) for c in param["components"])
+        return f"({inner}){param['type'][5:]}"
+    return param["type"]
+
+
+class HotCall:
+    """单个合约函数的选择器与预构建编解码器"""
+
+    __slots__ = ("name", "signature", "selector", "input_types", "output_types", "_encoder", "_decoder")
+
+    def __init__(self, fragment: Dict[str, Any]):
+        self.name = fragment["name"]
+        self.input_types = tuple(_abi_type(p) for p in fragment["inputs"])
+        self.output_types = tuple(_abi_type(p) for p in fragment.get("outputs", ()))
+        self.signature = f"{self.name}({','.join(self.input_types)})"
+        self.selector = function_signature_to_4byte_selector(self.signature)
+        registry = default_codec._registry
+        self._encoder = registry.get_tuple_encoder(*self.input_types)
+        self._decoder = registry.get_tuple_decoder(*self.output_types)
+
+    def encode(self, *args) -> bytes:
+        """calldata = 选择器 + 参数编码"""
+        return self.selector + self._encoder(args)
+
+    def decode(self, data: bytes) -> Tuple[Any, ...]:
+        """解码返回值（元组）"""
+        return self._decoder(default_codec.stream_class(data))
+
+
+def _build_hot_calls() -> Dict[str, HotCall]:
+    fragments = {f["name"]: f for f in load_abi() if f.get("type") == "function"}
+    return {name: HotCall(fragments[name]) for name in HOT_FUNCTIONS if name in fragments}
+
+
+BUYER_WALLET_ABI: List[Dict[str, Any]] = list(load_abi())
+HOT_CALLS = _build_hot_calls()
+
+
+def _abi_string(value: str) -> bytes:
+    data = value.encode()
+    return len(data).to_bytes(32, "big") + data + b"\x00" * (-len(data) % 32)
+
+
+def x402_payment_hash(info: X402PaymentInfo) -> bytes:
+    """
+    与合约 getX402PaymentHash 相同的支付哈希（发送 payX402 之前即可得到）
+
+    直接拼接 abi.encode(string, address, uint256, string, uint256, uint256) 的字节，
+    不经过 eth_abi 的类型分派（WalletModel 每笔 x402 支付都要计算一次）。
+
+    Raises:
+        ValueError: 地址格式错误或整数超出 uint256
+    """
+    recipient = bytes.fromhex(info.recipient[2:])
+    if len(recipient) != 20:
+        raise ValueError(f"invalid address: {info.recipient}")
+    agent_id = _abi_string(info.agent_id)
+    try:
+        head = b"".join((
+            _X402_AGENT_OFFSET, bytes(12), recipient, info.amount.to_bytes(32, "big"),
+            (192 + len(agent_id)).to_bytes(32, "big"), info.nonce.to_bytes(32, "big"),
+            info.expiry.to_bytes(32, "big"),
+        ))
+    except OverflowError:
+        raise ValueError("x402 payment integer out of uint256 range") from None
+    return keccak(head + agent_id + _abi_string(info.api_endpoint))
+
+
+# ============ EIP-712 Agent 授权 ============
+
+@lru_cache(maxsize=64)
+def domain_separator(chain_id: int, wallet_address: str) -> bytes:
+    """合约 DOMAIN_SEPARATOR()（每个 (链ID, 合约地址) 只计算一次）"""
+    return keccak(encode(
+        ["bytes32", "bytes32", "bytes32", "uint256", "address"],
+        [_DOMAIN_TYPEHASH, keccak(text=EIP712_NAME), keccak(text=EIP712_VERSION), chain_id, wallet_address],
+    ))
+
+
+def agent_payment_digest(domain: bytes, agent_id: str, recipient: str, amount: int, metadata: str,
+                         nonce: int, deadline: int) -> bytes:
+    """与合约 getAgentPaymentDigest 相同的待签名摘要"""
+    struct_hash = keccak(encode(
+        ["bytes32", "bytes32", "address", "uint256", "bytes32", "uint256", "uint256"],
+        [_AGENT_PAYMENT_TYPEHASH, keccak(text=agent_id), recipient, amount, keccak(text=metadata), nonce, deadline],
+    ))
+    return keccak(b"\x19\x01" + domain + struct_hash)
+
+
+def agent_payment_typed_data(chain_id: int, wallet_address: str, agent_id: str, recipient: str, amount: int,
+                             metadata: str, nonce: int, deadline: int) -> Dict[str, Any]:
+    """eth_signTypedData_v4 格式的授权（供钱包或外部签名器使用）"""
+    return {
+        "types": {
+            "EIP712Domain": [
+                {"name": "name", "type": "string"},
+                {"name": "version", "type": "string"},
+                {"name": "chainId", "type": "uint256"},
+                {"name": "verifyingContract", "type": "address"},
+            ],
+            "AgentPayment": [
+                {"name": "agentId", "type": "string"},
+                {"name": "recipient", "type": "address"},
+                {"name": "amount", "type": "uint256"},
+                {"name": "metadata", "type": "string"},
+                {"name": "nonce", "type": "uint256"},
+                {"name": "deadline", "type": "uint256"},
+            ],
+        },
+        "primaryType": "AgentPayment",
+        "domain": {"name": EIP712_NAME, "version": EIP712_VERSION, "chainId": chain_id,
+                   "verifyingContract": wallet_address},
+        "message": {"agentId": agent_id, "recipient": recipient, "amount": amount, "metadata": metadata,
+                    "nonce": nonce, "deadline": deadline},
+    }
+
+
+class AgentSigner:
+    """Agent 支付授权签名器（域分隔符预先计算，适合批量预签）"""
+
+    def __init__(self, private_key, chain_id: int, wallet_address: str):
+        self.account = Account.from_key(private_key)
+        self.domain = domain_separator(chain_id, to_checksum_address(wallet_address))
+
+    @property
+    def address(self) -> str:
+        return self.account.address
+
+    def sign(self, agent_id: str, recipient: str, amount: int, metadata: str, nonce: int, deadline: int) -> bytes:
+        """签名一笔授权，返回 r + s + v（65字节）"""
+        digest = agent_payment_digest(self.domain, agent_id, recipient, amount, metadata, nonce, deadline)
+        return bytes(self.account.unsafe_sign_hash(digest).signature)
+
+    def sign_x402(self, info: X402PaymentInfo) -> bytes:
+        """payX402 的授权：metadata 为 API 端点，deadline 为 expiry"""
+        return self.sign(info.agent_id, info.recipient, info.amount, info.api_endpoint, info.nonce, info.expiry)
+
+
+def _hash_bytes(payment_hash) -> bytes:
+    if isinstance(payment_hash, str):
+        return bytes.fromhex(payment_hash[2:] if payment_hash.startswith(("0x", "0X")) else payment_hash)
+    return payment_hash
+
+
+@lru_cache(maxsize=64)
+def get_contract(w3: Web3, address: str):
+    """同一 (Web3, 地址) 共享一个合约对象"""
+    return w3.eth.contract(address=address, abi=BUYER_WALLET_ABI)
+
+
+def _call_params(address: str, call: HotCall, args, block) -> list:
+    return [{"to": address, "data": "0x" + call.encode(*args).hex()}, block]
+
+
+def _result(call: HotCall, response: Dict[str, Any]) -> Tuple[Any, ...]:
+    if "error" in response:
+        raise RawCallError(f"{call.name} failed: {response['error']}")
+    result = response.get("result") or "0x"
+    return call.decode(bytes.fromhex(result[2:]))
+
+
+class BuyerWalletClient:
+    """BuyerWallet 只读调用的快速路径（同步 Web3 或 AsyncWeb3）"""
+
+    def __init__(self, w3, address: str):
+        self.w3 = w3
+        self.address = address
+
+    def call_raw(self, name: str, *args, block: str = "latest") -> Tuple[Any, ...]:
+        """
+        直接发送 eth_call 并用预构建的解码器解析返回值
+
+        Raises:
+            RawCallError: 节点返回错误或合约 revert
+        """
+        call = HOT_CALLS[name]
+        response = self.w3.provider.make_request("eth_call", _call_params(self.address, call, args, block))
+        return _result(call, response)
+
+    async def call_raw_async(self, name: str, *args, block: str = "latest") -> Tuple[Any, ...]:
+        """call_raw 的 AsyncWeb3 版本"""
+        call = HOT_CALLS[name]
+        response = await self.w3.provider.make_request("eth_call", _call_params(self.address, call, args, block))
+        return _result(call, response)
+
+    def get_today_spending(self, agent_id: str) -> int:
+        return self.call_raw("getTodaySpending", agent_id)[0]
+
+    def get_payment_rules(self, agent_id: str) -> Tuple[int, int, bool]:
+        """(dailyLimit, transactionLimit, enabled)"""
+        return self.call_raw("getPaymentRules", agent_id)[0]
+
+    def get_nonce(self, agent_id: str) -> int:
+        return self.call_raw("agentNonces", agent_id)[0]
+
+    def get_agent_signer(self, agent_id: str) -> str:
+        """Agent 注册的签名地址（未注册时为零地址）"""
+        return self.call_raw("agents", agent_id)[2]
+
+    def get_x402_proof(self, payment_hash) -> X402PaymentProof:
+        """读取链上记录的x402支付证明（不存在时各字段为零值）"""
+        return X402PaymentProof.from_abi(self.call_raw("verifyX402Payment", _hash_bytes(payment_hash))[0])
+
+    def get_x402_proofs(self, payment_hashes: Iterable) -> List[X402PaymentProof]:
+        """一次 eth_call 读取多笔支付证明，顺序与输入一致"""
+        (proofs,) = self.call_raw("verifyX402Payments", [_hash_bytes(h) for h in payment_hashes])
+        return [X402PaymentProof.from_abi(p) for p in proofs]
+
+    async def get_x402_proofs_async(self, payment_hashes: Iterable) -> List[X402PaymentProof]:
+        """get_x402_proofs 的 AsyncWeb3 版本"""
+        (proofs,) = await self.call_raw_async("verifyX402Payments", [_hash_bytes(h) for h in payment_hashes])
+        return [X402PaymentProof.from_abi(p) for p in proofs]
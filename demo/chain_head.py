@@ -0,0 +1,231 @@
+"""
+ACPay Chain Head - 进程内共享的链头跟踪器
+
+通过 WebSocket 订阅 newHeads；没有配置 WebSocket 地址或连接失败时，
+退回到自适应间隔的 HTTP 轮询。最新区块号与时间戳发布给进程内的订阅者
+（缓存失效、收据等待、日期滚动等），用一条数据流替代各处独立的轮询。
+
+    tracker = get_tracker(INJECTIVE_TESTNET_RPC, ws_url)
+    tracker.subscribe(lambda head: cache.clear())
+    tracker.now()            # 按链上时间估算的当前时间戳
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from web3 import AsyncWeb3, Web3, WebSocketProvider
+from web3.exceptions import TransactionNotFound
+
+from resilience import ResilientHTTPProvider
+
+logger = logging.getLogger(__name__)
+
+SECONDS_PER_DAY = 86400
+
+
+class ChainHead(NamedTuple):
+    """最新区块头"""
+    number: int
+    timestamp: int
+    hash: str
+    received_at: float  # 本地 time.monotonic()
+
+
+class ChainHeadTracker:
+    """链头跟踪器（后台线程）"""
+
+    def __init__(self, rpc_url: str, ws_url: Optional[str] = None,
+                 min_poll_interval: float = 0.25, max_poll_interval: float = 5.0,
+                 ws_stall_timeout: float = 30.0, ws_retry_interval: float = 60.0):
+        """
+        Args:
+            rpc_url: HTTP RPC地址（轮询用）
+            ws_url: WebSocket RPC地址（可选）
+            min_poll_interval / max_poll_interval: 轮询间隔范围（秒）
+            ws_stall_timeout: WebSocket 超过该时间无新区块则切换到轮询
+            ws_retry_interval: 切换到轮询后多久重试 WebSocket
+        """
+        self.rpc_url = rpc_url
+        self.ws_url = ws_url
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.ws_stall_timeout = ws_stall_timeout
+        self.ws_retry_interval = ws_retry_interval
+
+        self._latest: Optional[ChainHead] = None
+        self._block_time = 1.0  # 出块间隔估计（EWMA）
+        self._poll_interval = min_poll_interval
+        self._ws_retry_at = 0.0
+        self._subscribers: List[Callable[[ChainHead], None]] = []
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._w3: Optional[Web3] = None
+
+    # ============ 查询 ============
+
+    @property
+    def latest(self) -> Optional[ChainHead]:
+        return self._latest
+
+    @property
+    def source(self) -> str:
+        """当前数据来源：websocket / polling"""
+        return "websocket" if self.ws_url and time.monotonic() >= self._ws_retry_at else "polling"
+
+    def now(self) -> float:
+        """按最新区块时间戳外推的链上当前时间；尚无区块时使用本地时间"""
+        head = self._latest
+        if head is None:
+            return time.time()
+        return head.timestamp + (time.monotonic() - head.received_at)
+
+    def today(self) -> int:
+        """链上日期索引（与合约中 block.timestamp / 86400 一致）"""
+        return int(self.now()) // SECONDS_PER_DAY
+
+    def subscribe(self, callback: Callable[[ChainHead], None]) -> Callable[[], None]:
+        """订阅新区块，返回取消订阅函数；回调在跟踪线程中执行，应尽量轻量"""
+        with self._cond:
+            self._subscribers.append(callback)
+
+        def unsubscribe():
+            with self._cond:
+                if callback in self._subscribers:
+                    self._subscribers.remove(callback)
+        return unsubscribe
+
+    def wait_for_block(self, after: Optional[int] = None, timeout: Optional[float] = None) -> Optional[ChainHead]:
+        """
+        等待区块号大于 after（默认当前最新区块）的新区块
+
+        Returns:
+            新区块头，超时返回 None
+        """
+        with self._cond:
+            if after is None:
+                after = self._latest.number if self._latest else -1
+            ok = self._cond.wait_for(
+                lambda: self._latest is not None and self._latest.number > after, timeout
+            )
+            return self._latest if ok else None
+
+    # ============ 生命周期 ============
+
+    def start(self) -> "ChainHeadTracker":
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="chain-head", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    # ============ 内部实现 ============
+
+    def _publish(self, number: int, timestamp: int, block_hash) -> None:
+        if not isinstance(block_hash, str):
+            block_hash = Web3.to_hex(block_hash)
+        head = ChainHead(number, timestamp, block_hash, time.monotonic())
+        with self._cond:
+            previous = self._latest
+            if previous is not None and number <= previous.number:
+                return
+            if previous is not None and timestamp > previous.timestamp:
+                observed = (timestamp - previous.timestamp) / (number - previous.number)
+                self._block_time = 0.8 * self._block_time + 0.2 * observed
+            self._latest = head
+            subscribers = list(self._subscribers)
+            self._cond.notify_all()
+        for callback in subscribers:
+            try:
+                callback(head)
+            except Exception:
+                logger.exception("chain head subscriber failed")
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            if self.ws_url and time.monotonic() >= self._ws_retry_at:
+                try:
+                    asyncio.run(self._stream_websocket())
+                except Exception as e:
+                    logger.warning("newHeads subscription failed, falling back to polling: %s", e)
+                    self._ws_retry_at = time.monotonic() + self.ws_retry_interval
+                continue
+            self._poll_once()
+            self._stop.wait(self._poll_interval)
+
+    async def _stream_websocket(self) -> None:
+        async with AsyncWeb3(WebSocketProvider(self.ws_url)) as w3:
+            await w3.eth.subscribe("newHeads")
+            logger.info("subscribed to newHeads via %s", self.ws_url)
+            stream = w3.socket.process_subscriptions().__aiter__()
+            while not self._stop.is_set():
+                message = await asyncio.wait_for(stream.__anext__(), self.ws_stall_timeout)
+                header = message["result"]
+                self._publish(int(header["number"]), int(header["timestamp"]), header["hash"])
+
+    def _poll_once(self) -> None:
+        try:
+            if self._w3 is None:
+                self._w3 = Web3(ResilientHTTPProvider(self.rpc_url))
+            block = self._w3.eth.get_block("latest")
+        except Exception as e:
+            logger.warning("chain head poll failed: %s", e)
+            self._poll_interval = min(self._poll_interval * 2, self.max_poll_interval)
+            return
+
+        previous = self._latest
+        self._publish(block["number"], block["timestamp"], block["hash"])
+        if previous is None or block["number"] > previous.number:
+            # 新区块：按出块间隔的一半轮询
+            self._poll_interval = min(max(self._block_time / 2, self.min_poll_interval), self.max_poll_interval)
+        else:
+            self._poll_interval = min(self._poll_interval * 1.5, self.max_poll_interval)
+
+
+_trackers: Dict[Tuple[str, Optional[str]], ChainHeadTracker] = {}
+_trackers_lock = threading.Lock()
+
+
+def get_tracker(rpc_url: str, ws_url: Optional[str] = None, start: bool = True) -> ChainHeadTracker:
+    """获取进程内共享的跟踪器（同一 RPC 地址只建立一条连接）"""
+    key = (rpc_url, ws_url)
+    with _trackers_lock:
+        tracker = _trackers.get(key)
+        if tracker is None:
+            tracker = _trackers[key] = ChainHeadTracker(rpc_url, ws_url)
+    if start:
+        tracker.start()
+    return tracker
+
+
+def wait_for_receipt(w3: Web3, tx_hash, tracker: ChainHeadTracker, timeout: float = 120):
+    """
+    等待交易收据：每个新区块只查询一次，替代 wait_for_transaction_receipt 的固定间隔轮询
+
+    Raises:
+        TimeoutError: 超时仍未上链
+    """
+    deadline = time.monotonic() + timeout
+    after = None
+    while True:
+        try:
+            receipt = w3.eth.get_transaction_receipt(tx_hash)
+            if receipt is not None:
+                return receipt
+        except TransactionNotFound:
+            pass
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"transaction {tx_hash!r} not mined within {timeout}s")
+        head = tracker.wait_for_block(after, timeout=remaining)
+        if head is None:
+            raise TimeoutError(f"transaction {tx_hash!r} not mined within {timeout}s")
+        after = head.number
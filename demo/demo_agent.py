@@ -17,6 +17,11 @@ from dataclasses import dataclass
 from datetime import datetime
 import logging
 
+from buyer_wallet import get_contract
+from spending_ledger import SpendingLedger, REASON_NAMES, REASON_TRANSACTION_LIMIT, REASON_DAILY_LIMIT
+from x402_metrics import METRICS
+from x402_quotes import QuoteCache
+
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -27,6 +32,36 @@ BUYER_WALLET_ADDRESS = "0x14ebB18cA52796a3c1A68FfC0E74374CD735f74A"
 USDT_ADDRESS = "0xaDC7bcB5d8fe053Ef19b4E0C861c262Af6e0db60"
 DEMO_API_BASE = "http://localhost:5001"
 
+# 所有演示Agent共享一个RPC连接（合约对象由 get_contract 按连接缓存）
+DEMO_W3 = Web3(Web3.HTTPProvider(INJECTIVE_TESTNET_RPC))
+
+# 所有演示Agent共享一个HTTP连接池：402探价与带证明的重试复用同一个持久连接
+HTTP_POOL_SIZE = int(os.getenv("ACPAY_HTTP_POOL", "32"))
+DEMO_HTTP = requests.Session()
+DEMO_HTTP.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE))
+DEMO_HTTP.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE))
+
+# 演示服务报价缓存（所有Agent共享，按ETag重新验证）
+DEMO_QUOTES = QuoteCache(f"{DEMO_API_BASE}/demo/services", session=DEMO_HTTP)
+
+# 默认支付规则（与合约部署参数一致）
+DEFAULT_DAILY_LIMIT = 100 * 10**6  # 100 USDT
+DEFAULT_TX_LIMIT = 10 * 10**6      # 10 USDT
+
+# 为了演示不同场景，各Agent预置的今日消费
+SIMULATED_DAILY_SPENDING = {
+    'weather-agent': 0,          # 0 USDT - 正常支付
+    'ai-agent': 2000000,         # 2 USDT - 中等价格测试
+    'premium-agent': 0,          # 0 USDT - 单笔限额测试
+    'bulk-agent': 80000000,      # 80 USDT - 日限额测试（80+25=105 > 100）
+}
+
+# 演示用本地消费账本（模拟合约中的规则与日消费记录）
+DEMO_LEDGER = SpendingLedger()
+for _agent_id, _spent in SIMULATED_DAILY_SPENDING.items():
+    DEMO_LEDGER.register(_agent_id, DEFAULT_DAILY_LIMIT, DEFAULT_TX_LIMIT)
+    DEMO_LEDGER.set_spending(_agent_id, _spent)
+
 @dataclass
 class DemoScenario:
     """演示场景配置"""
@@ -68,57 +103,15 @@ DEMO_SCENARIOS = [
     )
 ]
 
-# 简化的合约ABI
-BUYER_WALLET_ABI = [
-    {
-        "inputs": [
-            {"name": "_agentId", "type": "string"},
-            {"name": "_recipient", "type": "address"},
-            {"name": "_amount", "type": "uint256"},
-            {"name": "_metadata", "type": "string"},
-            {"name": "_signature", "type": "bytes"},
-            {"name": "_nonce", "type": "uint256"}
-        ],
-        "name": "payByAgent",
-        "outputs": [],
-        "stateMutability": "nonpayable",
-        "type": "function"
-    },
-    {
-        "inputs": [
-            {"name": "_agentId", "type": "string"}
-        ],
-        "name": "getTodaySpending",
-        "outputs": [{"name": "", "type": "uint256"}],
-        "stateMutability": "view",
-        "type": "function"
-    },
-    {
-        "inputs": [
-            {"name": "_agentId", "type": "string"}
-        ],
-        "name": "getPaymentRules",
-        "outputs": [
-            {
-                "components": [
-                    {"name": "dailyLimit", "type": "uint256"},
-                    {"name": "transactionLimit", "type": "uint256"},
-                    {"name": "enabled", "type": "bool"}
-                ],
-                "name": "",
-                "type": "tuple"
-            }
-        ],
-        "stateMutability": "view",
-        "type": "function"
-    }
-]
 
 class DemoAgent:
     """演示Agent类"""
     
-    def __init__(self, agent_id: str, private_key: str = None):
+    def __init__(self, agent_id: str, private_key: str = None, quotes: Optional[QuoteCache] = None,
+                 http: Optional[requests.Session] = None):
         self.agent_id = agent_id
+        self.quotes = quotes
+        self.http = http or DEMO_HTTP
         
         # 如果没有提供私钥，生成一个演示用的
         if not private_key:
@@ -127,13 +120,10 @@ class DemoAgent:
             private_key = hashlib.sha256(seed.encode()).hexdigest()
         
         self.account = Account.from_key(private_key)
-        self.w3 = Web3(Web3.HTTPProvider(INJECTIVE_TESTNET_RPC))
+        self.w3 = DEMO_W3
         
         # 初始化合约
-        self.contract = self.w3.eth.contract(
-            address=BUYER_WALLET_ADDRESS,
-            abi=BUYER_WALLET_ABI
-        )
+        self.contract = get_contract(self.w3, BUYER_WALLET_ADDRESS)
         
         logger.info(f"🤖 初始化演示Agent: {agent_id}")
         logger.info(f"📝 签名地址: {self.account.address}")
@@ -142,34 +132,56 @@ class DemoAgent:
                                   data: Dict = None) -> Tuple[bool, Dict[str, Any]]:
         """
         调用支持x402协议的API
+        
+        报价已缓存时先按 ETag 确认报价仍然有效，再预付并在首个请求中附带支付证明；
+        服务端仍返回402时按该响应中的报价处理：与预付的金额和收款方相同则复用预付的支付，
+        不同则作废预付后按新报价支付（每次调用最多支付一次有效报价）
         """
         url = f"{DEMO_API_BASE}{endpoint}"
         
         logger.info(f"🌐 Agent {self.agent_id} 调用API: {endpoint}")
         
         try:
-            # 第一次调用，预期收到402响应
-            if method == "GET":
-                response = requests.get(url)
+            # 预付前确认报价（通常为304），确认失败则走402流程
+            quote = self.quotes.revalidate(endpoint) if self.quotes else None
+            prepaid = None
+            if quote is not None:
+                result, response, prepaid = self._call_with_quote(url, quote, method, data)
+                if result is not None:
+                    return result
             else:
-                response = requests.post(url, json=data)
+                # 第一次调用，预期收到402响应
+                with METRICS.span("agent_request"):
+                    response = self._request(url, method, data)
             
             if response.status_code == 402:
                 # 收到402响应，解析支付信息
                 payment_info = response.json()
+                if 'payment_info' not in payment_info:
+                    # 支付本身被拒绝（不是报价）：不再重复支付
+                    logger.error(f"❌ 支付被拒绝: {payment_info.get('error')}")
+                    return False, payment_info
                 logger.info(f"📨 收到402响应: 需要支付 {payment_info['service']['price']}")
                 
-                # 模拟支付过程
-                payment_result = self.simulate_payment(payment_info)
+                quoted = payment_info['payment_info']
+                if prepaid and (prepaid['amount'], prepaid['recipient'].lower()) == \
+                        (quoted['amount'], quoted['recipient'].lower()):
+                    # 报价未变：复用预付的支付，不再支付第二次
+                    logger.info(f"♻️  复用预付的支付: {prepaid['payment_hash'][:10]}...")
+                    payment_result = prepaid
+                else:
+                    if prepaid:
+                        METRICS.inc("quote_prepay_voided")
+                        logger.warning(f"⚠️  预付与最新报价不一致，作废预付: {prepaid['payment_hash'][:10]}...")
+                    # 模拟支付过程
+                    payment_result = self.simulate_payment(payment_info)
                 
                 if payment_result['success']:
                     # 支付成功，重新调用API
-                    headers = {'X-Payment-Hash': payment_result['payment_hash']}
+                    headers = {'X-Payment-Hash': payment_result['payment_hash'], 'X-Agent-ID': self.agent_id}
                     
-                    if method == "GET":
-                        response = requests.get(url, headers=headers)
-                    else:
-                        response = requests.post(url, json=data, headers=headers)
+                    with METRICS.span("agent_retry"):
+                        response = self._request(url, method, data, headers)
                     
                     if response.status_code == 200:
                         logger.info(f"✅ API调用成功，服务已获取")
@@ -195,6 +207,47 @@ class DemoAgent:
             logger.error(f"❌ API调用异常: {e}")
             return False, {"error": "网络异常", "details": str(e)}
     
+    def _call_with_quote(self, url: str, quote, method: str, data: Dict = None
+                         ) -> Tuple[Optional[Tuple[bool, Dict[str, Any]]], Optional[requests.Response], Optional[Dict]]:
+        """
+        按缓存报价预付并调用API（省去402探价往返）
+        
+        Returns:
+            (调用结果, 响应, 预付的支付)；服务端仍要求支付时调用结果为None，
+            由调用方按该402响应决定复用还是作废预付的支付
+        """
+        logger.info(f"⚡ 使用缓存报价预付: {quote.amount / 10**6} {quote.currency}")
+        payment_result = self.simulate_payment({
+            'payment_info': {'amount': quote.amount, 'recipient': quote.recipient, 'endpoint': quote.endpoint}
+        })
+        if not payment_result['success']:
+            logger.warning(f"⚠️  支付失败: {payment_result['error']}")
+            return (False, payment_result), None, None
+        
+        headers = {'X-Payment-Hash': payment_result['payment_hash'], 'X-Agent-ID': self.agent_id}
+        with METRICS.span("agent_request"):
+            response = self._request(url, method, data, headers)
+        
+        if response.status_code == 200:
+            METRICS.inc("quote_prepaid")
+            logger.info(f"✅ API调用成功（预付）")
+            return (True, response.json()), response, payment_result
+        if response.status_code == 402:
+            METRICS.inc("quote_mismatch")
+            logger.warning(f"⚠️  预付未被接受，按402响应处理")
+            self.quotes.invalidate()
+            return None, response, payment_result
+        
+        logger.error(f"❌ 预付后API调用失败: {response.status_code}")
+        return (False, {"error": f"HTTP {response.status_code}", "details": response.text}), response, payment_result
+    
+    def _request(self, url: str, method: str, data: Dict = None,
+                 headers: Optional[Dict[str, str]] = None) -> requests.Response:
+        if method == "GET":
+            return self.http.get(url, headers=headers)
+        return self.http.post(url, json=data, headers=headers)
+    
+    @METRICS.timed("agent_pay")
     def simulate_payment(self, payment_info: Dict) -> Dict[str, Any]:
         """
         模拟智能合约支付过程
@@ -243,36 +296,45 @@ class DemoAgent:
         检查支付规则（模拟智能合约规则检查）
         """
         try:
-            # 模拟获取规则（实际应用中从合约读取）
-            default_daily_limit = 100 * 10**6  # 100 USDT
-            default_tx_limit = 10 * 10**6      # 10 USDT
+            if self.agent_id not in DEMO_LEDGER:
+                DEMO_LEDGER.register(self.agent_id, DEFAULT_DAILY_LIMIT, DEFAULT_TX_LIMIT)
             
-            # 模拟今日已消费（在实际应用中从合约读取）
+            row = DEMO_LEDGER.index_of([self.agent_id])[0]
+            daily_limit = int(DEMO_LEDGER.daily_limit[row])
+            tx_limit = int(DEMO_LEDGER.transaction_limit[row])
             today_spent = self.get_simulated_daily_spending()
             
-            logger.info(f"📊 规则检查 - 单笔限额: {default_tx_limit / 10**6} USDT, 日限额: {default_daily_limit / 10**6} USDT")
+            logger.info(f"📊 规则检查 - 单笔限额: {tx_limit / 10**6} USDT, 日限额: {daily_limit / 10**6} USDT")
             logger.info(f"📊 今日已消费: {today_spent / 10**6} USDT, 本次金额: {amount / 10**6} USDT")
             
-            # 检查单笔限额
-            if amount > default_tx_limit:
+            allowed, reasons = DEMO_LEDGER.check([self.agent_id], [amount])
+            reason = int(reasons[0])
+            
+            if reason == REASON_TRANSACTION_LIMIT:
                 return {
                     'allowed': False,
-                    'reason': f'超出单笔限额: {amount / 10**6} > {default_tx_limit / 10**6} USDT',
+                    'reason': f'超出单笔限额: {amount / 10**6} > {tx_limit / 10**6} USDT',
                     'limit_type': 'transaction_limit'
                 }
             
-            # 检查日限额
-            if today_spent + amount > default_daily_limit:
+            if reason == REASON_DAILY_LIMIT:
                 return {
                     'allowed': False,
-                    'reason': f'超出日限额: {(today_spent + amount) / 10**6} > {default_daily_limit / 10**6} USDT',
+                    'reason': f'超出日限额: {(today_spent + amount) / 10**6} > {daily_limit / 10**6} USDT',
                     'limit_type': 'daily_limit'
                 }
             
+            if not allowed[0]:
+                return {
+                    'allowed': False,
+                    'reason': f'支付规则拒绝: {REASON_NAMES[reason]}',
+                    'limit_type': REASON_NAMES[reason]
+                }
+            
             return {
                 'allowed': True,
-                'remaining_daily': default_daily_limit - today_spent - amount,
-                'remaining_tx': default_tx_limit - amount
+                'remaining_daily': daily_limit - today_spent - amount,
+                'remaining_tx': tx_limit - amount
             }
             
         except Exception as e:
@@ -286,16 +348,9 @@ class DemoAgent:
     def get_simulated_daily_spending(self) -> int:
         """
         模拟获取今日消费金额
-        为了演示不同场景，根据agent_id返回不同的模拟值
+        从演示账本读取，跨日后自动归零
         """
-        spending_map = {
-            'weather-agent': 0,          # 0 USDT - 正常支付
-            'ai-agent': 2000000,         # 2 USDT - 中等价格测试
-            'premium-agent': 0,          # 0 USDT - 单笔限额测试
-            'bulk-agent': 80000000,      # 80 USDT - 日限额测试（80+25=105 > 100）
-        }
-        
-        return spending_map.get(self.agent_id, 0)
+        return int(DEMO_LEDGER.today_spending([self.agent_id])[0])
     
     def generate_mock_payment_hash(self, amount: int, recipient: str, endpoint: str) -> str:
         """
@@ -310,7 +365,7 @@ class DemoAgent:
         获取消费状态
         """
         today_spent = self.get_simulated_daily_spending()
-        daily_limit = 100 * 10**6  # 100 USDT
+        daily_limit = DEFAULT_DAILY_LIMIT
         
         return {
             'agent_id': self.agent_id,
@@ -331,7 +386,7 @@ def run_demo_scenario(scenario: DemoScenario) -> None:
     print(f"{'='*60}")
     
     # 创建演示Agent
-    agent = DemoAgent(scenario.agent_id)
+    agent = DemoAgent(scenario.agent_id, quotes=DEMO_QUOTES)
     
     # 显示Agent状态
     status = agent.get_spending_status()
@@ -383,7 +438,7 @@ def main():
     
     # 检查API服务器
     try:
-        response = requests.get(f"{DEMO_API_BASE}/demo/status")
+        response = DEMO_HTTP.get(f"{DEMO_API_BASE}/demo/status")
         if response.status_code == 200:
             print("✅ API服务器正在运行")
         else:
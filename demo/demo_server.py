@@ -8,14 +8,23 @@ import os
 import json
 import time
 import hashlib
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, request, jsonify, make_response, has_request_context
 from web3 import Web3
 from typing import Dict, Any, Optional
 from datetime import datetime
+from urllib.parse import quote
 import logging
 
-# 配置日志
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from x402_headers import format_accept_payment
+from x402_cbor import CBOR_CONTENT_TYPE, encode_payment_required, wants_cbor
+from x402_metrics import METRICS, PROMETHEUS_CONTENT_TYPE
+from x402_logging import setup_async_logging
+from x402_sessions import SessionError, SessionManager, bearer_token, load_session_secret
+from response_cache import ResponseCache
+from admission import Admission
+import prefork
+from spending_analytics import DIMENSIONS, Payment, PaymentStore, parse_query
+
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
@@ -78,9 +87,43 @@ DEMO_SERVICES = {
     }
 }
 
+# 报价版本：价格或收款地址变化时改变，Agent 据此重新验证缓存的报价
+QUOTE_MAX_AGE = 60  # 秒
+SERVICES_ETAG = hashlib.sha256(json.dumps(
+    [SERVICE_RECIPIENT, {endpoint: [service['price'], service['currency']] for endpoint, service in DEMO_SERVICES.items()}],
+    sort_keys=True
+).encode()).hexdigest()[:16]
+
+# 已验证支付的本地索引与按日/小时聚合（ACPAY_PAYMENTS_DB 指定文件，默认内存）
+PAYMENTS = PaymentStore(os.getenv("ACPAY_PAYMENTS_DB", ":memory:"))
+
+# 预付会话：一次支付换取带余额的令牌（多副本需配置相同的 ACPAY_SESSION_SECRET）。
+# 每笔支付只能换取一次：换取前在 PAYMENTS 中占用支付哈希，ACPAY_PAYMENTS_DB 为文件时
+# 重启后仍然有效，共享同一文件的副本之间也不能重复换取；已用额度计数每个副本各一份
+SESSION_ENDPOINT = "/demo/session"
+SESSIONS = SessionManager(load_session_secret(), claim=PAYMENTS.claim)
+
+# 准入控制：按客户端IP / Agent ID / 端点限流，在任何验证与RPC之前拒绝超限请求
+ADMISSION = Admission(paths=[*DEMO_SERVICES, SESSION_ENDPOINT, '/demo/analytics/spending', '/demo/analytics/export.csv'])
+app.before_request(ADMISSION.flask_hook)
+
+# 幂等GET端点的响应内容缓存: 新鲜5秒，之后30秒内返回旧内容并后台刷新
+RESPONSE_CACHES = {
+    "/api/weather": ResponseCache(ttl=5, stale=30),
+    "/api/premium-data": ResponseCache(ttl=5, stale=30),
+}
+
+# 日志采样规则: 路由 -> (每N条保留1条, 每秒上限)
+# 演示速度下全部保留；压测时每个路由每秒最多写出200条
+LOG_SAMPLING = {endpoint: (1, 200) for endpoint in DEMO_SERVICES}
+
+# 配置日志（异步队列 + 结构化JSON，ACPAY_LOG_FORMAT=text 输出文本格式）
+setup_async_logging(level=logging.INFO, sampling=LOG_SAMPLING)
+
 # Web3连接
 w3 = Web3(Web3.HTTPProvider(INJECTIVE_TESTNET_RPC))
 
+@METRICS.timed("response_build")
 def create_x402_response(endpoint: str) -> tuple:
     """创建标准x402响应"""
     service = DEMO_SERVICES.get(endpoint)
@@ -91,14 +134,20 @@ def create_x402_response(endpoint: str) -> tuple:
     nonce = int(time.time() * 1000)
     expiry = int(time.time()) + 3600  # 1小时过期
     
+    # 协商为CBOR时只返回紧凑响应体（不含演示说明与Accept-Payment头部）
+    if wants_cbor(request.accept_mimetypes):
+        response = make_response(encode_payment_required(
+            SERVICE_RECIPIENT, service['price'], service['currency'], endpoint, nonce, expiry
+        ), 402)
+        response.content_type = CBOR_CONTENT_TYPE
+        response.vary.add('Accept')
+        logger.info("📨 返回402响应(CBOR): %s (%s USDT)", endpoint, service['price'] / 10**6,
+                    extra={"route": endpoint, "event": "payment_required", "price": service['price']})
+        return response
+    
     # 创建Accept-Payment头部
-    accept_payment = (
-        f"injective address={SERVICE_RECIPIENT} "
-        f"amount={service['price']} "
-        f"currency={service['currency']} "
-        f"endpoint={endpoint} "
-        f"nonce={nonce} "
-        f"expiry={expiry}"
+    accept_payment = format_accept_payment(
+        SERVICE_RECIPIENT, service['price'], service['currency'], endpoint, nonce, expiry
     )
     
     # 响应体包含详细的支付信息
@@ -129,11 +178,14 @@ def create_x402_response(endpoint: str) -> tuple:
     response = make_response(jsonify(response_data), 402)
     response.headers['Accept-Payment'] = accept_payment
     response.headers['Payment-Required'] = 'true'
-    response.headers['X-Demo-Service'] = service['name']
+    response.headers['X-Demo-Service'] = quote(service['name'])  # HTTP头部只能是latin-1
+    response.vary.add('Accept')
     
-    logger.info(f"📨 返回402响应: {endpoint} - {service['name']} ({service['price'] / 10**6} USDT)")
+    logger.info("📨 返回402响应: %s - %s (%s USDT)", endpoint, service['name'], service['price'] / 10**6,
+                extra={"route": endpoint, "event": "payment_required", "price": service['price']})
     return response
 
+@METRICS.timed("payment_verify")
 def verify_payment_mock(payment_hash: str, endpoint: str, expected_amount: int) -> bool:
     """
     模拟支付验证 - 演示用
@@ -141,41 +193,135 @@ def verify_payment_mock(payment_hash: str, endpoint: str, expected_amount: int)
     """
     # 演示模式：简单验证payment_hash格式
     if payment_hash and payment_hash.startswith('0x') and len(payment_hash) == 66:
-        logger.info(f"✅ 支付验证成功: {payment_hash[:10]}... for {endpoint}")
+        logger.info("✅ 支付验证成功: %s... for %s", payment_hash[:10], endpoint,
+                    extra={"route": endpoint, "event": "payment_verified"})
+        agent_id = request.headers.get('X-Agent-ID', '') if has_request_context() else ''
+        PAYMENTS.record(Payment(payment_hash.lower(), agent_id, SERVICE_RECIPIENT.lower(),
+                                endpoint, expected_amount, int(time.time())))
         return True
     
-    logger.warning(f"❌ 支付验证失败: {payment_hash} for {endpoint}")
+    METRICS.inc("verify_error")
+    logger.warning("❌ 支付验证失败: %s for %s", payment_hash, endpoint,
+                   extra={"route": endpoint, "event": "payment_rejected"})
     return False
 
+def build_weather_data() -> dict:
+    """天气数据的公共部分（可缓存）"""
+    service = DEMO_SERVICES["/api/weather"]
+    data = service['demo_data'].copy()
+    data['timestamp'] = datetime.now().isoformat()
+    data['service_cost'] = f"{service['price'] / 10**6} {service['currency']}"
+    return data
+
+def build_premium_data() -> dict:
+    """高级数据的公共部分（可缓存）"""
+    service = DEMO_SERVICES["/api/premium-data"]
+    data = service['demo_data'].copy()
+    data['timestamp'] = datetime.now().isoformat()
+    data['service_cost'] = f"{service['price'] / 10**6} {service['currency']}"
+    data['demo_note'] = "这是高价服务，用于测试单笔限额功能"
+    return data
+
+def cached_response(endpoint: str, build, **fields):
+    """按查询参数取缓存负载，拼接本次请求的字段后返回JSON响应"""
+    key = tuple(sorted(request.args.items(multi=True)))
+    body = RESPONSE_CACHES[endpoint].render(key, build, **fields)
+    return app.response_class(body, mimetype='application/json')
+
+def charge_session(price: int):
+    """
+    按 Authorization: Bearer 令牌扣费
+    
+    Returns:
+        (Charge, None)、(None, 错误响应)，请求未携带令牌时为 (None, None)
+    """
+    token = bearer_token(request.headers.get('Authorization'))
+    if token is None:
+        return None, None
+    try:
+        return SESSIONS.charge(token, price), None
+    except SessionError as e:
+        METRICS.inc(f"session_{e.code}")
+        status = {"insufficient": 402, "unavailable": 503}.get(e.code, 401)
+        return None, (jsonify({"error": "会话令牌不可用", "reason": e.code, "details": str(e)}), status)
+
+@app.route(SESSION_ENDPOINT, methods=['POST'])
+def create_session():
+    """用一笔批量支付换取预付会话令牌"""
+    payment_hash = request.headers.get('X-Payment-Hash')
+    data = request.get_json(silent=True) or {}
+    amount = data.get('amount')
+    
+    if not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0:
+        return jsonify({"error": "缺少或无效的预付金额 amount（最小单位整数）"}), 400
+    if not payment_hash:
+        return jsonify({"error": "缺少 X-Payment-Hash"}), 402
+    if not verify_payment_mock(payment_hash, SESSION_ENDPOINT, amount):
+        return jsonify({"error": "支付验证失败", "payment_hash": payment_hash}), 402
+    
+    try:
+        token, session = SESSIONS.mint(payment_hash, amount, data.get('agent_id', ''))
+    except SessionError as e:
+        METRICS.inc(f"session_{e.code}")
+        if e.code == "unavailable":
+            return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
+        return jsonify({"error": "该支付已换取过会话令牌", "payment_hash": payment_hash}), 402
+    logger.info("🎫 会话已创建: %s (%s USDT)", session.session_id.hex(), amount / 10**6,
+                extra={"route": SESSION_ENDPOINT, "event": "session_minted"})
+    return jsonify({
+        "token": token,
+        "session_id": session.session_id.hex(),
+        "balance": amount,
+        "remaining": SESSIONS.remaining(token),
+        "expires_at": session.expiry
+    })
+
+@app.route(SESSION_ENDPOINT, methods=['GET'])
+def session_status():
+    """查询会话令牌余额"""
+    token = bearer_token(request.headers.get('Authorization'))
+    if token is None:
+        return jsonify({"error": "缺少 Authorization: Bearer 令牌"}), 401
+    try:
+        session = SESSIONS.parse(token)
+        remaining = SESSIONS.remaining(token)
+    except SessionError as e:
+        return jsonify({"error": "会话令牌不可用", "reason": e.code, "details": str(e)}), 401
+    return jsonify({
+        "session_id": session.session_id.hex(),
+        "balance": session.balance,
+        "remaining": remaining,
+        "expires_at": session.expiry
+    })
+
 @app.route('/api/weather', methods=['GET'])
 def weather_api():
     """天气API - 需要2 USDT支付"""
     endpoint = "/api/weather"
     service = DEMO_SERVICES[endpoint]
     
-    # 检查支付证明
-    payment_hash = request.headers.get('X-Payment-Hash')
+    # 会话令牌优先：本地扣费，无需逐次验证支付
+    charge, rejected = charge_session(service['price'])
+    if rejected:
+        return rejected
+    
+    payment_hash = f"session:{charge.session_id}" if charge else request.headers.get('X-Payment-Hash')
     
     if not payment_hash:
         return create_x402_response(endpoint)
     
     # 验证支付
-    if not verify_payment_mock(payment_hash, endpoint, service['price']):
+    if not charge and not verify_payment_mock(payment_hash, endpoint, service['price']):
         return jsonify({
             "error": "支付验证失败",
             "payment_hash": payment_hash,
             "demo_note": "请确保支付hash格式正确(0x开头的66字符)"
         }), 402
     
-    # 返回天气数据
-    weather_data = service['demo_data'].copy()
-    weather_data['timestamp'] = datetime.now().isoformat()
-    weather_data['payment_verified'] = True
-    weather_data['payment_hash'] = payment_hash
-    weather_data['service_cost'] = f"{service['price'] / 10**6} {service['currency']}"
-    
-    logger.info(f"🌤️  天气数据已提供，支付: {payment_hash[:10]}...")
-    return jsonify(weather_data)
+    logger.info("🌤️  天气数据已提供，支付: %s...", payment_hash[:10], extra={"route": endpoint, "event": "served"})
+    # 返回天气数据（公共部分来自缓存，只拼接本次支付字段）
+    with METRICS.span("response_build"):
+        return cached_response(endpoint, build_weather_data, payment_verified=True, payment_hash=payment_hash)
 
 @app.route('/api/ai-chat', methods=['POST'])
 def ai_chat_api():
@@ -183,12 +329,17 @@ def ai_chat_api():
     endpoint = "/api/ai-chat"
     service = DEMO_SERVICES[endpoint]
     
-    payment_hash = request.headers.get('X-Payment-Hash')
+    # 会话令牌优先：本地扣费，无需逐次验证支付
+    charge, rejected = charge_session(service['price'])
+    if rejected:
+        return rejected
+    
+    payment_hash = f"session:{charge.session_id}" if charge else request.headers.get('X-Payment-Hash')
     
     if not payment_hash:
         return create_x402_response(endpoint)
     
-    if not verify_payment_mock(payment_hash, endpoint, service['price']):
+    if not charge and not verify_payment_mock(payment_hash, endpoint, service['price']):
         return jsonify({
             "error": "支付验证失败", 
             "payment_hash": payment_hash
@@ -206,8 +357,9 @@ def ai_chat_api():
     ai_data['payment_hash'] = payment_hash
     ai_data['service_cost'] = f"{service['price'] / 10**6} {service['currency']}"
     
-    logger.info(f"🤖 AI对话已完成，支付: {payment_hash[:10]}...")
-    return jsonify(ai_data)
+    logger.info("🤖 AI对话已完成，支付: %s...", payment_hash[:10], extra={"route": endpoint, "event": "served"})
+    with METRICS.span("response_build"):
+        return jsonify(ai_data)
 
 @app.route('/api/premium-data', methods=['GET'])
 def premium_data_api():
@@ -215,27 +367,26 @@ def premium_data_api():
     endpoint = "/api/premium-data"
     service = DEMO_SERVICES[endpoint]
     
-    payment_hash = request.headers.get('X-Payment-Hash')
+    # 会话令牌优先：本地扣费，无需逐次验证支付
+    charge, rejected = charge_session(service['price'])
+    if rejected:
+        return rejected
+    
+    payment_hash = f"session:{charge.session_id}" if charge else request.headers.get('X-Payment-Hash')
     
     if not payment_hash:
         return create_x402_response(endpoint)
     
-    if not verify_payment_mock(payment_hash, endpoint, service['price']):
+    if not charge and not verify_payment_mock(payment_hash, endpoint, service['price']):
         return jsonify({
             "error": "支付验证失败",
             "payment_hash": payment_hash
         }), 402
     
-    # 返回高级数据
-    data = service['demo_data'].copy()
-    data['timestamp'] = datetime.now().isoformat()
-    data['payment_verified'] = True
-    data['payment_hash'] = payment_hash
-    data['service_cost'] = f"{service['price'] / 10**6} {service['currency']}"
-    data['demo_note'] = "这是高价服务，用于测试单笔限额功能"
-    
-    logger.info(f"💎 高级数据已提供，支付: {payment_hash[:10]}...")
-    return jsonify(data)
+    logger.info("💎 高级数据已提供，支付: %s...", payment_hash[:10], extra={"route": endpoint, "event": "served"})
+    # 返回高级数据（公共部分来自缓存，只拼接本次支付字段）
+    with METRICS.span("response_build"):
+        return cached_response(endpoint, build_premium_data, payment_verified=True, payment_hash=payment_hash)
 
 @app.route('/api/bulk-service', methods=['POST'])
 def bulk_service_api():
@@ -243,12 +394,17 @@ def bulk_service_api():
     endpoint = "/api/bulk-service"
     service = DEMO_SERVICES[endpoint]
     
-    payment_hash = request.headers.get('X-Payment-Hash')
+    # 会话令牌优先：本地扣费，无需逐次验证支付
+    charge, rejected = charge_session(service['price'])
+    if rejected:
+        return rejected
+    
+    payment_hash = f"session:{charge.session_id}" if charge else request.headers.get('X-Payment-Hash')
     
     if not payment_hash:
         return create_x402_response(endpoint)
     
-    if not verify_payment_mock(payment_hash, endpoint, service['price']):
+    if not charge and not verify_payment_mock(payment_hash, endpoint, service['price']):
         return jsonify({
             "error": "支付验证失败",
             "payment_hash": payment_hash
@@ -262,8 +418,9 @@ def bulk_service_api():
     data['service_cost'] = f"{service['price'] / 10**6} {service['currency']}"
     data['demo_note'] = "这是超高价服务，用于测试日限额功能"
     
-    logger.info(f"📦 批量服务已启动，支付: {payment_hash[:10]}...")
-    return jsonify(data)
+    logger.info("📦 批量服务已启动，支付: %s...", payment_hash[:10], extra={"route": endpoint, "event": "served"})
+    with METRICS.span("response_build"):
+        return jsonify(data)
 
 @app.route('/demo/services', methods=['GET'])
 def list_demo_services():
@@ -274,11 +431,13 @@ def list_demo_services():
             "name": service['name'],
             "price": f"{service['price'] / 10**6} {service['currency']}",
             "price_wei": service['price'],
+            "amount": service['price'],
+            "currency": service['currency'],
             "description": service['description'],
             "demo_purpose": get_demo_purpose(service['price'])
         }
     
-    return jsonify({
+    response = jsonify({
         "services": services_info,
         "payment_recipient": SERVICE_RECIPIENT,
         "contract_address": BUYER_WALLET_ADDRESS,
@@ -291,6 +450,9 @@ def list_demo_services():
             "very_high_price": "25 USDT - 日限额测试"
         }
     })
+    response.set_etag(SERVICES_ETAG)
+    response.cache_control.max_age = QUOTE_MAX_AGE
+    return response.make_conditional(request)
 
 def get_demo_purpose(price: int) -> str:
     """根据价格返回演示目的"""
@@ -313,11 +475,43 @@ def demo_status():
         "contract": BUYER_WALLET_ADDRESS,
         "recipient": SERVICE_RECIPIENT,
         "services_count": len(DEMO_SERVICES),
+        "response_cache": {endpoint: cache.stats() for endpoint, cache in RESPONSE_CACHES.items()},
         "rpc_endpoint": INJECTIVE_TESTNET_RPC,
         "timestamp": datetime.now().isoformat(),
         "demo_ready": True
     })
 
+@app.route('/demo/analytics/spending', methods=['GET'])
+def spending_analytics():
+    """按日/小时的消费统计（只读本地聚合）"""
+    try:
+        query = parse_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({
+        "start": query['start'],
+        "end": query['end'],
+        "series": PAYMENTS.spending(**query),
+        "totals": PAYMENTS.totals(query['start'], query['end'], query['by'],
+                                  **{k: v for k, v in query.items() if k in DIMENSIONS})
+    })
+
+@app.route('/demo/analytics/export.csv', methods=['GET'])
+def spending_export():
+    """按时间桶聚合的消费CSV（流式）"""
+    args = request.args.to_dict()
+    args.setdefault('by', ','.join(DIMENSIONS))
+    try:
+        query = parse_query(args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return app.response_class(PAYMENTS.export_csv(**query), mimetype='text/csv')
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus指标"""
+    return METRICS.render(), 200, {'Content-Type': PROMETHEUS_CONTENT_TYPE}
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """健康检查"""
@@ -331,7 +525,7 @@ def not_found(error):
     return jsonify({
         "error": "API端点未找到",
         "available_endpoints": list(DEMO_SERVICES.keys()),
-        "demo_endpoints": ["/demo/services", "/demo/status", "/health"]
+        "demo_endpoints": ["/demo/services", "/demo/status", SESSION_ENDPOINT, "/health", "/metrics"]
     }), 404
 
 if __name__ == '__main__':
@@ -351,4 +545,9 @@ if __name__ == '__main__':
     print("  3. 日限额测试 (25 USDT)")
     print("=" * 60)
     
-    app.run(host='0.0.0.0', port=5001, debug=False) 
\ No newline at end of file
+    if prefork.DEFAULT_WORKERS > 1:
+        ADMISSION.share_memory()
+        SESSIONS.share_memory()
+        prefork.serve(app, '0.0.0.0', 5001, prefork.DEFAULT_WORKERS, on_start=PAYMENTS.reopen)
+    else:
+        app.run(host='0.0.0.0', port=5001, debug=False, request_handler=prefork.request_handler())
\ No newline at end of file
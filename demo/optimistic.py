@@ -0,0 +1,304 @@
+"""
+ACPay Optimistic Verification - 先服务、后验证的支付结算
+
+选择加入的廉价端点上，信誉良好的 Agent 携带支付证明时立即返回数据，
+链上验证交给后台线程池：
+
+    OPTIMISTIC = OptimisticVerifier(settle_payment, wallet.get_agent_signer)
+    if OPTIMISTIC.admit(agent_id, payment_hash, endpoint, amount):
+        ...  # 立即服务，验证在后台进行
+    elif (payer := verify_payment_agent(payment_hash, endpoint, amount)) == agent_id:
+        OPTIMISTIC.record_verified(agent_id, amount)
+
+只为链上证明的付款 Agent 累积信誉（声称的 Agent ID 与证明不符时不计）。
+信誉良好：同步验证成功至少 min_verified 次、链上签名地址已解析且未被拉黑、
+未结算敞口加本次金额不超过该 Agent 的风险上限、已验证的累计金额与全局上限
+（信誉按金额计：3 笔 5 USDT 的支付最多换来 15 USDT 的敞口）。
+
+后台验证失败时拉黑该 Agent 与其签名地址，金额计入损失；RPC 异常重试后仍失败
+只撤销信誉（敞口保持占用），不拉黑。被拉黑只意味着不再乐观服务，
+仍可走同步验证：冒用他人 Agent ID 最多造成一个风险上限的损失，且不会让对方无法付费。
+ACPAY_OPTIMISTIC=0 关闭乐观模式。
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from x402_metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RISK_CAP = int(os.getenv("ACPAY_OPTIMISTIC_RISK_CAP", str(20 * 10**6)))           # 每个Agent（20 USDT）
+DEFAULT_MAX_EXPOSURE = int(os.getenv("ACPAY_OPTIMISTIC_MAX_EXPOSURE", str(1_000 * 10**6)))  # 全部Agent合计
+DEFAULT_MIN_VERIFIED = int(os.getenv("ACPAY_OPTIMISTIC_MIN_VERIFIED", "3"))
+BLACKLIST_TTL = float(os.getenv("ACPAY_OPTIMISTIC_BLACKLIST_TTL", "86400"))  # 秒，0 为永久
+
+
+def load_caps(spec: Optional[str] = None) -> Dict[str, int]:
+    """
+    解析按 Agent 的风险上限："weather-agent=50000000,untrusted-agent=0"（默认读取 ACPAY_OPTIMISTIC_CAPS）
+
+    Raises:
+        ValueError: 格式错误
+    """
+    spec = os.getenv("ACPAY_OPTIMISTIC_CAPS", "") if spec is None else spec
+    caps = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        agent_id, sep, cap = item.rpartition("=")
+        if not sep or not agent_id or not cap.isdigit():
+            raise ValueError(f"invalid risk cap: {item!r}")
+        caps[agent_id] = int(cap)
+    return caps
+
+
+class Standing:
+    """一个 Agent 的信誉与未结算敞口"""
+
+    __slots__ = ("verified", "verified_value", "exposure", "signer", "resolving")
+
+    def __init__(self):
+        self.verified = 0        # 验证成功次数（同步 + 后台）
+        self.verified_value = 0  # 验证成功的累计金额，敞口不超过它
+        self.exposure = 0        # 已服务但未结算的金额
+        self.signer: Optional[str] = None   # 链上注册的签名地址（小写）
+        self.resolving = False
+
+
+class OptimisticVerifier:
+    """乐观服务的准入判断、敞口记账与后台结算"""
+
+    def __init__(self, settle: Callable[[str, str, str, int], bool],
+                 resolve_signer: Optional[Callable[[str], str]] = None, workers: int = 4,
+                 risk_cap: int = DEFAULT_RISK_CAP, max_exposure: int = DEFAULT_MAX_EXPOSURE,
+                 min_verified: int = DEFAULT_MIN_VERIFIED, blacklist_ttl: float = BLACKLIST_TTL,
+                 retries: int = 3, retry_delay: float = 1.0, caps: Optional[Dict[str, int]] = None,
+                 enabled: Optional[bool] = None):
+        """
+        Args:
+            settle: settle(payment_hash, agent_id, endpoint, amount) -> 证明是否有效；
+                RPC 失败时应抛出异常（会重试），而不是返回 False（会拉黑）
+            resolve_signer: 查询 Agent 链上签名地址；为 None 时不按签名地址拉黑
+            workers: 后台验证线程数
+            risk_cap: 每个 Agent 的默认风险上限（未结算金额，最小单位）
+            max_exposure: 全部 Agent 未结算金额之和的上限
+            min_verified: 获得乐观服务前需要的验证成功次数
+            blacklist_ttl: 拉黑时长（秒），0 为永久
+            retries, retry_delay: settle 抛出异常时的重试次数与退避基数（秒）
+            caps: 按 Agent 覆盖的风险上限（默认 load_caps()）
+            enabled: 默认读取 ACPAY_OPTIMISTIC（未设置时开启）
+        """
+        self.settle = settle
+        self.resolve_signer = resolve_signer
+        self.risk_cap = risk_cap
+        self.max_exposure = max_exposure
+        self.min_verified = min_verified
+        self.blacklist_ttl = blacklist_ttl
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.caps: Dict[str, int] = load_caps() if caps is None else dict(caps)
+        self.enabled = os.getenv("ACPAY_OPTIMISTIC", "1") != "0" if enabled is None else enabled
+
+        self.exposure = 0
+        self.settled = 0
+        self.losses = 0
+        self.unsettled = 0
+
+        self._standing: Dict[str, Standing] = {}
+        self._blacklist: Dict[tuple, float] = {}   # ("agent"|"signer", key) -> 到期时间（monotonic）
+        self._pending: Dict[str, int] = {}         # 后台验证中的支付哈希 -> 金额
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="optimistic")
+
+    # ============ 准入 ============
+
+    def admit(self, agent_id: Optional[str], payment_hash: str, endpoint: str, amount: int) -> bool:
+        """
+        信誉良好且未超出风险上限时预留敞口并提交后台验证
+
+        Returns:
+            True 表示可以立即服务；False 时调用方应同步验证
+        """
+        key = payment_hash.lower()
+        with self._lock:
+            reason = self._decline_reason(agent_id, key, amount)
+            if reason is None:
+                self._standing[agent_id].exposure += amount
+                self.exposure += amount
+                self._pending[key] = amount
+        if reason is not None:
+            METRICS.inc(f"optimistic_declined_{reason}")
+            return False
+        METRICS.inc("optimistic_served")
+        self._pool.submit(self._settle, agent_id, key, endpoint, amount)
+        return True
+
+    def record_verified(self, agent_id: Optional[str], amount: int) -> None:
+        """
+        同步验证成功：按金额累积信誉，首次时在后台解析签名地址
+
+        Args:
+            agent_id: 链上证明中的付款 Agent（不是请求声称的 Agent ID）
+            amount: 验证通过的金额
+        """
+        if not agent_id:
+            return
+        with self._lock:
+            standing = self._standing.setdefault(agent_id, Standing())
+            standing.verified += 1
+            standing.verified_value += amount
+            resolve = self.resolve_signer is not None and standing.signer is None and not standing.resolving
+            if resolve:
+                standing.resolving = True
+        if resolve:
+            self._pool.submit(self._resolve, agent_id)
+
+    def set_cap(self, agent_id: str, cap: int) -> None:
+        """覆盖单个 Agent 的风险上限（0 表示不再乐观服务）"""
+        with self._lock:
+            self.caps[agent_id] = cap
+
+    # ============ 黑名单 ============
+
+    def blacklist(self, agent_id: Optional[str] = None, signer: Optional[str] = None) -> None:
+        with self._lock:
+            self._add_blacklist(agent_id, signer)
+
+    def is_blacklisted(self, agent_id: str) -> bool:
+        with self._lock:
+            standing = self._standing.get(agent_id)
+            return self._blacklisted(agent_id, standing.signer if standing else None)
+
+    # ============ 查询 ============
+
+    def standing(self, agent_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            standing = self._standing.get(agent_id)
+            if standing is None:
+                return None
+            return {
+                "verified": standing.verified,
+                "verified_value": standing.verified_value,
+                "exposure": standing.exposure,
+                "risk_cap": self.caps.get(agent_id, self.risk_cap),
+                "signer": standing.signer,
+                "blacklisted": self._blacklisted(agent_id, standing.signer),
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "enabled": self.enabled,
+                "agents": len(self._standing),
+                "pending": len(self._pending),
+                "exposure": self.exposure,
+                "settled": self.settled,
+                "losses": self.losses,
+                "unsettled": self.unsettled,
+                "blacklisted": sum(1 for until in self._blacklist.values() if until > now),
+            }
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """等待全部后台验证结束；超时返回 False"""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
+
+    # ============ 内部实现 ============
+
+    def _decline_reason(self, agent_id: Optional[str], key: str, amount: int) -> Optional[str]:
+        """不能乐观服务的原因（持有锁时调用）"""
+        if not self.enabled:
+            return "disabled"
+        standing = self._standing.get(agent_id) if agent_id else None
+        if standing is None or standing.verified < self.min_verified:
+            return "untrusted"
+        if self.resolve_signer is not None and standing.signer is None:
+            return "untrusted"
+        if self._blacklisted(agent_id, standing.signer):
+            return "blacklisted"
+        if key in self._pending:
+            return "duplicate"
+        if standing.exposure + amount > min(self.caps.get(agent_id, self.risk_cap), standing.verified_value):
+            return "risk_cap"
+        if self.exposure + amount > self.max_exposure:
+            return "max_exposure"
+        return None
+
+    def _add_blacklist(self, agent_id: Optional[str], signer: Optional[str]) -> None:
+        until = time.monotonic() + self.blacklist_ttl if self.blacklist_ttl else float("inf")
+        if agent_id:
+            self._blacklist[("agent", agent_id)] = until
+        if signer:
+            self._blacklist[("signer", signer.lower())] = until
+
+    def _blacklisted(self, agent_id: str, signer: Optional[str]) -> bool:
+        now = time.monotonic()
+        for entry in (("agent", agent_id), ("signer", signer)):
+            until = self._blacklist.get(entry)
+            if until is not None:
+                if until > now:
+                    return True
+                del self._blacklist[entry]
+        return False
+
+    def _resolve(self, agent_id: str) -> None:
+        try:
+            signer = self.resolve_signer(agent_id)
+        except Exception as e:
+            logger.warning("resolve signer for %s failed: %s", agent_id, e)
+            signer = None
+        with self._lock:
+            standing = self._standing[agent_id]
+            standing.resolving = False
+            if signer and int(signer, 16):
+                standing.signer = signer.lower()
+
+    def _settle(self, agent_id: str, key: str, endpoint: str, amount: int) -> None:
+        valid = error = None
+        for attempt in range(self.retries + 1):
+            try:
+                with METRICS.span("optimistic_settle"):
+                    valid = self.settle(key, agent_id, endpoint, amount)
+                break
+            except Exception as e:
+                error = e
+                if attempt < self.retries:
+                    time.sleep(self.retry_delay * (attempt + 1))
+
+        with self._idle:
+            standing = self._standing[agent_id]
+            if valid is None:
+                # 无法确认：敞口保持占用，撤销信誉直到重新同步验证
+                self.unsettled += amount
+                standing.verified = standing.verified_value = 0
+            else:
+                standing.exposure -= amount
+                self.exposure -= amount
+                if valid:
+                    self.settled += amount
+                    standing.verified += 1
+                    standing.verified_value += amount
+                else:
+                    self.losses += amount
+                    self._add_blacklist(agent_id, standing.signer)
+            signer = standing.signer
+            del self._pending[key]
+            self._idle.notify_all()
+
+        if valid is None:
+            METRICS.inc("optimistic_unsettled")
+            logger.warning("optimistic settlement %s for %s unresolved: %s", key, agent_id, error)
+        elif valid:
+            METRICS.inc("optimistic_settled")
+        else:
+            METRICS.inc("optimistic_failed")
+            logger.warning("optimistic payment %s from %s failed verification, blacklisting agent %s signer %s",
+                           key, agent_id, agent_id, signer)
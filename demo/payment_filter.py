@@ -0,0 +1,315 @@
+"""
+ACPay Payment Filter - 已知支付哈希的布隆过滤器
+
+验证支付前先查本地过滤器，确定不存在的哈希（随机伪造或写错的 X-Payment-Hash）
+直接拒绝，不发 RPC：
+
+    KNOWN_PAYMENTS = PaymentFilter(w3, BUYER_WALLET_ADDRESS, chain_head, rotate_after=3600)
+    KNOWN_PAYMENTS.start()                      # 回填最近区块，之后随新区块同步
+    if not KNOWN_PAYMENTS.check(payment_hash):  # 未命中：一定没有对应的 payX402
+        return False
+
+过滤器由合约 X402PaymentMade 事件（paymentHash 为第一个 indexed 参数）维护，
+每个新区块用 eth_getLogs 增量同步。布隆过滤器不能删除，采用两代轮换：
+每 rotate_after 秒新建一代、丢弃最老的一代，查询同时检查两代，
+rotate_after 不小于证明有效期时不会漏掉仍可使用的支付。
+
+支付哈希由调用方任意提供，位下标不能直接取哈希本身的比特：
+全部32字节以每个过滤器的随机密钥做 keyed blake2b（16字节摘要），高低64位做双重哈希。
+不知道密钥就无法离线算出位下标、批量构造命中值；但随机伪造的哈希仍有 fp_rate
+的概率命中，命中只是多一次链上验证（由准入控制的 verify_ip 限速）。
+过滤器尚未完成回填或同步落后太多时 check 一律放行，交给链上验证判断。
+"""
+
+import hashlib
+import logging
+import math
+import os
+import secrets
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import numpy as np
+from eth_utils import keccak
+
+from x402_metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+X402_PAYMENT_TOPIC = "0x" + keccak(text="X402PaymentMade(bytes32,string,address,uint256,uint256)").hex()
+
+DEFAULT_FP_RATE = float(os.getenv("ACPAY_FILTER_FP_RATE", "0.001"))
+DEFAULT_BACKFILL_BLOCKS = int(os.getenv("ACPAY_FILTER_BACKFILL_BLOCKS", "6000"))
+
+_CHUNK = 1 << 16   # 批量操作每次处理的哈希数（限制下标数组的内存）
+_HASH_SIZE = 32
+
+
+def _hash_bytes(payment_hash) -> Optional[bytes]:
+    """0x 开头的64位十六进制或32字节；格式不对返回 None"""
+    if isinstance(payment_hash, str):
+        try:
+            payment_hash = bytes.fromhex(payment_hash[2:] if payment_hash[:2] in ("0x", "0X") else payment_hash)
+        except ValueError:
+            return None
+    return payment_hash if len(payment_hash) == _HASH_SIZE else None
+
+
+class BloomFilter:
+    """定长布隆过滤器（32字节哈希，带随机种子）"""
+
+    def __init__(self, capacity: int, fp_rate: float = DEFAULT_FP_RATE):
+        """
+        Args:
+            capacity: 预计元素数（超过后误判率上升）
+            fp_rate: capacity 个元素时的目标误判率
+        """
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.m = max(64, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        if self.m >= 1 << 32:
+            raise ValueError(f"bloom filter too large: {self.m} bits")   # 批量版本的 uint64 运算不溢出
+        self.k = max(1, round(self.m / capacity * math.log(2)))
+        self.count = 0
+        self._key = secrets.token_bytes(16)
+        self._bits = bytearray((self.m + 7) // 8)
+        self._array = np.frombuffer(self._bits, dtype=np.uint8)   # 与 _bits 共享内存
+        self._steps = np.arange(self.k, dtype=np.uint64)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._bits)
+
+    # ============ 单个哈希 ============
+
+    def add(self, payment_hash) -> None:
+        data = _hash_bytes(payment_hash)
+        if data is None:
+            raise ValueError(f"invalid payment hash: {payment_hash!r}")
+        h1, h2 = self._base(data)
+        bits, m = self._bits, self.m
+        for i in range(self.k):
+            index = (h1 + i * h2) % m
+            bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def __contains__(self, payment_hash) -> bool:
+        data = _hash_bytes(payment_hash)
+        if data is None:
+            return False
+        h1, h2 = self._base(data)
+        bits, m = self._bits, self.m
+        for i in range(self.k):
+            index = (h1 + i * h2) % m
+            if not bits[index >> 3] >> (index & 7) & 1:
+                return False
+        return True
+
+    def _digest(self, data: bytes) -> bytes:
+        return hashlib.blake2b(data, key=self._key, digest_size=16).digest()
+
+    def _base(self, data: bytes):
+        """双重哈希的两个基数：keyed blake2b 摘要的高低64位（对 m 取模）"""
+        h = int.from_bytes(self._digest(data), "little")
+        return (h & 0xFFFFFFFFFFFFFFFF) % self.m, ((h >> 64) | 1) % self.m
+
+    # ============ 批量（numpy） ============
+
+    def add_many(self, hashes) -> None:
+        """批量加入：hashes 为 32*n 字节的缓冲区或哈希序列"""
+        hashes = self._buffer(hashes)
+        n = len(hashes) // _HASH_SIZE
+        for start in range(0, n, _CHUNK):
+            indexes = self._index_array(hashes, start, min(start + _CHUNK, n))
+            np.bitwise_or.at(self._array, indexes >> np.uint64(3),
+                             np.uint8(1) << (indexes & np.uint64(7)).astype(np.uint8))
+        self.count += n
+
+    def contains_many(self, hashes) -> np.ndarray:
+        """批量查询，返回布尔数组"""
+        hashes = self._buffer(hashes)
+        n = len(hashes) // _HASH_SIZE
+        found = np.empty(n, dtype=bool)
+        for start in range(0, n, _CHUNK):
+            indexes = self._index_array(hashes, start, min(start + _CHUNK, n))
+            bits = self._array[indexes >> np.uint64(3)] >> (indexes & np.uint64(7)).astype(np.uint8)
+            found[start:start + _CHUNK] = np.all(bits & 1, axis=1)
+        return found
+
+    @staticmethod
+    def _buffer(hashes) -> memoryview:
+        if not isinstance(hashes, (bytes, bytearray, memoryview)):
+            hashes = b"".join(_hash_bytes(h) or b"\0" * _HASH_SIZE for h in hashes)
+        return memoryview(hashes).cast("B")
+
+    def _index_array(self, hashes: memoryview, start: int, end: int) -> np.ndarray:
+        """第 start..end 个哈希的 k 个位下标（摘要逐个计算，下标运算向量化）"""
+        digest = self._digest
+        digests = b"".join(digest(hashes[i * _HASH_SIZE:(i + 1) * _HASH_SIZE]) for i in range(start, end))
+        h = np.frombuffer(digests, dtype="<u8").reshape(-1, 2)
+        m = np.uint64(self.m)
+        h1 = h[:, 0] % m
+        h2 = (h[:, 1] | np.uint64(1)) % m
+        return (h1[:, None] + self._steps[None, :] * h2[:, None]) % m
+
+
+class PaymentFilter:
+    """两代轮换的已知支付哈希过滤器（由 X402PaymentMade 事件同步）"""
+
+    def __init__(self, w3, wallet_address: str, tracker=None, capacity: int = 1_000_000,
+                 fp_rate: float = DEFAULT_FP_RATE, rotate_after: float = 3600,
+                 backfill_blocks: int = DEFAULT_BACKFILL_BLOCKS, max_log_range: int = 2000,
+                 max_lag: int = 20, enabled: Optional[bool] = None):
+        """
+        Args:
+            w3: 同步 Web3
+            wallet_address: BuyerWallet 合约地址
+            tracker: ChainHeadTracker，新区块时触发同步；为 None 时需自行调用 sync()
+            capacity: 每一代的初始容量（轮换时按上一代实际数量扩容）
+            fp_rate: 目标误判率
+            rotate_after: 轮换间隔（秒），应不小于证明有效期
+            backfill_blocks: 启动时回填的区块数
+            max_log_range: 单次 eth_getLogs 的最大区块范围
+            max_lag: 同步落后链头超过这么多区块时不再拒绝
+            enabled: 默认读取 ACPAY_PAYMENT_FILTER（未设置时开启）
+        """
+        self.w3 = w3
+        self.wallet_address = wallet_address
+        self.tracker = tracker
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.rotate_after = rotate_after
+        self.backfill_blocks = backfill_blocks
+        self.max_log_range = max_log_range
+        self.max_lag = max_lag
+        self.enabled = os.getenv("ACPAY_PAYMENT_FILTER", "1") != "0" if enabled is None else enabled
+
+        self.current = BloomFilter(capacity, fp_rate)
+        self.previous: Optional[BloomFilter] = None
+        self.synced_block: Optional[int] = None    # 已同步到的区块（含）
+        self.rejected = 0
+        self._rotated_at = time.monotonic()
+        self._sync_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._unsubscribe = None
+
+    # ============ 查询 ============
+
+    def might_contain(self, payment_hash) -> bool:
+        """过滤器中可能存在（False 表示一定不存在）"""
+        previous = self.previous
+        return payment_hash in self.current or (previous is not None and payment_hash in previous)
+
+    def check(self, payment_hash, timeout: float = 1.0) -> bool:
+        """
+        是否需要继续链上验证；False 表示可以直接拒绝
+
+        未命中且链头比已同步区块新时，最多等待 timeout 秒让同步追上再判断
+        （Agent 拿到收据后立即请求，支付所在区块可能还没同步）。
+        """
+        if not self.enabled or self.synced_block is None or self.might_contain(payment_hash):
+            return True
+        head = self.tracker.latest if self.tracker is not None else None
+        if head is not None and head.number > self.synced_block:
+            if head.number - self.synced_block > self.max_lag:
+                return True   # 同步明显落后：不拒绝
+            with self._cond:
+                self._wake.set()
+                self._cond.wait_for(lambda: self.synced_block >= head.number, timeout)
+            if self.synced_block < head.number or self.might_contain(payment_hash):
+                return True
+        self.rejected += 1
+        METRICS.inc("verify_filter_rejected")
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        generations = [f for f in (self.current, self.previous) if f is not None]
+        return {
+            "enabled": self.enabled,
+            "synced_block": self.synced_block,
+            "hashes": sum(f.count for f in generations),
+            "bytes": sum(f.nbytes for f in generations),
+            "capacity": self.current.capacity,
+            "rejected": self.rejected,
+        }
+
+    # ============ 同步 ============
+
+    def add(self, payment_hash) -> None:
+        self.current.add(payment_hash)
+
+    def sync(self, to_block: Optional[int] = None) -> int:
+        """
+        拉取 synced_block 之后到 to_block（默认最新区块）的 X402PaymentMade 事件
+
+        Returns:
+            新加入的哈希数
+        """
+        with self._sync_lock:
+            if to_block is None:
+                to_block = self.w3.eth.block_number
+            start = (self.synced_block + 1 if self.synced_block is not None
+                     else max(0, to_block - self.backfill_blocks))
+            added = 0
+            while start <= to_block:
+                end = min(start + self.max_log_range - 1, to_block)
+                with METRICS.span("filter_sync"):
+                    logs = self.w3.eth.get_logs({
+                        "address": self.wallet_address,
+                        "topics": [X402_PAYMENT_TOPIC],
+                        "fromBlock": start,
+                        "toBlock": end,
+                    })
+                hashes = b"".join(bytes(log["topics"][1]) for log in logs)
+                if hashes:
+                    self.current.add_many(hashes)
+                    added += len(logs)
+                with self._cond:
+                    self.synced_block = end
+                    self._cond.notify_all()
+                start = end + 1
+            return added
+
+    def rotate(self) -> None:
+        """新建一代（按上一代实际数量扩容并更换种子），丢弃最老的一代"""
+        capacity = max(self.capacity, 2 * self.current.count)
+        self.previous, self.current = self.current, BloomFilter(capacity, self.fp_rate)
+        self._rotated_at = time.monotonic()
+
+    # ============ 运行 ============
+
+    def start(self) -> "PaymentFilter":
+        """后台线程：回填，之后每个新区块增量同步并按时轮换"""
+        if self.enabled and self._thread is None:
+            self._stop.clear()
+            if self.tracker is not None:
+                self._unsubscribe = self.tracker.subscribe(lambda head: self._wake.set())
+            self._thread = threading.Thread(target=self._run, name="payment-filter", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+            self._unsubscribe = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            head = self.tracker.latest if self.tracker is not None else None
+            try:
+                self.sync(head.number if head is not None else None)
+            except Exception as e:
+                logger.warning("payment filter sync failed: %s", e)
+            if time.monotonic() - self._rotated_at >= self.rotate_after:
+                self.rotate()
+            self._wake.wait(timeout=5.0)
+            self._wake.clear()
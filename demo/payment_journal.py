@@ -0,0 +1,223 @@
+"""
+ACPay Payment Journal - 客户端支付日志（崩溃恢复）
+
+每笔支付按状态推进并追加写入本地 SQLite（WAL 模式）：
+
+    intent -> signed -> broadcast -> confirmed -> consumed
+                  (任意未结束状态都可以转为 failed)
+
+    journal = PaymentJournal(journal_path("weather-agent"))
+    journal.append(payment_id, SIGNED, signature="0x...")   # 返回时已落盘
+    journal.pending()                                        # 重启后未完成的支付
+
+写入由后台线程成组提交：并发的 append 合并进同一个事务，一次 fsync 确认一批。
+get / pending / find 只反映已提交的记录；提交失败的记录不改变内存中的状态。
+重启时只回放本地日志即可恢复每笔支付的最新状态，不需要扫描链上数据。
+"""
+
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, NamedTuple, Optional
+
+INTENT = "intent"
+SIGNED = "signed"
+BROADCAST = "broadcast"
+CONFIRMED = "confirmed"
+CONSUMED = "consumed"
+FAILED = "failed"
+
+STATES = (INTENT, SIGNED, BROADCAST, CONFIRMED, CONSUMED)
+TERMINAL = frozenset((CONSUMED, FAILED))
+_ORDER = {state: i for i, state in enumerate(STATES)}
+
+
+class JournalEntry(NamedTuple):
+    """一笔支付的最新状态（data 为各状态写入字段的合并）"""
+    payment_id: str
+    state: str
+    data: Dict[str, Any]
+    updated_at: float
+
+
+def journal_path(name: str) -> str:
+    """默认日志位置：$ACPAY_HOME（默认 ~/.acpay）/<name>.journal"""
+    home = os.getenv("ACPAY_HOME", os.path.expanduser("~/.acpay"))
+    os.makedirs(home, exist_ok=True)
+    return os.path.join(home, f"{name}.journal")
+
+
+class PaymentJournal:
+    """追加写入、成组提交的支付日志"""
+
+    def __init__(self, path: str, batch_window: float = 0.0, max_batch: int = 1024):
+        """
+        Args:
+            path: SQLite 文件路径
+            batch_window: 收到第一条记录后额外等待更多记录并入同一事务的时间（秒）；
+                为 0 时只合并提交期间已排队的记录
+            max_batch: 单个事务最多包含的记录数
+        """
+        self.path = path
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.commits = 0
+        self.appended = 0
+
+        self._entries: Dict[str, JournalEntry] = {}   # 已提交的最新状态
+        self._staged: Dict[str, JournalEntry] = {}    # 已排队、尚未提交的最新状态（用于校验状态转换）
+        self._lock = threading.Lock()
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._closed = False
+
+        conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")  # 每次提交 fsync WAL
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            "seq INTEGER PRIMARY KEY, payment_id TEXT NOT NULL, state TEXT NOT NULL, "
+            "ts REAL NOT NULL, data TEXT NOT NULL)"
+        )
+        self._conn = conn
+        self._replay()
+
+        self._writer = threading.Thread(target=self._commit_loop, name="payment-journal", daemon=True)
+        self._writer.start()
+
+    # ============ 查询 ============
+
+    def get(self, payment_id: str) -> Optional[JournalEntry]:
+        return self._entries.get(payment_id)
+
+    def pending(self, *states: str) -> List[JournalEntry]:
+        """未结束（非 consumed / failed）的支付，可按状态过滤，按更新时间排序"""
+        with self._lock:
+            entries = [e for e in self._entries.values()
+                       if e.state not in TERMINAL and (not states or e.state in states)]
+        return sorted(entries, key=lambda e: e.updated_at)
+
+    def find(self, *states: str, **match) -> Optional[JournalEntry]:
+        """第一个处于指定状态且 data 包含全部 match 字段的未结束支付"""
+        for entry in self.pending(*states):
+            if all(entry.data.get(k) == v for k, v in match.items()):
+                return entry
+        return None
+
+    # ============ 写入 ============
+
+    def append(self, payment_id: str, state: str, wait: bool = True, **data) -> JournalEntry:
+        """
+        追加一条状态记录
+
+        Args:
+            payment_id: 支付的幂等键
+            state: 新状态（只能前进；重复写入同一状态会合并字段）
+            wait: 是否等待落盘
+            **data: 需要记录的字段（须可 JSON 序列化）
+
+        Raises:
+            ValueError: 非法的状态转换
+            TypeError: data 不能 JSON 序列化（日志状态不变）
+            sqlite3.Error: 提交失败（wait=True 时；日志状态不变）
+        """
+        if state not in _ORDER and state != FAILED:
+            raise ValueError(f"unknown payment state: {state}")
+        payload = json.dumps(data, separators=(",", ":"))
+        now = time.time()
+        with self._lock:
+            if self._closed:
+                raise ValueError("payment journal is closed")
+            current = self._staged.get(payment_id) or self._entries.get(payment_id)
+            if current is not None:
+                if current.state in TERMINAL and current.state != state:
+                    raise ValueError(f"payment {payment_id} already {current.state}")
+                if state != FAILED and _ORDER[state] < _ORDER.get(current.state, -1):
+                    raise ValueError(f"payment {payment_id} cannot go from {current.state} to {state}")
+                merged = {**current.data, **data}
+            else:
+                merged = dict(data)
+            entry = self._staged[payment_id] = JournalEntry(payment_id, state, merged, now)
+            future = Future()
+            self._queue.put((payment_id, state, now, payload, future, entry))
+        if wait:
+            future.result()
+        return entry
+
+    def flush(self) -> None:
+        """等待之前的全部记录落盘"""
+        future = Future()
+        self._queue.put(future)
+        future.result()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(None)
+        self._writer.join()
+        self._conn.close()
+
+    # ============ 内部实现 ============
+
+    def _replay(self) -> None:
+        for payment_id, state, ts, data in self._conn.execute(
+                "SELECT payment_id, state, ts, data FROM events ORDER BY seq"):
+            current = self._entries.get(payment_id)
+            merged = {**current.data, **json.loads(data)} if current else json.loads(data)
+            self._entries[payment_id] = JournalEntry(payment_id, state, merged, ts)
+
+    def _commit_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            batch, entries, waiters, stop = [], [], [], False
+            deadline = time.monotonic() + self.batch_window
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, Future):
+                    waiters.append(item)
+                else:
+                    batch.append(item[:4])
+                    waiters.append(item[4])
+                    entries.append(item[5])
+                if stop or len(batch) >= self.max_batch:
+                    break
+                try:
+                    # 先取走已排队的记录；设置了 batch_window 时再等待后续记录
+                    remaining = deadline - time.monotonic()
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            error = None
+            if batch:
+                try:
+                    self._conn.execute("BEGIN")
+                    self._conn.executemany(
+                        "INSERT INTO events (payment_id, state, ts, data) VALUES (?, ?, ?, ?)", batch
+                    )
+                    self._conn.execute("COMMIT")
+                    self.commits += 1
+                    self.appended += len(batch)
+                except sqlite3.Error as e:
+                    if self._conn.in_transaction:
+                        self._conn.execute("ROLLBACK")
+                    error = e
+            with self._lock:
+                for entry in entries:
+                    if error is None:
+                        self._entries[entry.payment_id] = entry
+                    if self._staged.get(entry.payment_id) is entry:
+                        del self._staged[entry.payment_id]
+            for waiter in waiters:
+                if error is None:
+                    waiter.set_result(None)
+                else:
+                    waiter.set_exception(error)
+            if stop:
+                return
@@ -0,0 +1,265 @@
+"""
+ACPay Prefork Runner - 多进程 pre-fork 运行 Flask 应用
+
+父进程完成导入与共享内存表的创建后 fork 出 N 个 worker，每个 worker 以
+SO_REUSEPORT 绑定同一端口，由内核在 worker 之间分配连接：
+
+    ACPAY_WORKERS=8 python3 x402_server.py
+
+    from prefork import serve
+    serve(app, "0.0.0.0", 5000, workers=8, on_start=chain_head.start)
+
+父进程只负责监督：worker 异常退出时重新 fork，收到 SIGTERM / SIGINT 时
+转发给全部 worker 并等待退出。
+
+默认以 HTTP/1.1 持久连接服务（单进程的 app.run 同样使用 request_handler()）：
+Agent 的402探价与带证明的重试复用同一个连接，连接空闲 ACPAY_KEEPALIVE_TIMEOUT
+秒后关闭；ACPAY_KEEPALIVE=0 回到每个请求一个连接（HTTP/1.0）。fork 之前创建的 SharedTable（准入令牌桶、
+验证缓存、重放集合）被所有 worker 共享；其余模块级状态（线程、SQLite 连接、
+进程内缓存）在每个 worker 中各自一份，后台线程须在 on_start 中启动。
+"""
+
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Callable, Dict, Optional
+
+from werkzeug.exceptions import InternalServerError
+from werkzeug.serving import WSGIRequestHandler, make_server
+from werkzeug.wsgi import LimitedStream
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = int(os.getenv("ACPAY_WORKERS", "1"))
+RESPAWN_DELAY = 1.0  # worker 连续崩溃时的重启间隔（秒）
+KEEPALIVE = os.getenv("ACPAY_KEEPALIVE", "1") != "0"
+KEEPALIVE_TIMEOUT = float(os.getenv("ACPAY_KEEPALIVE_TIMEOUT", "15"))
+DRAIN_LIMIT = 64 * 1024  # 应用未读完的请求体不超过该大小时读掉并保持连接，否则关闭
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """
+    HTTP/1.1 持久连接的 WSGI 请求处理
+
+    werkzeug 自带的处理类对每个响应都发送 Connection: close。这里按响应的形态给出长度：
+    应用给出 Content-Length 时原样边迭代边写出；响应体是列表（Flask 的普通响应）时
+    合并后补上 Content-Length；其余（生成器等流式响应，如 CSV 导出、SSE）不缓冲，
+    对 HTTP/1.1 客户端用分块传输编码写出，对 HTTP/1.0 客户端写完后关闭连接。
+    读掉未读完的请求体，之后由 BaseHTTPRequestHandler 在同一连接上读取下一个请求；
+    连接空闲 KEEPALIVE_TIMEOUT 秒后关闭（每个连接占用一个线程）。
+    """
+
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+    disable_nagle_algorithm = True   # 持久连接上头部与响应体分两次写出，避免 Nagle + 延迟确认的 40ms 等待
+
+    def run_wsgi(self) -> None:
+        if self.headers.get("Expect", "").lower().strip(" \t") == "100-continue":
+            self.wfile.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+        self.environ = environ = self.make_environ()
+        self.body_stream = None
+        if environ.get("wsgi.input_terminated"):
+            self.close_connection = True   # 分块请求体：不在连接上继续读取
+        else:
+            length = environ.get("CONTENT_LENGTH", "")
+            self.body_stream = LimitedStream(self.rfile, int(length) if length.isdigit() else 0)
+            environ["wsgi.input"] = self.body_stream
+
+        self.response = []    # [status, headers]
+        self.pending = []     # 响应头发出前经 write() 写入的数据
+        self.chunked = None   # 响应头发出后为 True / False
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if self.chunked is not None:
+                        raise exc_info[1].with_traceback(exc_info[2])
+                finally:
+                    exc_info = None
+            elif self.response:
+                raise AssertionError("headers already set")
+            self.response[:] = [status, headers]
+            return self._write
+
+        try:
+            result = self.server.app(environ, start_response)
+            try:
+                self._send(result)
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+        except Exception:
+            if self.server.passthrough_errors:
+                raise
+            logger.exception("Error on request %s %s", self.command, self.path)
+            self.close_connection = True
+            if self.chunked is not None:
+                return   # 响应已开始写出：只能断开连接
+            self.response.clear()
+            self.pending.clear()
+            self._send(InternalServerError()(environ, start_response))
+
+    def _write(self, data: bytes) -> None:
+        """start_response 返回的 write()（旧式 WSGI 应用）"""
+        if self.chunked is None:
+            self.pending.append(data)
+        else:
+            self._write_body(data)
+
+    def _send(self, result) -> None:
+        chunks = iter(result)
+        for chunk in chunks:
+            # 应用可以在第一次迭代时才调用 start_response
+            self.pending.append(chunk)
+            if self.response:
+                break
+        status, headers = self.response
+        code, _, reason = status.partition(" ")
+        length = next((value for key, value in headers if key.lower() == "content-length"), None)
+        bodiless = int(code) in (204, 304) or int(code) < 200
+        if length is None and (bodiless or isinstance(result, (list, tuple))):
+            # 响应体已在内存中：合并后给出长度
+            self.pending.extend(chunks)
+            length = "0" if bodiless else str(sum(map(len, self.pending)))
+        # HEAD 响应没有响应体：长度未知时两个头都不发
+        streaming = length is None and self.command != "HEAD"
+        if streaming and self.request_version != "HTTP/1.1":
+            self.close_connection = True   # HTTP/1.0 客户端不支持分块：以关闭连接结束响应体
+        self._drain_request()
+
+        self.send_response(int(code), reason)
+        for key, value in headers:
+            if key.lower() not in ("content-length", "connection", "transfer-encoding"):
+                self.send_header(key, value)
+        if length is not None:
+            self.send_header("Content-Length", length)
+        elif streaming and not self.close_connection:
+            self.send_header("Transfer-Encoding", "chunked")
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.chunked = streaming and not self.close_connection
+
+        if self.command == "HEAD":
+            self.wfile.flush()
+            return
+        pending, self.pending = self.pending, []
+        for chunk in pending:
+            self._write_body(chunk)
+        for chunk in chunks:
+            self._write_body(chunk)
+            if streaming:
+                self.wfile.flush()   # 流式响应（SSE）每块立即发出
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _write_body(self, data: bytes) -> None:
+        if not data:
+            return   # 空块会被当作分块编码的结束标记
+        if self.chunked:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def _drain_request(self) -> None:
+        """读掉应用未读完的请求体；剩余太多时改为关闭连接"""
+        body_stream = self.body_stream
+        if body_stream is not None and not body_stream.is_exhausted:
+            if body_stream.limit - body_stream.tell() <= DRAIN_LIMIT:
+                body_stream.exhaust()
+            else:
+                self.close_connection = True
+
+
+def request_handler() -> type:
+    """按 ACPAY_KEEPALIVE 选择请求处理类（传给 make_server / app.run）"""
+    return KeepAliveRequestHandler if KEEPALIVE else WSGIRequestHandler
+
+
+def reuseport_socket(host: str, port: int, backlog: int = 1024) -> socket.socket:
+    """绑定 SO_REUSEPORT 监听套接字（每个 worker 一个）"""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def serve(app, host: str, port: int, workers: int = DEFAULT_WORKERS,
+          on_start: Optional[Callable[[], None]] = None) -> None:
+    """
+    以 workers 个进程运行 WSGI 应用，直到收到 SIGTERM / SIGINT
+
+    Args:
+        app: WSGI 应用（Flask app）
+        host, port: 监听地址
+        workers: worker 进程数
+        on_start: 每个 worker fork 之后、开始接受连接之前调用（启动后台线程等）
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+    # 父进程先绑定一次：端口被占用时立即失败，而不是每个 worker 反复崩溃
+    reuseport_socket(host, port).close()
+
+    children: Dict[int, int] = {}   # pid -> worker 序号
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(workers):
+        children[_spawn(app, host, port, index, on_start)] = index
+    logger.info("prefork: %d workers on %s:%d", workers, host, port)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        logger.warning("prefork: worker %d (pid %d) exited with status %d, respawning", index, pid, status)
+        time.sleep(RESPAWN_DELAY)
+        children[_spawn(app, host, port, index, on_start)] = index
+
+
+def _spawn(app, host: str, port: int, index: int, on_start: Optional[Callable[[], None]]) -> int:
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 0
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)   # Ctrl+C 由父进程转发为 SIGTERM
+        sock = reuseport_socket(host, port)
+        if on_start is not None:
+            on_start()
+        server = make_server(host, port, app, threaded=True, request_handler=request_handler(),
+                             fd=sock.fileno())
+        server.serve_forever()
+    except BaseException:
+        logger.exception("prefork: worker %d failed", index)
+        code = 1
+    finally:
+        # 不执行父进程注册的 atexit（共享内存段由父进程释放）
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
@@ -0,0 +1,670 @@
+#!/usr/bin/env python3
+"""
+ACPay Relayer - 代 Agent 提交已签名的支付授权
+
+Agent 只持有签名私钥，不持有 gas；Relayer 用自己的账户把 EIP-712 授权
+（payByAgent / payX402）提交到 BuyerWallet：
+
+- 每个 Agent 一个按 nonce 排序的队列，只派发连续的下一个 nonce，乱序到达的授权等待补齐
+- 自行管理发送方 nonce：一轮内连续签出多笔交易（不等待收据），
+  原始交易通过一次 JSON-RPC 批量请求发送；收据同样批量查询
+- EIP-1559 费用：maxFee = 2 x baseFee + 小费（可设上限）；超时未上链的交易同 nonce 加价替换
+- 状态：GET /relay/<id> 轮询，GET /relay/events 以 SSE 推送状态变化
+- 受理前按 EIP-712 恢复签名者，与合约中 Agent 注册的签名地址（缓存）比对，
+  签名无效的授权不占用 (Agent, nonce)、也不会变成付 gas 的回滚交易；队列按 Agent 与总量限长
+
+    ACPAY_RELAYER_KEY=0x... ACPAY_RELAYER_RPC=http://127.0.0.1:8545 python3 relayer.py
+
+合约没有批量支付入口，每笔授权仍是一笔交易；批量体现在同一轮的签名、发送与收据查询。
+Relayer 账户应专用：外部使用同一私钥发送交易会打乱本地 nonce（检测到后自动重新同步）。
+"""
+
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from eth_account import Account
+from flask import Flask, Response, jsonify, request
+from web3 import Web3
+
+from buyer_wallet import HOT_CALLS, BuyerWalletClient, agent_payment_digest, domain_separator
+from x402_metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+RELAYER_RPC = os.getenv("ACPAY_RELAYER_RPC", "http://127.0.0.1:8545")
+RELAYER_PORT = int(os.getenv("ACPAY_RELAYER_PORT", "5003"))
+BUYER_WALLET_ADDRESS = os.getenv("ACPAY_BUYER_WALLET", "0x14ebB18cA52796a3c1A68FfC0E74374CD735f74A")
+
+KINDS = ("payByAgent", "payX402")
+GAS_LIMITS = {"payByAgent": 300_000, "payX402": 400_000}
+DEFAULT_PRIORITY_FEE = 10**9      # 节点不支持 eth_maxPriorityFeePerGas 时的小费（1 gwei）
+FEE_BUMP = 1.125                  # 替换交易的最低加价（节点通常要求 >= 10%）
+ZERO_ADDRESS = "0x0000000000000000000000000000000000000000"
+
+QUEUED = "queued"
+SUBMITTED = "submitted"
+CONFIRMED = "confirmed"
+FAILED = "failed"
+EXPIRED = "expired"
+FINAL = frozenset((CONFIRMED, FAILED, EXPIRED))
+
+
+class RelayError(ValueError):
+    """授权无效或无法受理"""
+
+
+class RelayBusy(RelayError):
+    """队列已满，稍后重试"""
+
+
+class Authorization(NamedTuple):
+    """Agent 签好的一笔支付授权（payX402 时 metadata 为API端点、deadline 为 expiry）"""
+    kind: str
+    agent_id: str
+    recipient: str
+    amount: int
+    metadata: str
+    nonce: int
+    deadline: int
+    signature: bytes
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "Authorization":
+        """
+        解析 POST /relay 的请求体
+
+        Raises:
+            RelayError: 字段缺失或格式错误
+        """
+        if not isinstance(data, dict):
+            raise RelayError("authorization must be an object")
+        try:
+            kind = data.get("kind", "payByAgent")
+            if kind not in KINDS:
+                raise RelayError(f"kind must be one of {', '.join(KINDS)}")
+            recipient = data["recipient"]
+            if not Web3.is_address(recipient):
+                raise RelayError("invalid recipient address")
+            signature = data["signature"]
+            signature = bytes.fromhex(signature[2:] if signature.startswith(("0x", "0X")) else signature)
+            if len(signature) != 65:
+                raise RelayError("signature must be 65 bytes")
+            auth = cls(kind, str(data["agent_id"]), Web3.to_checksum_address(recipient), int(data["amount"]),
+                       str(data.get("metadata", "")), int(data["nonce"]), int(data["deadline"]), signature)
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            if isinstance(e, RelayError):
+                raise
+            raise RelayError(f"invalid authorization: {e!r}") from None
+        if auth.amount <= 0 or auth.nonce <= 0:
+            raise RelayError("amount and nonce must be positive")
+        return auth
+
+    def to_json(self) -> Dict[str, Any]:
+        return {**self._asdict(), "signature": "0x" + self.signature.hex()}
+
+    def calldata(self) -> bytes:
+        """BuyerWallet 调用数据（预构建编码器）"""
+        if self.kind == "payX402":
+            info = (self.agent_id, self.recipient, self.amount, self.metadata, self.nonce, self.deadline)
+            return HOT_CALLS["payX402"].encode(info, self.signature)
+        return HOT_CALLS["payByAgent"].encode(self.agent_id, self.recipient, self.amount, self.metadata,
+                                              self.signature, self.nonce, self.deadline)
+
+
+class Fees(NamedTuple):
+    """一轮交易使用的费用（legacy 链上 max_fee 即 gasPrice）"""
+    max_fee: int
+    priority_fee: int
+    legacy: bool = False
+
+    def bumped(self, current: "Fees") -> "Fees":
+        """替换交易的费用：至少加价 FEE_BUMP，且不低于当前行情"""
+        return Fees(max(int(self.max_fee * FEE_BUMP) + 1, current.max_fee),
+                    max(int(self.priority_fee * FEE_BUMP) + 1, current.priority_fee),
+                    self.legacy)
+
+
+class RelayJob:
+    """一笔授权的提交状态"""
+
+    __slots__ = ("id", "auth", "calldata", "state", "tx_hashes", "sender_nonce", "fees", "replacements",
+                 "submitted_at", "block_number", "gas_used", "error", "created_at", "updated_at")
+
+    def __init__(self, job_id: str, auth: Authorization):
+        self.id = job_id
+        self.auth = auth
+        self.calldata = auth.calldata()
+        self.state = QUEUED
+        self.tx_hashes: List[str] = []
+        self.sender_nonce: Optional[int] = None
+        self.fees: Optional[Fees] = None
+        self.replacements = 0
+        self.submitted_at = 0.0   # time.monotonic()
+        self.block_number: Optional[int] = None
+        self.gas_used: Optional[int] = None
+        self.error: Optional[str] = None
+        self.created_at = self.updated_at = time.time()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "kind": self.auth.kind,
+            "agent_id": self.auth.agent_id,
+            "nonce": self.auth.nonce,
+            "state": self.state,
+            "tx_hash": self.tx_hashes[-1] if self.tx_hashes else None,
+            "sender_nonce": self.sender_nonce,
+            "replacements": self.replacements,
+            "block_number": self.block_number,
+            "gas_used": self.gas_used,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+class Relayer:
+    """授权队列 + 发送方 nonce / 费用管理（后台线程）"""
+
+    def __init__(self, w3: Web3, wallet_address: str, private_key, tracker=None, max_batch: int = 64,
+                 poll_interval: float = 0.5, replace_after: float = 30.0, max_replacements: int = 5,
+                 max_fee_cap: Optional[int] = None, gas_limits: Optional[Dict[str, int]] = None,
+                 max_per_agent: int = 256, max_queued: int = 10_000, keep_finished: int = 10_000,
+                 signer_ttl: float = 60.0):
+        """
+        Args:
+            w3: 同步 Web3（HTTPProvider，需要支持 JSON-RPC 批量请求）
+            wallet_address: BuyerWallet 合约地址
+            private_key: Relayer 发送账户私钥（支付 gas）
+            tracker: ChainHeadTracker（可选），提供链上时间判断授权是否过期
+            max_batch: 每轮最多派发的授权数
+            poll_interval: 无新授权时的轮询间隔（秒）
+            replace_after: 交易发出多久未上链后加价替换（秒）
+            max_replacements: 单笔交易最多替换次数
+            max_fee_cap: maxFeePerGas 上限（wei）
+            gas_limits: 每种调用的 gas 上限（默认 GAS_LIMITS）
+            max_per_agent: 单个 Agent 最多排队的授权数
+            max_queued: 全部 Agent 合计最多排队的授权数
+            keep_finished: 保留多少笔已结束的授权供查询（更早的从 jobs 中移除）
+            signer_ttl: Agent 签名地址的缓存时间（秒）
+        """
+        self.w3 = w3
+        self.wallet_address = Web3.to_checksum_address(wallet_address)
+        self.wallet = BuyerWalletClient(w3, self.wallet_address)
+        self.account = Account.from_key(private_key)
+        self.tracker = tracker
+        self.max_batch = max_batch
+        self.poll_interval = poll_interval
+        self.replace_after = replace_after
+        self.max_replacements = max_replacements
+        self.max_fee_cap = max_fee_cap
+        self.gas_limits = {**GAS_LIMITS, **(gas_limits or {})}
+        self.chain_id = w3.eth.chain_id
+        self.domain = domain_separator(self.chain_id, self.wallet_address)
+        self.max_per_agent = max_per_agent
+        self.max_queued = max_queued
+        self.keep_finished = keep_finished
+        self.signer_ttl = signer_ttl
+
+        self.jobs: Dict[str, RelayJob] = {}
+        self.counts = {state: 0 for state in (CONFIRMED, FAILED, EXPIRED)}
+        self.sent = 0
+        self.max_queue_depth = 0
+
+        self._queues: Dict[str, Dict[int, RelayJob]] = {}   # agent_id -> nonce -> 排队中的授权
+        self._next_nonce: Dict[str, int] = {}               # agent_id -> 下一个可派发的nonce
+        self._inflight: Dict[str, RelayJob] = {}            # 已发出、等待收据
+        self._finished: deque = deque()                      # 已结束授权的 id（按结束顺序）
+        self._signers: Dict[str, Tuple[str, float]] = {}    # agent_id -> (签名地址, 缓存到期 monotonic)
+        self._sender_nonce: Optional[int] = None
+        self._ids = itertools.count(1)
+        self._events: deque = deque(maxlen=10_000)
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> str:
+        return self.account.address
+
+    # ============ 受理 ============
+
+    def submit(self, auth: Authorization) -> RelayJob:
+        """
+        受理一笔授权（按 Agent 与 nonce 排队）
+
+        Raises:
+            RelayError: 已过期、签名者不是 Agent 注册的签名地址，或同一 (Agent, nonce) 已在队列中
+            RelayBusy: 该 Agent 或全部队列已满
+        """
+        if auth.deadline < self._chain_time():
+            raise RelayError("authorization already expired")
+        self._check_signer(auth)
+        with self._cond:
+            depth = sum(len(q) for q in self._queues.values())
+            if depth >= self.max_queued:
+                METRICS.inc("relayer_queue_full")
+                raise RelayBusy("relayer queue full")
+            queue = self._queues.setdefault(auth.agent_id, {})
+            if auth.nonce in queue:
+                raise RelayError(f"nonce {auth.nonce} already queued for {auth.agent_id}")
+            if len(queue) >= self.max_per_agent:
+                METRICS.inc("relayer_queue_full")
+                raise RelayBusy(f"too many queued authorizations for {auth.agent_id}")
+            next_nonce = self._next_nonce.get(auth.agent_id)
+            if next_nonce is not None and auth.nonce < next_nonce:
+                raise RelayError(f"nonce {auth.nonce} already used by {auth.agent_id}")
+            job = RelayJob(f"r{next(self._ids)}", auth)
+            self.jobs[job.id] = queue[auth.nonce] = job
+            self.max_queue_depth = max(self.max_queue_depth, depth + 1)
+            self._publish(job)
+            self._cond.notify_all()
+        METRICS.inc("relayer_accepted")
+        return job
+
+    def submit_many(self, auths: Iterable[Authorization]) -> List[RelayJob]:
+        return [self.submit(auth) for auth in auths]
+
+    # ============ 查询 ============
+
+    def get(self, job_id: str) -> Optional[RelayJob]:
+        return self.jobs.get(job_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            queued = sum(len(q) for q in self._queues.values())
+            return {
+                "sender": self.address,
+                "sender_nonce": self._sender_nonce,
+                "agents": len(self._queues),
+                "queued": queued,
+                "inflight": len(self._inflight),
+                "sent": self.sent,
+                "max_queue_depth": self.max_queue_depth,
+                **self.counts,
+            }
+
+    def idle(self) -> bool:
+        """没有排队或等待收据的授权"""
+        with self._lock:
+            return not self._inflight and not any(self._queues.values())
+
+    def events(self, after: int, timeout: float = 15.0) -> List[Tuple[int, Dict[str, Any]]]:
+        """seq 大于 after 的状态变化；没有时最多等待 timeout 秒"""
+        with self._cond:
+            if self._seq <= after:
+                self._cond.wait_for(lambda: self._seq > after or self._stop.is_set(), timeout)
+            return [(seq, job) for seq, job in self._events if seq > after]
+
+    @property
+    def last_event(self) -> int:
+        return self._seq
+
+    # ============ 运行 ============
+
+    def start(self) -> "Relayer":
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="relayer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def step(self) -> int:
+        """执行一轮：过期检查、收据、加价替换、派发；返回本轮发出的交易数"""
+        self._expire()
+        if self._inflight:
+            self._check_receipts()
+        fees = None
+        if self._inflight and self.replace_after:
+            fees = self._replace_stuck()
+        return self._dispatch(fees)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                sent = self.step()
+            except Exception as e:
+                METRICS.inc("relayer_error")
+                logger.warning("relayer step failed: %s", e)
+                sent = 0
+            if not sent:
+                with self._cond:
+                    self._cond.wait(self.poll_interval)
+
+    # ============ 内部实现 ============
+
+    def _chain_time(self) -> float:
+        return self.tracker.now() if self.tracker is not None else time.time()
+
+    def _agent_signer(self, agent_id: str) -> str:
+        """合约中 Agent 注册的签名地址（缓存 signer_ttl 秒）"""
+        now = time.monotonic()
+        cached = self._signers.get(agent_id)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        signer = self.wallet.get_agent_signer(agent_id)
+        self._signers[agent_id] = (signer, now + self.signer_ttl)
+        return signer
+
+    def _check_signer(self, auth: Authorization) -> None:
+        """
+        按合约的 EIP-712 摘要恢复签名者并与注册的签名地址比对
+
+        Raises:
+            RelayError: 签名无法恢复、Agent 未注册或签名者不匹配
+        """
+        digest = agent_payment_digest(self.domain, auth.agent_id, auth.recipient, auth.amount, auth.metadata,
+                                      auth.nonce, auth.deadline)
+        try:
+            recovered = Account._recover_hash(digest, signature=auth.signature)
+        except Exception:
+            METRICS.inc("relayer_bad_signature")
+            raise RelayError("invalid signature") from None
+        signer = self._agent_signer(auth.agent_id)
+        if signer == ZERO_ADDRESS:
+            raise RelayError(f"unknown agent: {auth.agent_id}")
+        if recovered.lower() != signer.lower():
+            METRICS.inc("relayer_bad_signature")
+            raise RelayError("signature does not match the agent's signer")
+
+    def _publish(self, job: RelayJob) -> None:
+        """记录状态变化（调用方持有锁）"""
+        job.updated_at = time.time()
+        self._seq += 1
+        self._events.append((self._seq, job.to_dict()))
+        self._cond.notify_all()
+
+    def _finish(self, job: RelayJob, state: str, error: Optional[str] = None) -> None:
+        """结束一笔授权（调用方持有锁）"""
+        job.state = state
+        job.error = error
+        self.counts[state] += 1
+        self._inflight.pop(job.id, None)
+        self._publish(job)
+        METRICS.inc(f"relayer_{state}")
+        self._finished.append(job.id)
+        while len(self._finished) > self.keep_finished:
+            self.jobs.pop(self._finished.popleft(), None)
+
+    def _expire(self) -> None:
+        """截止时间已过（按链上时间）的排队授权不再派发"""
+        now = self._chain_time()
+        with self._cond:
+            for queue in self._queues.values():
+                for nonce in [n for n, job in queue.items() if job.auth.deadline < now]:
+                    self._finish(queue.pop(nonce), EXPIRED, "deadline passed before submission")
+
+    def _sync_agents(self) -> None:
+        """首次见到的 Agent 从合约读取已使用的nonce"""
+        with self._lock:
+            unknown = [agent for agent in self._queues if agent not in self._next_nonce]
+        for agent in unknown:
+            next_nonce = self.wallet.get_nonce(agent) + 1
+            with self._lock:
+                self._next_nonce.setdefault(agent, next_nonce)
+
+    def _take_ready(self) -> List[RelayJob]:
+        """按 Agent 轮转取出可派发的授权（每个 Agent 只取连续的下一个 nonce）"""
+        ready: List[RelayJob] = []
+        with self._cond:
+            progress = True
+            while progress and len(ready) < self.max_batch:
+                progress = False
+                for agent, queue in self._queues.items():
+                    if agent not in self._next_nonce or not queue:
+                        continue
+                    expected = self._next_nonce[agent]
+                    for nonce in [n for n in queue if n < expected]:
+                        self._finish(queue.pop(nonce), FAILED, "nonce already used on-chain")
+                    job = queue.pop(expected, None)
+                    if job is None:
+                        continue
+                    self._next_nonce[agent] = expected + 1
+                    ready.append(job)
+                    progress = True
+                    if len(ready) >= self.max_batch:
+                        break
+        return ready
+
+    def _dispatch(self, fees: Optional[Fees] = None) -> int:
+        self._sync_agents()
+        ready = self._take_ready()
+        if not ready:
+            return 0
+        if self._sender_nonce is None:
+            self._sender_nonce = self.w3.eth.get_transaction_count(self.address, "pending")
+        fees = fees or self._fees()
+
+        signed = []
+        with METRICS.span("relayer_sign"):
+            for job in ready:
+                job.sender_nonce = self._sender_nonce
+                job.fees = fees
+                self._sender_nonce += 1
+                signed.append(self._sign(job.calldata, job.sender_nonce, fees, self.gas_limits[job.auth.kind]))
+
+        with METRICS.span("relayer_send"):
+            errors = self._send_raw([raw for raw, _ in signed])
+
+        resync, gaps = False, []
+        now = time.monotonic()
+        with self._cond:
+            for job, (_, tx_hash), error in zip(ready, signed, errors):
+                if error is None or "already known" in error:
+                    job.state = SUBMITTED
+                    job.tx_hashes.append(tx_hash)
+                    job.submitted_at = now
+                    self._inflight[job.id] = job
+                    self.sent += 1
+                    self._publish(job)
+                elif "nonce too low" in error:
+                    # 发送方 nonce 被外部占用：授权放回队列，下一轮重新签名
+                    resync = True
+                    job.sender_nonce = None
+                    self._queues[job.auth.agent_id][job.auth.nonce] = job
+                    self._next_nonce[job.auth.agent_id] = min(self._next_nonce[job.auth.agent_id], job.auth.nonce)
+                else:
+                    self._finish(job, FAILED, error)
+                    self._next_nonce[job.auth.agent_id] = min(self._next_nonce[job.auth.agent_id], job.auth.nonce)
+                    gaps.append(job.sender_nonce)
+        for nonce in gaps:
+            self._fill_nonce(nonce, fees)
+        if resync:
+            self._sender_nonce = self.w3.eth.get_transaction_count(self.address, "pending")
+        return len(ready)
+
+    def _check_receipts(self) -> None:
+        """一次批量请求查询全部在途交易（含被替换的旧交易）的收据"""
+        with self._lock:
+            pending = [(job, tx_hash) for job in self._inflight.values() for tx_hash in job.tx_hashes]
+        responses = self._batch([("eth_getTransactionReceipt", [tx_hash]) for _, tx_hash in pending])
+        reverted = set()
+        with self._cond:
+            for (job, _), response in zip(pending, responses):
+                receipt = response.get("result") if isinstance(response, dict) else None
+                if not receipt or job.state != SUBMITTED:
+                    continue
+                job.block_number = int(receipt["blockNumber"], 16)
+                job.gas_used = int(receipt["gasUsed"], 16)
+                if int(receipt["status"], 16) == 1:
+                    self._finish(job, CONFIRMED)
+                else:
+                    self._finish(job, FAILED, "reverted")
+                    reverted.add(job.auth.agent_id)
+        # 回滚的授权没有消耗 Agent nonce：从合约重新读取，后续排队授权按新 nonce 派发；
+        # 签名地址可能已被更换，缓存一并失效
+        for agent in reverted:
+            self._signers.pop(agent, None)
+            next_nonce = self.wallet.get_nonce(agent) + 1
+            with self._lock:
+                self._next_nonce[agent] = next_nonce
+
+    def _replace_stuck(self) -> Optional[Fees]:
+        """超过 replace_after 仍未上链的交易以同一发送方 nonce 加价重发；返回本轮行情"""
+        now = time.monotonic()
+        with self._lock:
+            stuck = [job for job in self._inflight.values()
+                     if now - job.submitted_at > self.replace_after and job.replacements < self.max_replacements]
+        if not stuck:
+            return None
+        current = self._fees()
+        for job in stuck:
+            fees = job.fees.bumped(current)
+            if self.max_fee_cap is not None and fees.max_fee > self.max_fee_cap:
+                continue
+            raw, tx_hash = self._sign(job.calldata, job.sender_nonce, fees, self.gas_limits[job.auth.kind])
+            (error,) = self._send_raw([raw])
+            with self._cond:
+                job.submitted_at = now
+                if error is None or "already known" in error:
+                    job.fees = fees
+                    job.replacements += 1
+                    job.tx_hashes.append(tx_hash)
+                    self._publish(job)
+                    METRICS.inc("relayer_replaced")
+                else:
+                    # 通常是原交易已上链（nonce too low），下一轮收据查询会结束它
+                    logger.info("replacement for %s rejected: %s", job.id, error)
+        return current
+
+    def _fees(self) -> Fees:
+        """按最新区块计算 EIP-1559 费用；没有 baseFee 的链使用 gasPrice"""
+        block = self.w3.eth.get_block("latest")
+        base_fee = block.get("baseFeePerGas")
+        if base_fee is None:
+            price = self.w3.eth.gas_price
+            if self.max_fee_cap is not None:
+                price = min(price, self.max_fee_cap)
+            return Fees(price, price, legacy=True)
+        try:
+            priority_fee = self.w3.eth.max_priority_fee
+        except Exception:
+            priority_fee = DEFAULT_PRIORITY_FEE
+        max_fee = 2 * base_fee + priority_fee
+        if self.max_fee_cap is not None:
+            max_fee = min(max_fee, self.max_fee_cap)
+        return Fees(max_fee, min(priority_fee, max_fee))
+
+    def _sign(self, data: bytes, nonce: int, fees: Fees, gas: int, to: Optional[str] = None) -> Tuple[bytes, str]:
+        tx = {"chainId": self.chain_id, "nonce": nonce, "to": to or self.wallet_address,
+              "data": data, "value": 0, "gas": gas}
+        if fees.legacy:
+            tx["gasPrice"] = fees.max_fee
+        else:
+            tx.update(type=2, maxFeePerGas=fees.max_fee, maxPriorityFeePerGas=fees.priority_fee)
+        signed = self.account.sign_transaction(tx)
+        return bytes(signed.raw_transaction), Web3.to_hex(signed.hash)
+
+    def _fill_nonce(self, nonce: int, fees: Fees) -> None:
+        """发送失败留下的发送方 nonce 空洞用一笔 0 值自转账补上，避免后续交易卡住"""
+        raw, _ = self._sign(b"", nonce, fees, 21_000, to=self.address)
+        (error,) = self._send_raw([raw])
+        if error is not None:
+            logger.warning("failed to fill sender nonce %d: %s", nonce, error)
+
+    def _send_raw(self, raws: List[bytes]) -> List[Optional[str]]:
+        """批量 eth_sendRawTransaction，返回每笔的错误信息（成功为 None）"""
+        responses = self._batch([("eth_sendRawTransaction", [Web3.to_hex(raw)]) for raw in raws])
+        return [None if "error" not in r else str(r["error"].get("message", r["error"])).lower()
+                for r in responses]
+
+    def _batch(self, calls: List[Tuple[str, list]]) -> List[Dict[str, Any]]:
+        if not calls:
+            return []
+        responses = self.w3.provider.make_batch_request(calls)
+        if isinstance(responses, dict):
+            # 整个批量请求失败时节点只返回一个错误对象
+            return [responses] * len(calls)
+        return responses
+
+
+# ============ HTTP 接口 ============
+
+def create_app(relayer: Relayer) -> Flask:
+    """
+    POST /relay            提交一笔授权或 {"authorizations": [...]}
+    GET  /relay/<id>       查询状态
+    GET  /relay/status     队列深度与计数
+    GET  /relay/events     SSE 状态流（支持 ?after=<seq> 或 Last-Event-ID）
+    """
+    app = Flask(__name__)
+
+    @app.route('/relay', methods=['POST'])
+    def relay():
+        data = request.get_json(silent=True)
+        batch = isinstance(data, dict) and isinstance(data.get("authorizations"), list)
+        items = data["authorizations"] if batch else [data]
+        jobs, errors = [], []
+        for i, item in enumerate(items):
+            try:
+                jobs.append(relayer.submit(Authorization.from_json(item)).to_dict())
+            except RelayError as e:
+                errors.append({"index": i, "error": str(e), "retry": isinstance(e, RelayBusy)})
+        if not batch and errors:
+            return jsonify({"error": errors[0]["error"]}), 503 if errors[0]["retry"] else 400
+        return jsonify({"jobs": jobs, "errors": errors} if batch else jobs[0]), 202
+
+    @app.route('/relay/status', methods=['GET'])
+    def relay_status():
+        return jsonify(relayer.stats())
+
+    @app.route('/relay/events', methods=['GET'])
+    def relay_events():
+        after = request.args.get("after", type=int)
+        if after is None:
+            after = int(request.headers.get("Last-Event-ID", relayer.last_event))
+
+        def stream():
+            seq = after
+            while True:
+                events = relayer.events(seq)
+                if not events:
+                    yield ": keepalive\n\n"
+                    continue
+                for seq, job in events:
+                    yield f"id: {seq}\ndata: {json.dumps(job)}\n\n"
+
+        return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    @app.route('/relay/<job_id>', methods=['GET'])
+    def relay_job(job_id: str):
+        job = relayer.get(job_id)
+        if job is None:
+            return jsonify({"error": "Unknown job"}), 404
+        return jsonify(job.to_dict())
+
+    return app
+
+
+if __name__ == '__main__':
+    from chain_head import get_tracker
+
+    key = os.getenv("ACPAY_RELAYER_KEY")
+    if not key:
+        raise SystemExit("Set ACPAY_RELAYER_KEY to the relayer account's private key")
+    max_fee_cap = os.getenv("ACPAY_RELAYER_MAX_FEE")
+    w3 = Web3(Web3.HTTPProvider(RELAYER_RPC))
+    relayer = Relayer(w3, BUYER_WALLET_ADDRESS, key, tracker=get_tracker(RELAYER_RPC),
+                      max_fee_cap=int(max_fee_cap) if max_fee_cap else None).start()
+
+    print("🚚 Starting ACPay Relayer")
+    print(f"   RPC: {RELAYER_RPC} (chain {relayer.chain_id})")
+    print(f"   Contract: {relayer.wallet_address}")
+    print(f"   Sender: {relayer.address}")
+    create_app(relayer).run(host='0.0.0.0', port=RELAYER_PORT, threaded=True)
@@ -0,0 +1,302 @@
+"""
+ACPay Resilience - RPC 与 API 调用的自适应超时、重试与熔断
+
+每个下游端点（RPC 节点地址、API 主机）共享一个 CallPolicy：
+
+    policy = get_policy("rpc:https://k8s.testnet.json-rpc.injective.network/")
+    response = policy.call(session.get, url, timeout=policy.timeout(), idempotent=True)
+
+    w3 = Web3(ResilientHTTPProvider(INJECTIVE_TESTNET_RPC))   # 每个 JSON-RPC 请求按方法经过策略
+
+- 自适应超时：最近调用耗时的 p99 × multiplier，限制在 [min_timeout, max_timeout]；
+  样本不足时使用 max_timeout。超时的调用按其耗时（即当时的超时）计入样本，
+  下游整体变慢时估计随之上升，而不是每次都超时、永远没有新样本
+- 重试：只对幂等调用（只读 RPC、未携带支付证明的请求），指数退避加全抖动
+- 熔断：连续 failure_threshold 次失败后断开 reset_timeout 秒，期间直接抛出
+  CircuitOpenError 而不占用线程等待；之后放行一个探测请求（超时取 max_timeout，
+  变慢但健康的节点也能探测成功），成功则恢复
+
+超时、连接错误与调用方判定的失败（如 5xx）都计为失败。
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Optional
+
+from requests.exceptions import Timeout as RequestTimeout
+from web3 import HTTPProvider
+
+from x402_metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIN_TIMEOUT = float(os.getenv("ACPAY_TIMEOUT_MIN", "0.5"))    # 秒
+DEFAULT_MAX_TIMEOUT = float(os.getenv("ACPAY_TIMEOUT_MAX", "10"))     # 秒，也是样本不足时的超时
+DEFAULT_RETRIES = int(os.getenv("ACPAY_RETRIES", "2"))                # 幂等调用的额外尝试次数
+DEFAULT_FAILURE_THRESHOLD = int(os.getenv("ACPAY_BREAKER_FAILURES", "5"))
+DEFAULT_RESET_TIMEOUT = float(os.getenv("ACPAY_BREAKER_RESET", "5"))  # 秒
+
+# 可以安全重试的 JSON-RPC 方法（只读）；eth_sendRawTransaction 等写操作只尝试一次
+IDEMPOTENT_RPC_METHODS = frozenset({
+    "eth_call", "eth_blockNumber", "eth_chainId", "eth_estimateGas", "eth_feeHistory", "eth_gasPrice",
+    "eth_getBalance", "eth_getBlockByHash", "eth_getBlockByNumber", "eth_getCode", "eth_getLogs",
+    "eth_getStorageAt", "eth_getTransactionByHash", "eth_getTransactionCount", "eth_getTransactionReceipt",
+    "eth_maxPriorityFeePerGas", "net_version", "web3_clientVersion",
+})
+
+# 计入延迟样本的超时异常（耗时约等于当时的超时）
+TIMEOUT_ERRORS = (TimeoutError, RequestTimeout)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """熔断中：调用未发出"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"circuit {name} is open, retry after {retry_after:.1f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class LatencyWindow:
+    """最近 size 次成功或超时调用的耗时（秒）"""
+
+    def __init__(self, size: int = 256):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """q 分位数（0-1），没有样本时返回 None"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class CircuitBreaker:
+    """连续失败计数熔断器（closed -> open -> half_open -> closed）"""
+
+    def __init__(self, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0            # 累计断开次数
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """是否放行本次调用（半开状态只放行一个探测请求）"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def retry_after(self) -> float:
+        with self._lock:
+            return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self) -> bool:
+        """记录一次失败；返回本次是否使熔断器断开"""
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+                self.opened += 1
+                return True
+            return False
+
+
+class CallPolicy:
+    """一个下游端点的超时、重试与熔断策略"""
+
+    def __init__(self, name: str, min_timeout: float = DEFAULT_MIN_TIMEOUT,
+                 max_timeout: float = DEFAULT_MAX_TIMEOUT, percentile: float = 0.99, multiplier: float = 3.0,
+                 min_samples: int = 20, retries: int = DEFAULT_RETRIES, backoff: float = 0.1,
+                 max_backoff: float = 2.0, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT):
+        """
+        Args:
+            name: 端点名称（指标与日志中使用）
+            min_timeout, max_timeout: 自适应超时的上下限（秒）
+            percentile, multiplier: 超时 = 最近成功与超时调用耗时的 percentile 分位数 × multiplier
+            min_samples: 少于该样本数时超时取 max_timeout
+            retries: 幂等调用失败后的重试次数
+            backoff, max_backoff: 第 n 次重试前等待 uniform(0, min(max_backoff, backoff × 2^n)) 秒
+            failure_threshold, reset_timeout: 熔断参数
+        """
+        self.name = name
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.latency = LatencyWindow()
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.calls = 0
+        self.failures = 0
+        self.retried = 0
+        self.rejected = 0
+
+    def timeout(self) -> float:
+        """当前的自适应超时（秒）；熔断器未闭合时（下一个调用是探测请求）取 max_timeout"""
+        if len(self.latency) < self.min_samples or self.breaker.state != CLOSED:
+            return self.max_timeout
+        estimate = self.latency.percentile(self.percentile) * self.multiplier
+        return min(self.max_timeout, max(self.min_timeout, estimate))
+
+    def call(self, fn: Callable[..., Any], *args, idempotent: bool = False,
+             failed: Optional[Callable[[Any], bool]] = None, **kwargs) -> Any:
+        """
+        经过熔断器调用 fn(*args, **kwargs)；幂等调用失败时抖动退避后重试
+
+        Args:
+            idempotent: 是否可以安全重试
+            failed: 判断返回值是否算作失败（如 HTTP 5xx）；重试用尽后仍返回该值
+
+        Raises:
+            CircuitOpenError: 熔断中（调用未发出）
+            fn 抛出的最后一个异常
+        """
+        attempts = 1 + (self.retries if idempotent else 0)
+        for attempt in range(attempts):
+            if attempt:
+                self.retried += 1
+                METRICS.inc("call_retry")
+                time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1))))
+            if not self.breaker.allow():
+                self.rejected += 1
+                METRICS.inc("circuit_rejected")
+                raise CircuitOpenError(self.name, self.breaker.retry_after())
+
+            self.calls += 1
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if isinstance(e, TIMEOUT_ERRORS):
+                    self.latency.record(time.perf_counter() - start)
+                self._record_failure(e)
+                if attempt + 1 == attempts:
+                    raise
+                continue
+            if failed is not None and failed(result):
+                self._record_failure(result)
+                if attempt + 1 < attempts:
+                    continue
+                return result
+            self.latency.record(time.perf_counter() - start)
+            self.breaker.record_success()
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.breaker.state,
+            "timeout": round(self.timeout(), 3),
+            "calls": self.calls,
+            "failures": self.failures,
+            "retried": self.retried,
+            "rejected": self.rejected,
+            "opened": self.breaker.opened,
+        }
+
+    def _record_failure(self, error) -> None:
+        self.failures += 1
+        METRICS.inc("call_failure")
+        if self.breaker.record_failure():
+            METRICS.inc("circuit_opened")
+            logger.warning("circuit %s opened after %d failures (last: %s)",
+                           self.name, self.breaker.failures, error)
+
+
+_policies: Dict[str, CallPolicy] = {}
+_policies_lock = threading.Lock()
+
+
+def get_policy(name: str, **options) -> CallPolicy:
+    """获取进程内共享的策略（同一端点共用延迟统计与熔断器；options 只在首次创建时生效）"""
+    with _policies_lock:
+        policy = _policies.get(name)
+        if policy is None:
+            policy = _policies[name] = CallPolicy(name, **options)
+        return policy
+
+
+def all_stats() -> Dict[str, Dict[str, Any]]:
+    """全部端点的策略状态（供 /health 使用）"""
+    with _policies_lock:
+        policies = list(_policies.values())
+    return {policy.name: policy.stats() for policy in policies}
+
+
+class ResilientHTTPProvider(HTTPProvider):
+    """
+    JSON-RPC 请求按 (节点, 方法) 经过 CallPolicy：自适应超时、只读方法重试、熔断
+
+    不同方法的耗时差别很大（eth_call 与大范围 eth_getLogs），延迟统计与熔断器按方法分开。
+    关闭 web3 自带的重试（固定退避、不区分节点状态），由策略统一处理；
+    批量请求（make_batch_request）不经过策略，使用 web3 的默认超时。
+    """
+
+    def __init__(self, endpoint_uri: str, **kwargs):
+        kwargs.setdefault("exception_retry_configuration", None)
+        super().__init__(endpoint_uri, **kwargs)
+        self._local = threading.local()
+
+    def policy(self, method: str) -> CallPolicy:
+        return get_policy(f"rpc:{self.endpoint_uri}:{method}")
+
+    def get_request_kwargs(self):
+        request_kwargs = super().get_request_kwargs()
+        timeout = getattr(self._local, "timeout", None)
+        if timeout is not None:
+            request_kwargs["timeout"] = timeout
+        return request_kwargs
+
+    def make_request(self, method, params):
+        # 节点返回的 JSON-RPC 错误（含 revert）不计入失败：节点本身是健康的
+        policy = self.policy(method)
+        parent = super().make_request
+
+        def attempt():
+            self._local.timeout = policy.timeout()
+            try:
+                return parent(method, params)
+            finally:
+                self._local.timeout = None
+
+        return policy.call(attempt, idempotent=method in IDEMPOTENT_RPC_METHODS)
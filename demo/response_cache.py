@@ -0,0 +1,107 @@
+"""
+ACPay Response Cache - 幂等付费 GET 端点的响应内容缓存
+
+缓存的是序列化后的公共负载（去掉末尾 "}" 的 JSON 字节），
+每次请求只把 payment_hash 等按支付变化的字段序列化后拼接上去：
+
+    cache = ResponseCache(ttl=5, stale=30)
+    body = cache.render(("/api/weather", ()), build_weather, payment_hash=h, payment_verified=True)
+
+过期但仍在 stale 窗口内的条目直接返回，同时在后台重建（stale-while-revalidate）。
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Tuple
+
+
+def _encode(payload: dict) -> bytes:
+    if not payload:
+        raise ValueError("cached payload must be a non-empty dict")
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()[:-1]
+
+
+class ResponseCache:
+    """单个端点的负载缓存（按查询参数区分条目，LRU 淘汰）"""
+
+    def __init__(self, ttl: float = 5.0, stale: float = 30.0, max_entries: int = 256):
+        """
+        Args:
+            ttl: 条目保持新鲜的时间（秒）
+            stale: 过期后仍可返回旧内容并后台刷新的时间（秒）
+            max_entries: 最多缓存的查询参数组合数
+        """
+        self.ttl = ttl
+        self.stale = stale
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Tuple[bytes, float]]" = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def payload(self, key: Hashable, build: Callable[[], dict]) -> bytes:
+        """返回缓存的负载前缀，缺失或彻底过期时同步重建"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = now - entry[1]
+                if age < self.ttl:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return entry[0]
+                if age < self.ttl + self.stale:
+                    self.stale_hits += 1
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        threading.Thread(target=self._refresh, args=(key, build), daemon=True).start()
+                    return entry[0]
+            self.misses += 1
+        return self._store(key, build)
+
+    def render(self, key: Hashable, build: Callable[[], dict], **fields) -> bytes:
+        """缓存负载 + 本次请求的字段，返回完整 JSON 字节"""
+        prefix = self.payload(key, build)
+        if not fields:
+            return prefix + b"}"
+        return prefix + b"," + json.dumps(fields, ensure_ascii=False, separators=(",", ":")).encode()[1:]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "hit_ratio": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+    def _store(self, key: Hashable, build: Callable[[], dict]) -> bytes:
+        prefix = _encode(build())
+        with self._lock:
+            self._entries[key] = (prefix, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return prefix
+
+    def _refresh(self, key: Hashable, build: Callable[[], dict]) -> None:
+        try:
+            self._store(key, build)
+            with self._lock:
+                self.refreshes += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
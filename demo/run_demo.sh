@@ -11,10 +11,10 @@ fi
 
 # 检查依赖包
 echo "📦 检查Python依赖包..."
-python3 -c "import flask, web3, requests, eth_account" 2>/dev/null
+python3 -c "import flask, web3, requests, eth_account, numpy, aiohttp" 2>/dev/null
 if [ $? -ne 0 ]; then
     echo "⚠️  缺少依赖包，正在安装..."
-    pip3 install flask web3 requests eth-account
+    pip3 install flask web3 requests eth-account numpy aiohttp
 fi
 
 echo "✅ 依赖检查完成"
@@ -0,0 +1,295 @@
+"""
+ACPay Shared Table - 多进程共享的定长开放寻址哈希表
+
+表位于 multiprocessing.shared_memory 段中，在 fork 之前创建，所有 worker 进程
+直接读写同一块内存（prefork.py）：
+
+    VERIFIED = SharedTable(65536, "B")          # 值为一个 uint8
+    VERIFIED.put("0xabc...|/x402/weather|5000000", (1,), ttl=300)
+    VERIFIED.get("0xabc...|/x402/weather|5000000")   # (1,)，不存在或过期为 None
+
+布局：每个槽 = 序列号(u32) + 状态(u8) + 键摘要(16字节 blake2b) + 过期时间(f64) + 值(struct)。
+线性探测，最多 max_probe 个槽。探测窗口内没有空槽或已过期的槽时：
+- evict=True（默认，适合可以重建的状态，如准入令牌桶）：淘汰最早过期的槽（计入 evictions）
+- evict=False（重放集合、验证缓存）：从不淘汰未过期的条目，put / update 抛出 TableFull，
+  put_if_absent 返回 FULL，由调用方拒绝请求（fail closed）
+
+不淘汰的表须按 "有效期 × 峰值写入速率" 的约 2 倍设置容量（负载因子 ≤ 0.5 时探测窗口几乎不会满）。
+
+- 读取无锁：按序列号（seqlock）读取，写入期间序列号为奇数，读到不一致时重读；
+  重读 READ_SPINS 次仍不一致的槽按未命中处理（get 返回 None），读取方不会无限自旋
+- 写入持有一把跨进程锁（multiprocessing.Lock，fork 时继承）；put_if_absent / update
+  在同一把锁内完成读-改-写
+- 持锁进程在写入中途崩溃时：表头记录持锁进程的 pid，等锁超过 LOCK_CHECK_INTERVAL 秒的
+  进程发现持锁进程已不存在（已被父进程回收，prefork.py 会回收）时接管这把锁；
+  写了一半的槽（序列号停在奇数）在持锁写入时按已过期的槽复用，其中的条目丢失。
+  持锁进程获取锁后、写入 pid 之前（或清除 pid 之后、释放锁之前）崩溃的极短窗口内
+  无法识别，此时该表的写入会一直阻塞，需要重启整个进程池
+- 删除与过期不回收为空槽，读取会越过已过期的槽继续探测；插入时复用它们
+
+只能在同一父进程 fork 出的进程之间共享（锁随 fork 继承）。
+创建表的进程退出时释放共享内存段。
+"""
+
+import atexit
+import hashlib
+import logging
+import multiprocessing
+import os
+import struct
+import time
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from typing import Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+READ_SPINS = 10000          # 无锁读取时一个槽最多重读的次数，超过后按未命中处理
+LOCK_CHECK_INTERVAL = 1.0   # 等锁超过该时间（秒）后检查持锁进程是否还存在
+
+_MAGIC = 0x41435054  # "ACPT"
+_HEADER = struct.Struct("<IIIIQI4x")   # magic, capacity, slot_size, max_probe, evictions, 持锁进程 pid
+_HOLDER_OFFSET = 24
+_SEQ = struct.Struct("<I")
+_SLOT_HEAD = struct.Struct("<IB3x16sd")  # seq, state, key, expires
+_EMPTY = 0
+_LIVE = 1
+_TORN = 2   # 读取时的状态：序列号停在奇数（写入中或写入进程已崩溃）
+_NEVER = float("inf")
+
+# put_if_absent 的返回值
+ADDED = "added"      # 键不存在，已写入
+PRESENT = "present"  # 键已存在且未过期
+FULL = "full"        # 探测窗口内没有可用的槽（仅 evict=False）
+
+
+class TableFull(RuntimeError):
+    """不淘汰的表在探测窗口内没有空槽或已过期的槽"""
+
+
+def _digest(key) -> bytes:
+    return hashlib.blake2b(key.encode() if isinstance(key, str) else key, digest_size=16).digest()
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedTable:
+    """共享内存中的定长哈希表（键为字符串或字节，值为定长 struct）"""
+
+    def __init__(self, capacity: int, value_format: str = "", max_probe: int = 16, evict: bool = True):
+        """
+        Args:
+            capacity: 槽数（固定，不扩容）
+            value_format: 值的 struct 格式（不含字节序前缀），为空时只记录键是否存在
+            max_probe: 线性探测的最大槽数
+            evict: 探测窗口已满时是否淘汰未过期的条目（False 时写入失败）
+        """
+        self.capacity = capacity
+        self.max_probe = min(max_probe, capacity)
+        self.evict = evict
+        self._slot = struct.Struct(_SLOT_HEAD.format + value_format)
+        self.slot_size = (self._slot.size + 7) & ~7
+        self._shm = shared_memory.SharedMemory(create=True, size=_HEADER.size + capacity * self.slot_size)
+        self._buf = self._shm.buf
+        _HEADER.pack_into(self._buf, 0, _MAGIC, capacity, self.slot_size, self.max_probe, 0, 0)
+        self._lock = multiprocessing.Lock()
+        self._recovery = multiprocessing.Lock()   # 串行化对孤儿锁的接管
+        self._owner = os.getpid()
+        atexit.register(self.close)
+
+    @property
+    def name(self) -> str:
+        """共享内存段名称（/dev/shm 下可见）"""
+        return self._shm.name
+
+    @property
+    def evictions(self) -> int:
+        return _HEADER.unpack_from(self._buf, 0)[4]
+
+    def __len__(self) -> int:
+        """未过期的键数（逐槽扫描，仅用于统计）"""
+        now = time.time()
+        slots = (self._read(i, now) for i in range(self.capacity))
+        return sum(1 for state, _, expires, _ in slots if state == _LIVE and expires > now)
+
+    # ============ 读取（无锁） ============
+
+    def get(self, key) -> Optional[Tuple]:
+        """键对应的值；不存在或已过期返回 None"""
+        digest = _digest(key)
+        now = time.time()
+        home = int.from_bytes(digest[:8], "little")
+        for i in range(self.max_probe):
+            state, slot_key, expires, value = self._read((home + i) % self.capacity, now)
+            if state == _EMPTY:
+                return None
+            if state == _LIVE and slot_key == digest:
+                return value if expires > now else None
+        return None
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    # ============ 写入（跨进程锁） ============
+
+    def put(self, key, value: Tuple = (), ttl: Optional[float] = None) -> None:
+        """
+        写入或覆盖（ttl 为 None 时不过期）
+
+        Raises:
+            TableFull: evict=False 且没有可用的槽
+        """
+        self.update(key, lambda old: value, ttl)
+
+    def put_if_absent(self, key, value: Tuple = (), ttl: Optional[float] = None) -> str:
+        """键不存在（或已过期）时写入；返回 ADDED、PRESENT 或 FULL（没有可用的槽，未写入）"""
+        written = []
+
+        def insert(old):
+            if old is not None:
+                return old
+            written.append(True)
+            return value
+
+        try:
+            self.update(key, insert, ttl, keep_expiry=True)
+        except TableFull:
+            return FULL
+        return ADDED if written else PRESENT
+
+    def update(self, key, fn: Callable[[Optional[Tuple]], Tuple], ttl: Optional[float] = None,
+               keep_expiry: bool = False) -> Tuple:
+        """
+        原子读-改-写：new = fn(old)，old 不存在或已过期时为 None
+
+        Args:
+            ttl: 新的有效期（秒），None 为不过期
+            keep_expiry: 键已存在时保留原过期时间
+
+        Raises:
+            TableFull: evict=False 且没有可用的槽（fn 未被调用）
+        """
+        digest = _digest(key)
+        home = int.from_bytes(digest[:8], "little")
+        with self._locked():
+            now = time.time()
+            index, old, expires = self._find_slot(digest, home, now)
+            value = tuple(fn(old))
+            if not (keep_expiry and old is not None):
+                expires = now + ttl if ttl is not None else _NEVER
+            self._write(index, digest, expires, value)
+        return value
+
+    def discard(self, key) -> None:
+        """删除键（标记为已过期，槽在之后的插入中复用）"""
+        digest = _digest(key)
+        home = int.from_bytes(digest[:8], "little")
+        with self._locked():
+            now = time.time()
+            for i in range(self.max_probe):
+                index = (home + i) % self.capacity
+                state, slot_key, _, value = self._read(index, now, spins=1)
+                if state == _EMPTY:
+                    return
+                if state == _LIVE and slot_key == digest:
+                    self._write(index, digest, 0.0, value)
+                    return
+
+    def close(self) -> None:
+        """释放映射；创建表的进程同时删除共享内存段"""
+        if self._shm is None:
+            return
+        self._buf = None
+        shm, self._shm = self._shm, None
+        shm.close()
+        if os.getpid() == self._owner:
+            shm.unlink()
+
+    # ============ 内部实现 ============
+
+    def _offset(self, index: int) -> int:
+        return _HEADER.size + index * self.slot_size
+
+    def _read(self, index: int, now: float, spins: int = READ_SPINS) -> Tuple[int, bytes, float, Tuple]:
+        """
+        seqlock 读取一个槽：(状态, 键摘要, 过期时间, 值)
+
+        重读 spins 次仍不一致时返回状态 _TORN。持锁时传 spins=1：此时不会有其他写入者，
+        序列号为奇数说明上一个持锁进程在写入中途崩溃
+        """
+        offset = self._offset(index)
+        buf = self._buf
+        for _ in range(spins):
+            seq = _SEQ.unpack_from(buf, offset)[0]
+            if seq & 1:
+                continue  # 写入进行中
+            fields = self._slot.unpack_from(buf, offset)
+            if _SEQ.unpack_from(buf, offset)[0] == seq:
+                return fields[1], fields[2], fields[3], fields[4:]
+        return _TORN, b"", 0.0, ()
+
+    def _find_slot(self, digest: bytes, home: int, now: float) -> Tuple[int, Optional[Tuple], float]:
+        """持有锁时调用：返回 (槽号, 未过期的旧值, 旧过期时间)"""
+        reusable = None
+        oldest, oldest_expires = home % self.capacity, _NEVER
+        for i in range(self.max_probe):
+            index = (home + i) % self.capacity
+            state, slot_key, expires, value = self._read(index, now, spins=1)
+            if state == _LIVE and slot_key == digest:
+                return index, (value if expires > now else None), expires
+            if state == _EMPTY:
+                return (index if reusable is None else reusable), None, 0.0
+            if expires <= now:   # 已过期，或写了一半的槽（_TORN 的过期时间为0）
+                if reusable is None:
+                    reusable = index
+            elif expires < oldest_expires:
+                oldest, oldest_expires = index, expires
+        if reusable is not None:
+            return reusable, None, 0.0
+        if not self.evict:
+            raise TableFull(f"no free slot within {self.max_probe} probes")
+        # 探测窗口已满：淘汰最早过期的槽
+        fields = list(_HEADER.unpack_from(self._buf, 0))
+        fields[4] += 1
+        _HEADER.pack_into(self._buf, 0, *fields)
+        return oldest, None, 0.0
+
+    def _write(self, index: int, digest: bytes, expires: float, value: Tuple) -> None:
+        offset = self._offset(index)
+        buf = self._buf
+        writing = _SEQ.unpack_from(buf, offset)[0] | 1   # 奇数：写入中（写了一半的槽已是奇数）
+        _SEQ.pack_into(buf, offset, writing)
+        self._slot.pack_into(buf, offset, writing, _LIVE, digest, expires, *value)
+        _SEQ.pack_into(buf, offset, (writing + 1) & 0xFFFFFFFF)
+
+    @contextmanager
+    def _locked(self):
+        """持有跨进程写锁；持锁进程已退出时接管这把锁"""
+        while not self._lock.acquire(timeout=LOCK_CHECK_INTERVAL):
+            if self._take_orphaned_lock():
+                break
+        _SEQ.pack_into(self._buf, _HOLDER_OFFSET, os.getpid())
+        try:
+            yield
+        finally:
+            _SEQ.pack_into(self._buf, _HOLDER_OFFSET, 0)
+            self._lock.release()
+
+    def _take_orphaned_lock(self) -> bool:
+        """等锁超时：表头记录的持锁进程已不存在时由本进程接管（锁仍处于被持有状态）"""
+        with self._recovery:
+            holder = _SEQ.unpack_from(self._buf, _HOLDER_OFFSET)[0]
+            if holder == 0 or holder == os.getpid() or _alive(holder):
+                return False
+            _SEQ.pack_into(self._buf, _HOLDER_OFFSET, os.getpid())
+        logger.warning("shm_table %s: lock holder pid %d exited while holding the lock, taking it over",
+                       self.name, holder)
+        return True
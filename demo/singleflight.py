@@ -0,0 +1,59 @@
+"""
+ACPay Single Flight - 合并对同一键的并发调用
+
+同一支付哈希的并发验证只发起一次 RPC，其余调用等待并共享结果：
+
+    VERIFY_FLIGHTS = SingleFlight("verify_coalesced")
+    VERIFY_FLIGHTS.do((payment_hash, endpoint, amount), verify_on_chain, payment_hash, endpoint, amount)
+
+只合并正在进行的调用，不缓存已完成的结果。
+"""
+
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from x402_metrics import METRICS
+
+
+class SingleFlight:
+    """线程版请求合并"""
+
+    def __init__(self, metric: Optional[str] = None):
+        """
+        Args:
+            metric: 被合并调用的计数事件名（METRICS.inc）
+        """
+        self.metric = metric
+        self.calls = 0
+        self.coalesced = 0
+        self._inflight: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """执行 fn(*args, **kwargs)；同一 key 已有调用在进行时等待其结果（包括异常）"""
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if self.metric:
+                METRICS.inc(self.metric)
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]
@@ -0,0 +1,363 @@
+"""
+ACPay Spending Analytics - 本地支付索引与按日/按小时预聚合的消费统计
+
+服务端每验证一笔支付就写入本地存储（同一支付哈希只计一次），
+同一事务内更新小时/日聚合表：按单个维度（agent_id / recipient / endpoint / 全部）
+汇总的 rollups，以及按三个维度组合汇总的 combos：
+
+    PAYMENTS = PaymentStore("payments.db")
+    PAYMENTS.record(Payment.from_proof(proof))
+    PAYMENTS.spending(start, end, granularity=DAY, by=("agent_id",), endpoint="/x402/weather")
+
+区间查询只读聚合表，不扫描原始支付，也不访问链上数据；
+只涉及一个维度的查询（分组或过滤）读 rollups，其余读 combos。
+时间桶按 UTC 对齐（与合约 block.timestamp / 1 days 一致）。
+"""
+
+import csv
+import io
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Sequence, Tuple
+
+HOUR = 3600
+DAY = 86400
+GRANULARITIES = {"hour": HOUR, "day": DAY}
+DIMENSIONS = ("agent_id", "recipient", "endpoint")
+
+_TOTAL = "total"       # rollups 中不分维度的合计（key 为空字符串）
+_EXPORT_BUCKETS = 256  # 导出时每次查询的时间桶数
+_SWEEP_CLAIMS_EVERY = 1024
+MAX_RANGE_DAYS = 400   # HTTP 查询允许的最大时间跨度
+
+
+class Payment(NamedTuple):
+    """一笔已验证的支付"""
+    payment_hash: str
+    agent_id: str
+    recipient: str
+    endpoint: str
+    amount: int
+    timestamp: int
+
+    @classmethod
+    def from_proof(cls, proof) -> "Payment":
+        """从 X402PaymentProof 构造"""
+        payment_hash = proof.payment_hash
+        if isinstance(payment_hash, (bytes, bytearray)):
+            payment_hash = "0x" + bytes(payment_hash).hex()
+        return cls(payment_hash.lower(), proof.agent_id, proof.recipient.lower(),
+                   proof.api_endpoint, proof.amount, proof.timestamp)
+
+
+def _check_dimensions(names: Iterable[str]) -> Tuple[str, ...]:
+    names = tuple(names)
+    for name in names:
+        if name not in DIMENSIONS:
+            raise ValueError(f"unknown dimension: {name}")
+    return names
+
+
+class PaymentStore:
+    """支付索引（SQLite）与小时/日聚合"""
+
+    def __init__(self, path: str = ":memory:"):
+        """
+        Args:
+            path: SQLite 文件路径（默认进程内存）
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._claims = 0
+        self._inherited = None
+        self._conn = self._connect(path)
+
+    @staticmethod
+    def _connect(path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(
+            "CREATE TABLE IF NOT EXISTS payments ("
+            " payment_hash TEXT PRIMARY KEY, agent_id TEXT NOT NULL, recipient TEXT NOT NULL,"
+            " endpoint TEXT NOT NULL, amount INTEGER NOT NULL, ts INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS rollups ("
+            " granularity INTEGER NOT NULL, dimension TEXT NOT NULL, bucket INTEGER NOT NULL, key TEXT NOT NULL,"
+            " amount INTEGER NOT NULL, count INTEGER NOT NULL,"
+            " PRIMARY KEY (granularity, dimension, bucket, key)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS rollups_key ON rollups (granularity, dimension, key, bucket);"
+            "CREATE TABLE IF NOT EXISTS combos ("
+            " granularity INTEGER NOT NULL, bucket INTEGER NOT NULL, agent_id TEXT NOT NULL,"
+            " recipient TEXT NOT NULL, endpoint TEXT NOT NULL, amount INTEGER NOT NULL, count INTEGER NOT NULL,"
+            " PRIMARY KEY (granularity, bucket, agent_id, recipient, endpoint)) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, expires INTEGER NOT NULL) WITHOUT ROWID;"
+        )
+        return conn
+
+    def reopen(self) -> None:
+        """fork 之后在子进程中重新连接文件数据库（SQLite 连接不能跨 fork 使用；内存数据库不变）"""
+        if self.path == ":memory:":
+            return
+        with self._lock:
+            # 继承来的连接不在子进程中关闭，以免影响父进程
+            self._inherited, self._conn = self._conn, self._connect(self.path)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM payments").fetchone()[0]
+
+    # ============ 写入 ============
+
+    def record(self, payment: Payment) -> bool:
+        """记录一笔支付，已记录过的支付哈希返回 False"""
+        return self.record_many((payment,)) == 1
+
+    def record_many(self, payments: Iterable[Payment]) -> int:
+        """在一个事务内记录多笔支付，返回新增的笔数"""
+        added = 0
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN")
+            try:
+                for p in payments:
+                    inserted = conn.execute(
+                        "INSERT OR IGNORE INTO payments VALUES (?, ?, ?, ?, ?, ?)",
+                        (p.payment_hash, p.agent_id, p.recipient, p.endpoint, p.amount, p.timestamp)
+                    ).rowcount
+                    if not inserted:
+                        continue
+                    added += 1
+                    for granularity in (HOUR, DAY):
+                        bucket = p.timestamp // granularity * granularity
+                        conn.executemany(
+                            "INSERT INTO rollups VALUES (?, ?, ?, ?, ?, 1) "
+                            "ON CONFLICT DO UPDATE SET amount = amount + excluded.amount, count = count + 1",
+                            [(granularity, _TOTAL, bucket, "", p.amount),
+                             (granularity, "agent_id", bucket, p.agent_id, p.amount),
+                             (granularity, "recipient", bucket, p.recipient, p.amount),
+                             (granularity, "endpoint", bucket, p.endpoint, p.amount)]
+                        )
+                        conn.execute(
+                            "INSERT INTO combos VALUES (?, ?, ?, ?, ?, ?, 1) "
+                            "ON CONFLICT DO UPDATE SET amount = amount + excluded.amount, count = count + 1",
+                            (granularity, bucket, p.agent_id, p.recipient, p.endpoint, p.amount)
+                        )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return added
+
+    def claim(self, key: str, ttl: float) -> bool:
+        """
+        一次性占用 key（如一笔支付换取会话），ttl 秒内再次占用返回 False
+
+        与支付索引在同一个 SQLite 文件中：文件数据库重启后仍然有效，
+        共享同一文件的进程与副本互相可见（内存数据库只在本进程内有效）
+        """
+        now = int(time.time())
+        with self._lock:
+            claimed = self._conn.execute(
+                "INSERT INTO claims VALUES (?, ?) "
+                "ON CONFLICT DO UPDATE SET expires = excluded.expires WHERE claims.expires <= ?",
+                (key, now + int(ttl + 0.999), now)
+            ).rowcount == 1
+            self._claims += 1
+            if self._claims % _SWEEP_CLAIMS_EVERY == 0:
+                self._conn.execute("DELETE FROM claims WHERE expires <= ?", (now,))
+        return claimed
+
+    # ============ 查询 ============
+
+    def spending(self, start: int, end: int, granularity: int = DAY,
+                 by: Sequence[str] = ("agent_id",), **filters) -> List[Dict]:
+        """
+        按时间桶的消费序列
+
+        Args:
+            start, end: 时间范围 [start, end)（秒），包含 start、end 所在的整个时间桶
+            granularity: HOUR 或 DAY
+            by: 分组维度（DIMENSIONS 的子集）
+            **filters: 维度过滤，如 agent_id="agent-1"
+
+        Returns:
+            [{"bucket": ..., <维度>..., "amount": ..., "count": ...}]，按时间桶排序
+        """
+        return list(self._rollups(start, end, granularity, by, filters, per_bucket=True))
+
+    def totals(self, start: int, end: int, by: Sequence[str] = ("agent_id",), **filters) -> List[Dict]:
+        """
+        区间合计（按金额降序）
+
+        起止时间都在整日边界上时读日聚合，否则读小时聚合。
+        """
+        granularity = DAY if start % DAY == 0 and end % DAY == 0 else HOUR
+        rows = list(self._rollups(start, end, granularity, by, filters, per_bucket=False))
+        return sorted(rows, key=lambda row: row["amount"], reverse=True)
+
+    def payments(self, start: int, end: int, **filters) -> Iterator[Payment]:
+        """原始支付记录（按时间排序，分批读取）"""
+        where, params = self._where(filters)
+        condition, cursor = "ts >= ?", (start,)
+        while True:
+            with self._lock:
+                batch = self._conn.execute(
+                    "SELECT payment_hash, agent_id, recipient, endpoint, amount, ts FROM payments "
+                    f"WHERE {condition} AND ts < ?{where} ORDER BY ts, payment_hash LIMIT 1000",
+                    (*cursor, end, *params)
+                ).fetchall()
+            if not batch:
+                return
+            for row in batch:
+                yield Payment(*row)
+            condition, cursor = "(ts, payment_hash) > (?, ?)", (batch[-1][5], batch[-1][0])
+
+    # ============ 导出 ============
+
+    def export_csv(self, start: int, end: int, granularity: int = DAY,
+                   by: Sequence[str] = DIMENSIONS, **filters) -> Iterator[str]:
+        """按时间桶聚合的CSV（逐块生成，可直接作为流式响应体）"""
+        by = _check_dimensions(by)
+        columns = ("bucket", *by, "amount", "count")
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for i, row in enumerate(self._rollups(start, end, granularity, by, filters, per_bucket=True), 1):
+            writer.writerow([row[c] for c in columns])
+            if i % 1000 == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    def export_parquet(self, destination, start: int, end: int, granularity: int = DAY,
+                       by: Sequence[str] = DIMENSIONS, row_group_size: int = 65536, **filters) -> int:
+        """
+        按时间桶聚合写出 Parquet（需要 pyarrow，按行组分批写出）
+
+        Args:
+            destination: 文件路径或可写的二进制文件对象
+
+        Returns:
+            写出的行数
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Parquet export requires pyarrow: pip3 install pyarrow") from None
+
+        by = _check_dimensions(by)
+        schema = pa.schema([("bucket", pa.int64()), *((name, pa.string()) for name in by),
+                            ("amount", pa.int64()), ("count", pa.int64())])
+        written = 0
+        with pq.ParquetWriter(destination, schema) as writer:
+            chunk = []
+            for row in self._rollups(start, end, granularity, by, filters, per_bucket=True):
+                chunk.append(row)
+                if len(chunk) >= row_group_size:
+                    writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+                    written += len(chunk)
+                    chunk = []
+            if chunk or not written:
+                writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+                written += len(chunk)
+        return written
+
+    # ============ 内部实现 ============
+
+    @staticmethod
+    def _where(filters: Dict[str, str]) -> Tuple[str, list]:
+        names = _check_dimensions(filters)
+        return "".join(f" AND {name} = ?" for name in names), [filters[name] for name in names]
+
+    def _rollups(self, start: int, end: int, granularity: int, by: Sequence[str],
+                 filters: Dict[str, str], per_bucket: bool) -> Iterator[Dict]:
+        if granularity not in (HOUR, DAY):
+            raise ValueError(f"unsupported granularity: {granularity}")
+        by = _check_dimensions(by)
+        group = ("bucket", *by) if per_bucket else by
+        columns = (*group, "amount", "count")
+        used = set(by) | set(_check_dimensions(filters))
+        if len(used) <= 1:
+            # 单维度：读 rollups，维度值在 key 列
+            dimension = used.pop() if used else _TOTAL
+            table = "rollups"
+            select = ", ".join("key" if name == dimension else name for name in group)
+            where = " AND dimension = ?" + (" AND key = ?" if filters else "")
+            params = [dimension, *filters.values()]
+        else:
+            table = "combos"
+            select = ", ".join(group)
+            where, params = self._where(filters)
+        group_by = f" GROUP BY {select} ORDER BY {select}" if group else ""
+
+        first = start // granularity * granularity
+        if not per_bucket:
+            # 合计查询一次完成
+            windows: Iterable[Tuple[int, int]] = ((first, end),)
+        else:
+            # 按时间桶的序列分段查询，避免一次取出整个区间；每段从索引中实际存在的下一个桶开始，
+            # 跳过没有数据的区间
+            windows = self._windows(table, granularity, where, params, first, end, granularity * _EXPORT_BUCKETS)
+        for window, window_end in windows:
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT {select + ', ' if select else ''}SUM(amount), SUM(count) FROM {table} "
+                    f"WHERE granularity = ?{where} AND bucket >= ? AND bucket < ?{group_by}",
+                    (granularity, *params, window, window_end)
+                ).fetchall()
+            for row in rows:
+                if row[-1] is None:  # 无分组时空区间返回一行 NULL
+                    continue
+                yield dict(zip(columns, row))
+
+    def _windows(self, table: str, granularity: int, where: str, params: list, start: int, end: int,
+                 step: int) -> Iterator[Tuple[int, int]]:
+        """[start, end) 内的查询分段：每段从下一个存在数据的桶开始，长度不超过 step"""
+        cursor = start
+        while cursor < end:
+            with self._lock:
+                (bucket,) = self._conn.execute(
+                    f"SELECT MIN(bucket) FROM {table} WHERE granularity = ?{where} AND bucket >= ? AND bucket < ?",
+                    (granularity, *params, cursor, end)
+                ).fetchone()
+            if bucket is None:
+                return
+            cursor = min(bucket + step, end)
+            yield bucket, cursor
+
+
+def parse_range(args, default_days: int = 7, max_days: int = MAX_RANGE_DAYS) -> Tuple[int, int]:
+    """
+    从查询参数 start / end（UNIX秒）取时间范围，默认最近 default_days 天（按日对齐）
+
+    Raises:
+        ValueError: 不是整数、start 不早于 end，或跨度超过 max_days 天
+    """
+    end = int(args.get("end") or (int(time.time()) // DAY + 1) * DAY)
+    start = int(args.get("start") or end - default_days * DAY)
+    if start >= end:
+        raise ValueError("start must be before end")
+    if end - start > max_days * DAY:
+        raise ValueError(f"range must not exceed {max_days} days")
+    return start, end
+
+
+def parse_query(args) -> Dict:
+    """
+    把HTTP查询参数转换为 PaymentStore 查询参数
+
+    支持 start、end、granularity（hour/day）、by（逗号分隔的维度）及各维度过滤。
+
+    Raises:
+        ValueError: 参数无效
+    """
+    start, end = parse_range(args)
+    granularity = GRANULARITIES.get(args.get("granularity", "day"))
+    if granularity is None:
+        raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+    by = _check_dimensions(name for name in args.get("by", "agent_id").split(",") if name)
+    filters = {name: args[name] for name in DIMENSIONS if args.get(name)}
+    return {"start": start, "end": end, "granularity": granularity, "by": by, **filters}
@@ -0,0 +1,210 @@
+"""
+ACPay Spending Ledger - 列式（NumPy）Agent 消费规则账本
+为编排器批量预检支付意图，语义与合约 _validatePayment 保持一致
+"""
+
+import time
+import numpy as np
+from typing import Dict, Iterable, Optional, Sequence, Tuple, Union
+
+SECONDS_PER_DAY = 86400
+INT64_MAX = np.iinfo(np.int64).max
+
+# 原因码（check 返回）
+REASON_OK = 0
+REASON_UNKNOWN_AGENT = 1       # 未注册：合约中 agentRules 为零值，等同规则未启用
+REASON_RULES_DISABLED = 2      # rules.enabled == false
+REASON_INVALID_AMOUNT = 3      # amount == 0（validAmount 修饰符）
+REASON_TRANSACTION_LIMIT = 4   # 超出单笔限额
+REASON_DAILY_LIMIT = 5         # 超出日限额
+
+REASON_NAMES = {
+    REASON_OK: "ok",
+    REASON_UNKNOWN_AGENT: "unknown_agent",
+    REASON_RULES_DISABLED: "rules_disabled",
+    REASON_INVALID_AMOUNT: "invalid_amount",
+    REASON_TRANSACTION_LIMIT: "transaction_limit",
+    REASON_DAILY_LIMIT: "daily_limit",
+}
+
+AgentKeys = Union[Sequence[str], np.ndarray]
+
+
+def _is_integer(value) -> bool:
+    return isinstance(value, (int, np.integer)) and not isinstance(value, (bool, np.bool_))
+
+
+def _amounts(amounts: Iterable[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    金额转为 int64，不回绕、不截断
+
+    Returns:
+        (int64 金额数组, 超出 int64 的掩码)；超出的金额在数组中记为 INT64_MAX
+
+    Raises:
+        ValueError: 含非整数金额（浮点数、布尔值等，与合约 uint256 参数一样不接受）
+    """
+    raw = np.asarray(amounts)
+    if raw.size == 0:
+        return np.zeros(raw.shape, dtype=np.int64), np.zeros(raw.shape, dtype=np.bool_)
+    if raw.dtype.kind == "i":
+        return raw.astype(np.int64, copy=False), np.zeros(raw.shape, dtype=np.bool_)
+    if raw.dtype.kind == "u":
+        too_large = raw > INT64_MAX
+    elif raw.dtype.kind == "O":
+        if not all(_is_integer(a) for a in raw.ravel()):
+            raise ValueError("amounts must be integers (USDT wei)")
+        too_large = np.fromiter((int(a) > INT64_MAX for a in raw.ravel()), dtype=np.bool_, count=raw.size)
+        too_large = too_large.reshape(raw.shape)
+    else:
+        raise ValueError(f"amounts must be integers (USDT wei), got {raw.dtype}")
+    clamped = np.where(too_large, INT64_MAX, raw).astype(np.int64)
+    return clamped, too_large
+
+
+class SpendingLedger:
+    """
+    列式消费账本
+
+    每个Agent占一行，规则与当日消费存放在并行数组中：
+    daily_limit / transaction_limit / enabled / spent / day
+    金额单位为 USDT wei（6位小数），使用 int64 存储（上限约 9.2e12 USDT）。
+    """
+
+    def __init__(self, capacity: int = 1024):
+        capacity = max(1, capacity)
+        self._index: Dict[str, int] = {}
+        self._size = 0
+        self.daily_limit = np.zeros(capacity, dtype=np.int64)
+        self.transaction_limit = np.zeros(capacity, dtype=np.int64)
+        self.enabled = np.zeros(capacity, dtype=np.bool_)
+        self.spent = np.zeros(capacity, dtype=np.int64)
+        self.day = np.full(capacity, -1, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, agent_id: str) -> bool:
+        return agent_id in self._index
+
+    def _grow(self, min_capacity: int) -> None:
+        capacity = len(self.spent)
+        while capacity < min_capacity:
+            capacity *= 2
+        for name in ("daily_limit", "transaction_limit", "enabled", "spent", "day"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype) if name != "day" else np.full(capacity, -1, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def register(self, agent_id: str, daily_limit: int, transaction_limit: int,
+                 enabled: bool = True) -> int:
+        """注册Agent（或更新已有Agent的规则），返回行号"""
+        row = self._index.get(agent_id)
+        if row is None:
+            if self._size == len(self.spent):
+                self._grow(self._size + 1)
+            row = self._size
+            self._index[agent_id] = row
+            self._size += 1
+        self.set_rules(row, daily_limit, transaction_limit, enabled)
+        return row
+
+    def set_rules(self, agent: Union[str, int], daily_limit: int, transaction_limit: int,
+                  enabled: bool = True) -> None:
+        """设置支付规则（对应 setPaymentRules）"""
+        if daily_limit < transaction_limit:
+            raise ValueError("daily limit must be >= transaction limit")
+        row = self._index[agent] if isinstance(agent, str) else agent
+        self.daily_limit[row] = daily_limit
+        self.transaction_limit[row] = transaction_limit
+        self.enabled[row] = enabled
+
+    def set_spending(self, agent_id: str, amount: int, now: Optional[float] = None) -> None:
+        """直接写入某Agent的当日消费（用于从链上 getTodaySpending 同步）"""
+        row = self._index[agent_id]
+        self.spent[row] = amount
+        self.day[row] = int(time.time() if now is None else now) // SECONDS_PER_DAY
+
+    def index_of(self, agent_ids: AgentKeys) -> np.ndarray:
+        """把Agent ID映射为行号数组，未注册的为 -1；整数数组原样返回"""
+        if isinstance(agent_ids, np.ndarray) and agent_ids.dtype.kind in "iu":
+            return agent_ids.astype(np.int64, copy=False)
+        get = self._index.get
+        return np.fromiter((get(a, -1) for a in agent_ids), dtype=np.int64, count=len(agent_ids))
+
+    def today_spending(self, agent_ids: AgentKeys, now: Optional[float] = None) -> np.ndarray:
+        """批量查询今日消费（对应 getTodaySpending，跨日后为 0）"""
+        rows = self.index_of(agent_ids)
+        today = int(time.time() if now is None else now) // SECONDS_PER_DAY
+        known = rows >= 0
+        safe = np.where(known, rows, 0)
+        same_day = known & (self.day[safe] == today)
+        return np.where(same_day, self.spent[safe], 0)
+
+    def check(self, agent_ids: AgentKeys, amounts: Iterable[int],
+              now: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        批量检查支付意图
+
+        每个意图独立地与当前账本状态比较（不互相累加），与逐笔调用 payByAgent 的结果一致。
+        原因按合约中检查的先后给出：onlyValidAgent（未注册）→ validAmount（金额为0）→
+        _validatePayment（规则未启用 → 单笔限额 → 日限额）。超出 int64 的金额不回绕，
+        按超出单笔限额拒绝（合约中 uint256 金额同样在单笔限额处失败）。
+
+        Args:
+            agent_ids: Agent ID 序列，或 index_of 返回的行号数组
+            amounts: 支付金额（USDT wei）
+            now: 当前时间戳（默认 time.time()），用于日期滚动
+
+        Returns:
+            (allowed, reasons)：bool 数组与 uint8 原因码数组
+
+        Raises:
+            ValueError: 含非整数金额，或 agent_ids 与 amounts 长度不一致
+        """
+        rows = self.index_of(agent_ids)
+        amounts, too_large = _amounts(amounts)
+        if rows.shape != amounts.shape:
+            raise ValueError("agent_ids and amounts must have the same length")
+
+        today = int(time.time() if now is None else now) // SECONDS_PER_DAY
+        known = rows >= 0
+        safe = np.where(known, rows, 0)
+
+        spent_today = np.where(self.day[safe] == today, self.spent[safe], 0)
+        # 与剩余额度比较，避免 spent + amount 溢出
+        over_daily = amounts > self.daily_limit[safe] - spent_today
+
+        # 按优先级从低到高覆盖，最终保留合约中最先失败的检查项
+        reasons = np.where(over_daily, REASON_DAILY_LIMIT, REASON_OK).astype(np.uint8)
+        reasons[(amounts > self.transaction_limit[safe]) | too_large] = REASON_TRANSACTION_LIMIT
+        reasons[~self.enabled[safe]] = REASON_RULES_DISABLED
+        reasons[amounts <= 0] = REASON_INVALID_AMOUNT
+        reasons[~known] = REASON_UNKNOWN_AGENT
+
+        return reasons == REASON_OK, reasons
+
+    def record(self, agent_ids: AgentKeys, amounts: Iterable[int],
+               now: Optional[float] = None) -> None:
+        """
+        记录已执行的支付（对应 _updateSpending）
+
+        跨日的Agent先清零再累加；同一批次中同一Agent的多笔支付会正确累加。
+
+        Raises:
+            KeyError: 含未注册的Agent
+            ValueError: 金额不是整数或超出 int64
+        """
+        rows = self.index_of(agent_ids)
+        amounts, too_large = _amounts(amounts)
+        if np.any(rows < 0):
+            raise KeyError("cannot record spending for unknown agent")
+        if np.any(too_large):
+            raise ValueError("amount does not fit in int64")
+
+        today = int(time.time() if now is None else now) // SECONDS_PER_DAY
+        stale = rows[self.day[rows] != today]
+        self.spent[stale] = 0
+        self.day[stale] = today
+        np.add.at(self.spent, rows, amounts)
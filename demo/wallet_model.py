@@ -0,0 +1,390 @@
+"""
+ACPay Wallet Model - BuyerWallet 合约语义的纯 Python 模型
+
+用于容量规划与规则测试：不连链、不验签，按合约修饰符与 require 的顺序执行每个
+外部函数；失败时抛出 WalletRevert（原因字符串与合约 revert 原因相同），且不修改任何状态：
+
+    model = WalletModel(daily_limit=100 * 10**6, transaction_limit=10 * 10**6, owner=owner)
+    model.deposit(1_000 * 10**6)
+    model.register_agent("weather-agent", "Weather", signer)
+    model.pay_by_agent("weather-agent", recipient, 2 * 10**6, "/api/weather", 1, deadline, signer)
+    model.advance(86400)                      # 区块时间前进一天，日消费归零
+    model.get_today_spending("weather-agent")
+
+- 签名：调用方给出签名恢复出的地址（signer，无效签名传 None），模型只与登记的签名地址比较
+- 区块时间：model.timestamp（advance 或直接赋值），每次调用视为在该时间的区块中执行
+- 调用方：sender 为 None 表示 owner；Owner 函数收到其他地址时按 onlyOwner 拒绝
+- 代币：balance 为合约的 USDT 余额，received 为每个地址从合约收到的金额；
+  deposit 不模拟 owner 侧的余额与授权
+- 地址按原样比较，调用方应统一使用校验和地址
+
+与链上合约的一致性由 wallet_parity.py 在本地节点上对拍验证。
+"""
+
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from buyer_wallet import x402_payment_hash
+from x402_records import X402PaymentInfo, X402PaymentProof
+
+SECONDS_PER_DAY = 86400
+ZERO_ADDRESS = "0x0000000000000000000000000000000000000000"
+ZERO_HASH = b"\x00" * 32
+UINT64_MAX = (1 << 64) - 1
+DEFAULT_AGGREGATION_THRESHOLD = 50 * 10**6
+
+
+class WalletRevert(RuntimeError):
+    """调用被合约拒绝（args[0] 为 revert 原因，如 "BuyerWallet: invalid nonce"）"""
+
+    @property
+    def reason(self) -> str:
+        return self.args[0]
+
+
+class PaymentRules(NamedTuple):
+    """对应合约 PaymentRules"""
+    daily_limit: int
+    transaction_limit: int
+    enabled: bool
+
+
+class PendingPayment(NamedTuple):
+    """对应合约 PendingPayment"""
+    agent_id: str
+    recipient: str
+    amount: int
+    metadata: str
+    timestamp: int
+
+
+_NO_RULES = PaymentRules(0, 0, False)
+
+
+class AgentState:
+    """一个Agent的全部状态（合约中分布在 agents / agentRules / dailySpending / agentNonces）"""
+
+    __slots__ = ("agent_id", "name", "signer", "active", "total_spent", "registered_at",
+                 "rules", "day", "day_amount", "nonce")
+
+    def __init__(self, agent_id: str, name: str, signer: str, registered_at: int, rules: PaymentRules):
+        self.agent_id = agent_id
+        self.name = name
+        self.signer = signer
+        self.active = True
+        self.total_spent = 0
+        self.registered_at = registered_at
+        self.rules = rules
+        self.day = 0              # dailySpending.date
+        self.day_amount = 0       # dailySpending.amount
+        self.nonce = 0
+
+
+class WalletModel:
+    """BuyerWallet 的内存模型（单线程使用）"""
+
+    def __init__(self, daily_limit: int, transaction_limit: int, owner: Optional[str] = None,
+                 timestamp: Optional[int] = None):
+        """
+        Args:
+            daily_limit, transaction_limit: 构造函数中的默认规则
+            owner: 合约所有者地址（sender 为 None 的调用视为 owner）
+            timestamp: 初始区块时间（默认当前时间）
+        """
+        self.owner = owner
+        self.timestamp = int(time.time()) if timestamp is None else timestamp
+        self.paused = False
+        self.aggregation_threshold = DEFAULT_AGGREGATION_THRESHOLD
+        self.default_rules = PaymentRules(daily_limit, transaction_limit, True)
+        self.agents: Dict[str, AgentState] = {}
+        self.agent_list: List[str] = []
+        self.pending_payments: List[PendingPayment] = []
+        self.pending_amounts: Dict[str, int] = {}
+        self.pool_addresses: List[str] = []
+        self.pools = set()
+        self.receipts: Dict[bytes, Tuple[str, int, int, str, str]] = {}
+        self.balance = 0
+        self.received: Dict[str, int] = {}
+        # 统计（容量规划用）
+        self.direct_payments = 0
+        self.pooled_payments = 0
+        self.aggregations = 0
+
+    def advance(self, seconds: int) -> int:
+        """区块时间前进 seconds 秒，返回新的时间"""
+        self.timestamp += seconds
+        return self.timestamp
+
+    # ============ Agent 与规则管理 ============
+
+    def register_agent(self, agent_id: str, name: str, signer: str, sender: Optional[str] = None) -> None:
+        self._only_owner(sender)
+        self._valid_address(signer)
+        self._when_not_paused()
+        if not agent_id:
+            raise WalletRevert("BuyerWallet: agentId cannot be empty")
+        if not name:
+            raise WalletRevert("BuyerWallet: name cannot be empty")
+        if agent_id in self.agents:
+            raise WalletRevert("BuyerWallet: agent already registered")
+        self.agents[agent_id] = AgentState(agent_id, name, signer, self.timestamp, self.default_rules)
+        self.agent_list.append(agent_id)
+
+    def update_agent(self, agent_id: str, name: str, signer: str, active: bool,
+                     sender: Optional[str] = None) -> None:
+        self._only_owner(sender)
+        self._valid_address(signer)
+        agent = self.agents.get(agent_id)
+        if agent is None:
+            raise WalletRevert("BuyerWallet: agent not found")
+        if not name:
+            raise WalletRevert("BuyerWallet: name cannot be empty")
+        agent.name = name
+        agent.signer = signer
+        agent.active = active
+
+    def set_payment_rules(self, agent_id: str, daily_limit: int, transaction_limit: int, enabled: bool,
+                          sender: Optional[str] = None) -> None:
+        """agent_id 为空字符串时设置默认规则（只影响之后注册的Agent）"""
+        self._only_owner(sender)
+        if daily_limit < transaction_limit:
+            raise WalletRevert("BuyerWallet: daily limit must be >= transaction limit")
+        rules = PaymentRules(daily_limit, transaction_limit, enabled)
+        if not agent_id:
+            self.default_rules = rules
+            return
+        agent = self.agents.get(agent_id)
+        if agent is None:
+            raise WalletRevert("BuyerWallet: agent not found")
+        agent.rules = rules
+
+    def get_payment_rules(self, agent_id: str) -> PaymentRules:
+        agent = self.agents.get(agent_id)
+        return self.default_rules if agent is None else agent.rules
+
+    def agent_rules(self, agent_id: str) -> PaymentRules:
+        """agentRules 映射（未注册为零值）"""
+        agent = self.agents.get(agent_id)
+        return _NO_RULES if agent is None else agent.rules
+
+    def agent_nonce(self, agent_id: str) -> int:
+        agent = self.agents.get(agent_id)
+        return 0 if agent is None else agent.nonce
+
+    def get_today_spending(self, agent_id: str) -> int:
+        agent = self.agents.get(agent_id)
+        if agent is None or agent.day != self.timestamp // SECONDS_PER_DAY:
+            return 0
+        return agent.day_amount
+
+    # ============ 支付 ============
+
+    def pay_by_agent(self, agent_id: str, recipient: str, amount: int, metadata: str, nonce: int,
+                     deadline: int, signer: Optional[str]) -> None:
+        """
+        Agent 签名授权的支付：收款方为池子地址时进入待聚合队列，否则立即转账
+
+        Args:
+            signer: 签名恢复出的地址（无效签名为 None）
+        """
+        agent = self._valid_agent(agent_id, nonce, deadline, signer)
+        self._valid_address(recipient)
+        self._valid_amount(amount)
+        self._when_not_paused()
+        self._pay(agent, recipient, amount, metadata)
+
+    def pay_x402(self, info: X402PaymentInfo, signer: Optional[str]) -> bytes:
+        """x402 支付并记录支付证明（API端点作为 metadata，expiry 作为 deadline），返回支付哈希"""
+        agent = self._valid_agent(info.agent_id, info.nonce, info.expiry, signer)
+        self._valid_address(info.recipient)
+        self._valid_amount(info.amount)
+        self._when_not_paused()
+        if info.amount > UINT64_MAX:
+            raise WalletRevert("BuyerWallet: amount too large")
+        self._check_rules(agent, info.amount)   # 先检查规则：被拒绝的支付不计算哈希
+        payment_hash = x402_payment_hash(info)
+        self._pay(agent, info.recipient, info.amount, info.api_endpoint)
+        self.receipts[payment_hash] = (info.recipient, info.amount, self.timestamp & 0xFFFFFFFF,
+                                       info.agent_id, info.api_endpoint)
+        return payment_hash
+
+    def pay_direct(self, agent_id: str, recipient: str, amount: int, metadata: str,
+                   sender: Optional[str] = None) -> None:
+        """Owner 直接支付：不检查 isActive 与签名，也不走池子聚合"""
+        self._only_owner(sender)
+        self._valid_address(recipient)
+        self._valid_amount(amount)
+        self._when_not_paused()
+        agent = self.agents.get(agent_id)
+        if agent is None:
+            raise WalletRevert("BuyerWallet: agent not found")
+        self._check_rules(agent, amount)
+        self._check_balance(amount)
+        self._spend(agent, amount)
+        self._transfer(recipient, amount)
+        self.direct_payments += 1
+
+    def x402_proof(self, payment_hash: bytes) -> X402PaymentProof:
+        """对应 verifyX402Payment（不存在时为零值证明）"""
+        receipt = self.receipts.get(payment_hash)
+        if receipt is None:
+            return X402PaymentProof(ZERO_HASH, "", ZERO_ADDRESS, 0, "", 0, ZERO_HASH)
+        recipient, amount, timestamp, agent_id, api_endpoint = receipt
+        return X402PaymentProof(payment_hash, agent_id, recipient, amount, api_endpoint, timestamp, ZERO_HASH)
+
+    # ============ 聚合与池子 ============
+
+    def force_aggregate_payment(self, recipient: str, sender: Optional[str] = None) -> None:
+        self._only_owner(sender)
+        self._valid_address(recipient)
+        if not self.pending_amounts.get(recipient):
+            raise WalletRevert("BuyerWallet: no pending payments for recipient")
+        self._check_balance(self.pending_amounts[recipient])
+        self._aggregate(recipient)
+
+    def add_pool_address(self, pool: str, sender: Optional[str] = None) -> None:
+        self._only_owner(sender)
+        self._valid_address(pool)
+        if pool in self.pools:
+            raise WalletRevert("BuyerWallet: pool address already exists")
+        self.pools.add(pool)
+        self.pool_addresses.append(pool)
+
+    def remove_pool_address(self, pool: str, sender: Optional[str] = None) -> None:
+        """与合约相同的 swap-and-pop（poolAddresses 的顺序一致）；已暂存的金额保留"""
+        self._only_owner(sender)
+        self._valid_address(pool)
+        if pool not in self.pools:
+            raise WalletRevert("BuyerWallet: pool address not found")
+        self.pools.discard(pool)
+        i = self.pool_addresses.index(pool)
+        self.pool_addresses[i] = self.pool_addresses[-1]
+        self.pool_addresses.pop()
+
+    def set_aggregation_threshold(self, threshold: int, sender: Optional[str] = None) -> None:
+        self._only_owner(sender)
+        self._valid_amount(threshold)
+        self.aggregation_threshold = threshold
+
+    # ============ 管理 ============
+
+    def pause(self, sender: Optional[str] = None) -> None:
+        self._only_owner(sender)
+        self.paused = True
+
+    def unpause(self, sender: Optional[str] = None) -> None:
+        self._only_owner(sender)
+        self.paused = False
+
+    def deposit(self, amount: int, sender: Optional[str] = None) -> None:
+        self._only_owner(sender)
+        self._valid_amount(amount)
+        self.balance += amount
+
+    def withdraw(self, amount: int, sender: Optional[str] = None) -> None:
+        self._only_owner(sender)
+        self._valid_amount(amount)
+        self._check_balance(amount)
+        self._transfer(self.owner, amount)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "agents": len(self.agent_list),
+            "direct_payments": self.direct_payments,
+            "pooled_payments": self.pooled_payments,
+            "aggregations": self.aggregations,
+            "pending_payments": len(self.pending_payments),
+            "pending_amount": sum(self.pending_amounts.values()),
+            "balance": self.balance,
+        }
+
+    # ============ 内部实现 ============
+    # 检查全部在修改状态之前完成：任何一步失败都等同于整笔交易回滚
+
+    def _only_owner(self, sender: Optional[str]) -> None:
+        if sender is not None and sender != self.owner:
+            raise WalletRevert("BuyerWallet: caller is not the owner")
+
+    def _when_not_paused(self) -> None:
+        if self.paused:
+            raise WalletRevert("BuyerWallet: contract is paused")
+
+    @staticmethod
+    def _valid_address(address: Optional[str]) -> None:
+        if not address or address == ZERO_ADDRESS:
+            raise WalletRevert("BuyerWallet: invalid address")
+
+    @staticmethod
+    def _valid_amount(amount: int) -> None:
+        if amount <= 0:
+            raise WalletRevert("BuyerWallet: invalid amount")
+
+    def _valid_agent(self, agent_id: str, nonce: int, deadline: int, signer: Optional[str]) -> AgentState:
+        """onlyValidAgent 修饰符（nonce 在整笔调用成功后才递增）"""
+        agent = self.agents.get(agent_id)
+        if agent is None or not agent.active:
+            raise WalletRevert("BuyerWallet: agent not active")
+        if self.timestamp > deadline:
+            raise WalletRevert("BuyerWallet: authorization expired")
+        if nonce != agent.nonce + 1:
+            raise WalletRevert("BuyerWallet: invalid nonce")
+        if signer is None or signer == ZERO_ADDRESS or signer != agent.signer:
+            raise WalletRevert("BuyerWallet: invalid signature")
+        return agent
+
+    def _check_rules(self, agent: AgentState, amount: int) -> None:
+        """_validatePayment"""
+        rules = agent.rules
+        if not rules.enabled or amount > rules.transaction_limit:
+            raise WalletRevert("BuyerWallet: payment violates rules")
+        spent = agent.day_amount if agent.day == self.timestamp // SECONDS_PER_DAY else 0
+        if spent + amount > rules.daily_limit:
+            raise WalletRevert("BuyerWallet: payment violates rules")
+
+    def _check_balance(self, amount: int) -> None:
+        if self.balance < amount:
+            raise WalletRevert("BuyerWallet: insufficient contract balance")
+
+    def _pay(self, agent: AgentState, recipient: str, amount: int, metadata: str) -> None:
+        """payByAgent / payX402 的主体（签名检查之后）"""
+        self._check_rules(agent, amount)
+        if recipient in self.pools:
+            pending = self.pending_amounts.get(recipient, 0) + amount
+            aggregate = pending >= self.aggregation_threshold
+            if aggregate:
+                self._check_balance(pending)
+            agent.nonce += 1
+            self._spend(agent, amount)
+            self.pending_payments.append(PendingPayment(agent.agent_id, recipient, amount, metadata,
+                                                        self.timestamp))
+            self.pending_amounts[recipient] = pending
+            self.pooled_payments += 1
+            if aggregate:
+                self._aggregate(recipient)
+        else:
+            self._check_balance(amount)
+            agent.nonce += 1
+            self._spend(agent, amount)
+            self._transfer(recipient, amount)
+            self.direct_payments += 1
+
+    def _spend(self, agent: AgentState, amount: int) -> None:
+        """_updateSpending"""
+        today = self.timestamp // SECONDS_PER_DAY
+        if agent.day != today:
+            agent.day = today
+            agent.day_amount = amount
+        else:
+            agent.day_amount += amount
+        agent.total_spent += amount
+
+    def _transfer(self, recipient: str, amount: int) -> None:
+        self.balance -= amount
+        self.received[recipient] = self.received.get(recipient, 0) + amount
+
+    def _aggregate(self, recipient: str) -> None:
+        """_executeAggregatedPayment（余额已检查）：转出暂存总额，按原顺序移除该收款方的待聚合支付"""
+        self._transfer(recipient, self.pending_amounts[recipient])
+        self.pending_amounts[recipient] = 0
+        self.pending_payments = [p for p in self.pending_payments if p.recipient != recipient]
+        self.aggregations += 1
@@ -0,0 +1,449 @@
+"""
+ACPay Wallet Parity - WalletModel 与 BuyerWallet 合约的差分对拍
+
+在本地节点（anvil）上为每个随机种子部署一套 MockUSDT + BuyerWallet，生成随机操作序列
+（注册/更新Agent、规则、签名支付、x402 支付、池子聚合、暂停、存取款，以及错误的
+nonce、签名、截止时间、调用方与金额），逐笔同时应用到合约与 WalletModel：
+
+- 每笔操作的结果（成功，或 revert 原因字符串）必须一致
+- 每 check_every 笔比较一次全部可读状态（Agent、规则、日消费、nonce、待聚合队列、
+  池子列表、余额、收款方余额、x402 证明）
+
+    anvil &                                   # 本地节点
+    forge build                               # 在仓库根目录生成 out/ 产物
+    python3 wallet_parity.py                  # 种子 0..9，每个序列 200 笔操作
+    python3 wallet_parity.py --seeds 50 --ops 500 --check-every 10
+    python3 wallet_parity.py --seed 42        # 复现单个序列
+
+区块时间由 evm_setNextBlockTimestamp 与模型同步推进（偶尔跨日）；失败交易的 revert 原因
+在其所在区块上以 eth_call 重放取得。不一致时打印种子、操作序号与差异并以状态 1 退出。
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from eth_abi import decode
+from eth_account import Account
+from web3 import Web3
+from web3.exceptions import ContractLogicError
+
+from buyer_wallet import AgentSigner, x402_payment_hash
+from wallet_model import ZERO_ADDRESS, WalletModel, WalletRevert
+from x402_records import X402PaymentInfo
+
+E2E_RPC = os.getenv("ACPAY_E2E_RPC", "http://127.0.0.1:8545")
+ARTIFACTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "out")
+WALLET_ARTIFACT = os.path.join(ARTIFACTS_DIR, "BuyerWallet.sol", "BuyerWallet.json")
+USDT_ARTIFACT = os.path.join(ARTIFACTS_DIR, "BuyerWallet.t.sol", "MockUSDT.json")
+
+TX_GAS = 10_000_000
+DEPOSIT_CAP = 900_000 * 10**6     # MockUSDT 给部署账户 1M，存款总额不超过该值
+USDT = 10**6
+
+_ERROR_SELECTOR = bytes.fromhex("08c379a0")   # Error(string)
+_PANIC_SELECTOR = bytes.fromhex("4e487b71")   # Panic(uint256)
+
+# 操作及其相对权重
+WEIGHTS = {
+    "pay_by_agent": 30, "pay_x402": 15, "pay_direct": 5, "register_agent": 6, "update_agent": 4,
+    "set_payment_rules": 6, "add_pool_address": 4, "remove_pool_address": 2, "force_aggregate_payment": 3,
+    "set_aggregation_threshold": 2, "pause": 2, "unpause": 3, "deposit": 8, "withdraw": 3,
+}
+
+
+class ParityError(AssertionError):
+    """模型与合约的结果或状态不一致"""
+
+
+class Operation(NamedTuple):
+    """一笔随机操作：同一调用的模型形式与合约形式"""
+    name: str
+    model_args: tuple
+    chain_args: tuple
+    sender: str
+    owner_call: bool                               # Owner 函数：模型按 sender 判断 onlyOwner
+    on_success: Optional[Callable[[], None]] = None
+
+    def describe(self) -> str:
+        args = ", ".join(a.hex() if isinstance(a, bytes) else repr(a) for a in self.model_args)
+        return f"{self.name}({args}) from {self.sender}"
+
+
+def artifacts_available() -> bool:
+    return os.path.exists(WALLET_ARTIFACT) and os.path.exists(USDT_ARTIFACT)
+
+
+def deploy_contracts(w3: Web3, daily_limit: int, transaction_limit: int):
+    """
+    以 w3.eth.default_account 部署 MockUSDT 与 BuyerWallet（需要 forge build 产物）
+
+    Returns:
+        (usdt, wallet) 合约对象
+    """
+    def deploy(path, *args):
+        with open(path) as f:
+            artifact = json.load(f)
+        factory = w3.eth.contract(abi=artifact["abi"], bytecode=artifact["bytecode"]["object"])
+        receipt = w3.eth.wait_for_transaction_receipt(factory.constructor(*args).transact())
+        return w3.eth.contract(address=receipt.contractAddress, abi=artifact["abi"])
+
+    usdt = deploy(USDT_ARTIFACT)
+    wallet = deploy(WALLET_ARTIFACT, usdt.address, daily_limit, transaction_limit)
+    return usdt, wallet
+
+
+def revert_reason(data) -> str:
+    """从 revert 数据解析原因（Error(string) 返回字符串本身）"""
+    raw = bytes.fromhex(data[2:]) if isinstance(data, str) else bytes(data or b"")
+    if raw[:4] == _ERROR_SELECTOR:
+        return decode(["string"], raw[4:])[0]
+    if raw[:4] == _PANIC_SELECTOR:
+        return f"panic 0x{int.from_bytes(raw[4:36], 'big'):02x}"
+    return f"revert 0x{raw.hex()}"
+
+
+class ParityRun:
+    """一个随机种子的对拍：全新部署的合约 + 全新的 WalletModel"""
+
+    def __init__(self, w3: Web3, seed: int, daily_limit: int = 50 * USDT, transaction_limit: int = 10 * USDT,
+                 agents: int = 5, recipients: int = 6):
+        self.w3 = w3
+        self.seed = seed
+        self.rng = random.Random(seed)
+        accounts = w3.eth.accounts
+        self.owner, self.stranger, self.submitter = accounts[0], accounts[1], accounts[2]
+        w3.eth.default_account = self.owner
+
+        self.usdt, self.wallet = deploy_contracts(w3, daily_limit, transaction_limit)
+        self.usdt.functions.approve(self.wallet.address, DEPOSIT_CAP).transact()
+        latest = w3.eth.get_block("latest")
+        self.block = latest.number
+        self.model = WalletModel(daily_limit, transaction_limit, owner=self.owner, timestamp=latest.timestamp)
+        self.chain_id = w3.eth.chain_id
+
+        self.agent_ids = [f"agent-{i}" for i in range(agents)] + ["ghost-agent"]
+        self.addresses = [self._new_account().address for _ in range(recipients)]
+        self.keys: Dict[str, Any] = {agent_id: self._new_account() for agent_id in self.agent_ids}
+        self.hashes: List[bytes] = []
+        self.deposited = 0
+        self.outcomes = Counter()
+
+    # ============ 运行 ============
+
+    def run(self, ops: int, check_every: int = 1) -> Counter:
+        """执行 ops 笔随机操作，返回结果计数（"ok" 或 revert 原因）"""
+        for i in range(1, ops + 1):
+            op = self.next_operation()
+            self.model.advance(self._time_step())
+            expected = self._apply_model(op)
+            actual = self._apply_chain(op)
+            if expected != actual:
+                raise ParityError(f"seed {self.seed} op {i}: {op.describe()}\n"
+                                  f"  model: {expected}\n  chain: {actual}")
+            if expected == "ok" and op.on_success is not None:
+                op.on_success()
+            self.outcomes[expected] += 1
+            if i % check_every == 0 or i == ops:
+                self.check_state(f"after op {i} ({op.name})")
+        return self.outcomes
+
+    def check_state(self, where: str = "") -> None:
+        """比较模型与合约的全部可读状态"""
+        expected = self.model_snapshot()
+        actual = self.chain_snapshot()
+        diffs = [f"  {key}: model={expected[key]!r} chain={actual[key]!r}"
+                 for key in expected if expected[key] != actual[key]]
+        if diffs:
+            raise ParityError(f"seed {self.seed} state mismatch {where}:\n" + "\n".join(diffs))
+
+    def _apply_model(self, op: Operation) -> str:
+        args = op.model_args
+        if op.owner_call:
+            args += (None if op.sender == self.owner else op.sender,)
+        try:
+            getattr(self.model, op.name)(*args)
+        except WalletRevert as e:
+            return e.reason
+        return "ok"
+
+    def _apply_chain(self, op: Operation) -> str:
+        fn = getattr(self.wallet.functions, _camel(op.name))(*op.chain_args)
+        tx = {"from": op.sender, "gas": TX_GAS}
+        response = self.w3.provider.make_request("evm_setNextBlockTimestamp", [self.model.timestamp])
+        if "error" in response:
+            raise RuntimeError(f"evm_setNextBlockTimestamp failed: {response['error']}")
+        receipt = self.w3.eth.wait_for_transaction_receipt(fn.transact(tx))
+        self.block = receipt.blockNumber
+        if receipt.status == 1:
+            return "ok"
+        # 失败交易没有改变合约状态：在同一区块（同一时间戳）上重放取得原因
+        try:
+            fn.call(tx, block_identifier=receipt.blockNumber)
+        except ContractLogicError as e:
+            return revert_reason(e.data)
+        return "reverted without reason"
+
+    # ============ 状态快照 ============
+
+    def model_snapshot(self) -> Dict[str, Any]:
+        m = self.model
+        agents, rules, daily = {}, {}, {}
+        for agent_id in self.agent_ids:
+            agent = m.agents.get(agent_id)
+            if agent is None:
+                agents[agent_id] = ("", "", ZERO_ADDRESS, False, 0, 0)
+                daily[agent_id] = (0, 0)
+            else:
+                agents[agent_id] = (agent.agent_id, agent.name, agent.signer, agent.active,
+                                    agent.total_spent, agent.registered_at)
+                daily[agent_id] = (agent.day, agent.day_amount)
+            rules[agent_id] = tuple(m.agent_rules(agent_id))
+        return {
+            "paused": m.paused,
+            "aggregationThreshold": m.aggregation_threshold,
+            "defaultRules": tuple(m.default_rules),
+            "contractBalance": m.balance,
+            "agentList": list(m.agent_list),
+            "pendingPayments": [tuple(p) for p in m.pending_payments],
+            "poolAddresses": list(m.pool_addresses),
+            "agents": agents,
+            "agentRules": rules,
+            "dailySpending": daily,
+            "getPaymentRules": {a: tuple(m.get_payment_rules(a)) for a in self.agent_ids},
+            "agentNonces": {a: m.agent_nonce(a) for a in self.agent_ids},
+            "getTodaySpending": {a: m.get_today_spending(a) for a in self.agent_ids},
+            "pendingAmounts": {r: m.pending_amounts.get(r, 0) for r in self.addresses},
+            "isPoolAddress": {r: r in m.pools for r in self.addresses},
+            "recipientBalances": {r: m.received.get(r, 0) for r in self.addresses},
+            "proofs": {h: tuple(m.x402_proof(h)) for h in self.hashes},
+        }
+
+    def chain_snapshot(self) -> Dict[str, Any]:
+        f = self.wallet.functions
+        block = self.block
+
+        def call(fn):
+            return fn.call(block_identifier=block)
+
+        return {
+            "paused": call(f.paused()),
+            "aggregationThreshold": call(f.aggregationThreshold()),
+            "defaultRules": tuple(call(f.defaultRules())),
+            "contractBalance": call(f.getContractBalance()),
+            "agentList": [call(f.agentList(i)) for i in range(call(f.getAgentCount()))],
+            "pendingPayments": [tuple(call(f.pendingPayments(i))) for i in range(call(f.getPendingPaymentCount()))],
+            "poolAddresses": [call(f.poolAddresses(i)) for i in range(call(f.getPoolAddressCount()))],
+            "agents": {a: tuple(call(f.agents(a))) for a in self.agent_ids},
+            "agentRules": {a: tuple(call(f.agentRules(a))) for a in self.agent_ids},
+            "dailySpending": {a: tuple(call(f.dailySpending(a))) for a in self.agent_ids},
+            "getPaymentRules": {a: tuple(call(f.getPaymentRules(a))) for a in self.agent_ids},
+            "agentNonces": {a: call(f.agentNonces(a)) for a in self.agent_ids},
+            "getTodaySpending": {a: call(f.getTodaySpending(a)) for a in self.agent_ids},
+            "pendingAmounts": {r: call(f.pendingAmounts(r)) for r in self.addresses},
+            "isPoolAddress": {r: call(f.isPoolAddress(r)) for r in self.addresses},
+            "recipientBalances": {r: call(self.usdt.functions.balanceOf(r)) for r in self.addresses},
+            "proofs": {h: tuple(call(f.verifyX402Payment(h))) for h in self.hashes},
+        }
+
+    # ============ 随机操作 ============
+
+    def next_operation(self) -> Operation:
+        name = self.rng.choices(list(WEIGHTS), weights=list(WEIGHTS.values()))[0]
+        return getattr(self, f"_gen_{name}")()
+
+    def _new_account(self):
+        return Account.from_key(self.rng.randbytes(32))
+
+    def _time_step(self) -> int:
+        """大多数操作相隔几秒到两分钟，偶尔跨过数小时到一天以上（日消费滚动）"""
+        if self.rng.random() < 0.08:
+            return self.rng.randint(3 * 3600, 30 * 3600)
+        return self.rng.randint(1, 120)
+
+    def _chance(self, p: float) -> bool:
+        return self.rng.random() < p
+
+    def _owner_sender(self) -> str:
+        return self.stranger if self._chance(0.05) else self.owner
+
+    def _agent_id(self) -> str:
+        if self._chance(0.04):
+            return ""
+        return self.rng.choice(self.agent_ids)
+
+    def _address(self) -> str:
+        return ZERO_ADDRESS if self._chance(0.03) else self.rng.choice(self.addresses)
+
+    def _amount(self) -> int:
+        if self._chance(0.04):
+            return 0
+        if self._chance(0.5):
+            return self.rng.randint(1, 12) * USDT
+        return self.rng.randint(1, 12 * USDT)
+
+    def _authorization(self, agent_id: str):
+        """(nonce, deadline, 签名账户或 None 表示格式错误的签名)"""
+        nonce = self.model.agent_nonce(agent_id) + 1
+        if self._chance(0.08):
+            nonce += self.rng.choice((-1, 1, 5))
+        # 交易的区块时间在生成之后才推进：截止时间以推进前的时间为基准
+        deadline = self.model.timestamp + 3600
+        if self._chance(0.05):
+            deadline = self.model.timestamp - 1
+        account = self.keys.get(agent_id) or self._new_account()
+        if self._chance(0.06):
+            account = self._new_account()
+        elif self._chance(0.03):
+            account = None
+        return max(nonce, 0), deadline, account
+
+    def _sign(self, account, agent_id, recipient, amount, metadata, nonce, deadline) -> bytes:
+        if account is None:
+            return b"\x01" * 64
+        signer = AgentSigner(account.key, self.chain_id, self.wallet.address)
+        return signer.sign(agent_id, recipient, amount, metadata, nonce, deadline)
+
+    def _gen_pay_by_agent(self) -> Operation:
+        agent_id, recipient, amount = self._agent_id(), self._address(), self._amount()
+        metadata = self.rng.choice(("/api/weather", "/api/search", "batch"))
+        nonce, deadline, account = self._authorization(agent_id)
+        signature = self._sign(account, agent_id, recipient, amount, metadata, nonce, deadline)
+        return Operation("pay_by_agent",
+                         (agent_id, recipient, amount, metadata, nonce, deadline, account and account.address),
+                         (agent_id, recipient, amount, metadata, signature, nonce, deadline),
+                         self.submitter, False)
+
+    def _gen_pay_x402(self) -> Operation:
+        agent_id, recipient = self._agent_id(), self._address()
+        amount = (1 << 64) if self._chance(0.03) else self._amount()
+        endpoint = self.rng.choice(("/x402/weather", "/x402/search"))
+        nonce, deadline, account = self._authorization(agent_id)
+        info = X402PaymentInfo(agent_id, recipient, amount, endpoint, nonce, deadline)
+        signature = self._sign(account, agent_id, recipient, amount, endpoint, nonce, deadline)
+        self.hashes.append(x402_payment_hash(info))   # 失败的支付也记录：合约与模型都不应有证明
+        return Operation("pay_x402", (info, account and account.address), (tuple(info[:6]), signature),
+                         self.submitter, False)
+
+    def _gen_pay_direct(self) -> Operation:
+        args = (self._agent_id(), self._address(), self._amount(), "owner payment")
+        return Operation("pay_direct", args, args, self._owner_sender(), True)
+
+    def _gen_register_agent(self) -> Operation:
+        agent_id = self._agent_id()
+        name = "" if self._chance(0.03) else f"Agent {agent_id}"
+        account = self._new_account()
+        signer = ZERO_ADDRESS if self._chance(0.03) else account.address
+
+        def commit():
+            self.keys[agent_id] = account
+
+        args = (agent_id, name, signer)
+        return Operation("register_agent", args, args, self._owner_sender(), True, commit)
+
+    def _gen_update_agent(self) -> Operation:
+        agent_id = self._agent_id()
+        name = "" if self._chance(0.03) else f"Agent {agent_id} v{self.rng.randint(2, 9)}"
+        account = self._new_account() if self._chance(0.3) else self.keys.get(agent_id) or self._new_account()
+        signer = ZERO_ADDRESS if self._chance(0.03) else account.address
+        active = self._chance(0.8)
+
+        def commit():
+            self.keys[agent_id] = account
+
+        args = (agent_id, name, signer, active)
+        return Operation("update_agent", args, args, self._owner_sender(), True, commit)
+
+    def _gen_set_payment_rules(self) -> Operation:
+        transaction_limit = self.rng.randint(1, 15) * USDT
+        daily_limit = transaction_limit * self.rng.randint(1, 8)
+        if self._chance(0.05):
+            daily_limit = transaction_limit - 1
+        args = (self._agent_id(), daily_limit, transaction_limit, self._chance(0.9))
+        return Operation("set_payment_rules", args, args, self._owner_sender(), True)
+
+    def _gen_add_pool_address(self) -> Operation:
+        args = (self._address(),)
+        return Operation("add_pool_address", args, args, self._owner_sender(), True)
+
+    def _gen_remove_pool_address(self) -> Operation:
+        args = (self._address(),)
+        return Operation("remove_pool_address", args, args, self._owner_sender(), True)
+
+    def _gen_force_aggregate_payment(self) -> Operation:
+        args = (self._address(),)
+        return Operation("force_aggregate_payment", args, args, self._owner_sender(), True)
+
+    def _gen_set_aggregation_threshold(self) -> Operation:
+        args = (0 if self._chance(0.05) else self.rng.randint(1, 80) * USDT,)
+        return Operation("set_aggregation_threshold", args, args, self._owner_sender(), True)
+
+    def _gen_pause(self) -> Operation:
+        return Operation("pause", (), (), self._owner_sender(), True)
+
+    def _gen_unpause(self) -> Operation:
+        return Operation("unpause", (), (), self._owner_sender(), True)
+
+    def _gen_deposit(self) -> Operation:
+        amount = 0 if self._chance(0.04) else self.rng.randint(1, 100) * USDT
+        if self.deposited + amount > DEPOSIT_CAP:
+            amount = 0
+        sender = self._owner_sender()
+
+        def commit():
+            self.deposited += amount
+
+        return Operation("deposit", (amount,), (amount,), sender, True, commit)
+
+    def _gen_withdraw(self) -> Operation:
+        amount = 0 if self._chance(0.04) else self.rng.randint(1, 60) * USDT
+        return Operation("withdraw", (amount,), (amount,), self._owner_sender(), True)
+
+
+def _camel(name: str) -> str:
+    """pay_by_agent -> payByAgent"""
+    head, *rest = name.split("_")
+    return head + "".join(part.title() for part in rest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WalletModel 与 BuyerWallet 合约的差分对拍（需要本地节点）")
+    parser.add_argument("--seed", type=int, help="只运行这一个种子")
+    parser.add_argument("--seeds", type=int, default=10, help="运行种子 0..N-1（默认10）")
+    parser.add_argument("--ops", type=int, default=200, help="每个序列的操作数（默认200）")
+    parser.add_argument("--check-every", type=int, default=1, help="每 N 笔操作比较一次全部状态（默认1）")
+    parser.add_argument("--rpc", default=E2E_RPC, help=f"节点地址（默认 {E2E_RPC}，ACPAY_E2E_RPC）")
+    args = parser.parse_args()
+
+    if not artifacts_available():
+        sys.exit("需要 forge build 产物（在仓库根目录运行 forge build）")
+    w3 = Web3(Web3.HTTPProvider(args.rpc))
+    if not w3.is_connected():
+        sys.exit(f"需要本地节点：anvil（或设置 ACPAY_E2E_RPC），当前 {args.rpc} 不可用")
+
+    seeds = [args.seed] if args.seed is not None else range(args.seeds)
+    total = Counter()
+    for seed in seeds:
+        start = time.perf_counter()
+        try:
+            outcomes = ParityRun(w3, seed).run(args.ops, args.check_every)
+        except ParityError as e:
+            print(f"❌ {e}")
+            print(f"   复现: python3 wallet_parity.py --seed {seed} --ops {args.ops}")
+            sys.exit(1)
+        total.update(outcomes)
+        print(f"✅ seed {seed}: {args.ops} ops, {outcomes['ok']} ok, "
+              f"{args.ops - outcomes['ok']} reverted ({time.perf_counter() - start:.1f}s)")
+
+    print(f"\n{len(seeds)} sequences, {sum(total.values())} operations, model and contract agree")
+    for reason, count in total.most_common():
+        print(f"  {count:>6}  {reason}")
+
+
+if __name__ == "__main__":
+    main()
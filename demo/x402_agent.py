@@ -2,153 +2,41 @@ import os
 import json
 import time
 import requests
-import hashlib
+import uuid
+import weakref
 from web3 import Web3
 from eth_account import Account
-from eth_account.messages import encode_defunct
 from typing import Dict, Any, Optional, Tuple
-from dataclasses import dataclass
+from urllib.parse import urlparse
+
+from buyer_wallet import AgentSigner, BuyerWalletClient, get_contract, x402_payment_hash
+from x402_records import X402PaymentInfo
+from x402_headers import HeaderError, format_compact_payment_proof, format_payment_proof, parse_accept_payment
+from x402_cbor import CBOR_CONTENT_TYPE, CBORError, decode_payment_required
+from x402_metrics import METRICS
+from chain_head import get_tracker
+from x402_quotes import QuoteCache
+from payment_journal import (PaymentJournal, journal_path, INTENT, SIGNED, CONSUMED, FAILED)
+from relayer import Authorization
+from resilience import CircuitOpenError, ResilientHTTPProvider, get_policy
 
 # Injective EVM测试网配置
 INJECTIVE_TESTNET_RPC = "https://k8s.testnet.json-rpc.injective.network/"
+INJECTIVE_TESTNET_WS = os.getenv("INJECTIVE_WS_RPC")  # 可选，未设置时轮询链头
 BUYER_WALLET_ADDRESS = "0x..."  # 部署后的合约地址
 USDT_ADDRESS = "0xaDC7bcB5d8fe053Ef19b4E0C861c262Af6e0db60"
+AUTHORIZATION_TTL = int(os.getenv("ACPAY_AUTHORIZATION_TTL", "600"))  # 授权签名默认有效期（秒）
+RELAYER_URL = os.getenv("ACPAY_RELAYER_URL")  # 可选，设置后授权交给 relayer.py 上链
+RELAY_WAIT = float(os.getenv("ACPAY_RELAY_WAIT", "60"))  # 等待 Relayer 上链确认的最长时间（秒）
+RELAY_POLL_INTERVAL = 0.5
+COMPACT_TRANSPORT = os.getenv("ACPAY_COMPACT") == "1"  # 协商CBOR格式的402响应并发送二进制支付证明
 
-@dataclass
-class X402PaymentInfo:
-    """x402支付信息"""
-    agent_id: str
-    recipient: str
-    amount: int
-    currency: str
-    api_endpoint: str
-    nonce: int
-    expiry: int
-
-@dataclass
-class X402PaymentProof:
-    """x402支付证明"""
-    payment_hash: str
-    agent_id: str
-    recipient: str
-    amount: int
-    api_endpoint: str
-    timestamp: int
-    tx_hash: str
-
-# 合约ABI（更新以匹配新的Agent ID架构）
-BUYER_WALLET_ABI = [
-    {
-        "inputs": [
-            {"internalType": "address", "name": "_usdtAddress", "type": "address"},
-            {"internalType": "uint256", "name": "_dailyLimit", "type": "uint256"},
-            {"internalType": "uint256", "name": "_transactionLimit", "type": "uint256"}
-        ],
-        "stateMutability": "nonpayable",
-        "type": "constructor"
-    },
-    {
-        "inputs": [
-            {"internalType": "string", "name": "_agentId", "type": "string"},
-            {"internalType": "address", "name": "_recipient", "type": "address"},
-            {"internalType": "uint256", "name": "_amount", "type": "uint256"},
-            {"internalType": "string", "name": "_metadata", "type": "string"},
-            {"internalType": "bytes", "name": "_signature", "type": "bytes"},
-            {"internalType": "uint256", "name": "_nonce", "type": "uint256"}
-        ],
-        "name": "payByAgent",
-        "outputs": [],
-        "stateMutability": "nonpayable",
-        "type": "function"
-    },
-    {
-        "inputs": [
-            {"internalType": "string", "name": "_agentId", "type": "string"},
-            {"internalType": "address", "name": "_recipient", "type": "address"},
-            {"internalType": "uint256", "name": "_amount", "type": "uint256"},
-            {"internalType": "string", "name": "_metadata", "type": "string"}
-        ],
-        "name": "payDirect",
-        "outputs": [],
-        "stateMutability": "nonpayable",
-        "type": "function"
-    },
-    {
-        "inputs": [
-            {"internalType": "string", "name": "_agentId", "type": "string"}
-        ],
-        "name": "getTodaySpending",
-        "outputs": [
-            {"internalType": "uint256", "name": "", "type": "uint256"}
-        ],
-        "stateMutability": "view",
-        "type": "function"
-    },
-    {
-        "inputs": [
-            {"internalType": "string", "name": "_agentId", "type": "string"}
-        ],
-        "name": "getPaymentRules",
-        "outputs": [
-            {"components": [
-                {"internalType": "uint256", "name": "dailyLimit", "type": "uint256"},
-                {"internalType": "uint256", "name": "transactionLimit", "type": "uint256"},
-                {"internalType": "bool", "name": "enabled", "type": "bool"}
-            ], "internalType": "struct BuyerWallet.PaymentRules", "name": "", "type": "tuple"}
-        ],
-        "stateMutability": "view",
-        "type": "function"
-    },
-    {
-        "inputs": [],
-        "name": "getContractBalance",
-        "outputs": [
-            {"internalType": "uint256", "name": "", "type": "uint256"}
-        ],
-        "stateMutability": "view",
-        "type": "function"
-    },
-    {
-        "inputs": [
-            {"internalType": "string", "name": "", "type": "string"}
-        ],
-        "name": "agentNonces",
-        "outputs": [
-            {"internalType": "uint256", "name": "", "type": "uint256"}
-        ],
-        "stateMutability": "view",
-        "type": "function"
-    },
-    {
-        "anonymous": False,
-        "inputs": [
-            {"indexed": True, "internalType": "string", "name": "agentId", "type": "string"},
-            {"indexed": True, "internalType": "address", "name": "recipient", "type": "address"},
-            {"indexed": False, "internalType": "uint256", "name": "amount", "type": "uint256"},
-            {"indexed": False, "internalType": "string", "name": "metadata", "type": "string"},
-            {"indexed": False, "internalType": "uint256", "name": "timestamp", "type": "uint256"}
-        ],
-        "name": "PaymentMade",
-        "type": "event"
-    },
-    {
-        "anonymous": False,
-        "inputs": [
-            {"indexed": True, "internalType": "string", "name": "agentId", "type": "string"},
-            {"indexed": True, "internalType": "address", "name": "recipient", "type": "address"},
-            {"indexed": False, "internalType": "uint256", "name": "amount", "type": "uint256"},
-            {"indexed": False, "internalType": "string", "name": "metadata", "type": "string"},
-            {"indexed": False, "internalType": "uint256", "name": "timestamp", "type": "uint256"}
-        ],
-        "name": "PaymentPending",
-        "type": "event"
-    }
-]
 
 class X402Agent:
     """x402协议兼容的AI代理"""
     
-    def __init__(self, agent_id: str, private_key: str, name: str):
+    def __init__(self, agent_id: str, private_key: str, name: str, services_url: Optional[str] = None,
+                 journal: Optional[PaymentJournal] = None, compact: bool = COMPACT_TRANSPORT):
         """
         初始化Agent
         
@@ -156,71 +44,105 @@ class X402Agent:
             agent_id: Agent ID字符串标识
             private_key: 签名私钥（用于授权支付，不持有资金）
             name: Agent名称
+            services_url: 服务列表地址（可选），用于缓存报价并预付
+            journal: 支付日志（默认 ~/.acpay/<agent_id>.journal）
+            compact: 使用紧凑编码（Accept: application/cbor 与二进制 Payment-Proof）
         """
         self.agent_id = agent_id
+        # 持久连接：402探价与带证明的重试复用同一个连接
+        self.http = requests.Session()
+        self.quotes = QuoteCache(services_url, session=self.http) if services_url else None
+        self._owns_journal = journal is None
+        self.journal = journal or PaymentJournal(journal_path(agent_id))
         self.private_key = private_key
         self.name = name
+        self.compact = compact
+        # 未携带支付证明的请求头：紧凑模式下优先接受CBOR格式的402响应
+        self.probe_headers = {'Accept': f'{CBOR_CONTENT_TYPE}, application/json;q=0.9'} if compact else {}
         self.account = Account.from_key(private_key)
         
         # 初始化Web3连接
-        self.w3 = Web3(Web3.HTTPProvider(INJECTIVE_TESTNET_RPC))
+        self.w3 = Web3(ResilientHTTPProvider(INJECTIVE_TESTNET_RPC))
         if not self.w3.is_connected():
             raise Exception("Failed to connect to Injective testnet")
         
         # 初始化合约
-        self.buyer_wallet = self.w3.eth.contract(
-            address=BUYER_WALLET_ADDRESS,
-            abi=BUYER_WALLET_ABI
-        )
+        self.buyer_wallet = get_contract(self.w3, BUYER_WALLET_ADDRESS)
+        self.wallet = BuyerWalletClient(self.w3, BUYER_WALLET_ADDRESS)  # 只读调用的 eth_call 快速路径
+        self.signer = AgentSigner(private_key, self.w3.eth.chain_id, BUYER_WALLET_ADDRESS)
+        
+        # 消费状态按区块缓存：同一区块内重复查询不再访问合约，新区块到达时失效。
+        # 跟踪器是进程内共享的，只持有 Agent 的弱引用：Agent 不再使用时可以被回收
+        self._status_cache = None
+        self.chain_head = get_tracker(INJECTIVE_TESTNET_RPC, INJECTIVE_TESTNET_WS)
+        def on_new_block(head, method=weakref.WeakMethod(self._on_new_block)):
+            callback = method()
+            if callback is not None:
+                callback(head)
+        self._unsubscribe = self.chain_head.subscribe(on_new_block)
         
         print(f"🤖 Agent '{self.name}' (ID: {self.agent_id}) initialized")
         print(f"   Signer Address: {self.account.address}")
         print(f"   Network: Injective EVM Testnet")
     
-    def generate_signature(self, nonce: int) -> bytes:
+    @METRICS.timed("agent_sign")
+    def generate_signature(self, recipient: str, amount: int, metadata: str, nonce: int, deadline: int) -> bytes:
         """
-        生成支付授权签名
+        生成支付授权签名（EIP-712 AgentPayment，与合约 onlyValidAgent 匹配）
+        
+        签名不依赖出块时间，截止时间前任何时刻提交都有效，可以提前批量签好。
         
         Args:
+            recipient: 接收方地址
+            amount: 支付金额（最小单位）
+            metadata: 元数据（payX402 为API端点）
             nonce: 防重放nonce
+            deadline: 授权截止时间（unix秒）
             
         Returns:
-            签名字节
+            签名字节（r + s + v格式）
         """
-        # 构造签名消息（与合约中的验证逻辑匹配）
-        timestamp = int(time.time())
-        message_hash = Web3.keccak(
-            Web3.solidity_keccak(['string', 'uint256', 'uint256'], 
-                                [self.agent_id, nonce, timestamp])
-        )
-        
-        # 创建以太坊消息格式
-        message = encode_defunct(message_hash)
-        
-        # 签名
-        signed_message = self.account.sign_message(message)
-        
-        # 返回签名字节（r + s + v格式）
-        return signed_message.signature
+        return self.signer.sign(self.agent_id, recipient, amount, metadata, nonce, deadline)
     
     def get_next_nonce(self) -> int:
         """获取下一个可用的nonce"""
         try:
-            current_nonce = self.buyer_wallet.functions.agentNonces(self.agent_id).call()
+            current_nonce = self.wallet.get_nonce(self.agent_id)
             return current_nonce + 1
         except Exception as e:
             print(f"⚠️  Warning: Could not get nonce from contract: {e}")
             # 如果无法获取nonce，从1开始
             return 1
     
+    def _on_new_block(self, head) -> None:
+        self._status_cache = None
+    
+    def close(self) -> None:
+        """取消链头订阅，关闭HTTP连接（以及自行打开的支付日志）"""
+        self._stop_following()
+        self.http.close()
+        if self._owns_journal:
+            self.journal.close()
+    
+    def _stop_following(self) -> None:
+        unsubscribe, self._unsubscribe = getattr(self, "_unsubscribe", None), None
+        if unsubscribe is not None:
+            unsubscribe()
+    
+    def __del__(self):
+        # 未调用 close() 时至少从共享的链头跟踪器上摘掉回调
+        self._stop_following()
+    
     def get_spending_status(self) -> Optional[Dict[str, Any]]:
-        """获取Agent的消费状态"""
+        """获取Agent的消费状态（同一区块内复用上次结果）"""
+        if self._status_cache is not None:
+            return dict(self._status_cache)
         try:
             # 获取今日消费
-            today_spent = self.buyer_wallet.functions.getTodaySpending(self.agent_id).call()
+            today_spent = self.wallet.get_today_spending(self.agent_id)
             
             # 获取支付规则
-            rules = self.buyer_wallet.functions.getPaymentRules(self.agent_id).call()
+            rules = self.wallet.get_payment_rules(self.agent_id)
             daily_limit = rules[0]
             transaction_limit = rules[1]
             enabled = rules[2]
@@ -231,7 +153,7 @@ class X402Agent:
             transaction_limit_usdt = transaction_limit / 10**6
             remaining_limit_usdt = max(0, daily_limit_usdt - today_spent_usdt)
             
-            return {
+            status = {
                 "agent_id": self.agent_id,
                 "today_spent": today_spent_usdt,
                 "daily_limit": daily_limit_usdt,
@@ -239,11 +161,16 @@ class X402Agent:
                 "remaining_limit": remaining_limit_usdt,
                 "rules_enabled": enabled
             }
+            if self.chain_head.latest is not None:
+                self._status_cache = status
+            return dict(status)
         except Exception as e:
             print(f"❌ Error getting spending status: {e}")
             return None
     
-    def execute_payment(self, recipient: str, amount_usdt: float, metadata: str = "") -> Optional[str]:
+    @METRICS.timed("agent_pay")
+    def execute_payment(self, recipient: str, amount_usdt: float, metadata: str = "",
+                        nonce: Optional[int] = None, deadline: Optional[int] = None) -> Optional[str]:
         """
         执行支付（通过签名授权）
         
@@ -251,58 +178,139 @@ class X402Agent:
             recipient: 接收方地址
             amount_usdt: 支付金额（USDT）
             metadata: 元数据
+            nonce: 防重放nonce（默认从合约读取）
+            deadline: 授权截止时间（默认当前时间 + AUTHORIZATION_TTL）
             
         Returns:
             交易哈希或None
         """
         try:
             # 转换金额为wei单位（6位小数）
-            amount_wei = int(amount_usdt * 10**6)
+            amount_wei = round(amount_usdt * 10**6)
             
             # 获取nonce
-            nonce = self.get_next_nonce()
+            if nonce is None:
+                nonce = self.get_next_nonce()
+            
+            if deadline is None:
+                deadline = int(time.time()) + AUTHORIZATION_TTL
             
             # 生成签名
-            signature = self.generate_signature(nonce)
+            signature = self.generate_signature(recipient, amount_wei, metadata, nonce, deadline)
             
             print(f"💰 Executing payment...")
             print(f"   Agent ID: {self.agent_id}")
             print(f"   Recipient: {recipient}")
             print(f"   Amount: {amount_usdt} USDT")
             print(f"   Nonce: {nonce}")
+            print(f"   Deadline: {deadline}")
             
-            # 调用合约的payByAgent函数
-            # 注意：这需要用户（Owner）的私钥来实际发送交易
-            # 在实际应用中，这会通过后端服务或多签机制处理
-            print("⚠️  Note: In production, this would require the wallet owner to approve the transaction")
-            print("   For demo purposes, this shows the payment authorization signature")
+            # 授权交给 Relayer 提交 payByAgent（Relayer 支付 gas，Agent 不持有资金）
+            if RELAYER_URL:
+                auth = Authorization("payByAgent", self.agent_id, recipient, amount_wei, metadata,
+                                     nonce, deadline, bytes(signature))
+                job = self.http.post(f"{RELAYER_URL}/relay", json=auth.to_json(), timeout=10)
+                job.raise_for_status()
+                print(f"🚚 Submitted to relayer: job {job.json()['id']}")
+            else:
+                print("⚠️  Note: set ACPAY_RELAYER_URL to have relayer.py submit this authorization on-chain")
             
-            return f"0x{signature.hex()}"  # 返回签名作为演示
+            return f"0x{signature.hex()}"
             
         except Exception as e:
             print(f"❌ Payment execution failed: {e}")
             return None
     
+    @METRICS.timed("agent_pay")
+    def execute_x402_payment(self, info: X402PaymentInfo) -> Optional[Tuple[str, bool]]:
+        """
+        签名 payX402 授权并交给 Relayer 上链（合约记录以支付哈希为键的x402证明）
+        
+        Args:
+            info: 支付信息（nonce 为 Agent 的合约 nonce，expiry 为授权截止时间）
+            
+        Returns:
+            (支付哈希, 是否已上链确认)；授权失败或交易未成功返回None。
+            未设置 ACPAY_RELAYER_URL 时授权须由他人提交，视为已确认
+        """
+        try:
+            payment_hash = "0x" + x402_payment_hash(info).hex()
+            signature = self.signer.sign_x402(info)
+            
+            print(f"💰 Executing x402 payment...")
+            print(f"   Agent ID: {self.agent_id}")
+            print(f"   Recipient: {info.recipient}")
+            print(f"   Amount: {info.amount / 10**6} {info.currency}")
+            print(f"   Nonce: {info.nonce}")
+            print(f"   Payment hash: {payment_hash}")
+            
+            if not RELAYER_URL:
+                print("⚠️  Note: set ACPAY_RELAYER_URL to have relayer.py submit this authorization on-chain")
+                return payment_hash, True
+            
+            auth = Authorization("payX402", info.agent_id, info.recipient, info.amount, info.api_endpoint,
+                                 info.nonce, info.expiry, signature)
+            job = self.http.post(f"{RELAYER_URL}/relay", json=auth.to_json(), timeout=10)
+            job.raise_for_status()
+            job_id = job.json()['id']
+            print(f"🚚 Submitted to relayer: job {job_id}")
+            
+            # 服务端只接受已上链的证明：等待 Relayer 确认后再发送
+            state = self._wait_for_relay(job_id)
+            if state == "confirmed":
+                return payment_hash, True
+            if state in ("failed", "expired"):
+                print(f"❌ Relayer job {job_id} {state}")
+                return None
+            print(f"⏳ Relayer job {job_id} still {state} after {RELAY_WAIT:g}s")
+            return payment_hash, False
+            
+        except Exception as e:
+            print(f"❌ x402 payment failed: {e}")
+            return None
+    
+    def _wait_for_relay(self, job_id: str) -> str:
+        """轮询 Relayer 任务直到进入终态或超过 RELAY_WAIT，返回最后的状态"""
+        deadline = time.monotonic() + RELAY_WAIT
+        while True:
+            response = self.http.get(f"{RELAYER_URL}/relay/{job_id}", timeout=10)
+            response.raise_for_status()
+            state = response.json()['state']
+            if state in ("confirmed", "failed", "expired") or time.monotonic() >= deadline:
+                return state
+            time.sleep(RELAY_POLL_INTERVAL)
+    
     def parse_x402_response(self, response) -> Optional[X402PaymentInfo]:
         """解析x402协议响应"""
         if response.status_code != 402:
             return None
         
-        try:
-            # 解析Accept-Payment头
-            accept_payment = response.headers.get('Accept-Payment', '')
-            if not accept_payment.startswith('injective-evm'):
+        if response.headers.get('Content-Type', '').startswith(CBOR_CONTENT_TYPE):
+            try:
+                return decode_payment_required(response.content, self.agent_id)
+            except CBORError as e:
+                print(f"❌ Error parsing x402 response: {e}")
                 return None
-            
-            # 解析响应体中的支付信息
-            payment_data = response.json()
+        
+        # 优先解析Accept-Payment头，无需解码JSON响应体
+        accept_payment = response.headers.get('Accept-Payment')
+        if accept_payment:
+            try:
+                return parse_accept_payment(accept_payment, self.agent_id)
+            except HeaderError as e:
+                print(f"❌ Error parsing x402 response: {e}")
+                return None
+        
+        try:
+            # 没有头部时回退到响应体中的支付信息
+            payment_data = response.json()['payment_info']
             
             return X402PaymentInfo(
                 agent_id=self.agent_id,
                 recipient=payment_data['recipient'],
                 amount=int(payment_data['amount']),
                 currency=payment_data['currency'],
-                api_endpoint=payment_data['api_endpoint'],
+                api_endpoint=payment_data['endpoint'],
                 nonce=payment_data['nonce'],
                 expiry=payment_data['expiry']
             )
@@ -310,10 +318,106 @@ class X402Agent:
             print(f"❌ Error parsing x402 response: {e}")
             return None
     
+    def authorize_payment(self, payment_info: X402PaymentInfo, url: str) -> Optional[Tuple[str, Dict[str, str]]]:
+        """
+        执行支付授权并生成请求头（每一步先写入支付日志）
+        
+        同一URL、金额与收款方已有签名但未使用的授权时直接复用，避免重试造成重复支付。
+        授权以 payX402 上链，证明头携带支付哈希，服务端按哈希读取链上证明。
+        
+        Returns:
+            (支付日志ID, 带支付证明的请求头)，授权失败或尚未上链确认返回None
+            （未确认的授权保持 SIGNED，下次调用同一URL或 resume_pending 时使用）
+        """
+        recipient = payment_info.recipient.lower()
+        entry = self.journal.find(SIGNED, url=url, amount=payment_info.amount, recipient=recipient)
+        if entry:
+            print(f"♻️  Reusing unconsumed authorization {entry.payment_id[:8]}")
+            return entry.payment_id, {'Payment-Proof': entry.data['proof']}
+        
+        nonce = self.get_next_nonce()
+        payment_id = uuid.uuid4().hex
+        self.journal.append(payment_id, INTENT, url=url, recipient=recipient,
+                            amount=payment_info.amount, nonce=nonce)
+        
+        info = X402PaymentInfo(
+            self.agent_id, payment_info.recipient, payment_info.amount, payment_info.api_endpoint,
+            nonce, payment_info.expiry or int(time.time()) + AUTHORIZATION_TTL, payment_info.currency
+        )
+        paid = self.execute_x402_payment(info)
+        
+        if not paid:
+            self.journal.append(payment_id, FAILED, error="authorization failed")
+            print("❌ Payment authorization failed")
+            return None
+        payment_hash, confirmed = paid
+        
+        # 生成支付证明头
+        format_proof = format_compact_payment_proof if self.compact else format_payment_proof
+        payment_proof_header = format_proof(hash=payment_hash, agent=self.agent_id)
+        self.journal.append(payment_id, SIGNED, proof=payment_proof_header, payment_hash=payment_hash)
+        if not confirmed:
+            print("⏳ Payment not yet confirmed on-chain; proof kept for a later retry")
+            return None
+        
+        print("✅ Payment authorized successfully")
+        return payment_id, {
+            'Payment-Proof': payment_proof_header
+        }
+    
+    def api_get(self, url: str, headers: Dict[str, str], idempotent: bool = False) -> requests.Response:
+        """
+        经过目标主机的 CallPolicy 发出 GET：自适应超时，5xx 与网络错误计入熔断
+        
+        只有探价请求（不带支付证明）可以重试；带证明的请求只尝试一次，
+        失败时支付日志保持 SIGNED，由 resume_pending 处理。
+        
+        Raises:
+            CircuitOpenError: 该主机处于熔断中
+            requests.RequestException: 网络错误或超时
+        """
+        policy = get_policy(f"api:{urlparse(url).netloc}")
+        return policy.call(self.http.get, url, headers=headers, timeout=policy.timeout(),
+                           idempotent=idempotent, failed=lambda r: r.status_code >= 500)
+    
+    def settle_payment(self, payment_id: str, response) -> None:
+        """按带证明请求的结果更新支付日志：200为已使用，402为被拒绝，其余保留待重试"""
+        if response.status_code == 200:
+            self.journal.append(payment_id, CONSUMED, status=200)
+        elif response.status_code == 402:
+            self.journal.append(payment_id, FAILED, status=402)
+    
+    def resume_pending(self) -> int:
+        """
+        重启后恢复未完成的支付（只读取本地日志，不扫描链上数据）
+        
+        Returns:
+            成功完成的支付数
+        """
+        resumed = 0
+        for entry in self.journal.pending(INTENT):
+            # 签名前中断：没有产生任何授权，直接结束
+            self.journal.append(entry.payment_id, FAILED, error="interrupted before signing")
+        for entry in self.journal.pending(SIGNED):
+            print(f"🔁 Resuming payment {entry.payment_id[:8]} for {entry.data['url']}")
+            try:
+                response = self.api_get(entry.data['url'], {'Payment-Proof': entry.data['proof']})
+            except (requests.RequestException, CircuitOpenError) as e:
+                print(f"⚠️  Resume failed, will retry later: {e}")
+                continue
+            self.settle_payment(entry.payment_id, response)
+            resumed += response.status_code == 200
+        return resumed
+    
     def call_x402_api(self, url: str, max_amount: float = None) -> Optional[Dict[str, Any]]:
         """
         调用支持x402协议的API
         
+        报价已缓存且不超过max_amount时，先按 ETag 确认报价仍然有效，再签名预付
+        （授权交给 Relayer 即上链扣款），首个请求即附带支付证明；
+        服务端仍返回402时丢弃缓存，按该402响应中的报价支付：金额与收款方都相同则复用
+        预付的授权（不再支付第二次），不同则把预付记为失败后重新授权。
+        
         Args:
             url: API端点URL
             max_amount: 最大支付金额限制
@@ -324,8 +428,37 @@ class X402Agent:
         try:
             print(f"🌐 Calling x402 API: {url}")
             
-            # 第一次调用
-            response = requests.get(url, timeout=10)
+            # 预付的授权会立即上链：签名前按 ETag 确认报价（通常为304），确认失败则走402流程
+            quote = self.quotes.revalidate(urlparse(url).path) if self.quotes else None
+            prepaid = None
+            if quote and not (max_amount and quote.amount / 10**6 > max_amount):
+                print(f"⚡ Prepaying cached quote: {quote.amount / 10**6} {quote.currency}")
+                authorized = self.authorize_payment(X402PaymentInfo(
+                    self.agent_id, quote.recipient, quote.amount, quote.endpoint, 0, 0, quote.currency
+                ), url)
+                if not authorized:
+                    return None
+                payment_id, headers = authorized
+                with METRICS.span("agent_request"):
+                    response = self.api_get(url, headers)
+                if response.status_code != 402:
+                    self.settle_payment(payment_id, response)
+                if response.status_code == 200:
+                    METRICS.inc("quote_prepaid")
+                    print("✅ API call successful with prepayment")
+                    return response.json()
+                if response.status_code != 402:
+                    print(f"❌ API call failed: {response.status_code}")
+                    return None
+                METRICS.inc("quote_mismatch")
+                print("⚠️  Cached quote rejected, falling back to 402 flow")
+                self.quotes.invalidate()
+                # 这个402响应已带有最新报价；预付的授权保持 SIGNED，下面决定复用还是作废
+                prepaid = (payment_id, quote.amount, quote.recipient.lower())
+            else:
+                # 第一次调用
+                with METRICS.span("agent_request"):
+                    response = self.api_get(url, self.probe_headers, idempotent=True)
             
             if response.status_code == 200:
                 print("✅ API call successful (no payment required)")
@@ -344,34 +477,26 @@ class X402Agent:
                 print(f"   Required payment: {amount_usdt} USDT")
                 print(f"   Recipient: {payment_info.recipient}")
                 
+                if prepaid and prepaid[1:] != (payment_info.amount, payment_info.recipient.lower()):
+                    # 报价已变：预付的授权不会被接受，记为失败，避免之后被当作可复用的授权
+                    self.journal.append(prepaid[0], FAILED, error="quote mismatch", status=402)
+                
                 # 检查金额限制
                 if max_amount and amount_usdt > max_amount:
                     print(f"❌ Payment amount exceeds limit ({max_amount} USDT)")
                     return None
                 
                 # 执行支付授权
-                payment_signature = self.execute_payment(
-                    payment_info.recipient,
-                    amount_usdt,
-                    f"x402 payment for {payment_info.api_endpoint}"
-                )
-                
-                if not payment_signature:
-                    print("❌ Payment authorization failed")
+                authorized = self.authorize_payment(payment_info, url)
+                if not authorized:
                     return None
-                
-                print("✅ Payment authorized successfully")
-                
-                # 生成支付证明头
-                payment_proof_header = f"injective-evm signature={payment_signature}"
+                payment_id, headers = authorized
                 
                 # 重新调用API，带上支付证明
-                headers = {
-                    'Payment-Proof': payment_proof_header
-                }
-                
                 print("🔄 Retrying API call with payment proof...")
-                response = requests.get(url, headers=headers, timeout=10)
+                with METRICS.span("agent_retry"):
+                    response = self.api_get(url, headers)
+                self.settle_payment(payment_id, response)
                 
                 if response.status_code == 200:
                     print("✅ API call successful with payment")
@@ -455,10 +580,12 @@ def main():
         agent = X402Agent(
             agent_id="weather-ai-agent",  # 使用字符串ID
             private_key=agent_private_key,
-            name="Weather & AI Agent"
+            name="Weather & AI Agent",
+            services_url="https://demo-api.acpay.com/services"
         )
         
-        # 运行x402协议演示场景
+        # 恢复上次未完成的支付，再运行x402协议演示场景
+        agent.resume_pending()
         agent.demo_x402_scenario()
         
     except Exception as e:
@@ -0,0 +1,210 @@
+"""
+ACPay x402 CBOR - 协商式紧凑编码（RFC 8949 子集）
+
+Agent 发送 Accept: application/cbor 时，服务端的402响应体改为一个 CBOR 数组，
+不再返回 JSON 说明文字与 Accept-Payment 头部：
+
+    [recipient(20字节), amount, currency, endpoint, nonce, expiry]
+
+    body = encode_payment_required(recipient, 2000000, "USDT", "/x402/weather", nonce, expiry)
+    info = decode_payment_required(body, agent_id="weather-agent")   # X402PaymentInfo
+
+Payment-Proof 的二进制形式见 x402_headers.format_compact_payment_proof。
+
+编解码只支持本协议用到的类型：无符号/负整数（64位内）、字节串、UTF-8 文本、
+定长数组与映射、true/false/null；不支持浮点、标签与不定长编码。
+解码严格：截断、多余字节、不支持的类型与过深嵌套都会抛出 CBORError。
+"""
+
+import struct
+from functools import lru_cache
+from typing import Any
+
+from eth_utils import to_checksum_address
+
+from x402_records import X402PaymentInfo
+
+CBOR_CONTENT_TYPE = "application/cbor"
+MAX_DEPTH = 8
+
+_UINT64_MAX = (1 << 64) - 1
+_HEAD = {1: struct.Struct(">B"), 2: struct.Struct(">H"), 4: struct.Struct(">I"), 8: struct.Struct(">Q")}
+_SIMPLE = {False: b"\xf4", True: b"\xf5", None: b"\xf6"}
+
+
+class CBORError(ValueError):
+    """CBOR 数据格式错误或包含不支持的类型"""
+
+
+# ============ 编码 ============
+
+def _head(major: int, value: int) -> bytes:
+    major <<= 5
+    if value < 24:
+        return bytes((major | value,))
+    if value <= 0xFF:
+        return bytes((major | 24, value))
+    if value <= 0xFFFF:
+        return bytes((major | 25,)) + _HEAD[2].pack(value)
+    if value <= 0xFFFFFFFF:
+        return bytes((major | 26,)) + _HEAD[4].pack(value)
+    if value <= _UINT64_MAX:
+        return bytes((major | 27,)) + _HEAD[8].pack(value)
+    raise CBORError(f"integer out of range: {value}")
+
+
+def _encode(obj, out: list) -> None:
+    if obj is None or obj is True or obj is False:
+        out.append(_SIMPLE[obj])
+    elif isinstance(obj, int):
+        out.append(_head(0, obj) if obj >= 0 else _head(1, -1 - obj))
+    elif isinstance(obj, (bytes, bytearray)):
+        out.append(_head(2, len(obj)))
+        out.append(bytes(obj))
+    elif isinstance(obj, str):
+        data = obj.encode()
+        out.append(_head(3, len(data)))
+        out.append(data)
+    elif isinstance(obj, (list, tuple)):
+        out.append(_head(4, len(obj)))
+        for item in obj:
+            _encode(item, out)
+    elif isinstance(obj, dict):
+        out.append(_head(5, len(obj)))
+        for key, value in obj.items():
+            _encode(key, out)
+            _encode(value, out)
+    else:
+        raise CBORError(f"unsupported type: {type(obj).__name__}")
+
+
+def dumps(obj) -> bytes:
+    """编码为 CBOR（定长形式，映射按插入顺序）"""
+    out = []
+    _encode(obj, out)
+    return b"".join(out)
+
+
+# ============ 解码 ============
+
+def _decode(data: bytes, pos: int, depth: int):
+    try:
+        initial = data[pos]
+    except IndexError:
+        raise CBORError("truncated CBOR data") from None
+    major, info = initial >> 5, initial & 0x1F
+    pos += 1
+
+    if major == 7:
+        if info == 20:
+            return False, pos
+        if info == 21:
+            return True, pos
+        if info == 22:
+            return None, pos
+        raise CBORError(f"unsupported simple value: 0x{initial:02x}")
+
+    if info < 24:
+        value = info
+    elif info <= 27:
+        size = 1 << (info - 24)
+        if pos + size > len(data):
+            raise CBORError("truncated CBOR data")
+        value = _HEAD[size].unpack_from(data, pos)[0]
+        pos += size
+    else:
+        raise CBORError(f"unsupported additional info: {info}")
+
+    if major == 0:
+        return value, pos
+    if major == 1:
+        return -1 - value, pos
+    if major in (2, 3):
+        end = pos + value
+        if end > len(data):
+            raise CBORError("truncated CBOR data")
+        chunk = data[pos:end]
+        if major == 2:
+            return bytes(chunk), end
+        try:
+            return chunk.decode(), end
+        except UnicodeDecodeError:
+            raise CBORError("invalid UTF-8 text") from None
+    if major == 6:
+        raise CBORError("CBOR tags are not supported")
+
+    if depth >= MAX_DEPTH:
+        raise CBORError("CBOR nesting too deep")
+    if value > len(data) - pos:   # 每个元素至少1字节：拒绝虚报的长度
+        raise CBORError("truncated CBOR data")
+    if major == 4:
+        items = []
+        for _ in range(value):
+            item, pos = _decode(data, pos, depth + 1)
+            items.append(item)
+        return items, pos
+    result = {}
+    for _ in range(value):
+        key, pos = _decode(data, pos, depth + 1)
+        if isinstance(key, (list, dict)):
+            raise CBORError("unhashable map key")
+        result[key], pos = _decode(data, pos, depth + 1)
+    return result, pos
+
+
+def loads(data: bytes) -> Any:
+    """
+    解码一个完整的 CBOR 数据项
+
+    Raises:
+        CBORError: 格式错误、不支持的类型或存在多余字节
+    """
+    value, pos = _decode(bytes(data), 0, 0)
+    if pos != len(data):
+        raise CBORError(f"{len(data) - pos} trailing bytes after CBOR item")
+    return value
+
+
+# ============ 402 响应体 ============
+
+@lru_cache(maxsize=1024)
+def _checksum_address(recipient: bytes) -> str:
+    """EIP-55 校验和地址（收款地址很少，缓存避免每次计算 keccak）"""
+    return to_checksum_address(recipient)
+
+
+def encode_payment_required(recipient: str, amount: int, currency: str, endpoint: str,
+                            nonce: int, expiry: int) -> bytes:
+    """生成紧凑402响应体"""
+    return dumps((bytes.fromhex(recipient[2:]), amount, currency, endpoint, nonce, expiry))
+
+
+def decode_payment_required(body: bytes, agent_id: str = "") -> X402PaymentInfo:
+    """
+    解析紧凑402响应体
+
+    Raises:
+        CBORError: 格式错误或字段类型不符
+    """
+    fields = loads(body)
+    if not isinstance(fields, list) or len(fields) != 6:
+        raise CBORError("payment required body must be a 6-element array")
+    recipient, amount, currency, endpoint, nonce, expiry = fields
+    if not isinstance(recipient, bytes) or len(recipient) != 20:
+        raise CBORError("recipient must be 20 bytes")
+    for value in (amount, nonce, expiry):
+        if type(value) is not int or value < 0:
+            raise CBORError("amount, nonce and expiry must be unsigned integers")
+    if not isinstance(currency, str) or not isinstance(endpoint, str) or not endpoint.startswith("/"):
+        raise CBORError("currency and endpoint must be text")
+    return X402PaymentInfo(agent_id, _checksum_address(recipient), amount, endpoint, nonce, expiry, currency)
+
+
+def wants_cbor(accept_mimetypes) -> bool:
+    """
+    按 Accept 头协商：CBOR 的优先级高于 JSON 时返回 True（*/* 仍返回 JSON）
+
+    Args:
+        accept_mimetypes: werkzeug 的 request.accept_mimetypes
+    """
+    return accept_mimetypes.best_match(("application/json", CBOR_CONTENT_TYPE)) == CBOR_CONTENT_TYPE
@@ -0,0 +1,223 @@
+"""
+ACPay x402 Headers - Accept-Payment / Payment-Proof 头部编解码
+
+Agent 与服务端共用的严格单遍解析器：
+
+    Accept-Payment: injective address=0x... amount=2000000 currency=USDT endpoint=/api/weather nonce=... expiry=...
+    Payment-Proof:  injective hash=0x... agent=weather-agent nonce=1 timestamp=... signature=0x...
+    Payment-Proof:  injective-cbor <base64url(CBOR [hash, agent, nonce, timestamp, signature])>
+
+每个字段按固定类型校验，未知字段、重复字段、缺失的必填字段以及
+超长头部都会抛出 HeaderError。二进制形式中哈希与签名为原始字节、
+缺省字段为 null，解析结果与文本形式相同。
+"""
+
+import base64
+import binascii
+import re
+from typing import NamedTuple, Optional
+
+from x402_cbor import CBORError, dumps, loads
+from x402_records import X402PaymentInfo
+
+PAYMENT_SCHEME = "injective"
+COMPACT_PROOF_SCHEME = "injective-cbor"
+MAX_HEADER_LENGTH = 1024
+
+_ADDRESS = re.compile(r"0x[0-9a-fA-F]{40}").fullmatch
+_HASH = re.compile(r"0x[0-9a-fA-F]{64}").fullmatch
+_SIGNATURE = re.compile(r"0x[0-9a-fA-F]{130}").fullmatch
+_UINT = re.compile(r"[0-9]{1,78}").fullmatch
+_CURRENCY = re.compile(r"[A-Z0-9]{1,16}").fullmatch
+_ENDPOINT = re.compile(r"/[\x21-\x7e]{0,255}").fullmatch
+_AGENT_ID = re.compile(r"[A-Za-z0-9._:-]{1,64}").fullmatch
+
+
+# 规范字段顺序的整头匹配：一次 C 层扫描完成切分与校验，失败时回退到逐字段解析
+_ACCEPT_CANONICAL = re.compile(
+    r"injective address=(0x[0-9a-fA-F]{40}) amount=([0-9]{1,78}) currency=([A-Z0-9]{1,16}) "
+    r"endpoint=(/[\x21-\x7e]{0,255}) nonce=([0-9]{1,78}) expiry=([0-9]{1,78})"
+).fullmatch
+_PROOF_CANONICAL = re.compile(
+    r"injective(?: hash=(0x[0-9a-fA-F]{64}))?(?: agent=([A-Za-z0-9._:-]{1,64}))?"
+    r"(?: nonce=([0-9]{1,78}))?(?: timestamp=([0-9]{1,78}))?(?: signature=(0x[0-9a-fA-F]{130}))?"
+).fullmatch
+
+
+class HeaderError(ValueError):
+    """x402头部格式错误"""
+
+
+class PaymentProofHeader(NamedTuple):
+    """Payment-Proof 头部内容"""
+    hash: Optional[str] = None
+    agent: Optional[str] = None
+    nonce: Optional[int] = None
+    timestamp: Optional[int] = None
+    signature: Optional[str] = None
+
+
+# 字段名 -> (校验函数, 是否转为整数)
+_ACCEPT_FIELDS = {
+    "address": (_ADDRESS, False),
+    "amount": (_UINT, True),
+    "currency": (_CURRENCY, False),
+    "endpoint": (_ENDPOINT, False),
+    "nonce": (_UINT, True),
+    "expiry": (_UINT, True),
+}
+
+_PROOF_FIELDS = {
+    "hash": (_HASH, False),
+    "agent": (_AGENT_ID, False),
+    "nonce": (_UINT, True),
+    "timestamp": (_UINT, True),
+    "signature": (_SIGNATURE, False),
+}
+
+
+def _parse(header: Optional[str], fields: dict, name: str) -> dict:
+    if not header:
+        raise HeaderError(f"missing {name} header")
+    if len(header) > MAX_HEADER_LENGTH:
+        raise HeaderError(f"{name} header too long ({len(header)} > {MAX_HEADER_LENGTH})")
+
+    scheme, _, rest = header.partition(" ")
+    if scheme != PAYMENT_SCHEME:
+        raise HeaderError(f"unsupported payment scheme: {scheme[:32]!r}")
+
+    values = {}
+    for part in rest.split():
+        key, sep, value = part.partition("=")
+        spec = fields.get(key)
+        if spec is None or not sep:
+            raise HeaderError(f"unexpected {name} field: {part[:32]!r}")
+        if key in values:
+            raise HeaderError(f"duplicate {name} field: {key}")
+        check, as_int = spec
+        if check(value) is None:
+            raise HeaderError(f"invalid {name} field {key}: {value[:32]!r}")
+        values[key] = int(value) if as_int else value
+    return values
+
+
+def parse_accept_payment(header: Optional[str], agent_id: str = "") -> X402PaymentInfo:
+    """
+    解析 Accept-Payment 头部
+
+    Args:
+        header: 头部原始值
+        agent_id: 填入返回记录的 Agent ID
+
+    Returns:
+        X402PaymentInfo
+
+    Raises:
+        HeaderError: 格式错误或缺少字段
+    """
+    if header and len(header) <= MAX_HEADER_LENGTH:
+        m = _ACCEPT_CANONICAL(header)
+        if m is not None:
+            address, amount, currency, endpoint, nonce, expiry = m.groups()
+            return X402PaymentInfo(agent_id, address, int(amount), endpoint, int(nonce), int(expiry), currency)
+
+    values = _parse(header, _ACCEPT_FIELDS, "Accept-Payment")
+    if len(values) != len(_ACCEPT_FIELDS):
+        missing = ", ".join(k for k in _ACCEPT_FIELDS if k not in values)
+        raise HeaderError(f"missing Accept-Payment fields: {missing}")
+    return X402PaymentInfo(
+        agent_id, values["address"], values["amount"], values["endpoint"],
+        values["nonce"], values["expiry"], values["currency"]
+    )
+
+
+def format_accept_payment(recipient: str, amount: int, currency: str, endpoint: str,
+                          nonce: int, expiry: int) -> str:
+    """生成 Accept-Payment 头部"""
+    return (
+        f"{PAYMENT_SCHEME} address={recipient} amount={amount} currency={currency} "
+        f"endpoint={endpoint} nonce={nonce} expiry={expiry}"
+    )
+
+
+def parse_payment_proof(header: Optional[str]) -> PaymentProofHeader:
+    """
+    解析 Payment-Proof 头部，至少需要 hash 或 signature 之一
+
+    Raises:
+        HeaderError: 格式错误
+    """
+    if header and header.startswith(_COMPACT_PREFIX):
+        return _parse_compact_proof(header)
+    if header and len(header) <= MAX_HEADER_LENGTH:
+        m = _PROOF_CANONICAL(header)
+        if m is not None and (m.group(1) or m.group(5)):
+            payment_hash, agent, nonce, timestamp, signature = m.groups()
+            return PaymentProofHeader(
+                payment_hash, agent,
+                None if nonce is None else int(nonce),
+                None if timestamp is None else int(timestamp),
+                signature
+            )
+
+    values = _parse(header, _PROOF_FIELDS, "Payment-Proof")
+    if "hash" not in values and "signature" not in values:
+        raise HeaderError("Payment-Proof requires hash or signature")
+    return PaymentProofHeader(**values)
+
+
+def format_payment_proof(hash: Optional[str] = None, agent: Optional[str] = None,
+                         nonce: Optional[int] = None, timestamp: Optional[int] = None,
+                         signature: Optional[str] = None) -> str:
+    """生成 Payment-Proof 头部（省略为 None 的字段）"""
+    proof = PaymentProofHeader(hash, agent, nonce, timestamp, signature)
+    parts = [PAYMENT_SCHEME]
+    parts.extend(f"{key}={value}" for key, value in zip(proof._fields, proof) if value is not None)
+    return " ".join(parts)
+
+
+# ============ 二进制 Payment-Proof ============
+
+_COMPACT_PREFIX = COMPACT_PROOF_SCHEME + " "
+
+
+def _hex_bytes(value: Optional[str]) -> Optional[bytes]:
+    return None if value is None else bytes.fromhex(value[2:])
+
+
+def format_compact_payment_proof(hash: Optional[str] = None, agent: Optional[str] = None,
+                                 nonce: Optional[int] = None, timestamp: Optional[int] = None,
+                                 signature: Optional[str] = None) -> str:
+    """生成二进制形式的 Payment-Proof 头部（CBOR 数组，base64url 无填充）"""
+    data = dumps((_hex_bytes(hash), agent, nonce, timestamp, _hex_bytes(signature)))
+    return _COMPACT_PREFIX + base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _parse_compact_proof(header: str) -> PaymentProofHeader:
+    if len(header) > MAX_HEADER_LENGTH:
+        raise HeaderError(f"Payment-Proof header too long ({len(header)} > {MAX_HEADER_LENGTH})")
+    encoded = header[len(_COMPACT_PREFIX):]
+    try:
+        fields = loads(base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)))
+    except (binascii.Error, CBORError) as e:
+        raise HeaderError(f"invalid compact Payment-Proof: {e}") from None
+    if not isinstance(fields, list) or len(fields) != 5:
+        raise HeaderError("compact Payment-Proof must be a 5-element array")
+
+    payment_hash, agent, nonce, timestamp, signature = fields
+    if payment_hash is not None and not (isinstance(payment_hash, bytes) and len(payment_hash) == 32):
+        raise HeaderError("invalid Payment-Proof field hash")
+    if agent is not None and not (isinstance(agent, str) and _AGENT_ID(agent)):
+        raise HeaderError("invalid Payment-Proof field agent")
+    for key, value in (("nonce", nonce), ("timestamp", timestamp)):
+        if value is not None and not (isinstance(value, int) and not isinstance(value, bool) and value >= 0):
+            raise HeaderError(f"invalid Payment-Proof field {key}")
+    if signature is not None and not (isinstance(signature, bytes) and len(signature) == 65):
+        raise HeaderError("invalid Payment-Proof field signature")
+    if payment_hash is None and signature is None:
+        raise HeaderError("Payment-Proof requires hash or signature")
+    return PaymentProofHeader(
+        None if payment_hash is None else "0x" + payment_hash.hex(),
+        agent, nonce, timestamp,
+        None if signature is None else "0x" + signature.hex()
+    )
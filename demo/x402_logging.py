@@ -0,0 +1,160 @@
+"""
+ACPay Logging - 异步、结构化、按路由采样的日志管道
+
+请求线程只做采样判断并把 LogRecord 放入队列（不格式化消息），
+后台 QueueListener 线程负责格式化为 JSON 并写出：
+
+    setup_async_logging(sampling={"/api/weather": (10, 100)})
+    logger.info("📨 返回402响应: %s", endpoint, extra={"route": endpoint})
+
+采样规则为 路由 -> (每N条保留1条, 每秒上限)，上限为 0 表示不限速。
+WARNING 及以上级别不参与采样，但仍受每秒上限约束。
+只替换本模块装到根 logger 上的队列处理器，其他处理器保持不变；
+fork 后重启监听线程的钩子在首次调用 setup_async_logging 时注册。
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+from typing import Dict, Optional, Tuple
+
+from x402_metrics import METRICS
+
+# LogRecord 自带的属性，不作为结构化字段输出
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """把 LogRecord 格式化为单行 JSON（extra 中的字段原样输出）"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    按路由采样与限速
+
+    路由取自 record.route（通过 extra 传入），没有时使用 logger 名称。
+    """
+
+    def __init__(self, rules: Optional[Dict[str, Tuple[int, float]]] = None,
+                 default: Tuple[int, float] = (1, 0.0)):
+        super().__init__()
+        self.rules = dict(rules or {})
+        self.default = default
+        self._seen: Dict[str, int] = {}
+        self._buckets: Dict[str, list] = {}  # route -> [tokens, last_refill]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        route = getattr(record, "route", record.name)
+        every, per_second = self.rules.get(route, self.default)
+
+        if every > 1 and record.levelno < logging.WARNING:
+            seen = self._seen.get(route, 0)
+            self._seen[route] = seen + 1
+            if seen % every:
+                METRICS.inc("log_sampled_out")
+                return False
+
+        if per_second > 0:
+            now = time.monotonic()
+            bucket = self._buckets.get(route)
+            if bucket is None:
+                bucket = self._buckets[route] = [per_second, now]
+            tokens = min(per_second, bucket[0] + (now - bucket[1]) * per_second)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                METRICS.inc("log_rate_limited")
+                return False
+            bucket[0] = tokens - 1
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """不在调用线程格式化消息，原样把 LogRecord 交给后台线程"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_handler: Optional[LazyQueueHandler] = None   # 本模块装到根 logger 上的处理器
+_fork_hook = False
+
+
+@atexit.register
+def _stop_listener() -> None:
+    """进程退出时停止后台线程并写出队列中剩余的日志"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _restart_listener() -> None:
+    """fork 出的子进程没有父进程的后台线程：重新启动监听线程（prefork worker）"""
+    if _listener is not None:
+        _listener._thread = None
+        _listener.start()
+
+
+def setup_async_logging(level: int = logging.INFO,
+                        sampling: Optional[Dict[str, Tuple[int, float]]] = None,
+                        stream=None, fmt: Optional[str] = None) -> logging.handlers.QueueListener:
+    """
+    配置根 logger 使用异步队列管道
+
+    Args:
+        level: 日志级别
+        sampling: 路由采样规则 {route: (每N条保留1条, 每秒上限)}
+        stream: 输出流（默认 stderr）
+        fmt: "json" 或 "text"（默认读取 ACPAY_LOG_FORMAT，未设置时为 json）
+
+    Returns:
+        已启动的 QueueListener（进程退出时自动停止并刷新）
+    """
+    global _listener, _handler, _fork_hook
+    _stop_listener()
+    if not _fork_hook:
+        os.register_at_fork(after_in_child=_restart_listener)
+        _fork_hook = True
+
+    fmt = fmt or os.getenv("ACPAY_LOG_FORMAT", "json")
+    output = logging.StreamHandler(stream or sys.stderr)
+    if fmt == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    handler = LazyQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(sampling))
+
+    root = logging.getLogger()
+    if _handler is not None:
+        root.removeHandler(_handler)
+    _handler = handler
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
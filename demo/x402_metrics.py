@@ -0,0 +1,275 @@
+"""
+ACPay Metrics - 请求链路分阶段耗时统计与 Prometheus 导出
+
+    from x402_metrics import METRICS
+
+    with METRICS.span("rpc_call"):
+        ...
+
+直方图采用 HDR 风格的对数-线性分桶（每个2的幂区间再等分 2**SUB_BITS 份），
+计数按线程分片保存：热路径只写本线程的列表，不加锁；导出时合并各分片。
+已退出线程的分片在新建分片或导出时并入基础分片，分片数不超过存活线程数 + 1。
+设置环境变量 ACPAY_METRICS=0 可关闭统计，此时 span() 返回共享的空上下文。
+"""
+
+import functools
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+SUB_BITS = 3                      # 每个2的幂区间的子桶数 = 8（相对误差 < 12.5%）
+_SUB_COUNT = 1 << SUB_BITS
+_MAX_NS = (1 << 40) - 1           # 约18分钟，超出的值计入最后一个桶
+_BUCKET_COUNT = (_MAX_NS.bit_length() - SUB_BITS) * _SUB_COUNT + _SUB_COUNT
+
+# 导出的 le 边界：1.024µs ~ 17.2s 之间的每个2的幂（恰好落在内部分桶边界上）
+_EXPORT_EXPONENTS = range(10, 35)
+
+
+def _bucket_index(ns: int) -> int:
+    if ns < _SUB_COUNT:
+        return ns if ns > 0 else 0
+    if ns > _MAX_NS:
+        ns = _MAX_NS
+    shift = ns.bit_length() - SUB_BITS - 1
+    return (shift + 1) * _SUB_COUNT + ((ns >> shift) & (_SUB_COUNT - 1))
+
+
+def _bucket_upper(index: int) -> int:
+    """分桶的上界（不含），单位纳秒"""
+    if index < _SUB_COUNT:
+        return index + 1
+    shift = index // _SUB_COUNT - 1
+    return (_SUB_COUNT + index % _SUB_COUNT + 1) << shift
+
+
+class _Shards:
+    """按线程分片的存储：每个线程一个分片，已退出线程的分片并入基础分片"""
+
+    def __init__(self, new: Callable[[], list], fold: Callable[[list, list], None]):
+        self._new = new
+        self._fold = fold
+        self.tls = threading.local()   # .shard 为本线程的分片
+        self._base = new()
+        self._shards: List[tuple] = []   # (线程, 分片)
+        self._lock = threading.Lock()
+
+    def local(self) -> list:
+        """本线程的分片（首次调用时创建）"""
+        try:
+            return self.tls.shard
+        except AttributeError:
+            pass
+        shard = self._new()
+        with self._lock:
+            self._collect()
+            self._shards.append((threading.current_thread(), shard))
+        self.tls.shard = shard
+        return shard
+
+    def merged(self) -> list:
+        """基础分片与全部存活分片之和"""
+        total = self._new()
+        with self._lock:
+            self._collect()
+            self._fold(total, self._base)
+            for _, shard in self._shards:
+                self._fold(total, shard)
+        return total
+
+    def _collect(self) -> None:
+        """已退出线程的分片并入基础分片（调用方持有锁；退出的线程不会再写入）"""
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._fold(self._base, shard)
+        self._shards = live
+
+
+def _new_histogram_shard() -> list:
+    return [[0] * _BUCKET_COUNT, 0]  # [counts, sum_ns]
+
+
+def _fold_histogram_shard(into: list, shard: list) -> None:
+    counts = into[0]
+    for i, c in enumerate(shard[0]):
+        if c:
+            counts[i] += c
+    into[1] += shard[1]
+
+
+def _fold_counter_shard(into: list, shard: list) -> None:
+    into[0] += shard[0]
+
+
+class Histogram:
+    """按线程分片的无锁直方图（纳秒）"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._shards = _Shards(_new_histogram_shard, _fold_histogram_shard)
+        self._local = self._shards.tls
+
+    def record_ns(self, ns: int) -> None:
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._shards.local()
+        shard[0][_bucket_index(ns)] += 1
+        shard[1] += ns
+
+    def snapshot(self):
+        """合并各线程分片，返回 (counts, sum_ns)"""
+        counts, total_ns = self._shards.merged()
+        return counts, total_ns
+
+    def percentile(self, q: float) -> Optional[float]:
+        """估算分位数（秒），q 取 0~100；无样本时返回 None"""
+        counts, _ = self.snapshot()
+        total = sum(counts)
+        if not total:
+            return None
+        rank = max(1, int(total * q / 100 + 0.5))
+        seen = 0
+        for i, c in enumerate(counts):
+            seen += c
+            if seen >= rank:
+                return _bucket_upper(i) / 1e9
+        return _bucket_upper(_BUCKET_COUNT - 1) / 1e9
+
+
+class Counter:
+    """按线程分片的无锁计数器"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._shards = _Shards(lambda: [0], _fold_counter_shard)
+        self._local = self._shards.tls
+
+    def inc(self, amount: int = 1) -> None:
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._shards.local()
+        shard[0] += amount
+
+    @property
+    def value(self) -> int:
+        return self._shards.merged()[0]
+
+
+class _Span:
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram: Histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.record_ns(time.perf_counter_ns() - self._start)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Metrics:
+    """指标注册表"""
+
+    def __init__(self, namespace: str = "acpay", enabled: bool = True):
+        self.namespace = namespace
+        self.enabled = enabled
+        self._histograms: Dict[str, Histogram] = {}
+        self._counters: Dict[str, Counter] = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, stage: str) -> Histogram:
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(stage, Histogram(stage))
+        return histogram
+
+    def counter(self, event: str) -> Counter:
+        counter = self._counters.get(event)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(event, Counter(event))
+        return counter
+
+    def span(self, stage: str):
+        """计时上下文：with METRICS.span("header_parse"): ..."""
+        if not self.enabled:
+            return _NOOP_SPAN
+        return _Span(self.histogram(stage))
+
+    def timed(self, stage: str) -> Callable:
+        """装饰器：统计函数调用耗时"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with _Span(self.histogram(stage)):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """记录一次已测得的耗时"""
+        if self.enabled:
+            self.histogram(stage).record_ns(int(seconds * 1e9))
+
+    def inc(self, event: str, amount: int = 1) -> None:
+        """事件计数（如 verify_error）"""
+        if self.enabled:
+            self.counter(event).inc(amount)
+
+    def render(self) -> str:
+        """生成 Prometheus 文本格式"""
+        stage_metric = f"{self.namespace}_stage_seconds"
+        event_metric = f"{self.namespace}_events_total"
+        bounds = [(1 << k, f"{(1 << k) / 1e9:.9g}") for k in _EXPORT_EXPONENTS]
+        lines = [
+            f"# HELP {stage_metric} Latency of request pipeline stages.",
+            f"# TYPE {stage_metric} histogram",
+        ]
+        for stage, histogram in sorted(self._histograms.items()):
+            counts, total_ns = histogram.snapshot()
+            cumulative = 0
+            index = 0
+            for bound_ns, label in bounds:
+                while index < _BUCKET_COUNT and _bucket_upper(index) <= bound_ns:
+                    cumulative += counts[index]
+                    index += 1
+                lines.append(f'{stage_metric}_bucket{{stage="{stage}",le="{label}"}} {cumulative}')
+            total = sum(counts)
+            lines.append(f'{stage_metric}_bucket{{stage="{stage}",le="+Inf"}} {total}')
+            lines.append(f'{stage_metric}_sum{{stage="{stage}"}} {total_ns / 1e9:.9f}')
+            lines.append(f'{stage_metric}_count{{stage="{stage}"}} {total}')
+        lines.append(f"# HELP {event_metric} Count of notable pipeline events.")
+        lines.append(f"# TYPE {event_metric} counter")
+        for event, counter in sorted(self._counters.items()):
+            lines.append(f'{event_metric}{{event="{event}"}} {counter.value}')
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics(enabled=os.getenv("ACPAY_METRICS", "1") != "0")
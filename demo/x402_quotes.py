@@ -0,0 +1,153 @@
+"""
+ACPay x402 Quotes - Agent 侧的服务报价缓存
+
+从服务端的 /services（或 /demo/services）加载全部端点价格，按 ETag 与
+Cache-Control max-age 重新验证。报价已知且不超过 max_amount 时，
+Agent 可以在第一次请求就附带支付证明，省去 402 探价往返：
+
+    quotes = QuoteCache("http://localhost:5001/demo/services")
+    quote = quotes.get("/api/weather")   # Quote 或 None
+
+预付会真正扣款（授权交给 Relayer 上链）时，应先用 revalidate() 按 ETag 确认报价仍然有效
+（通常是一个没有响应体的 304）。服务端仍返回 402 时（价格变更等），调用方应
+invalidate() 并走常规 402 流程。
+"""
+
+import re
+import threading
+import time
+from typing import Dict, NamedTuple, Optional
+
+import requests
+
+DEFAULT_TTL = 60.0    # 服务端未给出 max-age 时的缓存时间（秒）
+RETRY_AFTER = 5.0     # 加载失败后多久再试（秒）
+
+_MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+class Quote(NamedTuple):
+    """单个端点的报价"""
+    endpoint: str
+    recipient: str
+    amount: int
+    currency: str = "USDT"
+
+
+class QuoteCache:
+    """服务报价缓存（线程安全）"""
+
+    def __init__(self, services_url: str, ttl: float = DEFAULT_TTL, session=None, timeout: float = 5):
+        """
+        Args:
+            services_url: 服务列表地址
+            ttl: 默认缓存时间（秒），响应中的 max-age 优先
+            session: requests.Session（默认使用 requests 模块）
+            timeout: 请求超时（秒）
+        """
+        self.services_url = services_url
+        self.ttl = ttl
+        self.timeout = timeout
+        self._session = session or requests
+        self._quotes: Dict[str, Quote] = {}
+        self._etag: Optional[str] = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.revalidations = 0
+        self.invalidations = 0
+
+    def get(self, endpoint: str) -> Optional[Quote]:
+        """返回端点报价；缓存过期时先重新验证"""
+        if time.monotonic() >= self._expires:
+            self.refresh()
+        quote = self._quotes.get(endpoint)
+        if quote is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return quote
+
+    def revalidate(self, endpoint: str) -> Optional[Quote]:
+        """
+        不论缓存是否过期都向服务端确认（带 If-None-Match），返回最新报价
+
+        Returns:
+            确认后的报价；服务端不可达或没有该端点时为 None
+        """
+        if not self.refresh(force=True):
+            return None
+        return self._quotes.get(endpoint)
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        重新加载或验证报价
+
+        Args:
+            force: 缓存未过期也发出请求
+
+        Returns:
+            是否得到了有效的服务端响应（200 或 304）
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._expires and not force:
+                return True
+
+            headers = {}
+            if self._etag and self._quotes:
+                headers["If-None-Match"] = self._etag
+            try:
+                response = self._session.get(self.services_url, headers=headers, timeout=self.timeout)
+            except requests.RequestException:
+                self._expires = now + RETRY_AFTER
+                return False
+
+            if response.status_code == 304:
+                self.revalidations += 1
+            elif response.status_code == 200:
+                try:
+                    self._quotes = self._parse(response.json())
+                except (ValueError, KeyError, TypeError):
+                    self._expires = now + RETRY_AFTER
+                    return False
+                self._etag = response.headers.get("ETag")
+                self.fetches += 1
+            else:
+                self._expires = now + RETRY_AFTER
+                return False
+
+            m = _MAX_AGE.search(response.headers.get("Cache-Control", ""))
+            self._expires = now + (int(m.group(1)) if m else self.ttl)
+            return True
+
+    def invalidate(self) -> None:
+        """丢弃全部报价，下次 get() 重新完整加载"""
+        with self._lock:
+            self._quotes = {}
+            self._etag = None
+            self._expires = 0.0
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "quotes": len(self._quotes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "fetches": self.fetches,
+            "revalidations": self.revalidations,
+            "invalidations": self.invalidations,
+        }
+
+    @staticmethod
+    def _parse(data: dict) -> Dict[str, Quote]:
+        recipient = data["payment_recipient"]
+        quotes = {}
+        for endpoint, info in data["services"].items():
+            if "amount" not in info:
+                continue
+            quotes[endpoint] = Quote(endpoint, recipient, int(info["amount"]), info.get("currency", "USDT"))
+        return quotes
@@ -0,0 +1,116 @@
+"""
+ACPay x402 Records - Agent 与服务端共享的 x402 支付记录类型
+
+记录基于 NamedTuple：无实例 __dict__、不可变，可直接由合约 ABI
+返回的元组构造（字段顺序与 BuyerWallet.sol 中的结构体一致），
+并提供紧凑的二进制序列化，适合大量缓存或索引支付证明。
+"""
+
+import struct
+from typing import NamedTuple
+
+# 二进制布局（大端）：定长头部 + 变长 UTF-8 字符串
+# 金额与时间戳以 uint64 存储，超出范围时序列化抛出 ValueError
+_PROOF_HEADER = struct.Struct(">32s20sQQ32sHH")
+_INFO_HEADER = struct.Struct(">20sQQQHHB")
+
+
+def _address_to_bytes(address: str) -> bytes:
+    return bytes.fromhex(address[2:] if address.startswith(("0x", "0X")) else address)
+
+
+def _hash_to_bytes(value) -> bytes:
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    return bytes.fromhex(value[2:] if value.startswith(("0x", "0X")) else value)
+
+
+class X402PaymentInfo(NamedTuple):
+    """x402支付信息（对应合约 X402PaymentInfo，附加币种字段）"""
+    agent_id: str
+    recipient: str
+    amount: int
+    api_endpoint: str
+    nonce: int
+    expiry: int
+    currency: str = "USDT"
+
+    @classmethod
+    def from_abi(cls, values) -> "X402PaymentInfo":
+        """从合约返回的 X402PaymentInfo 元组构造"""
+        return cls._make(values)
+
+    def to_bytes(self) -> bytes:
+        """紧凑二进制序列化（地址以小写十六进制还原）"""
+        agent_id = self.agent_id.encode()
+        endpoint = self.api_endpoint.encode()
+        currency = self.currency.encode()
+        try:
+            header = _INFO_HEADER.pack(
+                _address_to_bytes(self.recipient), self.amount, self.nonce, self.expiry,
+                len(agent_id), len(endpoint), len(currency)
+            )
+        except struct.error as e:
+            raise ValueError(f"payment info not serializable: {e}") from None
+        return header + agent_id + endpoint + currency
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "X402PaymentInfo":
+        """从 to_bytes 的输出还原"""
+        recipient, amount, nonce, expiry, n_agent, n_endpoint, n_currency = _INFO_HEADER.unpack_from(data)
+        offset = _INFO_HEADER.size
+        agent_id = data[offset:offset + n_agent].decode()
+        offset += n_agent
+        endpoint = data[offset:offset + n_endpoint].decode()
+        offset += n_endpoint
+        currency = data[offset:offset + n_currency].decode()
+        if offset + n_currency != len(data):
+            raise ValueError("payment info length mismatch")
+        return cls(agent_id, "0x" + recipient.hex(), amount, endpoint, nonce, expiry, currency)
+
+
+class X402PaymentProof(NamedTuple):
+    """x402支付证明（对应合约 X402PaymentProof，verifyX402Payment 的返回值）"""
+    payment_hash: bytes
+    agent_id: str
+    recipient: str
+    amount: int
+    api_endpoint: str
+    timestamp: int
+    tx_hash: bytes
+
+    @classmethod
+    def from_abi(cls, values) -> "X402PaymentProof":
+        """从 verifyX402Payment 返回的元组构造（不做拷贝或类型转换）"""
+        return cls._make(values)
+
+    @property
+    def exists(self) -> bool:
+        """合约对未知哈希返回零值结构体"""
+        return self.timestamp != 0
+
+    def to_bytes(self) -> bytes:
+        """紧凑二进制序列化（地址以小写十六进制还原）"""
+        agent_id = self.agent_id.encode()
+        endpoint = self.api_endpoint.encode()
+        try:
+            header = _PROOF_HEADER.pack(
+                _hash_to_bytes(self.payment_hash), _address_to_bytes(self.recipient),
+                self.amount, self.timestamp, _hash_to_bytes(self.tx_hash),
+                len(agent_id), len(endpoint)
+            )
+        except struct.error as e:
+            raise ValueError(f"payment proof not serializable: {e}") from None
+        return header + agent_id + endpoint
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "X402PaymentProof":
+        """从 to_bytes 的输出还原"""
+        payment_hash, recipient, amount, timestamp, tx_hash, n_agent, n_endpoint = _PROOF_HEADER.unpack_from(data)
+        offset = _PROOF_HEADER.size
+        agent_id = data[offset:offset + n_agent].decode()
+        offset += n_agent
+        endpoint = data[offset:offset + n_endpoint].decode()
+        if offset + n_endpoint != len(data):
+            raise ValueError("payment proof length mismatch")
+        return cls(payment_hash, agent_id, "0x" + recipient.hex(), amount, endpoint, timestamp, tx_hash)
@@ -2,48 +2,45 @@ import os
 import json
 import time
 import hashlib
-from flask import Flask, request, jsonify, make_response
+import logging
+from eth_abi.exceptions import EncodingError
+from flask import Flask, g, request, jsonify, make_response
 from web3 import Web3
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
+
+from buyer_wallet import BuyerWalletClient
+from x402_headers import HeaderError, format_accept_payment, parse_payment_proof
+from x402_cbor import CBOR_CONTENT_TYPE, encode_payment_required, wants_cbor
+from x402_metrics import METRICS, PROMETHEUS_CONTENT_TYPE
+from chain_head import get_tracker
+from x402_sessions import SessionError, SessionManager, bearer_token, load_session_secret
+from response_cache import ResponseCache
+from admission import Admission
+from singleflight import SingleFlight
+from optimistic import OptimisticVerifier
+from shm_table import FULL, PRESENT, SharedTable, TableFull
+from payment_filter import PaymentFilter
+from resilience import CircuitOpenError, ResilientHTTPProvider, all_stats as resilience_stats
+import prefork
+from spending_analytics import DIMENSIONS, Payment, PaymentStore, parse_query
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
 # 配置
 INJECTIVE_TESTNET_RPC = "https://k8s.testnet.json-rpc.injective.network/"
+INJECTIVE_TESTNET_WS = os.getenv("INJECTIVE_WS_RPC")  # 可选，未设置时轮询链头
 BUYER_WALLET_ADDRESS = "0x..."  # 实际部署的合约地址
 SERVICE_RECIPIENT = "0x..."     # 服务提供商的收款地址
 
-# 合约ABI（简化版）
-BUYER_WALLET_ABI = [
-    {
-        "inputs": [{"name": "_paymentHash", "type": "bytes32"}],
-        "name": "verifyX402Payment",
-        "outputs": [
-            {
-                "components": [
-                    {"name": "paymentHash", "type": "bytes32"},
-                    {"name": "agent", "type": "address"},
-                    {"name": "recipient", "type": "address"},
-                    {"name": "amount", "type": "uint256"},
-                    {"name": "apiEndpoint", "type": "string"},
-                    {"name": "timestamp", "type": "uint256"},
-                    {"name": "txHash", "type": "bytes32"}
-                ],
-                "name": "proof",
-                "type": "tuple"
-            }
-        ],
-        "stateMutability": "view",
-        "type": "function"
-    }
-]
 
-# Web3连接
-w3 = Web3(Web3.HTTPProvider(INJECTIVE_TESTNET_RPC))
-buyer_wallet_contract = w3.eth.contract(
-    address=BUYER_WALLET_ADDRESS,
-    abi=BUYER_WALLET_ABI
-)
+# Web3连接（自适应超时、只读调用重试、节点故障时熔断）
+w3 = Web3(ResilientHTTPProvider(INJECTIVE_TESTNET_RPC))
+wallet = BuyerWalletClient(w3, BUYER_WALLET_ADDRESS)
+
+# 共享链头（在 __main__ 中启动；未启动时 now() 回退到本地时间）
+chain_head = get_tracker(INJECTIVE_TESTNET_RPC, INJECTIVE_TESTNET_WS, start=False)
 
 # 服务配置
 SERVICES = {
@@ -51,7 +48,8 @@ SERVICES = {
         "name": "Weather API",
         "price": 5000000,  # 5 USDT (6 decimals)
         "currency": "USDT",
-        "description": "Real-time weather data"
+        "description": "Real-time weather data",
+        "optimistic": True  # 信誉良好的Agent先服务、后台验证
     },
     "/x402/ai-model": {
         "name": "AI Model API",
@@ -61,53 +59,206 @@ SERVICES = {
     }
 }
 
-def parse_payment_proof(payment_proof_header: str) -> Optional[Dict[str, str]]:
+MAX_BATCH_VERIFY = 100  # 单次批量验证的最大证明数（一次 eth_call）
+
+# 报价版本：价格或收款地址变化时改变，Agent 据此重新验证缓存的报价
+QUOTE_MAX_AGE = 60  # 秒
+SERVICES_ETAG = hashlib.sha256(json.dumps(
+    [SERVICE_RECIPIENT, {endpoint: [service['price'], service['currency']] for endpoint, service in SERVICES.items()}],
+    sort_keys=True
+).encode()).hexdigest()[:16]
+
+# 已验证支付的本地索引与按日/小时聚合（ACPAY_PAYMENTS_DB 指定文件，默认内存）
+PAYMENTS = PaymentStore(os.getenv("ACPAY_PAYMENTS_DB", ":memory:"))
+
+# 预付会话：一次支付换取带余额的令牌（多副本需配置相同的 ACPAY_SESSION_SECRET）。
+# 每笔支付只能换取一次：换取前在 PAYMENTS 中占用支付哈希，ACPAY_PAYMENTS_DB 为文件时
+# 重启后仍然有效，共享同一文件的副本之间也不能重复换取；已用额度计数每个副本各一份
+SESSION_ENDPOINT = "/x402/session"
+SESSIONS = SessionManager(load_session_secret(), claim=PAYMENTS.claim)
+
+# 准入控制：按客户端IP / Agent ID / 端点限流，在任何验证与RPC之前拒绝超限请求
+ADMISSION = Admission(paths=[*SERVICES, SESSION_ENDPOINT, '/analytics/spending', '/analytics/export.csv'])
+app.before_request(ADMISSION.flask_hook)
+
+# 天气数据的响应内容缓存: 新鲜5秒，之后30秒内返回旧内容并后台刷新
+WEATHER_CACHE = ResponseCache(ttl=5, stale=30)
+
+def build_weather_data() -> dict:
+    """天气数据的公共部分（可缓存）"""
+    return {
+        "location": "San Francisco",
+        "temperature": 22,
+        "humidity": 65,
+        "condition": "Sunny",
+        "timestamp": int(time.time())
+    }
+
+# 并发验证合并：同一 (哈希, 端点, 金额) 同时只有一次RPC在进行
+VERIFY_FLIGHTS = SingleFlight("verify_coalesced")
+
+# 验证缓存与重放集合：fork 之前创建的共享内存表，prefork 的所有 worker 共享（无锁读取）
+# 两张表都不淘汰未过期的条目：重放集合装满时带证明的请求返回503（fail closed），
+# 验证缓存装满时只是不再缓存。重放集合的条目存活 PROOF_MAX_AGE 秒，
+# 容量 = PROOF_MAX_AGE × 峰值付费请求速率（ACPAY_PAID_RPS）× 2，取2的幂（每槽32字节）
+PROOF_MAX_AGE = 3600     # 秒，证明在支付后多久内可用
+VERIFY_CACHE_TTL = 300   # 秒，验证通过的结果缓存时间（不超过证明剩余有效期）
+PAID_RPS = float(os.getenv("ACPAY_PAID_RPS", "20"))
+SHM_SLOTS = int(os.getenv("ACPAY_SHM_SLOTS", "0")) or 1 << max(10, int(PROOF_MAX_AGE * PAID_RPS * 2 - 1).bit_length())
+SHM_MAX_PROBE = 64
+VERIFIED = SharedTable(SHM_SLOTS, max_probe=SHM_MAX_PROBE, evict=False)   # 验证通过的 (哈希, 端点, 金额)
+CONSUMED = SharedTable(SHM_SLOTS, max_probe=SHM_MAX_PROBE, evict=False)   # 已换取过响应的支付哈希（每个证明只能使用一次）
+
+# 已知支付哈希的布隆过滤器（X402PaymentMade 事件同步），确定不存在的哈希不发RPC
+KNOWN_PAYMENTS = PaymentFilter(w3, BUYER_WALLET_ADDRESS, chain_head, rotate_after=PROOF_MAX_AGE)
+
+class VerificationUnavailable(RuntimeError):
+    """链上验证暂时无法完成（RPC 超时、节点错误或熔断中），不代表支付无效"""
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def _unavailable(e: Exception) -> VerificationUnavailable:
+    METRICS.inc("verify_error")
+    retry_after = e.retry_after if isinstance(e, CircuitOpenError) else 1.0
+    return VerificationUnavailable(f"payment verification unavailable: {e}", retry_after)
+
+def verification_unavailable_response(e: VerificationUnavailable):
+    """503 + Retry-After：客户端已支付，稍后带同一证明重试即可"""
+    retry_after = max(1, int(e.retry_after + 0.999))
+    response = jsonify({"error": "Payment verification unavailable", "retry_after": retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def _well_formed(payment_hash) -> bool:
+    """32字节的十六进制支付哈希（可带 0x）；格式错误的哈希视为无效证明，不发RPC"""
+    if not isinstance(payment_hash, str):
+        return False
+    digits = payment_hash[2:] if payment_hash.startswith(("0x", "0X")) else payment_hash
+    try:
+        return len(bytes.fromhex(digits)) == 32
+    except ValueError:
+        return False
+
+def _verified_key(payment_hash: str, expected_endpoint: str, expected_amount: int) -> str:
+    return f"{payment_hash.lower()}|{expected_endpoint}|{expected_amount}"
+
+def _remember_verified(payment_hash: str, expected_endpoint: str, expected_amount: int, paid_at: int) -> None:
+    ttl = min(VERIFY_CACHE_TTL, paid_at + PROOF_MAX_AGE - chain_head.now())
+    if ttl <= 0:
+        return
+    try:
+        VERIFIED.put(_verified_key(payment_hash, expected_endpoint, expected_amount), ttl=ttl)
+    except TableFull:
+        METRICS.inc("verify_cache_full")
+
+def verify_payment_on_chain(payment_hash: str, expected_endpoint: str, expected_amount: int) -> bool:
+    """
+    在链上验证支付证明（命中验证缓存或被过滤器排除时不发RPC；同一证明的并发验证共享一次RPC）
+    
+    Raises:
+        VerificationUnavailable: RPC 失败，无法确认支付是否有效
+    """
+    return verify_payment_agent(payment_hash, expected_endpoint, expected_amount) is not None
+
+def verify_payment_agent(payment_hash: str, expected_endpoint: str, expected_amount: int) -> Optional[str]:
     """
-    解析Payment-Proof头部
+    同 verify_payment_on_chain，返回链上证明中的付款 Agent ID（无效时为 None；
+    命中验证缓存时付款方未知，返回空字符串）
     
-    格式: injective hash=0x... agent=0x... timestamp=1234567890
+    Raises:
+        VerificationUnavailable: RPC 失败，无法确认支付是否有效
     """
-    try:
-        parts = payment_proof_header.split()
-        if parts[0] != "injective":
-            return None
-        
-        proof_data = {}
-        for part in parts[1:]:
-            if '=' in part:
-                key, value = part.split('=', 1)
-                proof_data[key] = value
-        
-        return proof_data
-    except:
+    if not _well_formed(payment_hash):
         return None
+    if _verified_key(payment_hash, expected_endpoint, expected_amount) in VERIFIED:
+        METRICS.inc("verify_cache_hit")
+        return ""
+    if not KNOWN_PAYMENTS.check(payment_hash):
+        return None
+    key = (payment_hash.lower(), expected_endpoint, expected_amount)
+    return VERIFY_FLIGHTS.do(key, _verify_on_chain, payment_hash, expected_endpoint, expected_amount)
 
-def verify_payment_on_chain(payment_hash: str, expected_endpoint: str, expected_amount: int) -> bool:
+def _verify_on_chain(payment_hash: str, expected_endpoint: str, expected_amount: int) -> Optional[str]:
     """
-    在链上验证支付证明
+    在链上验证支付证明，返回证明中的付款 Agent ID（无效为 None；
+    格式错误的哈希视为无效；RPC 失败抛出 VerificationUnavailable）
     """
     try:
-        # 调用合约验证支付证明
-        proof_data = buyer_wallet_contract.functions.verifyX402Payment(payment_hash).call()
-        
-        # 检查支付信息
-        if (proof_data[2].lower() != SERVICE_RECIPIENT.lower() or  # recipient
-            proof_data[3] != expected_amount or                    # amount
-            expected_endpoint not in proof_data[4]):               # apiEndpoint
-            return False
-        
-        # 检查支付时间（不能太久之前，防止重放攻击）
-        payment_time = proof_data[5]
-        current_time = int(time.time())
-        if current_time - payment_time > 3600:  # 1小时过期
-            return False
-        
-        return True
+        # 读取链上记录的支付证明（直接 eth_call，预构建的解码器）
+        with METRICS.span("rpc_call"):
+            proof = wallet.get_x402_proof(payment_hash)
+    except (ValueError, EncodingError):
+        return None
+    except Exception as e:
+        logger.warning("Error verifying payment %s: %s", payment_hash, e)
+        raise _unavailable(e) from e
+    if not _accept_proof(proof, expected_endpoint, expected_amount):
+        return None
+    _remember_verified(payment_hash, expected_endpoint, expected_amount, proof.timestamp)
+    return proof.agent_id
+
+def verify_payments_on_chain(payments: List[Tuple[str, str, int]]) -> List[bool]:
+    """
+    批量验证支付证明：一次 verifyX402Payments eth_call 读取全部证明
+    
+    Args:
+        payments: (payment_hash, expected_endpoint, expected_amount) 列表
         
+    Returns:
+        与输入顺序一致的验证结果（格式错误的哈希与逐个验证一样判为无效，不进入批量调用）
+    
+    Raises:
+        VerificationUnavailable: RPC 失败
+    """
+    well_formed = [_well_formed(payment[0]) for payment in payments]
+    results = [ok and _verified_key(*payment) in VERIFIED for ok, payment in zip(well_formed, payments)]
+    misses = [i for i, cached in enumerate(results)
+              if well_formed[i] and not cached and KNOWN_PAYMENTS.check(payments[i][0])]
+    if not misses:
+        return results
+    try:
+        with METRICS.span("rpc_call"):
+            proofs = wallet.get_x402_proofs(payments[i][0] for i in misses)
     except Exception as e:
-        print(f"Error verifying payment: {e}")
+        logger.warning("Error verifying %d payments: %s", len(misses), e)
+        raise _unavailable(e) from e
+    for i, proof in zip(misses, proofs):
+        results[i] = _accept_proof(proof, payments[i][1], payments[i][2])
+        if results[i]:
+            _remember_verified(*payments[i], proof.timestamp)
+    return results
+
+def settle_optimistic(payment_hash: str, agent_id: str, expected_endpoint: str, expected_amount: int) -> bool:
+    """
+    乐观服务的后台结算：证明须由声称的 Agent 支付；RPC 异常向上抛出（由 OptimisticVerifier 重试）
+    """
+    with METRICS.span("rpc_call"):
+        proof = wallet.get_x402_proof(payment_hash)
+    return proof.agent_id == agent_id and _accept_proof(proof, expected_endpoint, expected_amount)
+
+# 乐观模式：SERVICES 中 optimistic 为 True 的端点，对信誉良好的Agent先返回数据再后台验证
+OPTIMISTIC = OptimisticVerifier(settle_optimistic, wallet.get_agent_signer)
+
+def _accept_proof(proof, expected_endpoint: str, expected_amount: int) -> bool:
+    """检查链上证明是否匹配本服务的收款信息，通过时写入支付索引"""
+    if (not proof.exists or
+        proof.recipient.lower() != SERVICE_RECIPIENT.lower() or
+        proof.amount != expected_amount or
+        expected_endpoint not in proof.api_endpoint):
         return False
+    
+    # 检查支付时间（不能太久之前，防止重放攻击），以链上时间为准
+    current_time = int(chain_head.now())
+    if current_time - proof.timestamp > PROOF_MAX_AGE:  # 1小时过期
+        return False
+    
+    PAYMENTS.record(Payment.from_proof(proof))
+    return True
 
+@METRICS.timed("response_build")
 def create_x402_response(endpoint: str) -> tuple:
     """
     创建标准x402响应
@@ -120,8 +271,20 @@ def create_x402_response(endpoint: str) -> tuple:
     nonce = int(time.time() * 1000)
     expiry = int(time.time()) + 3600  # 1小时过期
     
+    # 协商为CBOR时只返回紧凑响应体（不含说明文字与Accept-Payment头部）
+    if wants_cbor(request.accept_mimetypes):
+        body = encode_payment_required(
+            SERVICE_RECIPIENT, service['price'], service['currency'], endpoint, nonce, expiry
+        )
+        response = make_response(body, 402)
+        response.content_type = CBOR_CONTENT_TYPE
+        response.vary.add('Accept')
+        return response
+    
     # 创建Accept-Payment头部
-    accept_payment = f"injective address={SERVICE_RECIPIENT} amount={service['price']} currency={service['currency']} endpoint={endpoint} nonce={nonce} expiry={expiry}"
+    accept_payment = format_accept_payment(
+        SERVICE_RECIPIENT, service['price'], service['currency'], endpoint, nonce, expiry
+    )
     
     # 响应体包含详细的支付信息
     response_data = {
@@ -141,44 +304,160 @@ def create_x402_response(endpoint: str) -> tuple:
     response = make_response(jsonify(response_data), 402)
     response.headers['Accept-Payment'] = accept_payment
     response.headers['Payment-Required'] = 'true'
+    response.vary.add('Accept')
     
     return response
 
-@app.route('/x402/weather', methods=['GET'])
-def weather_api():
-    """天气API - 需要5 USDT支付"""
-    endpoint = "/x402/weather"
-    service = SERVICES[endpoint]
+def check_payment_proof(endpoint: str, amount: int, consume: bool = True):
+    """
+    校验 Payment-Proof / X-Payment-Hash 并在链上验证（证明中带 hash 时可省略 X-Payment-Hash）
     
-    # 检查是否提供了支付证明
-    payment_proof = request.headers.get('Payment-Proof')
-    payment_hash = request.headers.get('X-Payment-Hash')
+    Args:
+        consume: 把支付哈希记入重放集合（同一证明再次使用时返回402）
     
-    if not payment_proof or not payment_hash:
+    Returns:
+        验证失败时的响应，成功返回None（支付哈希记入 g.payment_hash）
+    """
+    payment_proof = request.headers.get('Payment-Proof')
+    if not payment_proof:
         # 没有支付证明，返回402响应
         return create_x402_response(endpoint)
     
     # 解析支付证明
-    proof_data = parse_payment_proof(payment_proof)
-    if not proof_data:
-        return jsonify({"error": "Invalid payment proof format"}), 400
+    try:
+        with METRICS.span("header_parse"):
+            proof = parse_payment_proof(payment_proof)
+    except HeaderError as e:
+        return jsonify({"error": "Invalid payment proof format", "details": str(e)}), 400
+    
+    payment_hash = request.headers.get('X-Payment-Hash') or proof.hash
+    if not payment_hash:
+        return jsonify({"error": "X-Payment-Hash or Payment-Proof hash required"}), 402
+    g.payment_hash = payment_hash
     
-    # 验证支付证明
-    if not verify_payment_on_chain(payment_hash, endpoint, service['price']):
+    # 重放检查：先占用支付哈希，验证失败时释放（并发的重复请求只有一个能通过）
+    if consume:
+        status = CONSUMED.put_if_absent(payment_hash.lower(), ttl=PROOF_MAX_AGE)
+        if status == PRESENT:
+            METRICS.inc("payment_replayed")
+            return jsonify({"error": "Payment already used", "payment_hash": payment_hash}), 402
+        if status == FULL:
+            # 无法记录已使用的证明：拒绝服务而不是冒重放的风险
+            METRICS.inc("replay_set_full")
+            return verification_unavailable_response(VerificationUnavailable("replay set full"))
+    
+    # 乐观模式：立即服务，验证在后台进行（g.payment_pending 标记未确认）
+    agent_id = proof.agent or request.headers.get('X-Agent-ID')
+    if SERVICES.get(endpoint, {}).get('optimistic') and OPTIMISTIC.admit(agent_id, payment_hash, endpoint, amount):
+        g.payment_pending = True
+        return None
+    
+    # 验证支付证明（RPC 故障时返回503，证明保持可用，而不是把已支付的请求判为402）
+    try:
+        payer = verify_payment_agent(payment_hash, endpoint, amount)
+    except VerificationUnavailable as e:
+        if consume:
+            CONSUMED.discard(payment_hash.lower())
+        return verification_unavailable_response(e)
+    if payer is None:
+        if consume:
+            CONSUMED.discard(payment_hash.lower())
         return jsonify({"error": "Payment verification failed"}), 402
+    # 只为链上证明的付款方累积信誉：声称他人的 Agent ID 不会替对方（或自己）攒信誉
+    if agent_id and payer == agent_id:
+        OPTIMISTIC.record_verified(payer, amount)
+    return None
+
+def charge_session(price: int):
+    """
+    按 Authorization: Bearer 令牌扣费
     
-    # 支付验证成功，返回天气数据
-    weather_data = {
-        "location": "San Francisco",
-        "temperature": 22,
-        "humidity": 65,
-        "condition": "Sunny",
-        "timestamp": int(time.time()),
-        "payment_verified": True,
-        "payment_hash": payment_hash
-    }
+    Returns:
+        (Charge, None)、(None, 错误响应)，请求未携带令牌时为 (None, None)
+    """
+    token = bearer_token(request.headers.get('Authorization'))
+    if token is None:
+        return None, None
+    try:
+        return SESSIONS.charge(token, price), None
+    except SessionError as e:
+        METRICS.inc(f"session_{e.code}")
+        status = {"insufficient": 402, "unavailable": 503}.get(e.code, 401)
+        return None, (jsonify({"error": "Session token rejected", "reason": e.code, "details": str(e)}), status)
+
+@app.route(SESSION_ENDPOINT, methods=['POST'])
+def create_session():
+    """用一笔批量支付换取预付会话令牌（支付的 apiEndpoint 须为 /x402/session）"""
+    data = request.get_json(silent=True) or {}
+    amount = data.get('amount')
+    if not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0:
+        return jsonify({"error": "Missing or invalid amount (integer, 6 decimals)"}), 400
+    
+    if not request.headers.get('Payment-Proof'):
+        return jsonify({"error": "Payment-Proof required"}), 402
+    # 不记入重放集合：SESSIONS.mint 按哈希派生会话ID，同一笔支付第二次换取被拒绝
+    rejected = check_payment_proof(SESSION_ENDPOINT, amount, consume=False)
+    if rejected:
+        return rejected
+    
+    try:
+        token, session = SESSIONS.mint(g.payment_hash, amount, data.get('agent_id', ''))
+    except SessionError as e:
+        METRICS.inc(f"session_{e.code}")
+        if e.code == "unavailable":
+            return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
+        return jsonify({"error": "Payment already used", "payment_hash": g.payment_hash}), 402
+    return jsonify({
+        "token": token,
+        "session_id": session.session_id.hex(),
+        "balance": amount,
+        "remaining": SESSIONS.remaining(token),
+        "expires_at": session.expiry
+    })
+
+@app.route(SESSION_ENDPOINT, methods=['GET'])
+def session_status():
+    """查询会话令牌余额"""
+    token = bearer_token(request.headers.get('Authorization'))
+    if token is None:
+        return jsonify({"error": "Missing Authorization: Bearer token"}), 401
+    try:
+        session = SESSIONS.parse(token)
+        remaining = SESSIONS.remaining(token)
+    except SessionError as e:
+        return jsonify({"error": "Session token rejected", "reason": e.code, "details": str(e)}), 401
+    return jsonify({
+        "session_id": session.session_id.hex(),
+        "balance": session.balance,
+        "remaining": remaining,
+        "expires_at": session.expiry
+    })
+
+@app.route('/x402/weather', methods=['GET'])
+def weather_api():
+    """天气API - 需要5 USDT支付"""
+    endpoint = "/x402/weather"
+    service = SERVICES[endpoint]
+    
+    # 会话令牌优先：本地扣费，无需逐次链上验证
+    charge, rejected = charge_session(service['price'])
+    if rejected:
+        return rejected
     
-    return jsonify(weather_data)
+    if charge:
+        payment_hash = f"session:{charge.session_id}"
+    else:
+        rejected = check_payment_proof(endpoint, service['price'])
+        if rejected:
+            return rejected
+        payment_hash = g.payment_hash
+    
+    # 支付验证成功，返回天气数据（公共部分来自缓存，只拼接本次支付字段）
+    with METRICS.span("response_build"):
+        key = tuple(sorted(request.args.items(multi=True)))
+        body = WEATHER_CACHE.render(key, build_weather_data, payment_verified=not g.get('payment_pending'),
+                                    payment_hash=payment_hash)
+        return app.response_class(body, mimetype='application/json')
 
 @app.route('/x402/ai-model', methods=['GET'])
 def ai_model_api():
@@ -186,22 +465,18 @@ def ai_model_api():
     endpoint = "/x402/ai-model"
     service = SERVICES[endpoint]
     
-    # 检查是否提供了支付证明
-    payment_proof = request.headers.get('Payment-Proof')
-    payment_hash = request.headers.get('X-Payment-Hash')
+    # 会话令牌优先：本地扣费，无需逐次链上验证
+    charge, rejected = charge_session(service['price'])
+    if rejected:
+        return rejected
     
-    if not payment_proof or not payment_hash:
-        # 没有支付证明，返回402响应
-        return create_x402_response(endpoint)
-    
-    # 解析支付证明
-    proof_data = parse_payment_proof(payment_proof)
-    if not proof_data:
-        return jsonify({"error": "Invalid payment proof format"}), 400
-    
-    # 验证支付证明
-    if not verify_payment_on_chain(payment_hash, endpoint, service['price']):
-        return jsonify({"error": "Payment verification failed"}), 402
+    if charge:
+        payment_hash = f"session:{charge.session_id}"
+    else:
+        rejected = check_payment_proof(endpoint, service['price'])
+        if rejected:
+            return rejected
+        payment_hash = g.payment_hash
     
     # 支付验证成功，返回AI模型结果
     ai_result = {
@@ -210,17 +485,21 @@ def ai_model_api():
         "output": "This is a simulated AI model response. Your payment has been verified and the service is now available.",
         "confidence": 0.95,
         "timestamp": int(time.time()),
-        "payment_verified": True,
+        "payment_verified": not g.get('payment_pending'),
         "payment_hash": payment_hash
     }
     
-    return jsonify(ai_result)
+    with METRICS.span("response_build"):
+        return jsonify(ai_result)
 
 @app.route('/verify-payment', methods=['POST'])
 def verify_payment():
-    """验证支付证明的独立端点"""
+    """验证支付证明的独立端点（payment_hashes 为列表时一次RPC批量验证）"""
     data = request.get_json()
     
+    if data and isinstance(data.get('payment_hashes'), list):
+        return verify_payments(data)
+    
     if not data or 'payment_hash' not in data:
         return jsonify({"error": "Missing payment_hash"}), 400
     
@@ -232,7 +511,10 @@ def verify_payment():
         return jsonify({"error": "Invalid endpoint"}), 400
     
     # 验证支付
-    is_valid = verify_payment_on_chain(payment_hash, endpoint, service['price'])
+    try:
+        is_valid = verify_payment_on_chain(payment_hash, endpoint, service['price'])
+    except VerificationUnavailable as e:
+        return verification_unavailable_response(e)
     
     return jsonify({
         "valid": is_valid,
@@ -241,6 +523,34 @@ def verify_payment():
         "timestamp": int(time.time())
     })
 
+def verify_payments(data: dict):
+    """批量验证：payment_hashes 可与 endpoints 列表逐一对应，或共用 endpoint"""
+    payment_hashes = data['payment_hashes']
+    endpoints = data.get('endpoints') or [data.get('endpoint', '/x402/weather')] * len(payment_hashes)
+    if len(endpoints) != len(payment_hashes):
+        return jsonify({"error": "endpoints must match payment_hashes"}), 400
+    if len(payment_hashes) > MAX_BATCH_VERIFY:
+        return jsonify({"error": f"At most {MAX_BATCH_VERIFY} payment hashes per request"}), 400
+    
+    payments = []
+    for payment_hash, endpoint in zip(payment_hashes, endpoints):
+        service = SERVICES.get(endpoint)
+        if not service:
+            return jsonify({"error": "Invalid endpoint", "endpoint": endpoint}), 400
+        payments.append((payment_hash, endpoint, service['price']))
+    
+    try:
+        results = verify_payments_on_chain(payments)
+    except VerificationUnavailable as e:
+        return verification_unavailable_response(e)
+    return jsonify({
+        "results": [
+            {"payment_hash": payment_hash, "endpoint": endpoint, "valid": valid}
+            for (payment_hash, endpoint, _), valid in zip(payments, results)
+        ],
+        "timestamp": int(time.time())
+    })
+
 @app.route('/services', methods=['GET'])
 def list_services():
     """列出所有可用的服务"""
@@ -249,16 +559,52 @@ def list_services():
         services_info[endpoint] = {
             "name": service['name'],
             "price": f"{service['price'] / 10**6} {service['currency']}",
+            "amount": service['price'],
+            "currency": service['currency'],
             "description": service['description'],
             "payment_required": True
         }
     
-    return jsonify({
+    response = jsonify({
         "services": services_info,
         "payment_recipient": SERVICE_RECIPIENT,
         "protocol": "x402",
         "blockchain": "Injective EVM"
     })
+    response.set_etag(SERVICES_ETAG)
+    response.cache_control.max_age = QUOTE_MAX_AGE
+    return response.make_conditional(request)
+
+@app.route('/analytics/spending', methods=['GET'])
+def spending_analytics():
+    """按日/小时的消费统计（只读本地聚合，不访问链上数据）"""
+    try:
+        query = parse_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({
+        "start": query['start'],
+        "end": query['end'],
+        "series": PAYMENTS.spending(**query),
+        "totals": PAYMENTS.totals(query['start'], query['end'], query['by'],
+                                  **{k: v for k, v in query.items() if k in DIMENSIONS})
+    })
+
+@app.route('/analytics/export.csv', methods=['GET'])
+def spending_export():
+    """按时间桶聚合的消费CSV（流式）"""
+    args = request.args.to_dict()
+    args.setdefault('by', ','.join(DIMENSIONS))
+    try:
+        query = parse_query(args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return app.response_class(PAYMENTS.export_csv(**query), mimetype='text/csv')
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus指标"""
+    return METRICS.render(), 200, {'Content-Type': PROMETHEUS_CONTENT_TYPE}
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -268,9 +614,19 @@ def health_check():
         "protocol": "x402",
         "blockchain": "Injective EVM",
         "contract": BUYER_WALLET_ADDRESS,
+        "response_cache": {"/x402/weather": WEATHER_CACHE.stats()},
+        "optimistic": OPTIMISTIC.stats(),
+        "payment_filter": KNOWN_PAYMENTS.stats(),
+        "resilience": resilience_stats(),
         "timestamp": int(time.time())
     })
 
+def start_background():
+    """启动链头跟踪与支付过滤器同步（prefork 时在每个 worker 中调用）"""
+    PAYMENTS.reopen()
+    chain_head.start()
+    KNOWN_PAYMENTS.start()
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({"error": "Endpoint not found"}), 404
@@ -294,4 +650,16 @@ if __name__ == '__main__':
         print("❌ Error: Please update contract addresses in the script")
         exit(1)
     
-    app.run(host='0.0.0.0', port=5000, debug=True) 
\ No newline at end of file
+    if prefork.DEFAULT_WORKERS > 1:
+        # 多进程：准入令牌桶与会话计数换到共享内存，链头跟踪线程在每个 worker 中启动。
+        # 乐观模式的信誉、敞口与黑名单只在进程内：每个 worker 各算一份会让风险上限放大 worker 倍
+        if OPTIMISTIC.enabled:
+            print("❌ Error: optimistic mode keeps exposure per process; set ACPAY_OPTIMISTIC=0 or ACPAY_WORKERS=1")
+            exit(1)
+        ADMISSION.share_memory()
+        SESSIONS.share_memory()
+        prefork.serve(app, '0.0.0.0', 5000, prefork.DEFAULT_WORKERS, on_start=start_background)
+    else:
+        start_background()
+        app.run(host='0.0.0.0', port=5000, debug=os.getenv("ACPAY_DEBUG") == "1",
+                request_handler=prefork.request_handler()) 
\ No newline at end of file
@@ -0,0 +1,255 @@
+"""
+ACPay x402 Sessions - 预付会话令牌
+
+一次链上（或演示模式）验证的批量支付换取一个签名的 bearer 令牌，
+令牌携带预付余额，之后每次调用只在本地扣费：
+
+    token, session = SESSIONS.mint(payment_hash, amount=100 * 10**6)
+    charge = SESSIONS.charge(token, price)    # O(1)，余额不足抛出 SessionError
+
+令牌是无状态的（HMAC-SHA256 签名，内含会话ID、余额与过期时间），
+配置相同 ACPAY_SESSION_SECRET 的任意副本都能验证。会话ID由支付哈希派生，
+每笔支付只能换取一次令牌（再次换取抛出 SessionError("used")），不会重复入账。
+传入 claim（如 PaymentStore.claim）时，换取前先一次性占用支付哈希：
+文件数据库在重启后仍然有效，共享同一数据库的副本之间也不能重复换取。
+会话计数保留到令牌过期；令牌有效期从换取时起算，不短于支付证明的有效期，
+计数被清理时该笔支付已无法再通过验证。
+
+已用额度计数是每个副本各自一份：保存在本进程内，prefork 运行时 share_memory()
+把计数换到 fork 前创建的共享内存表（shm_table.py，同一主机的 worker 共享，
+不淘汰未过期的会话，表满时返回 "unavailable"）。同一令牌在 N 个副本上最多
+可以各扣满一次余额（重启后计数也从零开始）；多副本部署时应换成共享计数器
+（如 Redis INCRBY），令牌格式无需改变。
+"""
+
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import struct
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from shm_table import ADDED, FULL, SharedTable, TableFull
+
+logger = logging.getLogger(__name__)
+
+TOKEN_VERSION = 1
+DEFAULT_SESSION_TTL = 3600  # 秒
+
+_HEADER = struct.Struct(">B16sQQ")  # version, session_id, balance, expiry
+_MAC_SIZE = 32
+_SWEEP_EVERY = 1024
+
+
+class SessionError(ValueError):
+    """会话令牌无效、过期或余额不足"""
+
+    def __init__(self, code: str, message: str):
+        super().__init__(message)
+        self.code = code  # invalid / expired / insufficient / used / unavailable
+
+
+class SessionToken(NamedTuple):
+    """令牌内容"""
+    session_id: bytes
+    balance: int
+    expiry: int
+    agent_id: str = ""
+
+
+class Charge(NamedTuple):
+    """一次扣费结果"""
+    session_id: str
+    amount: int
+    remaining: int
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def load_session_secret() -> bytes:
+    """读取 ACPAY_SESSION_SECRET；未设置时生成进程内随机密钥（仅单副本可用）"""
+    secret = os.getenv("ACPAY_SESSION_SECRET")
+    if secret:
+        return secret.encode()
+    logger.warning("ACPAY_SESSION_SECRET not set, session tokens are only valid in this process")
+    return os.urandom(32)
+
+
+def bearer_token(authorization: Optional[str]) -> Optional[str]:
+    """从 Authorization 头部取出 Bearer 令牌"""
+    if not authorization:
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    return token.strip()
+
+
+class SessionManager:
+    """会话令牌签发与扣费"""
+
+    def __init__(self, secret: bytes, ttl: int = DEFAULT_SESSION_TTL,
+                 claim: Optional[Callable[[str, float], bool]] = None):
+        """
+        Args:
+            secret: 令牌签名密钥
+            ttl: 令牌有效期（秒）
+            claim: claim(key, ttl) 一次性占用支付哈希，已被占用返回 False
+                （存储在重启与副本之间共享时才能保证每笔支付只换取一次）
+        """
+        self._secret = secret
+        self.ttl = ttl
+        self._claim = claim
+        self._spent: Dict[bytes, List[int]] = {}  # session_id -> [spent, expiry]
+        self._shared: Optional[SharedTable] = None   # share_memory() 之后的 session_id -> (spent,)
+        self._lock = threading.Lock()
+        self._mints = 0
+
+    def share_memory(self, capacity: int = 65536) -> None:
+        """
+        改用共享内存计数（prefork 运行时在 fork 之前调用，已有的进程内计数被丢弃）
+
+        会话计数保留到令牌过期（ttl 秒），容量应不小于 ttl 内换取令牌数的 2 倍
+        """
+        self._shared = SharedTable(capacity, "Q", max_probe=64, evict=False)
+        self._spent = {}
+
+    def _sign(self, payload: bytes) -> bytes:
+        return hmac.new(self._secret, payload, hashlib.sha256).digest()
+
+    def mint(self, payment_hash: str, amount: int, agent_id: str = "") -> Tuple[str, SessionToken]:
+        """
+        为一笔已验证的支付签发令牌
+
+        Args:
+            payment_hash: 已验证的支付哈希（决定会话ID）
+            amount: 预付余额（最小单位）
+            agent_id: 可选的Agent ID
+
+        Returns:
+            (令牌字符串, 令牌内容)
+
+        Raises:
+            SessionError: 这笔支付已经换取过令牌（code="used"），或无法记录（code="unavailable"）
+        """
+        if amount <= 0:
+            raise ValueError("session amount must be positive")
+        session_id = hashlib.sha256(payment_hash.lower().encode()).digest()[:16]
+        session = SessionToken(session_id, amount, int(time.time()) + self.ttl, agent_id)
+        payload = _HEADER.pack(TOKEN_VERSION, session_id, amount, session.expiry) + agent_id.encode()
+        token = f"{_b64encode(payload)}.{_b64encode(self._sign(payload))}"
+
+        if self._claim is not None:
+            try:
+                claimed = self._claim(f"session:{payment_hash.lower()}", self.ttl)
+            except Exception as e:
+                logger.warning("Could not record session claim for %s: %s", payment_hash, e)
+                raise SessionError("unavailable", "session claim store unavailable") from None
+            if not claimed:
+                raise SessionError("used", "payment already exchanged for a session")
+
+        if self._shared is not None:
+            status = self._shared.put_if_absent(session_id, (0,), ttl=self.ttl)
+            if status == FULL:
+                raise SessionError("unavailable", "session table full")
+            if status != ADDED:
+                raise SessionError("used", "payment already exchanged for a session")
+            return token, session
+
+        with self._lock:
+            if session_id in self._spent:
+                raise SessionError("used", "payment already exchanged for a session")
+            self._spent[session_id] = [0, session.expiry]
+            self._mints += 1
+            if self._mints % _SWEEP_EVERY == 0:
+                self._sweep()
+        return token, session
+
+    def parse(self, token: str) -> SessionToken:
+        """验证签名与过期时间"""
+        try:
+            payload_part, _, mac_part = token.partition(".")
+            payload = _b64decode(payload_part)
+            mac = _b64decode(mac_part)
+        except (ValueError, UnicodeEncodeError):
+            raise SessionError("invalid", "malformed session token")
+        if len(mac) != _MAC_SIZE or len(payload) < _HEADER.size:
+            raise SessionError("invalid", "malformed session token")
+        if not hmac.compare_digest(mac, self._sign(payload)):
+            raise SessionError("invalid", "bad session token signature")
+
+        version, session_id, balance, expiry = _HEADER.unpack_from(payload)
+        if version != TOKEN_VERSION:
+            raise SessionError("invalid", f"unsupported session token version {version}")
+        if expiry < time.time():
+            raise SessionError("expired", "session token expired")
+        try:
+            agent_id = payload[_HEADER.size:].decode()
+        except UnicodeDecodeError:
+            raise SessionError("invalid", "malformed session token")
+        return SessionToken(session_id, balance, expiry, agent_id)
+
+    def charge(self, token: str, amount: int) -> Charge:
+        """
+        从令牌余额扣费（原子操作）
+
+        Raises:
+            SessionError: 令牌无效、过期或余额不足
+        """
+        session = self.parse(token)
+        if self._shared is not None:
+            return self._charge_shared(session, amount)
+        with self._lock:
+            entry = self._spent.get(session.session_id)
+            if entry is None:
+                # 其他副本签发的令牌：本进程首次见到
+                entry = self._spent[session.session_id] = [0, session.expiry]
+            elif session.expiry > entry[1]:
+                entry[1] = session.expiry
+            if entry[0] + amount > session.balance:
+                raise SessionError(
+                    "insufficient",
+                    f"session balance {session.balance - entry[0]} < {amount}"
+                )
+            entry[0] += amount
+            spent = entry[0]
+        return Charge(session.session_id.hex(), amount, session.balance - spent)
+
+    def remaining(self, token: str) -> int:
+        """令牌剩余余额"""
+        session = self.parse(token)
+        if self._shared is not None:
+            entry = self._shared.get(session.session_id)
+        else:
+            entry = self._spent.get(session.session_id)
+        return session.balance - (entry[0] if entry else 0)
+
+    def _charge_shared(self, session: SessionToken, amount: int) -> Charge:
+        """共享内存计数上的扣费（读-改-写在表的跨进程锁内完成）"""
+        def debit(old):
+            spent = old[0] if old is not None else 0
+            if spent + amount > session.balance:
+                raise SessionError("insufficient", f"session balance {session.balance - spent} < {amount}")
+            return (spent + amount,)
+
+        try:
+            (spent,) = self._shared.update(session.session_id, debit, ttl=max(session.expiry - time.time(), 0),
+                                           keep_expiry=True)
+        except TableFull:
+            raise SessionError("unavailable", "session table full") from None
+        return Charge(session.session_id.hex(), amount, session.balance - spent)
+
+    def _sweep(self) -> None:
+        """清理已过期会话的计数（调用方持有锁）"""
+        now = time.time()
+        for session_id in [sid for sid, (_, expiry) in self._spent.items() if expiry < now]:
+            del self._spent[session_id]
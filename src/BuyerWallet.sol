@@ -11,7 +11,7 @@ import "./interfaces/IERC20.sol";
  * 核心功能：
  * 1. Agent ID管理 - 支持注册和管理多个AI代理（用ID标识，非地址）
  * 2. 规则限制 - 实现日限额、单笔限额等安全规则
- * 3. 签名验证 - Agent通过签名授权支付，无需持有资金私钥
+ * 3. 签名验证 - Agent通过EIP-712签名授权支付（带截止时间，可预先签名），无需持有资金私钥
  * 4. 延迟聚合支付 - 小额支付先暂存，达到阈值后统一结算
  * 5. 池子对接 - 自动识别seller池子并聚合支付
  * 6. x402支付 - 支持HTTP 402协议的自动支付
@@ -29,6 +29,18 @@ contract BuyerWallet {
     /// @dev 聚合支付阈值（默认50 USDT）
     uint256 public aggregationThreshold = 50 * 10**6;
     
+    /// @dev EIP-712 域类型哈希
+    bytes32 private constant DOMAIN_TYPEHASH =
+        keccak256("EIP712Domain(string name,string version,uint256 chainId,address verifyingContract)");
+    
+    /// @dev Agent支付授权类型哈希（metadata 在 payX402 中为 API 端点）
+    bytes32 public constant AGENT_PAYMENT_TYPEHASH =
+        keccak256("AgentPayment(string agentId,address recipient,uint256 amount,string metadata,uint256 nonce,uint256 deadline)");
+    
+    /// @dev 部署时的域分隔符与链ID（分叉后链ID变化时重新计算）
+    bytes32 private immutable _cachedDomainSeparator;
+    uint256 private immutable _cachedChainId;
+    
     
     /**
      * @dev AI代理信息结构体
@@ -104,6 +116,18 @@ contract BuyerWallet {
         bytes32 txHash;            // 交易哈希
     }
     
+    /**
+     * @dev x402支付的链上紧凑记录（以支付哈希为键）
+     * @notice 接收方、金额与时间戳共用一个存储槽；短于32字节的字符串各占一个槽
+     */
+    struct X402Receipt {
+        address recipient;         // 接收方地址
+        uint64 amount;             // 支付金额 (USDT, 6 decimals)
+        uint32 timestamp;          // 支付时间戳（0 表示不存在）
+        string agentId;            // Agent ID
+        string apiEndpoint;        // API端点
+    }
+    
     // ============ 状态变量 ============
     
     /// @dev Agent ID到Agent信息的映射
@@ -133,8 +157,8 @@ contract BuyerWallet {
     /// @dev 地址是否为池子地址
     mapping(address => bool) public isPoolAddress;
     
-    /// @dev x402支付证明映射
-    mapping(bytes32 => X402PaymentProof) public x402Proofs;
+    /// @dev 支付哈希到x402支付记录的映射（通过 verifyX402Payment(s) 或 x402Proofs 查询）
+    mapping(bytes32 => X402Receipt) internal x402Receipts;
     
     /// @dev Agent签名nonce映射
     mapping(string => uint256) public agentNonces;
@@ -165,17 +189,26 @@ contract BuyerWallet {
     }
     
     /**
-     * @dev 只有注册的活跃Agent可以调用（通过签名验证）
+     * @dev 只有注册的活跃Agent可以调用（通过EIP-712签名验证）
+     * @notice 签名覆盖收款方、金额、元数据、nonce 与截止时间，截止时间前任何时刻提交都有效
      */
-    modifier onlyValidAgent(string calldata agentId, bytes calldata signature, uint256 nonce) {
+    modifier onlyValidAgent(
+        string calldata agentId,
+        address recipient,
+        uint256 amount,
+        string calldata metadata,
+        uint256 nonce,
+        uint256 deadline,
+        bytes calldata signature
+    ) {
         require(agents[agentId].isActive, "BuyerWallet: agent not active");
+        require(block.timestamp <= deadline, "BuyerWallet: authorization expired");
         require(nonce == agentNonces[agentId] + 1, "BuyerWallet: invalid nonce");
         
         // 验证签名
-        bytes32 hash = keccak256(abi.encodePacked(agentId, nonce, block.timestamp));
-        bytes32 ethSignedMessageHash = keccak256(abi.encodePacked("\x19Ethereum Signed Message:\n32", hash));
-        address signer = _recoverSigner(ethSignedMessageHash, signature);
-        require(signer == agents[agentId].signerAddress, "BuyerWallet: invalid signature");
+        bytes32 digest = getAgentPaymentDigest(agentId, recipient, amount, metadata, nonce, deadline);
+        address signer = _recoverSigner(digest, signature);
+        require(signer != address(0) && signer == agents[agentId].signerAddress, "BuyerWallet: invalid signature");
         
         // 更新nonce
         agentNonces[agentId] = nonce;
@@ -221,6 +254,8 @@ contract BuyerWallet {
     ) validAddress(_usdtAddress) {
         owner = msg.sender;
         USDT = IERC20(_usdtAddress);
+        _cachedChainId = block.chainid;
+        _cachedDomainSeparator = _buildDomainSeparator();
         
         // 设置默认规则
         defaultRules = PaymentRules({
@@ -361,8 +396,9 @@ contract BuyerWallet {
      * @param _recipient 接收方地址
      * @param _amount 支付金额
      * @param _metadata 元数据
-     * @param _signature Agent签名
+     * @param _signature Agent对 AgentPayment 的EIP-712签名
      * @param _nonce 防重放nonce
+     * @param _deadline 授权截止时间（block.timestamp 不得晚于此时间）
      */
     function payByAgent(
         string calldata _agentId,
@@ -370,10 +406,11 @@ contract BuyerWallet {
         uint256 _amount,
         string calldata _metadata,
         bytes calldata _signature,
-        uint256 _nonce
+        uint256 _nonce,
+        uint256 _deadline
     ) 
         external 
-        onlyValidAgent(_agentId, _signature, _nonce)
+        onlyValidAgent(_agentId, _recipient, _amount, _metadata, _nonce, _deadline, _signature)
         validAddress(_recipient) 
         validAmount(_amount) 
         whenNotPaused 
@@ -387,6 +424,63 @@ contract BuyerWallet {
         }
     }
     
+    /**
+     * @dev Agent发起x402支付并在链上记录支付证明（需要签名验证）
+     * @param _info x402支付信息（API端点作为签名中的 metadata，expiry 作为 deadline）
+     * @param _signature Agent对 AgentPayment 的EIP-712签名
+     * @return paymentHash 支付哈希（见 getX402PaymentHash）
+     */
+    function payX402(
+        X402PaymentInfo calldata _info,
+        bytes calldata _signature
+    ) 
+        external 
+        onlyValidAgent(_info.agentId, _info.recipient, _info.amount, _info.apiEndpoint, _info.nonce, _info.expiry, _signature)
+        validAddress(_info.recipient) 
+        validAmount(_info.amount) 
+        whenNotPaused 
+        returns (bytes32 paymentHash)
+    {
+        require(_info.amount <= type(uint64).max, "BuyerWallet: amount too large");
+        
+        // nonce 在 onlyValidAgent 中单调递增，同一Agent不会产生重复的支付哈希
+        paymentHash = getX402PaymentHash(_info);
+        
+        // 先记录证明再转账
+        x402Receipts[paymentHash] = X402Receipt({
+            recipient: _info.recipient,
+            amount: uint64(_info.amount),
+            timestamp: uint32(block.timestamp),
+            agentId: _info.agentId,
+            apiEndpoint: _info.apiEndpoint
+        });
+        
+        if (isPoolAddress[_info.recipient]) {
+            _addToPendingPayments(_info.agentId, _info.recipient, _info.amount, _info.apiEndpoint);
+            _checkAndExecuteAggregation(_info.recipient);
+        } else {
+            _executeDirectPayment(_info.agentId, _info.recipient, _info.amount, _info.apiEndpoint);
+        }
+        
+        emit X402PaymentMade(paymentHash, _info.agentId, _info.recipient, _info.amount, block.timestamp);
+    }
+    
+    /**
+     * @dev 计算x402支付哈希（链下可预先计算）
+     * @param _info x402支付信息
+     * @return keccak256(abi.encode(agentId, recipient, amount, apiEndpoint, nonce, expiry))
+     */
+    function getX402PaymentHash(X402PaymentInfo calldata _info) public pure returns (bytes32) {
+        return keccak256(abi.encode(
+            _info.agentId,
+            _info.recipient,
+            _info.amount,
+            _info.apiEndpoint,
+            _info.nonce,
+            _info.expiry
+        ));
+    }
+    
     /**
      * @dev 直接支付（由用户调用，用于紧急情况）
      * @param _agentId Agent ID
@@ -577,6 +671,61 @@ contract BuyerWallet {
         emit PoolAddressRemoved(_poolAddress, block.timestamp);
     }
     
+    // ============ 签名授权 ============
+    
+    /**
+     * @dev EIP-712 域分隔符（name "BuyerWallet"，version "1"）
+     */
+    function DOMAIN_SEPARATOR() public view returns (bytes32) {
+        return block.chainid == _cachedChainId ? _cachedDomainSeparator : _buildDomainSeparator();
+    }
+    
+    /**
+     * @dev 计算Agent支付授权的EIP-712摘要（Agent对其签名）
+     * @param _agentId Agent ID
+     * @param _recipient 接收方地址
+     * @param _amount 支付金额
+     * @param _metadata 元数据（payX402 为API端点）
+     * @param _nonce 防重放nonce
+     * @param _deadline 授权截止时间
+     */
+    function getAgentPaymentDigest(
+        string calldata _agentId,
+        address _recipient,
+        uint256 _amount,
+        string calldata _metadata,
+        uint256 _nonce,
+        uint256 _deadline
+    ) 
+        public 
+        view 
+        returns (bytes32) 
+    {
+        bytes32 structHash = keccak256(abi.encode(
+            AGENT_PAYMENT_TYPEHASH,
+            keccak256(bytes(_agentId)),
+            _recipient,
+            _amount,
+            keccak256(bytes(_metadata)),
+            _nonce,
+            _deadline
+        ));
+        return keccak256(abi.encodePacked("\x19\x01", DOMAIN_SEPARATOR(), structHash));
+    }
+    
+    /**
+     * @dev 内部函数：构建域分隔符
+     */
+    function _buildDomainSeparator() internal view returns (bytes32) {
+        return keccak256(abi.encode(
+            DOMAIN_TYPEHASH,
+            keccak256("BuyerWallet"),
+            keccak256("1"),
+            block.chainid,
+            address(this)
+        ));
+    }
+    
     // ============ 内部验证函数 ============
     
     /**
@@ -667,6 +816,71 @@ contract BuyerWallet {
         return poolAddresses.length;
     }
     
+    /**
+     * @dev 查询x402支付证明
+     * @param _paymentHash 支付哈希
+     * @return 支付证明（不存在时各字段为零值；链上无法获得交易哈希，txHash 恒为0）
+     */
+    function verifyX402Payment(bytes32 _paymentHash) external view returns (X402PaymentProof memory) {
+        return _x402Proof(_paymentHash);
+    }
+    
+    /**
+     * @dev 批量查询x402支付证明（一次 eth_call 验证多笔支付）
+     * @param _paymentHashes 支付哈希列表
+     * @return proofs 与输入顺序一致的支付证明
+     */
+    function verifyX402Payments(bytes32[] calldata _paymentHashes) 
+        external 
+        view 
+        returns (X402PaymentProof[] memory proofs) 
+    {
+        proofs = new X402PaymentProof[](_paymentHashes.length);
+        for (uint256 i = 0; i < _paymentHashes.length; i++) {
+            proofs[i] = _x402Proof(_paymentHashes[i]);
+        }
+    }
+    
+    /**
+     * @dev 兼容旧版 public 映射 x402Proofs 的查询接口（返回值与原自动 getter 一致）
+     * @param _paymentHash 支付哈希
+     */
+    function x402Proofs(bytes32 _paymentHash) 
+        external 
+        view 
+        returns (
+            bytes32 paymentHash,
+            string memory agentId,
+            address recipient,
+            uint256 amount,
+            string memory apiEndpoint,
+            uint256 timestamp,
+            bytes32 txHash
+        ) 
+    {
+        X402PaymentProof memory proof = _x402Proof(_paymentHash);
+        return (proof.paymentHash, proof.agentId, proof.recipient, proof.amount, proof.apiEndpoint, proof.timestamp, proof.txHash);
+    }
+    
+    /**
+     * @dev 内部函数：由紧凑记录还原支付证明
+     */
+    function _x402Proof(bytes32 _paymentHash) internal view returns (X402PaymentProof memory proof) {
+        X402Receipt storage receipt = x402Receipts[_paymentHash];
+        if (receipt.timestamp == 0) {
+            return proof;
+        }
+        proof = X402PaymentProof({
+            paymentHash: _paymentHash,
+            agentId: receipt.agentId,
+            recipient: receipt.recipient,
+            amount: receipt.amount,
+            apiEndpoint: receipt.apiEndpoint,
+            timestamp: receipt.timestamp,
+            txHash: bytes32(0)
+        });
+    }
+    
     /**
      * @dev 获取Agent的今日消费
      */
@@ -202,26 +202,27 @@ contract BuyerWalletTest is Test {
         buyerWallet.setPaymentRules("", 5 * 10**6, 10 * 10**6, true);
     }
     
-    function _generateValidSignature(string memory agentId, uint256 nonce) internal view returns (bytes memory) {
-        bytes32 hash = keccak256(abi.encodePacked(agentId, nonce, block.timestamp));
-        bytes32 ethSignedMessageHash = keccak256(abi.encodePacked("\x19Ethereum Signed Message:\n32", hash));
+    uint256 constant DEADLINE = 1 hours;
+    
+    function _signAuthorization(
+        string memory agentId,
+        address to,
+        uint256 amount,
+        string memory metadata,
+        uint256 nonce,
+        uint256 deadline
+    ) internal view returns (bytes memory) {
+        bytes32 digest = buyerWallet.getAgentPaymentDigest(agentId, to, amount, metadata, nonce, deadline);
         
         uint256 privateKey = 0x1; // agent1Signer的私钥
-        (uint8 v, bytes32 r, bytes32 s) = vm.sign(privateKey, ethSignedMessageHash);
+        (uint8 v, bytes32 r, bytes32 s) = vm.sign(privateKey, digest);
         return abi.encodePacked(r, s, v);
     }
     
-    function _generateValidSignatureAtTime(string memory agentId, uint256 nonce, uint256 timestamp) internal pure returns (bytes memory) {
-        bytes32 hash = keccak256(abi.encodePacked(agentId, nonce, timestamp));
-        bytes32 ethSignedMessageHash = keccak256(abi.encodePacked("\x19Ethereum Signed Message:\n32", hash));
-        
-        // 使用ecrecover的方式来避免vm.sign的问题
-        // 这里我们需要用更简单的方法
-        return abi.encodePacked(
-            bytes32(0x1234567890123456789012345678901234567890123456789012345678901234), // r
-            bytes32(0x1234567890123456789012345678901234567890123456789012345678901235), // s
-            uint8(27) // v
-        );
+    function _payByAgent(address to, uint256 amount, string memory metadata, uint256 nonce) internal {
+        uint256 deadline = block.timestamp + DEADLINE;
+        bytes memory signature = _signAuthorization(AGENT1_ID, to, amount, metadata, nonce, deadline);
+        buyerWallet.payByAgent(AGENT1_ID, to, amount, metadata, signature, nonce, deadline);
     }
     
     function testPayByAgentDirect() public {
@@ -230,7 +231,8 @@ contract BuyerWalletTest is Test {
         
         uint256 paymentAmount = 5 * 10**6; // 5 USDT
         uint256 nonce = 1;
-        bytes memory signature = _generateValidSignature(AGENT1_ID, nonce);
+        uint256 deadline = block.timestamp + DEADLINE;
+        bytes memory signature = _signAuthorization(AGENT1_ID, recipient, paymentAmount, "Test payment", nonce, deadline);
         
         uint256 initialBalance = mockUSDT.balanceOf(recipient);
         
@@ -241,7 +243,8 @@ contract BuyerWalletTest is Test {
             paymentAmount,
             "Test payment",
             signature,
-            nonce
+            nonce,
+            deadline
         );
         
         // 验证支付结果
@@ -259,18 +262,9 @@ contract BuyerWalletTest is Test {
         buyerWallet.addPoolAddress(poolAddress);
         
         uint256 paymentAmount = 5 * 10**6;
-        uint256 nonce = 1;
-        bytes memory signature = _generateValidSignature(AGENT1_ID, nonce);
         
         // 向池子地址支付（应该被聚合）
-        buyerWallet.payByAgent(
-            AGENT1_ID,
-            poolAddress,
-            paymentAmount,
-            "Pool payment",
-            signature,
-            nonce
-        );
+        _payByAgent(poolAddress, paymentAmount, "Pool payment", 1);
         
         // 验证支付被添加到待聚合队列
         assertEq(buyerWallet.getPendingPaymentCount(), 1);
@@ -347,11 +341,9 @@ contract BuyerWalletTest is Test {
         buyerWallet.addPoolAddress(poolAddress);
         
         uint256 paymentAmount = 5 * 10**6;
-        uint256 nonce = 1;
-        bytes memory signature = _generateValidSignature(AGENT1_ID, nonce);
         
         // 进行一次小额支付（不会自动聚合）
-        buyerWallet.payByAgent(AGENT1_ID, poolAddress, paymentAmount, "Payment", signature, nonce);
+        _payByAgent(poolAddress, paymentAmount, "Payment", 1);
         
         // 手动触发聚合
         buyerWallet.forceAggregatePayment(poolAddress);
@@ -366,25 +358,24 @@ contract BuyerWalletTest is Test {
         buyerWallet.registerAgent(AGENT1_ID, "GPT Agent", agent1Signer);
         
         uint256 nonce = 1;
-        bytes memory signature = _generateValidSignature(AGENT1_ID, nonce);
+        uint256 deadline = block.timestamp + DEADLINE;
+        bytes memory signature = _signAuthorization(AGENT1_ID, recipient, 15 * 10**6, "Large payment", nonce, deadline);
         
         // 测试超出单笔限额
         vm.expectRevert("BuyerWallet: payment violates rules");
-        buyerWallet.payByAgent(AGENT1_ID, recipient, 15 * 10**6, "Large payment", signature, nonce);
+        buyerWallet.payByAgent(AGENT1_ID, recipient, 15 * 10**6, "Large payment", signature, nonce, deadline);
         
         // 测试日限额
         // 先进行几次支付接近日限额
         for (uint i = 0; i < 10; i++) {
-            uint256 currentNonce = i + 1;
-            bytes memory currentSignature = _generateValidSignature(AGENT1_ID, currentNonce);
-            buyerWallet.payByAgent(AGENT1_ID, recipient, 10 * 10**6, "Payment", currentSignature, currentNonce);
+            _payByAgent(recipient, 10 * 10**6, "Payment", i + 1);
         }
         
         // 现在应该达到日限额，下一次支付应该失败
         uint256 finalNonce = 11;
-        bytes memory finalSignature = _generateValidSignature(AGENT1_ID, finalNonce);
+        bytes memory finalSignature = _signAuthorization(AGENT1_ID, recipient, 1 * 10**6, "Exceeds limit", finalNonce, deadline);
         vm.expectRevert("BuyerWallet: payment violates rules");
-        buyerWallet.payByAgent(AGENT1_ID, recipient, 1 * 10**6, "Exceeds limit", finalSignature, finalNonce);
+        buyerWallet.payByAgent(AGENT1_ID, recipient, 1 * 10**6, "Exceeds limit", finalSignature, finalNonce, deadline);
     }
     
     function testContractPauseUnpause() public {
@@ -436,4 +427,236 @@ contract BuyerWalletTest is Test {
         
         vm.stopPrank();
     }
-} 
\ No newline at end of file
+    
+    // ============ x402支付测试 ============
+    
+    function _x402Info(string memory endpoint, address to, uint256 amount, uint256 nonce) internal view returns (BuyerWallet.X402PaymentInfo memory) {
+        return BuyerWallet.X402PaymentInfo({
+            agentId: AGENT1_ID,
+            recipient: to,
+            amount: amount,
+            apiEndpoint: endpoint,
+            nonce: nonce,
+            expiry: block.timestamp + 300
+        });
+    }
+    
+    function _signX402(BuyerWallet.X402PaymentInfo memory info) internal view returns (bytes memory) {
+        return _signAuthorization(info.agentId, info.recipient, info.amount, info.apiEndpoint, info.nonce, info.expiry);
+    }
+    
+    function _payX402(string memory endpoint, address to, uint256 amount, uint256 nonce) internal returns (bytes32) {
+        BuyerWallet.X402PaymentInfo memory info = _x402Info(endpoint, to, amount, nonce);
+        return buyerWallet.payX402(info, _signX402(info));
+    }
+    
+    function testPayX402RecordsProof() public {
+        buyerWallet.registerAgent(AGENT1_ID, "GPT Agent", agent1Signer);
+        
+        uint256 paymentAmount = 2 * 10**6;
+        BuyerWallet.X402PaymentInfo memory info = _x402Info("/x402/weather", recipient, paymentAmount, 1);
+        bytes32 expectedHash = keccak256(abi.encode(
+            info.agentId, info.recipient, info.amount, info.apiEndpoint, info.nonce, info.expiry
+        ));
+        assertEq(buyerWallet.getX402PaymentHash(info), expectedHash);
+        
+        bytes32 paymentHash = buyerWallet.payX402(info, _signX402(info));
+        assertEq(paymentHash, expectedHash);
+        
+        // 验证转账与消费记录
+        assertEq(mockUSDT.balanceOf(recipient), paymentAmount);
+        assertEq(buyerWallet.getTodaySpending(AGENT1_ID), paymentAmount);
+        assertEq(buyerWallet.agentNonces(AGENT1_ID), 1);
+        
+        // 验证链上证明
+        BuyerWallet.X402PaymentProof memory proof = buyerWallet.verifyX402Payment(paymentHash);
+        assertEq(proof.paymentHash, paymentHash);
+        assertEq(proof.agentId, AGENT1_ID);
+        assertEq(proof.recipient, recipient);
+        assertEq(proof.amount, paymentAmount);
+        assertEq(proof.apiEndpoint, "/x402/weather");
+        assertEq(proof.timestamp, block.timestamp);
+        assertEq(proof.txHash, bytes32(0));
+        
+        // 兼容旧版 x402Proofs getter
+        (bytes32 legacyHash, string memory legacyAgentId, address legacyRecipient, uint256 legacyAmount, , uint256 legacyTimestamp, ) =
+            buyerWallet.x402Proofs(paymentHash);
+        assertEq(legacyHash, paymentHash);
+        assertEq(legacyAgentId, AGENT1_ID);
+        assertEq(legacyRecipient, recipient);
+        assertEq(legacyAmount, paymentAmount);
+        assertEq(legacyTimestamp, block.timestamp);
+    }
+    
+    function testPayX402ToPool() public {
+        buyerWallet.registerAgent(AGENT1_ID, "GPT Agent", agent1Signer);
+        buyerWallet.addPoolAddress(poolAddress);
+        
+        bytes32 paymentHash = _payX402("/x402/ai-model", poolAddress, 5 * 10**6, 1);
+        
+        // 池子地址：进入聚合队列，证明照常记录
+        assertEq(buyerWallet.pendingAmounts(poolAddress), 5 * 10**6);
+        assertEq(mockUSDT.balanceOf(poolAddress), 0);
+        assertEq(buyerWallet.verifyX402Payment(paymentHash).recipient, poolAddress);
+    }
+    
+    function testPayX402Failures() public {
+        buyerWallet.registerAgent(AGENT1_ID, "GPT Agent", agent1Signer);
+        vm.warp(1000);
+        
+        // 已过期（expiry 即签名的截止时间）
+        BuyerWallet.X402PaymentInfo memory info = _x402Info("/x402/weather", recipient, 1 * 10**6, 1);
+        info.expiry = block.timestamp - 1;
+        bytes memory signature = _signX402(info);
+        vm.expectRevert("BuyerWallet: authorization expired");
+        buyerWallet.payX402(info, signature);
+        
+        // 违反支付规则时不留下证明
+        info = _x402Info("/x402/weather", recipient, 15 * 10**6, 1);
+        signature = _signX402(info);
+        bytes32 paymentHash = buyerWallet.getX402PaymentHash(info);
+        vm.expectRevert("BuyerWallet: payment violates rules");
+        buyerWallet.payX402(info, signature);
+        assertEq(buyerWallet.verifyX402Payment(paymentHash).timestamp, 0);
+        
+        // nonce 不能重用
+        info = _x402Info("/x402/weather", recipient, 1 * 10**6, 1);
+        signature = _signX402(info);
+        buyerWallet.payX402(info, signature);
+        vm.expectRevert("BuyerWallet: invalid nonce");
+        buyerWallet.payX402(info, signature);
+    }
+    
+    function testVerifyX402PaymentsBatch() public {
+        buyerWallet.registerAgent(AGENT1_ID, "GPT Agent", agent1Signer);
+        
+        bytes32[] memory hashes = new bytes32[](4);
+        hashes[0] = _payX402("/x402/weather", recipient, 1 * 10**6, 1);
+        hashes[1] = keccak256("unknown payment");
+        hashes[2] = _payX402("/x402/ai-model", recipient, 2 * 10**6, 2);
+        hashes[3] = _payX402("/x402/weather", recipient, 3 * 10**6, 3);
+        
+        BuyerWallet.X402PaymentProof[] memory proofs = buyerWallet.verifyX402Payments(hashes);
+        assertEq(proofs.length, 4);
+        assertEq(proofs[0].paymentHash, hashes[0]);
+        assertEq(proofs[0].amount, 1 * 10**6);
+        assertEq(proofs[2].apiEndpoint, "/x402/ai-model");
+        assertEq(proofs[3].amount, 3 * 10**6);
+        
+        // 未知哈希返回零值结构体
+        assertEq(proofs[1].paymentHash, bytes32(0));
+        assertEq(proofs[1].timestamp, 0);
+        assertEq(proofs[1].recipient, address(0));
+    }
+    
+    function testGasX402ProofLookup() public {
+        buyerWallet.registerAgent(AGENT1_ID, "GPT Agent", agent1Signer);
+        
+        uint256 count = 8;
+        bytes32[] memory hashes = new bytes32[](count);
+        uint256 gasStart = gasleft();
+        hashes[0] = _payX402("/x402/weather", recipient, 1 * 10**6, 1);
+        console.log("payX402 gas (incl. signing)", gasStart - gasleft());
+        for (uint256 i = 1; i < count; i++) {
+            hashes[i] = _payX402("/x402/weather", recipient, 1 * 10**6, i + 1);
+        }
+        
+        // 逐个查询 vs 一次批量查询
+        gasStart = gasleft();
+        for (uint256 i = 0; i < count; i++) {
+            buyerWallet.verifyX402Payment(hashes[i]);
+        }
+        uint256 singleGas = gasStart - gasleft();
+        
+        gasStart = gasleft();
+        BuyerWallet.X402PaymentProof[] memory proofs = buyerWallet.verifyX402Payments(hashes);
+        uint256 batchGas = gasStart - gasleft();
+        
+        for (uint256 i = 0; i < count; i++) {
+            assertEq(proofs[i].paymentHash, hashes[i]);
+        }
+        console.log("verifyX402Payment x8 gas", singleGas);
+        console.log("verifyX402Payments(8) gas", batchGas);
+        assertLt(batchGas, singleGas);
+    }
+    
+    // ============ EIP-712 授权测试 ============
+    
+    function testDomainSeparator() public {
+        bytes32 expected = keccak256(abi.encode(
+            keccak256("EIP712Domain(string name,string version,uint256 chainId,address verifyingContract)"),
+            keccak256("BuyerWallet"),
+            keccak256("1"),
+            block.chainid,
+            address(buyerWallet)
+        ));
+        assertEq(buyerWallet.DOMAIN_SEPARATOR(), expected);
+        
+        // 分叉到其他链ID后重新计算
+        vm.chainId(block.chainid + 1);
+        assertTrue(buyerWallet.DOMAIN_SEPARATOR() != expected);
+    }
+    
+    function testPreSignedAuthorizationsSubmittedLater() public {
+        buyerWallet.registerAgent(AGENT1_ID, "GPT Agent", agent1Signer);
+        
+        // 预先签好一批授权
+        uint256 count = 5;
+        uint256 deadline = block.timestamp + DEADLINE;
+        bytes[] memory signatures = new bytes[](count);
+        for (uint256 i = 0; i < count; i++) {
+            signatures[i] = _signAuthorization(AGENT1_ID, recipient, 1 * 10**6, "Prepaid", i + 1, deadline);
+        }
+        
+        // 在截止时间前的不同区块中依次提交
+        for (uint256 i = 0; i < count; i++) {
+            vm.warp(block.timestamp + 7 minutes);
+            buyerWallet.payByAgent(AGENT1_ID, recipient, 1 * 10**6, "Prepaid", signatures[i], i + 1, deadline);
+        }
+        assertEq(mockUSDT.balanceOf(recipient), count * 10**6);
+        assertEq(buyerWallet.agentNonces(AGENT1_ID), count);
+    }
+    
+    function testAuthorizationExpired() public {
+        buyerWallet.registerAgent(AGENT1_ID, "GPT Agent", agent1Signer);
+        
+        uint256 deadline = block.timestamp + DEADLINE;
+        bytes memory signature = _signAuthorization(AGENT1_ID, recipient, 1 * 10**6, "Late", 1, deadline);
+        
+        vm.warp(deadline + 1);
+        vm.expectRevert("BuyerWallet: authorization expired");
+        buyerWallet.payByAgent(AGENT1_ID, recipient, 1 * 10**6, "Late", signature, 1, deadline);
+        
+        // 截止时间当秒仍然有效
+        vm.warp(deadline);
+        buyerWallet.payByAgent(AGENT1_ID, recipient, 1 * 10**6, "Late", signature, 1, deadline);
+    }
+    
+    function testAuthorizationBindsPaymentFields() public {
+        buyerWallet.registerAgent(AGENT1_ID, "GPT Agent", agent1Signer);
+        
+        uint256 deadline = block.timestamp + DEADLINE;
+        bytes memory signature = _signAuthorization(AGENT1_ID, recipient, 1 * 10**6, "Signed", 1, deadline);
+        
+        // 篡改金额、收款方、元数据或截止时间都会使签名失效
+        vm.expectRevert("BuyerWallet: invalid signature");
+        buyerWallet.payByAgent(AGENT1_ID, recipient, 2 * 10**6, "Signed", signature, 1, deadline);
+        
+        vm.expectRevert("BuyerWallet: invalid signature");
+        buyerWallet.payByAgent(AGENT1_ID, poolAddress, 1 * 10**6, "Signed", signature, 1, deadline);
+        
+        vm.expectRevert("BuyerWallet: invalid signature");
+        buyerWallet.payByAgent(AGENT1_ID, recipient, 1 * 10**6, "Tampered", signature, 1, deadline);
+        
+        vm.expectRevert("BuyerWallet: invalid signature");
+        buyerWallet.payByAgent(AGENT1_ID, recipient, 1 * 10**6, "Signed", signature, 1, deadline + 1);
+        
+        // 其他Agent的签名无效
+        (uint8 v, bytes32 r, bytes32 s) = vm.sign(0x2, buyerWallet.getAgentPaymentDigest(AGENT1_ID, recipient, 1 * 10**6, "Signed", 1, deadline));
+        vm.expectRevert("BuyerWallet: invalid signature");
+        buyerWallet.payByAgent(AGENT1_ID, recipient, 1 * 10**6, "Signed", abi.encodePacked(r, s, v), 1, deadline);
+        
+        buyerWallet.payByAgent(AGENT1_ID, recipient, 1 * 10**6, "Signed", signature, 1, deadline);
+        assertEq(mockUSDT.balanceOf(recipient), 1 * 10**6);
+    }
+}